@@ -0,0 +1,198 @@
+# almacen_blobs.py
+"""Almacén de evidencias direccionado por contenido (SHA-256)"""
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_BLOQUE = 1024 * 1024
+
+
+class AlmacenBlobs:
+    """Guarda cada contenido una sola vez en ``raiz/ab/cd/<sha256>``.
+
+    Es el almacén en disco local; ``AlmacenS3`` (almacen_s3.py) implementa
+    la misma interfaz sobre un bucket S3 o compatible. Las rutas que
+    devuelven se guardan en evidencias.ruta y solo deben leerse con los
+    métodos del almacén (``abrir``, ``info``, ``copia_local``...).
+
+    El recuento de referencias vive en la tabla ``blobs``; esta clase solo
+    se ocupa de los archivos. Para evitar carreras con una subida del mismo
+    contenido, un blob que se queda sin referencias primero se aparta con
+    ``retirar`` (antes de confirmar el borrado de su fila) y solo después se
+    elimina con ``purgar``.
+    """
+
+    def __init__(self, raiz):
+        self.raiz = raiz
+        self._temporal = os.path.join(raiz, 'tmp')
+        os.makedirs(self._temporal, exist_ok=True)
+
+    def ruta(self, sha256):
+        return os.path.join(self.raiz, sha256[:2], sha256[2:4], sha256)
+
+    def ruta_temporal(self):
+        return os.path.join(self._temporal, uuid.uuid4().hex)
+
+    def pertenece(self, ruta):
+        """Indica si ``ruta`` es un blob de este almacén"""
+        return self.blob_local(ruta)
+
+    def blob_local(self, ruta):
+        """Indica si ``ruta`` es un blob del disco local (también con un
+        almacén remoto, para los que aún no se han migrado)"""
+        if not ruta:
+            return False
+        raiz = os.path.abspath(self.raiz) + os.sep
+        return os.path.abspath(ruta).startswith(raiz)
+
+    def recibir(self, flujo):
+        """Copia ``flujo`` a un archivo temporal calculando su SHA-256.
+
+        Devuelve (ruta_temporal, sha256, tamano); el archivo queda pendiente
+        de ``colocar`` o de borrarse.
+        """
+        temporal = self.ruta_temporal()
+        hasher = hashlib.sha256()
+        tamano = 0
+        try:
+            with open(temporal, 'wb') as destino:
+                while True:
+                    bloque = flujo.read(_BLOQUE)
+                    if not bloque:
+                        break
+                    hasher.update(bloque)
+                    destino.write(bloque)
+                    tamano += len(bloque)
+        except Exception:
+            self.descartar(temporal)
+            raise
+        return temporal, hasher.hexdigest(), tamano
+
+    def colocar(self, temporal, sha256):
+        """Mueve un temporal a su ruta definitiva; si el blob ya existe lo descarta"""
+        ruta = self.ruta(sha256)
+        if os.path.exists(ruta):
+            self.descartar(temporal)
+            return ruta
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        os.replace(temporal, ruta)
+        return ruta
+
+    def importar(self, origen):
+        """Añade al almacén un archivo existente sin moverlo; devuelve (ruta, sha256, tamano).
+
+        Se usa un enlace duro cuando el sistema de archivos lo permite, así que
+        migrar evidencias antiguas no duplica el espacio ni reescribe datos.
+        """
+        with open(origen, 'rb') as f:
+            hasher = hashlib.sha256()
+            tamano = 0
+            for bloque in iter(lambda: f.read(_BLOQUE), b''):
+                hasher.update(bloque)
+                tamano += len(bloque)
+        sha256 = hasher.hexdigest()
+
+        ruta = self.ruta(sha256)
+        if not os.path.exists(ruta):
+            temporal = self.ruta_temporal()
+            try:
+                os.link(origen, temporal)
+            except OSError:
+                shutil.copyfile(origen, temporal)
+            self.colocar(temporal, sha256)
+        return ruta, sha256, tamano
+
+    def descartar(self, temporal):
+        try:
+            os.remove(temporal)
+        except FileNotFoundError:
+            pass
+
+    def retirar(self, sha256):
+        """Aparta el blob para borrarlo; devuelve la ruta apartada o None"""
+        ruta = self.ruta(sha256)
+        apartado = os.path.join(self._temporal, f"{sha256}.borrar-{uuid.uuid4().hex[:8]}")
+        try:
+            os.replace(ruta, apartado)
+        except FileNotFoundError:
+            return None
+        return apartado
+
+    def restaurar(self, apartado, sha256):
+        """Deshace ``retirar`` si no se pudo confirmar el borrado"""
+        if apartado:
+            self.colocar(apartado, sha256)
+
+    def purgar(self, apartado):
+        if apartado:
+            self.descartar(apartado)
+
+    # ------------------------------
+    # Lectura de rutas guardadas
+    # ------------------------------
+    def existe(self, ruta):
+        return bool(ruta) and os.path.exists(ruta)
+
+    def info(self, ruta):
+        """(tamano, fecha de modificación en segundos) o None si no existe"""
+        try:
+            estado = os.stat(ruta)
+        except (FileNotFoundError, TypeError):
+            return None
+        return estado.st_size, estado.st_mtime
+
+    def abrir(self, ruta):
+        return open(ruta, 'rb')
+
+    def leer_rango(self, ruta, inicio, longitud):
+        """``longitud`` bytes desde ``inicio`` (p. ej. un bloque de un archivo de historial)"""
+        with open(ruta, 'rb') as f:
+            f.seek(inicio)
+            return f.read(longitud)
+
+    @contextmanager
+    def copia_local(self, ruta):
+        """Ruta en disco con el contenido, para lo que necesita un archivo"""
+        yield ruta
+
+    def url_descarga(self, ruta, nombre, mimetype, adjunto=True):
+        """URL firmada para descargar sin pasar por Flask (None: no hay)"""
+        return None
+
+    def publicar(self, ruta_local, nombre):
+        """Deja un archivo generado (p. ej. un ZIP) donde lo puedan servir
+        todos los nodos; devuelve su ruta"""
+        return ruta_local
+
+    def eliminar(self, ruta):
+        try:
+            os.remove(ruta)
+        except FileNotFoundError:
+            pass
+
+
+def crear_almacen(tipo='local', raiz='uploads/blobs', **opciones):
+    """Almacén de evidencias según la configuración (ALMACEN_CONFIG)"""
+    if tipo == 's3':
+        from almacen_s3 import AlmacenS3
+        return AlmacenS3(raiz, **opciones)
+    if tipo != 'local':
+        raise ValueError(f"Almacén de evidencias desconocido: {tipo}")
+    return AlmacenBlobs(raiz)
+
+
+_predeterminado = None
+
+
+def predeterminado():
+    """Almacén configurado en config.py, uno por proceso (web o worker)"""
+    global _predeterminado
+    if _predeterminado is None:
+        from config import ALMACEN_CONFIG
+        _predeterminado = crear_almacen(**ALMACEN_CONFIG)
+    return _predeterminado
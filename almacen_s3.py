@@ -0,0 +1,206 @@
+# almacen_s3.py
+"""Almacén de evidencias en S3 (o compatible: MinIO, Ceph...)"""
+import hashlib
+import logging
+import os
+import uuid
+from contextlib import closing, contextmanager
+
+from almacen_blobs import AlmacenBlobs, _BLOQUE
+from envio_archivos import disposicion
+
+logger = logging.getLogger(__name__)
+
+_ESQUEMA = 's3://'
+
+
+class AlmacenS3(AlmacenBlobs):
+    """Blobs direccionados por contenido en ``s3://bucket/prefijo/ab/cd/<sha256>``.
+
+    Las subidas se reciben primero en un temporal local (hace falta el
+    SHA-256 para conocer la clave) y se envían con la transferencia
+    gestionada de boto3: multiparte a partir de ``tamano_parte`` bytes, con
+    ``hilos`` partes en paralelo. Las descargas se sirven con URL firmadas
+    que caducan a los ``caducidad_url`` segundos, sin pasar por Flask.
+
+    Las rutas que no empiezan por s3:// (evidencias guardadas en disco antes
+    de usar S3) se siguen leyendo y borrando en local.
+    """
+
+    def __init__(self, raiz, bucket, prefijo='evidencias/', endpoint_url=None, region=None,
+                 tamano_parte=16 * 1024 * 1024, hilos=8, caducidad_url=300):
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+
+        if not bucket:
+            raise ValueError("Falta S3_BUCKET para el almacén S3")
+        super().__init__(raiz)
+        self.bucket = bucket
+        self.prefijo = prefijo
+        self.caducidad_url = caducidad_url
+        self._s3 = boto3.client('s3', endpoint_url=endpoint_url, region_name=region)
+        self._transferencia = TransferConfig(
+            multipart_threshold=tamano_parte,
+            multipart_chunksize=tamano_parte,
+            max_concurrency=hilos,
+            use_threads=hilos > 1
+        )
+
+    # ------------------------------
+    # Claves y rutas
+    # ------------------------------
+    def _clave(self, sha256):
+        return f"{self.prefijo}{sha256[:2]}/{sha256[2:4]}/{sha256}"
+
+    def ruta(self, sha256):
+        return f"{_ESQUEMA}{self.bucket}/{self._clave(sha256)}"
+
+    @staticmethod
+    def remota(ruta):
+        return bool(ruta) and ruta.startswith(_ESQUEMA)
+
+    @staticmethod
+    def _separar(ruta):
+        bucket, _, clave = ruta[len(_ESQUEMA):].partition('/')
+        return bucket, clave
+
+    def pertenece(self, ruta):
+        return self.remota(ruta) and ruta.startswith(f"{_ESQUEMA}{self.bucket}/{self.prefijo}")
+
+    def _existe(self, bucket, clave):
+        from botocore.exceptions import ClientError
+        try:
+            self._s3.head_object(Bucket=bucket, Key=clave)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def _copiar(self, clave_origen, clave_destino):
+        # copy gestionado: copia multiparte en el servidor para objetos grandes
+        self._s3.copy({'Bucket': self.bucket, 'Key': clave_origen}, self.bucket, clave_destino,
+                      Config=self._transferencia)
+
+    # ------------------------------
+    # Escritura
+    # ------------------------------
+    def _subir(self, ruta_local, clave):
+        self._s3.upload_file(ruta_local, self.bucket, clave, Config=self._transferencia)
+
+    def colocar(self, temporal, sha256):
+        """Sube un temporal a su clave; si el blob ya existe solo lo descarta"""
+        clave = self._clave(sha256)
+        try:
+            if not self._existe(self.bucket, clave):
+                self._subir(temporal, clave)
+        finally:
+            self.descartar(temporal)
+        return self.ruta(sha256)
+
+    def importar(self, origen):
+        """Sube un archivo local existente sin borrarlo; devuelve (ruta, sha256, tamano)"""
+        with open(origen, 'rb') as f:
+            hasher = hashlib.sha256()
+            tamano = 0
+            for bloque in iter(lambda: f.read(_BLOQUE), b''):
+                hasher.update(bloque)
+                tamano += len(bloque)
+        sha256 = hasher.hexdigest()
+        clave = self._clave(sha256)
+        if not self._existe(self.bucket, clave):
+            self._subir(origen, clave)
+        return self.ruta(sha256), sha256, tamano
+
+    def retirar(self, sha256):
+        """Mueve el blob a ``prefijo/borrar/`` (S3 no tiene renombrado atómico)"""
+        clave = self._clave(sha256)
+        if not self._existe(self.bucket, clave):
+            return None
+        apartado = f"{self.prefijo}borrar/{sha256}.{uuid.uuid4().hex[:8]}"
+        self._copiar(clave, apartado)
+        self._s3.delete_object(Bucket=self.bucket, Key=clave)
+        return f"{_ESQUEMA}{self.bucket}/{apartado}"
+
+    def restaurar(self, apartado, sha256):
+        if apartado:
+            _, clave_apartado = self._separar(apartado)
+            if not self._existe(self.bucket, self._clave(sha256)):
+                self._copiar(clave_apartado, self._clave(sha256))
+            self._s3.delete_object(Bucket=self.bucket, Key=clave_apartado)
+
+    def purgar(self, apartado):
+        if apartado:
+            self.eliminar(apartado)
+
+    def publicar(self, ruta_local, nombre):
+        clave = f"{self.prefijo}archivos/{nombre}"
+        self._subir(ruta_local, clave)
+        os.remove(ruta_local)
+        return f"{_ESQUEMA}{self.bucket}/{clave}"
+
+    def eliminar(self, ruta):
+        if not self.remota(ruta):
+            return super().eliminar(ruta)
+        bucket, clave = self._separar(ruta)
+        self._s3.delete_object(Bucket=bucket, Key=clave)
+
+    # ------------------------------
+    # Lectura
+    # ------------------------------
+    def existe(self, ruta):
+        if not self.remota(ruta):
+            return super().existe(ruta)
+        return self._existe(*self._separar(ruta))
+
+    def info(self, ruta):
+        if not self.remota(ruta):
+            return super().info(ruta)
+        from botocore.exceptions import ClientError
+        bucket, clave = self._separar(ruta)
+        try:
+            cabecera = self._s3.head_object(Bucket=bucket, Key=clave)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return cabecera['ContentLength'], cabecera['LastModified'].timestamp()
+
+    def abrir(self, ruta):
+        if not self.remota(ruta):
+            return super().abrir(ruta)
+        bucket, clave = self._separar(ruta)
+        return closing(self._s3.get_object(Bucket=bucket, Key=clave)['Body'])
+
+    def leer_rango(self, ruta, inicio, longitud):
+        if not self.remota(ruta):
+            return super().leer_rango(ruta, inicio, longitud)
+        bucket, clave = self._separar(ruta)
+        objeto = self._s3.get_object(Bucket=bucket, Key=clave, Range=f"bytes={inicio}-{inicio + longitud - 1}")
+        with closing(objeto['Body']) as cuerpo:
+            return cuerpo.read()
+
+    @contextmanager
+    def copia_local(self, ruta):
+        """Descarga el objeto a un temporal (por partes en paralelo) mientras se usa"""
+        if not self.remota(ruta):
+            yield ruta
+            return
+        bucket, clave = self._separar(ruta)
+        temporal = self.ruta_temporal()
+        try:
+            self._s3.download_file(bucket, clave, temporal, Config=self._transferencia)
+            yield temporal
+        finally:
+            self.descartar(temporal)
+
+    def url_descarga(self, ruta, nombre, mimetype, adjunto=True):
+        if not self.remota(ruta):
+            return None
+        bucket, clave = self._separar(ruta)
+        return self._s3.generate_presigned_url('get_object', Params={
+            'Bucket': bucket,
+            'Key': clave,
+            'ResponseContentType': mimetype,
+            'ResponseContentDisposition': disposicion(nombre, adjunto)
+        }, ExpiresIn=self.caducidad_url)
@@ -1,4 +1,5 @@
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory, abort, flash, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, send_from_directory, abort, flash, jsonify, session, g, has_request_context, Response, before_render_template, template_rendered, get_template_attribute
+from markupsafe import Markup
 import mysql.connector
 import os
 from datetime import datetime
@@ -6,6 +7,37 @@ from werkzeug.utils import secure_filename
 import logging
 import traceback
 import time
+import atexit
+import base64
+import binascii
+import re
+import sys
+from datetime import timedelta
+import click
+import hashlib
+import json
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+
+from db_pool import ConnectionPool
+from replicas import EnrutadorBD, Replica
+from escritor_historial import ENCOLADO, EscritorHistorial
+from estadisticas import ContadoresIncidentes
+from cache_detalle import CacheDetalle
+from eventos import CABECERAS_SSE, DESBORDADA, GLOBAL, CanalEventos, abrir_flujo, formato_sse, ultimo_id
+from migraciones import aplicar_migraciones, version_actual
+from zip_stream import generar_zip
+from subidas import GestorSubidas, SubidaInvalida, SubidaNoEncontrada
+from almacen_blobs import crear_almacen
+from miniaturas import CacheMiniaturas, TAMANOS as TAMANOS_MINIATURA
+import archivo_historial
+import busqueda
+import indicadores
+import capturas
+import trabajos
+import ingesta
+import correlacion
+import metricas
+from envio_archivos import enviar_archivo, fecha_http, no_modificado, tipo_mime
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -21,21 +53,151 @@ UPLOAD_FOLDER = "uploads"
 ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'txt', 'log', 'pcap', 'gif', 'bmp', 'webp'}
 
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+app.config["BLOBS_FOLDER"] = os.path.join(UPLOAD_FOLDER, "blobs")
+app.config["MINIATURAS_FOLDER"] = os.path.join(UPLOAD_FOLDER, "miniaturas")
+app.config["ZIPS_FOLDER"] = os.path.join(UPLOAD_FOLDER, "zips")
 app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024  # 16MB
 
 # Crear carpeta uploads si no existe
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# Configuración XAMPP MySQL
-DB_CONFIG = {
-    "host": "localhost",
-    "user": "root",
-    "password": "",
-    "database": "cyberincident",
-    "port": 3306,
-    "charset": "utf8mb4",
-    "autocommit": True
-}
+# Configuración XAMPP MySQL (primaria y réplicas en config.py)
+from config import DB_CONFIG, DB_REPLICAS, ALMACEN_CONFIG
+
+# Subida por fragmentos (cada fragmento sigue limitado por MAX_CONTENT_LENGTH)
+app.config["SUBIDA_TAMANO_BLOQUE"] = int(os.environ.get("SUBIDA_TAMANO_BLOQUE", 8 * 1024 * 1024))
+app.config["SUBIDA_TAMANO_MAXIMO"] = int(os.environ.get("SUBIDA_TAMANO_MAXIMO", 50 * 1024 ** 3))  # 50GB
+app.config["SUBIDA_CADUCIDAD"] = int(os.environ.get("SUBIDA_CADUCIDAD", 7 * 24 * 3600))
+
+# Miniaturas: por defecto se generan al pedirlas por primera vez
+app.config["MINIATURAS_AL_SUBIR"] = os.environ.get("MINIATURAS_AL_SUBIR", "0") == "1"
+app.config["MINIATURAS_MAX_AGE"] = int(os.environ.get("MINIATURAS_MAX_AGE", 365 * 24 * 3600))
+
+# Envío de evidencias: "python" (por bloques, con rangos), "x-sendfile"
+# (Apache/lighttpd) o "x-accel" (nginx). Con x-accel, nginx necesita:
+#   location /_evidencias/ { internal; alias /ruta/a/uploads/; }
+app.config["EVIDENCIAS_ENVIO"] = os.environ.get("EVIDENCIAS_ENVIO", "python")
+app.config["EVIDENCIAS_ACCEL_PREFIJO"] = os.environ.get("EVIDENCIAS_ACCEL_PREFIJO", "/_evidencias/")
+
+# Búsqueda de texto completo
+app.config["BUSQUEDA_POR_PAGINA"] = int(os.environ.get("BUSQUEDA_POR_PAGINA", 20))
+app.config["BUSQUEDA_MAX_RESULTADOS"] = int(os.environ.get("BUSQUEDA_MAX_RESULTADOS", 1000))
+
+# Extracción de indicadores (flask extraer-indicadores)
+app.config["INDICADORES_PROCESOS"] = int(os.environ.get("INDICADORES_PROCESOS", os.cpu_count() or 2))
+app.config["INDICADORES_CADUCIDAD"] = int(os.environ.get("INDICADORES_CADUCIDAD", 3600))
+
+# Resumen de capturas de red (flask resumir-capturas)
+app.config["CAPTURAS_PROCESOS"] = int(os.environ.get("CAPTURAS_PROCESOS", os.cpu_count() or 2))
+app.config["CAPTURAS_CADUCIDAD"] = int(os.environ.get("CAPTURAS_CADUCIDAD", 3600))
+
+# Trabajos en segundo plano. TRABAJOS_EN_SEGUNDO_PLANO=1 solo si hay algún
+# flask worker en marcha: si no, los trabajos se quedan en la cola. Por
+# defecto el ZIP y las miniaturas se hacen dentro de la petición, como antes
+app.config["TRABAJOS_EN_SEGUNDO_PLANO"] = os.environ.get("TRABAJOS_EN_SEGUNDO_PLANO", "0") == "1"
+app.config["TRABAJOS_PROCESOS"] = int(os.environ.get("TRABAJOS_PROCESOS", os.cpu_count() or 2))
+app.config["TRABAJOS_CADUCIDAD"] = int(os.environ.get("TRABAJOS_CADUCIDAD", 3600))
+app.config["TRABAJOS_RETENCION"] = int(os.environ.get("TRABAJOS_RETENCION", 7 * 24 * 3600))
+
+# Correlación: una alerta igual a un incidente abierto con actividad en los
+# últimos CORRELACION_VENTANA segundos se fusiona en él (0 la desactiva)
+app.config["CORRELACION_VENTANA"] = int(os.environ.get("CORRELACION_VENTANA", 3600))
+
+# Alta masiva de incidentes: filas por INSERT multi-fila y transacción
+app.config["INGESTA_TAMANO_LOTE"] = int(os.environ.get("INGESTA_TAMANO_LOTE", ingesta.TAMANO_LOTE))
+
+# Pool de conexiones (por proceso)
+app.config["DB_POOL_SIZE"] = int(os.environ.get("DB_POOL_SIZE", 10))
+app.config["DB_POOL_TIMEOUT"] = float(os.environ.get("DB_POOL_TIMEOUT", 5))
+app.config["DB_POOL_RECYCLE"] = int(os.environ.get("DB_POOL_RECYCLE", 3600))
+app.config["DB_POOL_PING_INTERVAL"] = int(os.environ.get("DB_POOL_PING_INTERVAL", 30))
+
+# Réplicas de lectura (DB_REPLICAS en config.py). Una réplica con más de
+# DB_REPLICAS_MAX_RETRASO segundos de retraso, o que falla, se aparta
+# DB_REPLICAS_PENALIZACION segundos. Tras una escritura, la misma sesión lee
+# de la primaria durante DB_LECTURA_PROPIA segundos para ver sus cambios
+app.config["DB_REPLICAS_MAX_RETRASO"] = float(os.environ.get("DB_REPLICAS_MAX_RETRASO", 5))
+app.config["DB_REPLICAS_INTERVALO"] = float(os.environ.get("DB_REPLICAS_INTERVALO", 5))
+app.config["DB_REPLICAS_PENALIZACION"] = float(os.environ.get("DB_REPLICAS_PENALIZACION", 30))
+app.config["DB_LECTURA_PROPIA"] = float(os.environ.get("DB_LECTURA_PROPIA", 10))
+
+# Escritura de historial por lotes en segundo plano
+app.config["HISTORIAL_ASYNC"] = os.environ.get("HISTORIAL_ASYNC", "1") == "1"
+app.config["HISTORIAL_LOTE"] = int(os.environ.get("HISTORIAL_LOTE", 100))
+app.config["HISTORIAL_INTERVALO"] = float(os.environ.get("HISTORIAL_INTERVALO", 0.5))
+app.config["HISTORIAL_MAX_COLA"] = int(os.environ.get("HISTORIAL_MAX_COLA", 10000))
+app.config["HISTORIAL_BLOQUEO"] = float(os.environ.get("HISTORIAL_BLOQUEO", 2))
+app.config["HISTORIAL_SPOOL"] = os.environ.get("HISTORIAL_SPOOL", "")  # vacío = sin spool
+
+# Retención de historial (flask archivar-historial, p. ej. diario por cron):
+# los meses anteriores a HISTORIAL_RETENCION_DIAS se exportan a NDJSON
+# comprimido en HISTORIAL_ARCHIVO_FOLDER (y de ahí al almacén de evidencias,
+# S3 si está configurado) y se eliminan de la tabla. 0 = no archivar.
+# HISTORIAL_ARCHIVO_FORMATO: "zstd" (necesita zstandard), "gzip" o vacío
+# (zstd si está instalado)
+app.config["HISTORIAL_RETENCION_DIAS"] = int(os.environ.get("HISTORIAL_RETENCION_DIAS", 365))
+app.config["HISTORIAL_ARCHIVO_FOLDER"] = os.environ.get("HISTORIAL_ARCHIVO_FOLDER", os.path.join(UPLOAD_FOLDER, "historial"))
+app.config["HISTORIAL_ARCHIVO_FORMATO"] = os.environ.get("HISTORIAL_ARCHIVO_FORMATO", "")
+app.config["HISTORIAL_PARTICIONES_ADELANTE"] = int(os.environ.get("HISTORIAL_PARTICIONES_ADELANTE", 3))
+
+# Acciones de alto volumen que no necesitan verse de inmediato: se registran
+# sin esperar a que el lote llegue a la base de datos
+ACCIONES_DIFERIDAS = {'VISUALIZACION_IMAGEN', 'DESCARGA_EVIDENCIA', 'DESCARGA_COMPLETA'}
+
+# Métricas Prometheus en /metrics (por proceso) y registro de consultas
+# lentas: las sentencias que superan METRICAS_CONSULTA_LENTA segundos se
+# escriben en el log (0 = sin registro)
+app.config["METRICAS"] = os.environ.get("METRICAS", "1") == "1"
+app.config["METRICAS_CONSULTA_LENTA"] = float(os.environ.get("METRICAS_CONSULTA_LENTA", 0))
+
+# Contadores del dashboard
+app.config["ESTADISTICAS_TTL"] = int(os.environ.get("ESTADISTICAS_TTL", 60))
+app.config["ESTADISTICAS_RECONCILIAR"] = int(os.environ.get("ESTADISTICAS_RECONCILIAR", 300))
+app.config["ESTADISTICAS_REDIS_URL"] = os.environ.get("ESTADISTICAS_REDIS_URL", "")  # vacío = en memoria
+
+# Caché del detalle de incidentes (cuerpo ya renderizado, por versión del
+# incidente). DETALLE_CACHE_MB=0 la desactiva; con Redis el límite de
+# memoria es el maxmemory del servidor. DETALLE_CACHE_VERIFICAR: cada
+# cuántos segundos se comprueba la versión en la base de datos (0 = nunca,
+# solo con un proceso y sin escrituras desde fuera de la aplicación)
+app.config["DETALLE_CACHE_MB"] = int(os.environ.get("DETALLE_CACHE_MB", 64))
+app.config["DETALLE_CACHE_TTL"] = int(os.environ.get("DETALLE_CACHE_TTL", 300))
+app.config["DETALLE_CACHE_VERIFICAR"] = float(os.environ.get("DETALLE_CACHE_VERIFICAR", 5))
+app.config["DETALLE_CACHE_REDIS_URL"] = os.environ.get("DETALLE_CACHE_REDIS_URL", "")  # vacío = en memoria
+# La línea de tiempo del detalle se guarda aparte: las descargas y
+# visualizaciones no suben la versión del incidente. Se invalida al
+# insertar historial; DETALLE_HISTORIAL_TTL acota lo que puede tardar en
+# verse una fila escrita por otro proceso (con la caché en memoria)
+app.config["DETALLE_HISTORIAL_TTL"] = int(os.environ.get("DETALLE_HISTORIAL_TTL", 30))
+
+# Eventos en tiempo real (SSE). Sin EVENTOS_REDIS_URL solo llegan a los
+# clientes conectados al mismo proceso. Cada flujo servido por Flask ocupa
+# un hilo del worker: EVENTOS_MAX_CLIENTES los limita por proceso (0 = las
+# rutas responden 503) y EVENTOS_DURACION corta la conexión para que el
+# navegador reconecte. Para muchos clientes, flask servir-eventos.
+# EVENTOS_EN_VIVO: las páginas abren los flujos; solo debe activarse cuando
+# los sirve algo que no ocupa un worker por cliente (servir-eventos detrás
+# del proxy, o el modo ASGI, que lo activa solo). Si no, cargan como antes
+app.config["EVENTOS_EN_VIVO"] = os.environ.get("EVENTOS_EN_VIVO", "0") == "1"
+app.config["EVENTOS_REDIS_URL"] = os.environ.get("EVENTOS_REDIS_URL", "")
+app.config["EVENTOS_MAX_CLIENTES"] = int(os.environ.get("EVENTOS_MAX_CLIENTES", 20))
+app.config["EVENTOS_DURACION"] = int(os.environ.get("EVENTOS_DURACION", 300))
+app.config["EVENTOS_LATIDO"] = int(os.environ.get("EVENTOS_LATIDO", 15))
+app.config["EVENTOS_HISTORIAL"] = int(os.environ.get("EVENTOS_HISTORIAL", 500))
+app.config["EVENTOS_MAX_COLA"] = int(os.environ.get("EVENTOS_MAX_COLA", 100))
+
+# Modo ASGI (asgi.py, flask servir-asgi): hilos que ejecutan las rutas,
+# memoria por cuerpo de petición antes de pasar a un archivo temporal y
+# clientes SSE por proceso (en este modo no ocupan hilos)
+app.config["ASGI_HILOS"] = int(os.environ.get("ASGI_HILOS", 32))
+app.config["ASGI_CUERPO_MEMORIA_MB"] = int(os.environ.get("ASGI_CUERPO_MEMORIA_MB", 1))
+app.config["ASGI_MAX_CLIENTES_EVENTOS"] = int(os.environ.get("ASGI_MAX_CLIENTES_EVENTOS", 10000))
+
+# Paginación por cursor
+app.config["INCIDENTES_POR_PAGINA"] = int(os.environ.get("INCIDENTES_POR_PAGINA", 25))
+app.config["MAX_POR_PAGINA"] = int(os.environ.get("MAX_POR_PAGINA", 200))
+app.config["HISTORIAL_POR_PAGINA"] = int(os.environ.get("HISTORIAL_POR_PAGINA", 20))
+app.config["HISTORIAL_CONTEO_TTL"] = int(os.environ.get("HISTORIAL_CONTEO_TTL", 60))
 
 # ==============================
 # FUNCIONES AUXILIARES
@@ -46,25 +208,567 @@ def allowed_file(filename):
     extension = filename.rsplit('.', 1)[1].lower()
     return extension in ALLOWED_EXTENSIONS
 
-def get_db():
+def tipo_evidencia(filename):
+    """Valor de evidencias.tipo_archivo para un nombre de archivo"""
+    extension = filename.lower().split('.')[-1]
+    if extension in ['png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp']:
+        return 'imagen'
+    return 'documento'
+
+_almacen = None
+
+def get_almacen():
+    """Devuelve el almacén de blobs de evidencias (disco local o S3, ver config.py)"""
+    global _almacen
+    if _almacen is None:
+        _almacen = crear_almacen(**dict(ALMACEN_CONFIG, raiz=app.config["BLOBS_FOLDER"]))
+    return _almacen
+
+_miniaturas = None
+
+def get_miniaturas():
+    """Devuelve la caché de miniaturas de evidencias"""
+    global _miniaturas
+    if _miniaturas is None:
+        _miniaturas = CacheMiniaturas(app.config["MINIATURAS_FOLDER"])
+    return _miniaturas
+
+def clave_miniatura(evidencia):
+    """Clave de caché de las miniaturas de una evidencia.
+
+    Es el SHA-256 del contenido; las evidencias anteriores al almacén por
+    contenido usan un hash de su ruta, fecha de modificación y tamaño.
+    """
+    if evidencia.get('sha256'):
+        return evidencia['sha256']
+    info = os.stat(evidencia['ruta'])
+    firma = f"{evidencia['ruta']}|{info.st_mtime_ns}|{info.st_size}"
+    return hashlib.sha256(firma.encode('utf-8')).hexdigest()
+
+def agregar_evidencia(cursor, incidente_id, filename, temporal, sha256, tamano):
+    """Registra una evidencia cuyo contenido está en ``temporal``.
+
+    Primero se suma la referencia al blob y después se coloca el archivo, de
+    modo que un borrado concurrente del mismo contenido no pueda dejar la
+    evidencia sin su blob. Devuelve el id de la evidencia.
+    """
+    cursor.execute("""
+        INSERT INTO blobs (sha256, tamano, referencias)
+        VALUES (%s, %s, 1)
+        ON DUPLICATE KEY UPDATE referencias = referencias + 1
+    """, (sha256, tamano))
+    
+    try:
+        ruta = get_almacen().colocar(temporal, sha256)
+    except Exception:
+        liberar_blob(sha256)
+        raise
+    
+    segundo_plano = app.config["TRABAJOS_EN_SEGUNDO_PLANO"]
+    if app.config["MINIATURAS_AL_SUBIR"] and tipo_evidencia(filename) == 'imagen':
+        if segundo_plano:
+            trabajos.encolar(cursor, 'miniaturas',
+                             {'origen': ruta, 'clave': sha256, 'raiz': app.config["MINIATURAS_FOLDER"]},
+                             incidente_id=incidente_id, clave=f"miniaturas:{sha256}")
+        else:
+            with get_almacen().copia_local(ruta) as origen:
+                get_miniaturas().pregenerar(origen, sha256)
+    
+    cursor.execute("""
+        INSERT INTO evidencias
+        (incidente_id, nombre_archivo, tipo_archivo, ruta, tamano, sha256)
+        VALUES (%s, %s, %s, %s, %s, %s)
+    """, (incidente_id, filename, tipo_evidencia(filename), ruta, tamano, sha256))
+    evidencia_id = cursor.lastrowid
+    busqueda.indexar(cursor, 'evidencia', evidencia_id, incidente_id,
+                     filename, busqueda.palabras_archivo(filename))
+    
+    # Los logs y textos quedan pendientes de extraer indicadores y las
+    # capturas de red de resumir (una vez por contenido); lo hace el worker
+    # o, sin él, flask extraer-indicadores / flask resumir-capturas
+    tipo_archivo = detectar_tipo_archivo(filename)
+    if tipo_archivo == 'texto':
+        cursor.execute("INSERT IGNORE INTO extracciones (sha256) VALUES (%s)", (sha256,))
+        if segundo_plano:
+            trabajos.encolar(cursor, 'indicadores',
+                             {'sha256': sha256, 'ruta': ruta, 'caducidad': app.config["INDICADORES_CADUCIDAD"]},
+                             incidente_id=incidente_id, clave=f"indicadores:{sha256}")
+    elif tipo_archivo == 'captura_red':
+        cursor.execute("INSERT IGNORE INTO resumenes_captura (sha256) VALUES (%s)", (sha256,))
+        if segundo_plano:
+            trabajos.encolar(cursor, 'captura',
+                             {'sha256': sha256, 'ruta': ruta, 'caducidad': app.config["CAPTURAS_CADUCIDAD"]},
+                             incidente_id=incidente_id, clave=f"captura:{sha256}")
+    return evidencia_id
+
+def liberar_blob(sha256, cantidad=1):
+    """Resta referencias a un blob y borra el archivo al llegar a cero;
+    devuelve True si se quedó sin referencias"""
+    db = get_db()
+    cursor = db.cursor()
+    apartado = None
+    sin_referencias = False
+    try:
+        db.start_transaction()
+        cursor.execute("SELECT referencias FROM blobs WHERE sha256 = %s FOR UPDATE", (sha256,))
+        fila = cursor.fetchone()
+        
+        if fila and fila[0] > cantidad:
+            cursor.execute(
+                "UPDATE blobs SET referencias = referencias - %s WHERE sha256 = %s",
+                (cantidad, sha256)
+            )
+        else:
+            # Se aparta antes de confirmar: una subida del mismo contenido
+            # espera al bloqueo de la fila y vuelve a colocar su copia
+            apartado = get_almacen().retirar(sha256)
+            cursor.execute("DELETE FROM blobs WHERE sha256 = %s", (sha256,))
+            sin_referencias = True
+        
+        db.commit()
+    except Exception:
+        db.rollback()
+        get_almacen().restaurar(apartado, sha256)
+        raise
+    finally:
+        cursor.close()
+        db.close()
+    
+    get_almacen().purgar(apartado)
+    if sin_referencias:
+        get_miniaturas().eliminar(sha256)
+    return sin_referencias
+
+def eliminar_archivo_evidencia(evidencia):
+    """Libera el contenido de una evidencia ya borrada de la base de datos"""
+    try:
+        almacen = get_almacen()
+        if evidencia.get('sha256') and almacen.pertenece(evidencia['ruta']):
+            liberar_blob(evidencia['sha256'])
+        elif evidencia.get('sha256') and almacen.blob_local(evidencia['ruta']):
+            # Blob del disco aún sin migrar a S3: puede ser de otras
+            # evidencias, así que solo se borra al quedarse sin referencias
+            if liberar_blob(evidencia['sha256']):
+                almacen.eliminar(evidencia['ruta'])
+        elif evidencia['ruta'] and os.path.exists(evidencia['ruta']):
+            # Evidencias guardadas antes del almacén por contenido
+            get_miniaturas().eliminar(clave_miniatura(evidencia))
+            os.remove(evidencia['ruta'])
+    except Exception as e:
+        logger.error(f"Error eliminando archivo: {e}")
+
+def enviar_evidencia(evidencia, adjunto, accion, descripcion):
+    """Respuesta con el contenido de una evidencia, o None si falta el archivo.
+
+    El 304 se decide con el SHA-256 y la fecha de subida de la fila, sin tocar
+    el disco. Solo se registra en el historial la petición que empieza en el
+    byte 0: las revalidaciones y los rangos de una descarga reanudada no
+    añaden filas.
+    """
+    etag = evidencia.get('sha256')
+    ultima_modificacion = fecha_http(evidencia.get('fecha_subida'))
+    
+    if no_modificado(request.environ, etag, ultima_modificacion):
+        respuesta = Response(status=304)
+        if etag:
+            respuesta.set_etag(etag)
+    else:
+        almacen = get_almacen()
+        mimetype = tipo_mime(evidencia['nombre_archivo'])
+        url = almacen.url_descarga(evidencia['ruta'], evidencia['nombre_archivo'], mimetype, adjunto)
+        if url:
+            # Almacén remoto: el navegador descarga del bucket con una URL
+            # firmada (rangos incluidos) y Flask no toca el contenido
+            info = almacen.info(evidencia['ruta'])
+            if info is None:
+                return None
+            respuesta = redirect(url)
+            if not request.headers.get('Range'):
+                metricas.EVIDENCIA_BYTES.sumar(info[0], 's3')
+        else:
+            if not os.path.exists(evidencia['ruta']):
+                return None
+            respuesta = enviar_archivo(
+                request.environ, evidencia['ruta'], mimetype,
+                etag=etag,
+                ultima_modificacion=ultima_modificacion,
+                nombre=evidencia['nombre_archivo'],
+                adjunto=adjunto,
+                modo=app.config["EVIDENCIAS_ENVIO"],
+                raiz_accel=app.config["UPLOAD_FOLDER"],
+                prefijo_accel=app.config["EVIDENCIAS_ACCEL_PREFIJO"]
+            )
+            if respuesta.status_code in (200, 206):
+                # Con x-sendfile/x-accel no hay Content-Length: cuenta el archivo
+                enviados = respuesta.content_length
+                if enviados is None and respuesta.status_code == 200:
+                    enviados = os.path.getsize(evidencia['ruta'])
+                metricas.EVIDENCIA_BYTES.sumar(enviados or 0, app.config["EVIDENCIAS_ENVIO"])
+        rango = request.headers.get('Range', '').replace(' ', '')
+        if respuesta.status_code in (200, 206, 302) and (not rango or rango.startswith('bytes=0-')):
+            registrar_historial(
+                incidente_id=evidencia['incidente_id'],
+                accion=accion,
+                descripcion=descripcion
+            )
+    
+    # Siempre se revalida: la evidencia puede haberse eliminado
+    respuesta.cache_control.private = True
+    respuesta.cache_control.no_cache = True
+    return respuesta
+
+_db_pool = None
+
+def get_pool():
+    """Devuelve el pool de conexiones del proceso, creándolo la primera vez"""
+    global _db_pool
+    if _db_pool is None:
+        _db_pool = ConnectionPool(
+            lambda: mysql.connector.connect(**DB_CONFIG),
+            size=app.config["DB_POOL_SIZE"],
+            timeout=app.config["DB_POOL_TIMEOUT"],
+            recycle=app.config["DB_POOL_RECYCLE"],
+            ping_interval=app.config["DB_POOL_PING_INTERVAL"]
+        )
+    return _db_pool
+
+class _ConexionPeticion:
+    """Conexión del pool ligada a la petición actual.
+
+    Las rutas siguen llamando a ``db.close()``; la conexión solo vuelve al
+    pool cuando termina la petición (ver ``liberar_db``).
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, nombre):
+        return getattr(self._conn, nombre)
+
+    def cursor(self, *args, **kwargs):
+        cursor = self._conn.cursor(*args, **kwargs)
+        if app.config["METRICAS"]:
+            return metricas.CursorMedido(cursor, medir_consulta)
+        return cursor
+
+    def close(self):
+        pass
+
+class _ConexionPool(_ConexionPeticion):
+    """Conexión fuera de una petición: ``close()`` la devuelve al pool"""
+
+    def __init__(self, conn, pool=None):
+        super().__init__(conn)
+        self._pool = pool or get_pool()
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._conn)
+            self._conn = None
+
+_enrutador = None
+
+def get_enrutador():
+    """Devuelve el enrutador de réplicas del proceso, creándolo la primera vez"""
+    global _enrutador
+    if _enrutador is None:
+        _enrutador = EnrutadorBD(
+            [Replica(f"{config['host']}:{config['port']}", ConnectionPool(
+                lambda config=config: mysql.connector.connect(**config),
+                size=app.config["DB_POOL_SIZE"],
+                timeout=app.config["DB_POOL_TIMEOUT"],
+                recycle=app.config["DB_POOL_RECYCLE"],
+                ping_interval=app.config["DB_POOL_PING_INTERVAL"]
+            )) for config in DB_REPLICAS],
+            max_retraso=app.config["DB_REPLICAS_MAX_RETRASO"],
+            intervalo_retraso=app.config["DB_REPLICAS_INTERVALO"],
+            penalizacion=app.config["DB_REPLICAS_PENALIZACION"]
+        )
+    return _enrutador
+
+def lectura_en_replica():
+    """Indica si las lecturas pueden ir a una réplica.
+
+    No si no hay réplicas, si la petición ya usa la primaria o si la sesión
+    escribió hace menos de DB_LECTURA_PROPIA segundos (leer lo escrito).
+    """
+    if not DB_REPLICAS:
+        return False
+    if has_request_context():
+        if 'db' in g:
+            return False
+        escritura = session.get('ultima_escritura')
+        if escritura and time.time() - escritura < app.config["DB_LECTURA_PROPIA"]:
+            return False
+    return True
+
+def get_db(lectura=False):
+    """Obtiene una conexión del pool (una sola por petición).
+
+    Con ``lectura=True`` la consulta es de solo lectura y puede servirse
+    desde una réplica; si ninguna está disponible se usa la primaria.
+    """
+    if has_request_context():
+        if 'db' in g:
+            return g.db
+        if lectura and 'db_lectura' in g:
+            return g.db_lectura
+
+    if lectura and lectura_en_replica():
+        inicio = time.perf_counter()
+        obtenida = get_enrutador().adquirir()
+        if obtenida:
+            metricas.CONEXION_ESPERA.observar(time.perf_counter() - inicio, 'replica')
+            conn, replica = obtenida
+            if has_request_context():
+                g.db_lectura = _ConexionPeticion(conn)
+                g.replica = replica
+                return g.db_lectura
+            return _ConexionPool(conn, replica.pool)
+
+    inicio = time.perf_counter()
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        return conn
-    except mysql.connector.Error as err:
+        conn = get_pool().acquire()
+    except Exception as err:
         logger.error(f"Error de conexión MySQL: {err}")
         raise
+    metricas.CONEXION_ESPERA.observar(time.perf_counter() - inicio, 'primaria')
+
+    if has_request_context():
+        g.db = _ConexionPeticion(conn)
+        return g.db
+    return _ConexionPool(conn)
+
+@app.teardown_appcontext
+def liberar_db(exc):
+    db = g.pop('db', None)
+    if db is not None:
+        get_pool().release(db._conn, descartar=isinstance(exc, mysql.connector.Error))
+    db_lectura = g.pop('db_lectura', None)
+    if db_lectura is not None:
+        g.pop('replica').pool.release(db_lectura._conn, descartar=isinstance(exc, mysql.connector.Error))
+
+# ==============================
+# MÉTRICAS
+# ==============================
+def _endpoint():
+    if has_request_context():
+        return request.endpoint or 'desconocido'
+    return 'segundo_plano'
+
+def medir_consulta(sql, segundos):
+    """Anota una sentencia medida por metricas.CursorMedido"""
+    identificador, normalizada = metricas.id_consulta(sql)
+    endpoint = _endpoint()
+    metricas.CONSULTAS.observar(segundos, endpoint, identificador)
+    if has_request_context():
+        g.consultas = g.get('consultas', 0) + 1
+        g.segundos_sql = g.get('segundos_sql', 0.0) + segundos
+    umbral = app.config["METRICAS_CONSULTA_LENTA"]
+    if umbral and segundos >= umbral:
+        logger.warning(f"Consulta lenta ({segundos * 1000:.0f} ms) en {endpoint} [{identificador}]: {normalizada[:1000]}")
+
+@app.before_request
+def iniciar_medida():
+    g.inicio_peticion = time.perf_counter()
+
+@app.after_request
+def registrar_medida(respuesta):
+    """Latencia, código y sentencias SQL de la petición"""
+    if app.config["METRICAS"] and 'inicio_peticion' in g:
+        endpoint = _endpoint()
+        metricas.PETICIONES.observar(time.perf_counter() - g.inicio_peticion, endpoint, request.method)
+        metricas.RESPUESTAS.sumar(1, endpoint, request.method, respuesta.status_code)
+        metricas.CONSULTAS_PETICION.observar(g.get('consultas', 0), endpoint)
+        metricas.SQL_PETICION.observar(g.get('segundos_sql', 0.0), endpoint)
+    return respuesta
+
+def _inicio_plantilla(sender, template, context, **extra):
+    g.inicio_plantilla = time.perf_counter()
+
+def _fin_plantilla(sender, template, context, **extra):
+    inicio = g.pop('inicio_plantilla', None)
+    if inicio is not None:
+        metricas.PLANTILLAS.observar(time.perf_counter() - inicio, template.name or 'cadena')
+
+if app.config["METRICAS"]:
+    before_render_template.connect(_inicio_plantilla, app)
+    template_rendered.connect(_fin_plantilla, app)
+
+@app.after_request
+def marcar_escritura(respuesta):
+    """Las peticiones que modifican datos dejan a la sesión leyendo de la primaria"""
+    if DB_REPLICAS and request.method not in ('GET', 'HEAD', 'OPTIONS'):
+        session['ultima_escritura'] = time.time()
+    return respuesta
 
 def get_current_user():
     """Obtiene el usuario actual (simulado para desarrollo)"""
     return session.get('usuario', 'admin@cyberincident.com')
 
+_escritor_historial = None
+
+def get_escritor_historial():
+    """Devuelve el escritor de historial del proceso, creándolo la primera vez"""
+    global _escritor_historial
+    if _escritor_historial is None:
+        # Conexión propia: las peticiones que esperan a su registro tienen
+        # ocupada la suya y no deben poder agotar el pool del escritor
+        pool_historial = ConnectionPool(
+            lambda: mysql.connector.connect(**DB_CONFIG),
+            size=1,
+            recycle=app.config["DB_POOL_RECYCLE"],
+            ping_interval=app.config["DB_POOL_PING_INTERVAL"]
+        )
+        _escritor_historial = EscritorHistorial(
+            lambda: _ConexionPool(pool_historial.acquire(), pool_historial),
+            lote=app.config["HISTORIAL_LOTE"],
+            intervalo=app.config["HISTORIAL_INTERVALO"],
+            max_cola=app.config["HISTORIAL_MAX_COLA"],
+            bloqueo=app.config["HISTORIAL_BLOQUEO"],
+            spool=app.config["HISTORIAL_SPOOL"] or None,
+            al_insertar=lambda filas: invalidar_linea_tiempo({fila[0] for fila in filas})
+        )
+        atexit.register(_escritor_historial.detener)
+    return _escritor_historial
+
+_estadisticas = None
+
+def get_estadisticas():
+    """Devuelve los contadores del dashboard, creándolos la primera vez"""
+    global _estadisticas
+    if _estadisticas is None:
+        _estadisticas = ContadoresIncidentes(
+            lambda: get_db(lectura=True),
+            ttl=app.config["ESTADISTICAS_TTL"],
+            reconciliar=app.config["ESTADISTICAS_RECONCILIAR"],
+            redis_url=app.config["ESTADISTICAS_REDIS_URL"] or None
+        )
+    return _estadisticas
+
+_cache_detalle = None
+
+def get_cache_detalle():
+    """Devuelve la caché del detalle de incidentes, creándola la primera vez"""
+    global _cache_detalle
+    if _cache_detalle is None:
+        _cache_detalle = CacheDetalle(
+            max_bytes=app.config["DETALLE_CACHE_MB"] * 1024 * 1024,
+            ttl=app.config["DETALLE_CACHE_TTL"],
+            verificar=app.config["DETALLE_CACHE_VERIFICAR"],
+            redis_url=app.config["DETALLE_CACHE_REDIS_URL"] or None
+        )
+    return _cache_detalle
+
+_cache_linea_tiempo = None
+
+def get_cache_linea_tiempo():
+    """Devuelve la caché de la línea de tiempo del detalle, creándola la primera vez"""
+    global _cache_linea_tiempo
+    if _cache_linea_tiempo is None:
+        # Sin versión: cada entrada vale hasta que se invalida o caduca
+        _cache_linea_tiempo = CacheDetalle(
+            max_bytes=app.config["DETALLE_CACHE_MB"] * 1024 * 1024 // 4,
+            ttl=app.config["DETALLE_HISTORIAL_TTL"],
+            verificar=0,
+            redis_url=app.config["DETALLE_CACHE_REDIS_URL"] or None,
+            prefijo='cyberincident:linea_tiempo'
+        )
+    return _cache_linea_tiempo
+
+def invalidar_linea_tiempo(incidentes):
+    cache = get_cache_linea_tiempo()
+    for incidente_id in incidentes:
+        cache.invalidar(incidente_id)
+
+_canal_eventos = None
+
+def get_canal_eventos():
+    """Devuelve el canal de eventos SSE, creándolo la primera vez"""
+    global _canal_eventos
+    if _canal_eventos is None:
+        _canal_eventos = CanalEventos(
+            redis_url=app.config["EVENTOS_REDIS_URL"] or None,
+            historial=app.config["EVENTOS_HISTORIAL"],
+            max_cola=app.config["EVENTOS_MAX_COLA"]
+        )
+    return _canal_eventos
+
+def publicar_evento(tipo, incidente_id=None, **datos):
+    get_canal_eventos().publicar(tipo, incidente_id, **datos)
+
+def publicar_estadisticas():
+    """Envía los contadores del dashboard tras un cambio (sin consultas si están cargados)"""
+    try:
+        publicar_evento('estadisticas', **get_estadisticas().resumen())
+    except Exception as e:
+        logger.warning(f"No se pudieron publicar las estadísticas: {e}")
+
+def incidente_modificado(incidente_id, **cambios):
+    """Sube la versión de un incidente tras cambiarlo, lo que invalida su detalle en caché.
+
+    Se llama después de escribir el cambio (y su historial), para que una
+    vista cargada entre medias no pueda quedar guardada como la versión nueva.
+    Los ``cambios`` (p. ej. estado) viajan en el evento 'incidente'.
+    """
+    version = None
+    try:
+        db = get_db()
+        cursor = db.cursor()
+        # LAST_INSERT_ID(expr) devuelve la versión nueva sin otra consulta
+        cursor.execute("UPDATE incidentes SET version = LAST_INSERT_ID(version + 1) WHERE id = %s",
+                       (incidente_id,))
+        if cursor.rowcount:
+            version = cursor.lastrowid
+        db.commit()
+        cursor.close()
+        db.close()
+    except Exception as e:
+        logger.error(f"Error actualizando la versión del incidente {incidente_id}: {e}")
+    get_cache_detalle().invalidar(incidente_id, version)
+    publicar_evento('incidente', incidente_id, version=version, **cambios)
+
+def version_incidente(incidente_id):
+    """Versión actual de un incidente en la base de datos (None si no existe)"""
+    db = get_db()
+    cursor = db.cursor()
+    cursor.execute("SELECT version FROM incidentes WHERE id = %s", (incidente_id,))
+    fila = cursor.fetchone()
+    cursor.close()
+    db.close()
+    return fila[0] if fila else None
+
+def publicar_historial(incidente_id, usuario, accion, descripcion):
+    publicar_evento('historial', incidente_id, usuario=usuario, accion=accion, descripcion=descripcion,
+                    fecha=datetime.now().isoformat(timespec='seconds'))
+
 def registrar_historial(incidente_id, accion, descripcion=None, usuario=None):
     """Registra una acción en el historial"""
+    inicio = time.perf_counter()
     try:
         if usuario is None:
             usuario = get_current_user()
         
-        conn = mysql.connector.connect(**DB_CONFIG)
+        if app.config["HISTORIAL_ASYNC"]:
+            # Las acciones diferidas vuelven en cuanto están encoladas; el
+            # resto espera a su inserción (el escritor vacía la cola en
+            # seguida) para que la siguiente página ya las muestre
+            diferida = accion in ACCIONES_DIFERIDAS
+            registrado = get_escritor_historial().registrar(
+                incidente_id, usuario, accion, descripcion,
+                esperar=not diferida
+            )
+            metricas.HISTORIAL_REGISTRO.observar(time.perf_counter() - inicio,
+                                                 'diferido' if diferida else 'lote')
+            if registrado is ENCOLADO:
+                # Está en la cola (y en el spool): la fila llegará cuando
+                # vuelva la base de datos, así que se publica igualmente
+                logger.warning(f"Historial pendiente de insertar: {accion} para incidente {incidente_id}")
+            if registrado:
+                publicar_historial(incidente_id, usuario, accion, descripcion)
+            return registrado
+        
+        conn = get_db()
         cursor = conn.cursor()
         
         sql = """
@@ -76,7 +780,10 @@ def registrar_historial(incidente_id, accion, descripcion=None, usuario=None):
         cursor.execute(sql, (incidente_id, usuario, accion, descripcion))
         conn.commit()
         cursor.close()
-        conn.close()
+        conn.close()  # Solo devuelve la conexión al pool fuera de una petición
+        invalidar_linea_tiempo([incidente_id])
+        metricas.HISTORIAL_REGISTRO.observar(time.perf_counter() - inicio, 'directo')
+        publicar_historial(incidente_id, usuario, accion, descripcion)
         
         logger.debug(f"Historial registrado: {accion} para incidente {incidente_id}")
         return True
@@ -97,46 +804,10 @@ def init_database():
         cursor.execute("CREATE DATABASE IF NOT EXISTS cyberincident")
         cursor.execute("USE cyberincident")
         
-        # Tabla incidentes
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS incidentes (
-                id INT PRIMARY KEY AUTO_INCREMENT,
-                titulo VARCHAR(200) NOT NULL,
-                descripcion TEXT NOT NULL,
-                tipo VARCHAR(50) NOT NULL,
-                severidad VARCHAR(20) NOT NULL,
-                estado VARCHAR(30) DEFAULT 'Abierto',
-                usuario_reporta VARCHAR(100),
-                fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Tabla evidencias
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS evidencias (
-                id INT PRIMARY KEY AUTO_INCREMENT,
-                incidente_id INT NOT NULL,
-                nombre_archivo VARCHAR(255) NOT NULL,
-                tipo_archivo VARCHAR(30),
-                ruta TEXT,
-                tamano BIGINT,
-                fecha_subida TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (incidente_id) REFERENCES incidentes(id) ON DELETE CASCADE
-            )
-        """)
-        
-        # Tabla historial
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS historial (
-                id INT PRIMARY KEY AUTO_INCREMENT,
-                incidente_id INT NOT NULL,
-                usuario VARCHAR(100) NOT NULL,
-                accion VARCHAR(50) NOT NULL,
-                descripcion TEXT,
-                fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (incidente_id) REFERENCES incidentes(id) ON DELETE CASCADE
-            )
-        """)
+        # Tablas e índices (migraciones versionadas)
+        aplicadas = aplicar_migraciones(cursor)
+        if aplicadas:
+            logger.info(f"Migraciones aplicadas: {aplicadas}")
         
         # Insertar datos de prueba si está vacío
         cursor.execute("SELECT COUNT(*) FROM incidentes")
@@ -163,6 +834,341 @@ def init_database():
         logger.error(f"Error inicializando base de datos: {err}")
         return False
 
+def codificar_cursor(fecha, id):
+    """Codifica la posición (fecha, id) de la última fila de una página"""
+    texto = f"{fecha.strftime('%Y-%m-%dT%H:%M:%S.%f')}|{id}"
+    return base64.urlsafe_b64encode(texto.encode()).decode().rstrip('=')
+
+def decodificar_cursor(cursor):
+    """Devuelve (fecha, id) a partir de un cursor, o None si no es válido"""
+    if not cursor:
+        return None
+    try:
+        relleno = '=' * (-len(cursor) % 4)
+        fecha, id = base64.urlsafe_b64decode(cursor + relleno).decode().split('|')
+        return datetime.strptime(fecha, '%Y-%m-%dT%H:%M:%S.%f'), int(id)
+    except (ValueError, binascii.Error):
+        return None
+
+def leer_por_pagina(defecto):
+    """Tamaño de página pedido en la URL, acotado a MAX_POR_PAGINA"""
+    por_pagina = request.args.get('por_pagina', defecto, type=int)
+    return max(1, min(por_pagina, app.config["MAX_POR_PAGINA"]))
+
+def rango_fechas():
+    """Filtros 'desde' / 'hasta' (AAAA-MM-DD, ambos inclusive) como
+    (desde, hasta exclusivo); None en los que faltan o no son válidos"""
+    rango = []
+    for clave, dias in (('desde', 0), ('hasta', 1)):
+        try:
+            rango.append(datetime.strptime(request.args.get(clave, '').strip(), '%Y-%m-%d') + timedelta(days=dias))
+        except ValueError:
+            rango.append(None)
+    return tuple(rango)
+
+def leer_rango_fechas(condiciones, parametros, columna):
+    """Añade los filtros 'desde' / 'hasta' (AAAA-MM-DD, ambos inclusive)"""
+    for operador, fecha in zip(('>=', '<'), rango_fechas()):
+        if fecha is None:
+            continue
+        condiciones.append(f"{columna} {operador} %s")
+        parametros.append(fecha)
+
+def condicion_cursor(condiciones, parametros, columna, cursor, descendente=True, columna_id='id'):
+    """Añade la condición de keyset que continúa después de ``cursor``"""
+    posicion = decodificar_cursor(cursor)
+    if posicion is None:
+        return
+    fecha, id = posicion
+    operador = '<' if descendente else '>'
+    condiciones.append(
+        f"({columna} {operador} %s OR ({columna} = %s AND {columna_id} {operador} %s))"
+    )
+    parametros.extend([fecha, fecha, id])
+
+def serializar_fila(fila):
+    """Convierte las fechas de una fila a ISO 8601 para las respuestas JSON"""
+    return {
+        clave: valor.isoformat() if isinstance(valor, datetime) else valor
+        for clave, valor in fila.items()
+    }
+
+# Columnas que muestra incidentes.html (sin la descripción completa)
+COLUMNAS_LISTA_INCIDENTES = """
+    id, titulo, LEFT(descripcion, 100) AS descripcion, tipo, severidad,
+    estado, usuario_reporta, fecha_creacion
+"""
+
+FILTROS_INCIDENTES = (
+    ('tipo', 'tipo'),
+    ('severidad', 'severidad'),
+    ('estado', 'estado'),
+    ('reporta', 'usuario_reporta'),
+)
+
+def consultar_incidentes():
+    """Página de incidentes según los filtros y el cursor de la petición.
+
+    Devuelve (incidentes, cursor_siguiente, filtros) donde ``filtros`` son los
+    parámetros activos, para reconstruir los enlaces de paginación.
+    """
+    condiciones = []
+    parametros = []
+    filtros = {}
+    
+    for clave, columna in FILTROS_INCIDENTES:
+        valor = request.args.get(clave, '').strip()
+        if valor and valor != 'todos':
+            condiciones.append(f"{columna} = %s")
+            parametros.append(valor)
+            filtros[clave] = valor
+    
+    leer_rango_fechas(condiciones, parametros, 'fecha_creacion')
+    for clave in ('desde', 'hasta'):
+        if request.args.get(clave):
+            filtros[clave] = request.args[clave]
+    
+    descendente = request.args.get('orden', 'desc') != 'asc'
+    if not descendente:
+        filtros['orden'] = 'asc'
+    
+    por_pagina = leer_por_pagina(app.config["INCIDENTES_POR_PAGINA"])
+    if por_pagina != app.config["INCIDENTES_POR_PAGINA"]:
+        filtros['por_pagina'] = por_pagina
+    
+    condicion_cursor(condiciones, parametros, 'fecha_creacion',
+                     request.args.get('cursor'), descendente)
+    
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    direccion = 'DESC' if descendente else 'ASC'
+    
+    db = get_db(lectura=True)
+    cursor = db.cursor(dictionary=True)
+    cursor.execute(f"""
+        SELECT {COLUMNAS_LISTA_INCIDENTES}
+        FROM incidentes
+        {where}
+        ORDER BY fecha_creacion {direccion}, id {direccion}
+        LIMIT %s
+    """, (*parametros, por_pagina + 1))
+    incidentes = cursor.fetchall()
+    cursor.close()
+    db.close()
+    
+    siguiente = None
+    if len(incidentes) > por_pagina:
+        incidentes = incidentes[:por_pagina]
+        ultimo = incidentes[-1]
+        siguiente = codificar_cursor(ultimo['fecha_creacion'], ultimo['id'])
+    
+    return incidentes, siguiente, filtros
+
+_tabla_historial = None
+_tabla_historial_verificada = 0.0
+
+def historial_disponible():
+    """Indica si existe la tabla historial (se consulta una vez por proceso)"""
+    global _tabla_historial, _tabla_historial_verificada
+    # Si no existía se vuelve a mirar como mucho una vez por minuto
+    if _tabla_historial or time.time() - _tabla_historial_verificada < 60:
+        return bool(_tabla_historial)
+    
+    db = get_db(lectura=True)
+    cursor = db.cursor()
+    cursor.execute("SHOW TABLES LIKE 'historial'")
+    _tabla_historial = cursor.fetchone() is not None
+    _tabla_historial_verificada = time.time()
+    cursor.close()
+    db.close()
+    return _tabla_historial
+
+_conteos_historial = {}
+
+def contar_historial(where, parametros):
+    """Total de registros de historial, cacheado HISTORIAL_CONTEO_TTL segundos.
+
+    Sin filtros se usa la estimación de filas de information_schema en vez de
+    un COUNT(*) sobre toda la tabla. Devuelve (total, es_aproximado).
+    """
+    clave = (where, tuple(parametros))
+    guardado = _conteos_historial.get(clave)
+    if guardado and guardado[2] > time.time():
+        return guardado[0], guardado[1]
+    
+    db = get_db(lectura=True)
+    cursor = db.cursor()
+    if where:
+        cursor.execute(f"SELECT COUNT(*) FROM historial h {where}", parametros)
+        aproximado = False
+    else:
+        cursor.execute("""
+            SELECT TABLE_ROWS FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'historial'
+        """)
+        aproximado = True
+    fila = cursor.fetchone()
+    total = int(fila[0] or 0) if fila else 0
+    cursor.close()
+    db.close()
+    
+    if len(_conteos_historial) >= 256:
+        _conteos_historial.clear()
+    _conteos_historial[clave] = (total, aproximado, time.time() + app.config["HISTORIAL_CONTEO_TTL"])
+    return total, aproximado
+
+def historial_archivado_pagina(db, cursor, incidente_id, accion, usuario, posicion, cantidad):
+    """Filas archivadas de un incidente que cumplen los filtros de /historial
+    y van después de ``posicion`` (fecha, id); como mucho ``cantidad``"""
+    desde, hasta = rango_fechas()
+    filas = []
+    for fila in archivo_historial.historial_archivado(db, get_almacen(), incidente_id):
+        if len(filas) >= cantidad:
+            break
+        if posicion and (fila['fecha'], fila['id']) >= posicion:
+            continue
+        if (accion and fila['accion'] != accion) or (usuario and not fila['usuario'].startswith(usuario)):
+            continue
+        if (desde and fila['fecha'] < desde) or (hasta and fila['fecha'] >= hasta):
+            continue
+        filas.append(fila)
+    if filas:
+        cursor.execute("SELECT titulo FROM incidentes WHERE id = %s", (incidente_id,))
+        incidente = cursor.fetchone()
+        for fila in filas:
+            fila['incidente_titulo'] = incidente['titulo'] if incidente else None
+    return filas
+
+def consultar_historial():
+    """Página del historial global según los filtros y el cursor de la petición.
+
+    Devuelve (historial, cursor_siguiente, filtros, condiciones, parametros);
+    las condiciones no incluyen el cursor y sirven para contar el total.
+    """
+    condiciones = []
+    parametros = []
+    filtros = {}
+    
+    accion = request.args.get('accion', '').strip()
+    if accion:
+        condiciones.append("h.accion = %s")
+        parametros.append(accion)
+        filtros['accion'] = accion
+    
+    usuario = request.args.get('usuario', '').strip()
+    if usuario:
+        # Búsqueda por prefijo para poder usar el índice de usuario
+        patron = usuario.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        condiciones.append("h.usuario LIKE %s")
+        parametros.append(patron + '%')
+        filtros['usuario'] = usuario
+    
+    incidente = request.args.get('incidente', type=int)
+    if incidente:
+        condiciones.append("h.incidente_id = %s")
+        parametros.append(incidente)
+        filtros['incidente'] = incidente
+    
+    leer_rango_fechas(condiciones, parametros, 'h.fecha')
+    for clave in ('desde', 'hasta'):
+        if request.args.get(clave):
+            filtros[clave] = request.args[clave]
+    
+    por_pagina = leer_por_pagina(app.config["HISTORIAL_POR_PAGINA"])
+    if por_pagina != app.config["HISTORIAL_POR_PAGINA"]:
+        filtros['por_pagina'] = por_pagina
+    
+    condiciones_pagina = list(condiciones)
+    parametros_pagina = list(parametros)
+    condicion_cursor(condiciones_pagina, parametros_pagina, 'h.fecha',
+                     request.args.get('cursor'), columna_id='h.id')
+    where = f"WHERE {' AND '.join(condiciones_pagina)}" if condiciones_pagina else ""
+    
+    db = get_db(lectura=True)
+    cursor = db.cursor(dictionary=True)
+    cursor.execute(f"""
+        SELECT h.*, i.titulo as incidente_titulo, i.id as incidente_id
+        FROM historial h 
+        LEFT JOIN incidentes i ON h.incidente_id = i.id 
+        {where}
+        ORDER BY h.fecha DESC, h.id DESC
+        LIMIT %s
+    """, (*parametros_pagina, por_pagina + 1))
+    historial = cursor.fetchall()
+    
+    if incidente and len(historial) <= por_pagina:
+        # El resto de la página sale de los meses archivados del incidente
+        historial += historial_archivado_pagina(
+            db, cursor, incidente, accion, usuario,
+            decodificar_cursor(request.args.get('cursor')), por_pagina + 1 - len(historial)
+        )
+    cursor.close()
+    db.close()
+    
+    siguiente = None
+    if len(historial) > por_pagina:
+        historial = historial[:por_pagina]
+        ultimo = historial[-1]
+        siguiente = codificar_cursor(ultimo['fecha'], ultimo['id'])
+    
+    return historial, siguiente, filtros, condiciones, parametros
+
+def consultar_busqueda():
+    """Resultados de búsqueda según los parámetros de la petición.
+
+    La relevancia no sirve como cursor estable, así que se pagina por número
+    de página hasta BUSQUEDA_MAX_RESULTADOS. Devuelve
+    (resultados, pagina_siguiente, filtros).
+    """
+    filtros = {}
+    texto = request.args.get('q', '').strip()
+    filtros['q'] = texto
+    
+    tipos = [t for t in request.args.getlist('tipo') if t in busqueda.TIPOS]
+    if tipos:
+        filtros['tipo'] = tipos
+    for clave in ('estado', 'severidad', 'desde', 'hasta'):
+        valor = request.args.get(clave, '').strip()
+        if valor:
+            filtros[clave] = valor
+    
+    fechas = {}
+    for clave, dias in (('desde', 0), ('hasta', 1)):
+        try:
+            fechas[clave] = datetime.strptime(filtros.get(clave, ''), '%Y-%m-%d') + timedelta(days=dias)
+        except ValueError:
+            fechas[clave] = None
+    
+    por_pagina = leer_por_pagina(app.config["BUSQUEDA_POR_PAGINA"])
+    if por_pagina != app.config["BUSQUEDA_POR_PAGINA"]:
+        filtros['por_pagina'] = por_pagina
+    pagina = max(1, request.args.get('pagina', 1, type=int))
+    desplazamiento = (pagina - 1) * por_pagina
+    if not texto or desplazamiento >= app.config["BUSQUEDA_MAX_RESULTADOS"]:
+        return [], None, filtros
+    
+    db = get_db(lectura=True)
+    cursor = db.cursor(dictionary=True)
+    resultados = busqueda.buscar(
+        cursor, texto,
+        tipos=tipos,
+        estado=filtros.get('estado'),
+        severidad=filtros.get('severidad'),
+        desde=fechas['desde'],
+        hasta=fechas['hasta'],
+        limite=por_pagina,
+        desplazamiento=desplazamiento
+    )
+    cursor.close()
+    db.close()
+    
+    siguiente = None
+    if len(resultados) > por_pagina:
+        resultados = resultados[:por_pagina]
+        if desplazamiento + por_pagina < app.config["BUSQUEDA_MAX_RESULTADOS"]:
+            siguiente = pagina + 1
+    
+    return resultados, siguiente, filtros
+
 # ==============================
 # RUTAS PRINCIPALES
 # ==============================
@@ -170,29 +1176,13 @@ def init_database():
 @app.route("/")
 def index():
     try:
-        db = get_db()
-        cursor = db.cursor(dictionary=True)
-        
-        cursor.execute("SELECT COUNT(*) as total FROM incidentes")
-        total = cursor.fetchone()['total']
-        
-        cursor.execute("SELECT COUNT(*) as abiertos FROM incidentes WHERE estado = 'Abierto'")
-        abiertos = cursor.fetchone()['abiertos']
-        
-        cursor.execute("SELECT COUNT(*) as criticos FROM incidentes WHERE severidad = 'critica'")
-        criticos = cursor.fetchone()['criticos']
-        
-        cursor.execute("SELECT COUNT(*) as resueltos FROM incidentes WHERE estado = 'Resuelto'")
-        resueltos = cursor.fetchone()['resueltos']
-        
-        cursor.close()
-        db.close()
+        resumen = get_estadisticas().resumen()
         
         return render_template("index.html",
-                             total=total,
-                             abiertos=abiertos,
-                             criticos=criticos,
-                             resueltos=resueltos)
+                             total=resumen['total'],
+                             abiertos=resumen['abiertos'],
+                             criticos=resumen['criticos'],
+                             resueltos=resumen['resueltos'])
     
     except Exception as e:
         logger.error(f"Error en página principal: {e}")
@@ -202,32 +1192,203 @@ def index():
                              criticos=0,
                              resueltos=0)
 
+@app.route("/api/estadisticas")
+def api_estadisticas():
+    """Conteos de incidentes para el dashboard (consultado por scripts.js)"""
+    try:
+        return jsonify(get_estadisticas().resumen())
+    except Exception as e:
+        logger.error(f"Error obteniendo estadísticas: {e}")
+        return jsonify({'error': 'No se pudieron obtener las estadísticas'}), 500
+
 @app.route("/incidentes")
 def listar_incidentes():
+    estado_filter = request.args.get('estado', 'todos')
     try:
-        db = get_db()
-        cursor = db.cursor(dictionary=True)
-        
-        estado_filter = request.args.get('estado', 'todos')
-        
-        if estado_filter != 'todos':
-            cursor.execute("SELECT * FROM incidentes WHERE estado = %s ORDER BY fecha_creacion DESC", (estado_filter,))
-        else:
-            cursor.execute("SELECT * FROM incidentes ORDER BY fecha_creacion DESC")
-        
-        incidentes = cursor.fetchall()
-        
-        cursor.close()
-        db.close()
+        incidentes, siguiente, filtros = consultar_incidentes()
         
         return render_template("incidentes.html", 
                              incidentes=incidentes,
-                             estado_filter=estado_filter)
+                             estado_filter=estado_filter,
+                             filtros=filtros,
+                             siguiente=siguiente,
+                             es_primera=not request.args.get('cursor'))
     
     except Exception as e:
         logger.error(f"Error listando incidentes: {e}")
         flash("Error al cargar los incidentes", "danger")
-        return render_template("incidentes.html", incidentes=[])
+        return render_template("incidentes.html", incidentes=[], estado_filter=estado_filter,
+                               filtros={}, siguiente=None, es_primera=True)
+
+@app.route("/api/incidentes")
+def api_incidentes():
+    """Lista paginada de incidentes en JSON (mismos filtros que /incidentes)"""
+    try:
+        incidentes, siguiente, filtros = consultar_incidentes()
+        return jsonify({
+            'incidentes': [serializar_fila(i) for i in incidentes],
+            'siguiente': siguiente,
+            'filtros': filtros
+        })
+    except Exception as e:
+        logger.error(f"Error listando incidentes (API): {e}")
+        return jsonify({'error': 'No se pudieron obtener los incidentes'}), 500
+
+@app.route("/buscar")
+def buscar():
+    """Búsqueda de texto completo en incidentes, evidencias y comentarios"""
+    try:
+        resultados, siguiente, filtros = consultar_busqueda()
+        return render_template(
+            "buscar.html",
+            resultados=resultados,
+            siguiente=siguiente,
+            pagina=request.args.get('pagina', 1, type=int),
+            filtros=filtros
+        )
+    except Exception as e:
+        logger.error(f"Error en la búsqueda: {e}")
+        flash("Error al realizar la búsqueda", "danger")
+        return render_template("buscar.html", resultados=[], siguiente=None, pagina=1,
+                               filtros={'q': request.args.get('q', '')})
+
+@app.route("/api/buscar")
+def api_buscar():
+    """Búsqueda en JSON (mismos parámetros que /buscar)"""
+    try:
+        resultados, siguiente, filtros = consultar_busqueda()
+        return jsonify({
+            'resultados': [serializar_fila(r) for r in resultados],
+            'siguiente': siguiente,
+            'filtros': filtros
+        })
+    except Exception as e:
+        logger.error(f"Error en la búsqueda (API): {e}")
+        return jsonify({'error': 'No se pudo realizar la búsqueda'}), 500
+
+def consultar_indicador():
+    """Incidentes cuyas evidencias contienen el indicador pedido en ``valor``"""
+    valor = request.args.get('valor', '').strip()
+    tipo = request.args.get('tipo', '').strip()
+    filtros = {'valor': valor}
+    if not valor:
+        return [], filtros
+    if not valor.lower().startswith(('http://', 'https://')):
+        valor = valor.lower()
+    
+    condiciones = ["ind.valor = %s"]
+    parametros = [valor[:indicadores.MAX_VALOR]]
+    if tipo in indicadores.TIPOS:
+        condiciones.append("ind.tipo = %s")
+        parametros.append(tipo)
+        filtros['tipo'] = tipo
+    
+    db = get_db()
+    cursor = db.cursor(dictionary=True)
+    cursor.execute(f"""
+        SELECT i.id, i.titulo, i.estado, i.severidad, i.fecha_creacion, ind.tipo,
+               COUNT(DISTINCT e.id) AS evidencias,
+               CAST(SUM(ind.apariciones) AS UNSIGNED) AS apariciones
+        FROM indicadores ind
+        JOIN evidencias e ON e.sha256 = ind.sha256
+        JOIN incidentes i ON i.id = e.incidente_id
+        WHERE {' AND '.join(condiciones)}
+        GROUP BY i.id, ind.tipo
+        ORDER BY i.fecha_creacion DESC
+        LIMIT %s
+    """, (*parametros, app.config["MAX_POR_PAGINA"]))
+    incidentes = cursor.fetchall()
+    cursor.close()
+    db.close()
+    return incidentes, filtros
+
+@app.route("/indicadores")
+def buscar_indicador():
+    """Qué incidentes mencionan una IP, dominio, URL, hash o correo"""
+    try:
+        incidentes, filtros = consultar_indicador()
+    except Exception as e:
+        logger.error(f"Error buscando indicador: {e}")
+        flash("Error al buscar el indicador", "danger")
+        incidentes, filtros = [], {'valor': request.args.get('valor', '')}
+    return render_template("indicadores.html", incidentes=incidentes, filtros=filtros,
+                           tipos=indicadores.TIPOS)
+
+@app.route("/api/indicadores")
+def api_indicadores():
+    """Incidentes que mencionan un indicador, en JSON"""
+    try:
+        incidentes, filtros = consultar_indicador()
+        return jsonify({
+            'incidentes': [serializar_fila(i) for i in incidentes],
+            'filtros': filtros
+        })
+    except Exception as e:
+        logger.error(f"Error buscando indicador (API): {e}")
+        return jsonify({'error': 'No se pudo buscar el indicador'}), 500
+
+@app.route("/api/incidentes/<int:incidente_id>/indicadores")
+def api_indicadores_incidente(incidente_id):
+    """Indicadores extraídos de las evidencias de un incidente"""
+    try:
+        db = get_db()
+        cursor = db.cursor(dictionary=True)
+        cursor.execute("""
+            SELECT ind.tipo, ind.valor, CAST(SUM(ind.apariciones) AS UNSIGNED) AS apariciones
+            FROM evidencias e
+            JOIN indicadores ind ON ind.sha256 = e.sha256
+            WHERE e.incidente_id = %s
+            GROUP BY ind.tipo, ind.valor
+            ORDER BY apariciones DESC
+            LIMIT %s
+        """, (incidente_id, app.config["MAX_POR_PAGINA"]))
+        filas = cursor.fetchall()
+        cursor.close()
+        db.close()
+        return jsonify({'indicadores': [serializar_fila(f) for f in filas]})
+    except Exception as e:
+        logger.error(f"Error obteniendo indicadores del incidente {incidente_id}: {e}")
+        return jsonify({'error': 'No se pudieron obtener los indicadores'}), 500
+
+@app.route("/api/incidentes/lote", methods=["POST"])
+def importar_incidentes_api():
+    """Alta masiva de incidentes.
+
+    Acepta una lista JSON, un objeto {"incidentes": [...]} o NDJSON (un
+    incidente por línea). Devuelve un resultado por registro con su 'id' o
+    su 'error'; con ?resultados=errores solo se devuelven los fallidos.
+    """
+    try:
+        db = get_db()
+        resultados, creados = ingesta.importar(
+            db, ingesta.leer_registros(request.stream), get_current_user(),
+            tamano_lote=app.config["INGESTA_TAMANO_LOTE"],
+            ventana=app.config["CORRELACION_VENTANA"]
+        )
+        db.close()
+    except ingesta.RegistroInvalido as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error en la importación de incidentes: {e}")
+        return jsonify({'error': 'Error al importar los incidentes'}), 500
+    
+    for (estado, severidad), cantidad in creados.items():
+        get_estadisticas().incidente_creado(estado, severidad, cantidad)
+    # La fusión ya subió la versión de esos incidentes en la base de datos
+    for incidente_id in {r['id'] for r in resultados if r.get('fusionado')}:
+        get_cache_detalle().invalidar(incidente_id)
+        publicar_evento('incidente', incidente_id, repeticion=True)
+    if creados:
+        publicar_estadisticas()
+    
+    resumen = {
+        'creados': sum(creados.values()),
+        'fusionados': sum(1 for r in resultados if r.get('fusionado')),
+        'errores': sum(1 for r in resultados if 'error' in r)
+    }
+    if request.args.get('resultados') == 'errores':
+        resultados = [r for r in resultados if 'error' in r]
+    return jsonify(dict(resumen, resultados=resultados))
 
 @app.route("/incidentes/nuevo")
 def nuevo_incidente():
@@ -245,28 +1406,61 @@ def crear_incidente():
         db = get_db()
         cursor = db.cursor()
         
-        sql_incidente = """
-            INSERT INTO incidentes
-            (titulo, descripcion, tipo, severidad, usuario_reporta)
-            VALUES (%s, %s, %s, %s, %s)
-        """
-        
-        cursor.execute(sql_incidente, (
-            data["titulo"],
-            data["descripcion"],
-            data["tipo"],
-            data["severidad"],
-            data.get("usuario_reporta", "Anónimo")
-        ))
-        
-        incidente_id = cursor.lastrowid
-        
-        # Registrar en historial
-        registrar_historial(
-            incidente_id=incidente_id,
-            accion="CREACION",
-            descripcion=f"Incidente creado: {data['titulo']}"
-        )
+        usuario_reporta = data.get("usuario_reporta", "Anónimo")
+        huella = correlacion.huella(data["titulo"], data["tipo"], usuario_reporta, data["descripcion"])
+        
+        # Una alerta repetida se fusiona con el incidente abierto que ya la
+        # recoge. La búsqueda y el alta van con la huella bloqueada y en una
+        # transacción: dos alertas iguales a la vez no abren dos incidentes
+        ventana = app.config["CORRELACION_VENTANA"]
+        bloqueadas = correlacion.bloquear(cursor, [huella]) if ventana > 0 else []
+        try:
+            db.start_transaction()
+            coincidencias = correlacion.buscar_abiertos(cursor, [huella], ventana)
+            fusionado = huella in coincidencias
+            
+            if fusionado:
+                incidente_id = coincidencias[huella]
+                escaladas = correlacion.fusionar(
+                    cursor, {incidente_id: (1, data["titulo"], data["severidad"])}, get_current_user())
+            else:
+                sql_incidente = """
+                    INSERT INTO incidentes
+                    (titulo, descripcion, tipo, severidad, usuario_reporta, huella)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                """
+                
+                cursor.execute(sql_incidente, (
+                    data["titulo"],
+                    data["descripcion"],
+                    data["tipo"],
+                    data["severidad"],
+                    usuario_reporta,
+                    huella
+                ))
+                
+                incidente_id = cursor.lastrowid
+                busqueda.indexar(cursor, 'incidente', incidente_id, incidente_id,
+                                 data["titulo"], data["descripcion"])
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            correlacion.liberar(cursor, bloqueadas)
+        
+        if fusionado:
+            for estado, anterior, nueva in escaladas:
+                get_estadisticas().severidad_cambiada(estado, anterior, nueva)
+        else:
+            get_estadisticas().incidente_creado('Abierto', data["severidad"])
+            
+            # Registrar en historial
+            registrar_historial(
+                incidente_id=incidente_id,
+                accion="CREACION",
+                descripcion=f"Incidente creado: {data['titulo']}"
+            )
         
         uploaded_files = 0
         
@@ -289,28 +1483,9 @@ def crear_incidente():
                         flash(f'Archivo "{filename}" es muy grande (máx 16MB)', 'warning')
                         continue
                     
-                    incidente_folder = os.path.join(app.config["UPLOAD_FOLDER"], str(incidente_id))
-                    os.makedirs(incidente_folder, exist_ok=True)
-                    
-                    unique_filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{filename}"
-                    ruta = os.path.join(incidente_folder, unique_filename)
-                    file.save(ruta)
-                    
-                    tipo_archivo = 'imagen' if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')) else 'documento'
-                    
-                    sql_evidencia = """
-                        INSERT INTO evidencias
-                        (incidente_id, nombre_archivo, tipo_archivo, ruta, tamano)
-                        VALUES (%s, %s, %s, %s, %s)
-                    """
-                    
-                    cursor.execute(sql_evidencia, (
-                        incidente_id,
-                        filename,
-                        tipo_archivo,
-                        ruta,
-                        os.path.getsize(ruta)
-                    ))
+                    # Se guarda por contenido: un archivo repetido no ocupa disco dos veces
+                    temporal, sha256, file_size = get_almacen().recibir(file.stream)
+                    agregar_evidencia(cursor, incidente_id, filename, temporal, sha256, file_size)
                     
                     uploaded_files += 1
         
@@ -318,7 +1493,21 @@ def crear_incidente():
         cursor.close()
         db.close()
         
-        if uploaded_files > 0:
+        if fusionado:
+            # fusionar ya subió la versión en la base de datos
+            get_cache_detalle().invalidar(incidente_id)
+            publicar_evento('incidente', incidente_id, repeticion=True)
+            if escaladas:
+                publicar_estadisticas()
+        else:
+            publicar_evento('incidente', incidente_id, creado=True, titulo=data["titulo"],
+                            severidad=data["severidad"])
+            publicar_estadisticas()
+        
+        if fusionado:
+            flash(f'🔗 Alerta repetida: se ha añadido al incidente abierto #{incidente_id}'
+                  + (f' con {uploaded_files} archivo(s)' if uploaded_files else ''), 'info')
+        elif uploaded_files > 0:
             flash(f'✅ Incidente creado con {uploaded_files} archivo(s)', 'success')
         else:
             flash('✅ Incidente creado sin archivos adjuntos', 'info')
@@ -332,46 +1521,102 @@ def crear_incidente():
 
 @app.route("/incidentes/<int:id>")
 def detalle_incidente(id):
+    """Detalle de un incidente; el cuerpo sale de la caché mientras no cambie su versión"""
     try:
-        db = get_db()
-        cursor = db.cursor(dictionary=True)
-        
-        # Obtener incidente
-        cursor.execute("SELECT * FROM incidentes WHERE id = %s", (id,))
-        incidente = cursor.fetchone()
-        
-        if not incidente:
-            flash("Incidente no encontrado", "danger")
-            return redirect(url_for('listar_incidentes'))
-        
-        # Obtener evidencias
-        cursor.execute("SELECT * FROM evidencias WHERE incidente_id = %s", (id,))
-        evidencias = cursor.fetchall()
+        cache = get_cache_detalle()
+        entrada = cache.obtener(id, lambda: version_incidente(id))
+        if entrada is None:
+            entrada = cargar_detalle(id, cache)
+            if entrada is None:
+                flash("Incidente no encontrado", "danger")
+                return redirect(url_for('listar_incidentes'))
         
-        # Obtener historial del incidente
-        cursor.execute("""
-            SELECT * FROM historial 
-            WHERE incidente_id = %s 
-            ORDER BY fecha DESC
-            LIMIT 20
-        """, (id,))
-        historial = cursor.fetchall()
+        contenido = completar_detalle(entrada['html'], linea_tiempo(id))
         
-        cursor.close()
-        db.close()
-        
-        return render_template(
-            "detalle.html",
-            incidente=incidente,
-            evidencias=evidencias,
-            historial=historial
-        )
+        return render_template("detalle.html", incidente_id=id, contenido=Markup(contenido))
     
     except Exception as e:
         logger.error(f"Error obteniendo incidente {id}: {e}")
         flash("Error al cargar el incidente", "danger")
         return redirect(url_for('listar_incidentes'))
 
+# Huecos de detalle_contenido.html que se rellenan con detalle_historial.html
+HUECOS_HISTORIAL = ('cuenta', 'linea_tiempo', 'ultima_actividad')
+
+def linea_tiempo(id):
+    """Partes del detalle que dependen del historial (los 20 últimos
+    registros, archivados incluidos), desde su caché si está vigente"""
+    cache = get_cache_linea_tiempo()
+    partes = cache.obtener(id, lambda: 0)
+    if partes is None:
+        db = get_db()
+        historial = archivo_historial.historial_incidente(db, get_almacen(), id, limite=20)
+        db.close()
+        partes = {hueco: str(get_template_attribute("detalle_historial.html", hueco)(historial))
+                  for hueco in HUECOS_HISTORIAL}
+        cache.guardar(id, 0, partes)
+    return partes
+
+def completar_detalle(html, partes):
+    """Pone en el cuerpo cacheado las partes que dependen del historial"""
+    for hueco in HUECOS_HISTORIAL:
+        html = html.replace(f"<!--historial:{hueco}-->", partes[hueco], 1)
+    return html
+
+def cargar_detalle(id, cache):
+    """Consulta y renderiza el cuerpo del detalle; None si el incidente no existe"""
+    db = get_db()
+    cursor = db.cursor(dictionary=True)
+    
+    # Obtener incidente
+    cursor.execute("SELECT * FROM incidentes WHERE id = %s", (id,))
+    incidente = cursor.fetchone()
+    
+    if not incidente:
+        cursor.close()
+        db.close()
+        return None
+    
+    # Obtener evidencias
+    cursor.execute("SELECT * FROM evidencias WHERE incidente_id = %s", (id,))
+    evidencias = cursor.fetchall()
+    
+    # Resúmenes de las capturas de red (por contenido)
+    cursor.execute("""
+        SELECT DISTINCT r.sha256, r.estado, r.resumen
+        FROM resumenes_captura r
+        JOIN evidencias e ON e.sha256 = r.sha256
+        WHERE e.incidente_id = %s
+    """, (id,))
+    resumenes_captura = {}
+    for fila in cursor.fetchall():
+        fila['resumen'] = json.loads(fila['resumen']) if fila['resumen'] else None
+        fila['periodo'] = None
+        if fila['resumen'] and fila['resumen']['inicio'] is not None:
+            fila['periodo'] = (datetime.fromtimestamp(fila['resumen']['inicio']),
+                               datetime.fromtimestamp(fila['resumen']['fin']))
+        resumenes_captura[fila['sha256']] = fila
+    
+    cursor.close()
+    db.close()
+    
+    # Imágenes y documentos se separan una vez aquí y no en cada render de la plantilla
+    imagenes = [e for e in evidencias if e['tipo_archivo'] == 'imagen']
+    documentos = [e for e in evidencias if e['tipo_archivo'] != 'imagen']
+    
+    entrada = {'html': render_template(
+        "detalle_contenido.html",
+        incidente=incidente,
+        evidencias=evidencias,
+        imagenes=imagenes,
+        documentos=documentos,
+        resumenes_captura=resumenes_captura
+    )}
+    
+    # El resumen de una captura que cambia de estado sube la versión (capturas.trabajar)
+    cache.guardar(id, incidente.get('version', 0), entrada)
+    return entrada
+
 @app.route("/incidentes/<int:id>/cambiar-estado", methods=["POST"])
 def cambiar_estado(id):
     try:
@@ -385,7 +1630,7 @@ def cambiar_estado(id):
         cursor = db.cursor(dictionary=True)
         
         # Obtener estado actual
-        cursor.execute("SELECT estado FROM incidentes WHERE id = %s", (id,))
+        cursor.execute("SELECT estado, severidad FROM incidentes WHERE id = %s", (id,))
         resultado = cursor.fetchone()
         estado_actual = resultado['estado'] if resultado else 'Desconocido'
         
@@ -395,6 +1640,9 @@ def cambiar_estado(id):
             (nuevo_estado, id)
         )
         
+        if resultado:
+            get_estadisticas().estado_cambiado(estado_actual, nuevo_estado, resultado['severidad'])
+        
         db.commit()
         cursor.close()
         db.close()
@@ -405,6 +1653,8 @@ def cambiar_estado(id):
             accion="CAMBIO_ESTADO",
             descripcion=f"Estado cambiado de '{estado_actual}' a '{nuevo_estado}'"
         )
+        incidente_modificado(id, estado=nuevo_estado)
+        publicar_estadisticas()
         
         flash(f'✅ Estado cambiado a {nuevo_estado}', 'success')
         return redirect(url_for('detalle_incidente', id=id))
@@ -421,12 +1671,12 @@ def eliminar_incidente(id):
         cursor = db.cursor(dictionary=True)
         
         # Obtener información del incidente
-        cursor.execute("SELECT titulo FROM incidentes WHERE id = %s", (id,))
+        cursor.execute("SELECT titulo, estado, severidad FROM incidentes WHERE id = %s", (id,))
         incidente = cursor.fetchone()
         titulo_incidente = incidente['titulo'] if incidente else 'Desconocido'
         
         # Obtener evidencias para eliminar archivos
-        cursor.execute("SELECT ruta FROM evidencias WHERE incidente_id = %s", (id,))
+        cursor.execute("SELECT ruta, sha256 FROM evidencias WHERE incidente_id = %s", (id,))
         evidencias = cursor.fetchall()
         
         # Registrar en historial
@@ -436,13 +1686,23 @@ def eliminar_incidente(id):
             descripcion=f"Incidente eliminado: {titulo_incidente}"
         )
         
-        # Eliminar archivos físicos
+        # Eliminar de la base de datos (las evidencias caen en cascada; el
+        # historial se borra aquí porque particionado ya no tiene clave foránea)
+        cursor.execute("DELETE FROM historial WHERE incidente_id = %s", (id,))
+        cursor.execute("DELETE FROM historial_archivo_bloques WHERE incidente_id = %s", (id,))
+        cursor.execute("DELETE FROM incidentes WHERE id = %s", (id,))
+        
+        if incidente and cursor.rowcount:
+            get_estadisticas().incidente_eliminado(incidente['estado'], incidente['severidad'])
+        
+        db.commit()
+        get_cache_detalle().invalidar(id)
+        publicar_evento('incidente', id, eliminado=True)
+        publicar_estadisticas()
+        
+        # Liberar archivos: los blobs solo se borran si ya nadie los usa
         for evidencia in evidencias:
-            if evidencia['ruta'] and os.path.exists(evidencia['ruta']):
-                try:
-                    os.remove(evidencia['ruta'])
-                except Exception as e:
-                    logger.error(f"Error eliminando archivo: {e}")
+            eliminar_archivo_evidencia(evidencia)
         
         # Eliminar carpeta del incidente
         incidente_folder = os.path.join(app.config["UPLOAD_FOLDER"], str(id))
@@ -453,10 +1713,6 @@ def eliminar_incidente(id):
             except Exception as e:
                 logger.warning(f"No se pudo eliminar carpeta: {e}")
         
-        # Eliminar de la base de datos
-        cursor.execute("DELETE FROM incidentes WHERE id = %s", (id,))
-        
-        db.commit()
         cursor.close()
         db.close()
         
@@ -493,19 +1749,17 @@ def eliminar_evidencia(id):
             descripcion=f"Archivo eliminado: {nombre_archivo}"
         )
         
-        # Eliminar archivo físico
-        if evidencia['ruta'] and os.path.exists(evidencia['ruta']):
-            try:
-                os.remove(evidencia['ruta'])
-            except Exception as e:
-                logger.error(f"Error eliminando archivo: {e}")
-        
         # Eliminar de la base de datos
         cursor.execute("DELETE FROM evidencias WHERE id = %s", (id,))
+        busqueda.desindexar(cursor, 'evidencia', id)
         
         db.commit()
+        
+        # Eliminar archivo físico (o solo la referencia si otro lo comparte)
+        eliminar_archivo_evidencia(evidencia)
         cursor.close()
         db.close()
+        incidente_modificado(incidente_id)
         
         flash('✅ Evidencia eliminada correctamente', 'success')
         return redirect(url_for('detalle_incidente', id=incidente_id))
@@ -532,6 +1786,13 @@ def agregar_comentario(incidente_id):
             accion="COMENTARIO",
             descripcion=comentario
         ):
+            db = get_db()
+            cursor = db.cursor()
+            busqueda.indexar(cursor, 'comentario', None, incidente_id, '', comentario)
+            db.commit()
+            cursor.close()
+            db.close()
+            incidente_modificado(incidente_id)
             flash('✅ Comentario agregado al historial', 'success')
         else:
             flash('⚠️ Comentario guardado, pero error en historial', 'warning')
@@ -543,13 +1804,150 @@ def agregar_comentario(incidente_id):
         flash("Error al agregar comentario", "danger")
         return redirect(url_for('detalle_incidente', id=incidente_id))
 
+# ==============================
+# API DE SUBIDA POR FRAGMENTOS
+# ==============================
+
+_gestor_subidas = None
+
+def get_gestor_subidas():
+    global _gestor_subidas
+    if _gestor_subidas is None:
+        _gestor_subidas = GestorSubidas(
+            app.config["UPLOAD_FOLDER"],
+            tamano_bloque=app.config["SUBIDA_TAMANO_BLOQUE"],
+            tamano_maximo=app.config["SUBIDA_TAMANO_MAXIMO"]
+        )
+    return _gestor_subidas
+
+def _error_subida(e):
+    """Respuesta JSON para los errores del protocolo de subida"""
+    if isinstance(e, SubidaNoEncontrada):
+        return jsonify({'error': 'Subida no encontrada'}), 404
+    return jsonify({'error': str(e), 'recibido': e.recibido}), 409
+
+@app.route("/api/incidentes/<int:incidente_id>/subidas", methods=["POST"])
+def iniciar_subida(incidente_id):
+    """Inicia una subida por fragmentos: {"nombre": ..., "tamano": ...}"""
+    datos = request.get_json(silent=True) or {}
+    filename = secure_filename(datos.get('nombre') or '')
+    tamano = datos.get('tamano')
+    
+    if not filename or not allowed_file(filename):
+        return jsonify({'error': f'Archivo "{filename}" no permitido'}), 400
+    if not isinstance(tamano, int):
+        return jsonify({'error': 'Tamaño de archivo no válido'}), 400
+    
+    try:
+        db = get_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT id FROM incidentes WHERE id = %s", (incidente_id,))
+        existe = cursor.fetchone() is not None
+        cursor.close()
+        db.close()
+        
+        if not existe:
+            return jsonify({'error': 'Incidente no encontrado'}), 404
+        
+        return jsonify(get_gestor_subidas().crear(incidente_id, filename, tamano)), 201
+    
+    except SubidaInvalida as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error iniciando subida: {e}")
+        return jsonify({'error': 'Error al iniciar la subida'}), 500
+
+@app.route("/api/subidas/<subida_id>", methods=["GET"])
+def estado_subida(subida_id):
+    """Estado de una subida; 'recibido' indica desde dónde reanudar"""
+    try:
+        return jsonify(get_gestor_subidas().estado(subida_id))
+    except SubidaNoEncontrada as e:
+        return _error_subida(e)
+
+@app.route("/api/subidas/<subida_id>", methods=["PUT"])
+def subir_fragmento(subida_id):
+    """Recibe un fragmento (cabecera Content-Range o parámetro ?inicio=)"""
+    rango = request.headers.get('Content-Range', '')
+    if rango:
+        coincidencia = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)$', rango.strip())
+        if not coincidencia:
+            return jsonify({'error': 'Content-Range no válido'}), 400
+        inicio = int(coincidencia.group(1))
+        longitud = int(coincidencia.group(2)) - inicio + 1
+    else:
+        inicio = request.args.get('inicio', 0, type=int)
+        longitud = request.content_length
+    
+    try:
+        # Se lee el cuerpo directamente del socket, sin cargarlo en memoria
+        return jsonify(get_gestor_subidas().escribir(subida_id, inicio, request.stream, longitud))
+    except (SubidaNoEncontrada, SubidaInvalida) as e:
+        return _error_subida(e)
+    except Exception as e:
+        logger.error(f"Error recibiendo fragmento de {subida_id}: {e}")
+        return jsonify({'error': 'Error al recibir el fragmento'}), 500
+
+@app.route("/api/subidas/<subida_id>/finalizar", methods=["POST"])
+def finalizar_subida(subida_id):
+    """Completa la subida y registra la evidencia ({"sha256": ...} opcional)"""
+    datos = request.get_json(silent=True) or {}
+    gestor = get_gestor_subidas()
+    
+    try:
+        estado = gestor.estado(subida_id)
+        incidente_id = estado['incidente_id']
+        filename = estado['nombre']
+        
+        temporal = get_almacen().ruta_temporal()
+        meta, sha256 = gestor.finalizar(subida_id, temporal, datos.get('sha256'))
+        
+        db = get_db()
+        cursor = db.cursor()
+        evidencia_id = agregar_evidencia(cursor, incidente_id, filename, temporal, sha256, meta['tamano'])
+        db.commit()
+        cursor.close()
+        db.close()
+        
+        registrar_historial(
+            incidente_id=incidente_id,
+            accion="EVIDENCIA_AGREGADA",
+            descripcion=f"Archivo agregado: {filename}"
+        )
+        incidente_modificado(incidente_id)
+        
+        return jsonify({
+            'evidencia_id': evidencia_id,
+            'incidente_id': incidente_id,
+            'nombre': filename,
+            'tamano': meta['tamano'],
+            'sha256': sha256
+        }), 201
+    
+    except (SubidaNoEncontrada, SubidaInvalida) as e:
+        return _error_subida(e)
+    except Exception as e:
+        logger.error(f"Error finalizando subida {subida_id}: {e}")
+        return jsonify({'error': 'Error al finalizar la subida'}), 500
+
+@app.route("/api/subidas/<subida_id>", methods=["DELETE"])
+def cancelar_subida(subida_id):
+    try:
+        get_gestor_subidas().cancelar(subida_id)
+        return '', 204
+    except SubidaNoEncontrada as e:
+        return _error_subida(e)
+
 @app.route("/descargar/<int:evidencia_id>")
 def descargar_evidencia(evidencia_id):
     try:
         db = get_db()
         cursor = db.cursor(dictionary=True)
         
-        cursor.execute("SELECT * FROM evidencias WHERE id = %s", (evidencia_id,))
+        cursor.execute("""
+            SELECT id, incidente_id, nombre_archivo, tipo_archivo, ruta, sha256, fecha_subida
+            FROM evidencias WHERE id = %s
+        """, (evidencia_id,))
         evidencia = cursor.fetchone()
         
         cursor.close()
@@ -559,20 +1957,16 @@ def descargar_evidencia(evidencia_id):
             flash("Archivo no encontrado", "danger")
             return redirect(request.referrer or url_for('index'))
         
-        if os.path.exists(evidencia['ruta']):
-            # Registrar descarga en historial
-            registrar_historial(
-                incidente_id=evidencia['incidente_id'],
-                accion="DESCARGA_EVIDENCIA",
-                descripcion=f"Archivo descargado: {evidencia['nombre_archivo']}"
-            )
-            
-            directory = os.path.dirname(evidencia['ruta'])
-            filename = os.path.basename(evidencia['ruta'])
-            return send_from_directory(directory, filename, as_attachment=True, download_name=evidencia['nombre_archivo'])
-        else:
+        respuesta = enviar_evidencia(
+            evidencia,
+            adjunto=True,
+            accion="DESCARGA_EVIDENCIA",
+            descripcion=f"Archivo descargado: {evidencia['nombre_archivo']}"
+        )
+        if respuesta is None:
             flash("El archivo no existe en el servidor", "danger")
             return redirect(request.referrer or url_for('index'))
+        return respuesta
     
     except Exception as e:
         logger.error(f"Error descargando archivo: {e}")
@@ -582,52 +1976,57 @@ def descargar_evidencia(evidencia_id):
 @app.route("/historial")
 def ver_historial_completo():
     """Página para ver todo el historial del sistema"""
+    vacio = dict(historial=[], filtros={}, siguiente=None, es_primera=True,
+                 total=0, total_aproximado=False)
     try:
-        db = get_db()
-        cursor = db.cursor(dictionary=True)
-        
-        # Verificar si la tabla historial existe
-        cursor.execute("SHOW TABLES LIKE 'historial'")
-        if not cursor.fetchone():
+        if not historial_disponible():
             flash("La tabla de historial no está disponible", "warning")
-            return render_template("historial.html", historial=[], page=1, total_pages=0, total=0)
+            return render_template("historial.html", **vacio)
         
-        # Paginación
-        page = request.args.get('page', 1, type=int)
-        items_per_page = 20
-        offset = (page - 1) * items_per_page
+        historial, siguiente, filtros, condiciones, parametros = consultar_historial()
         
-        # Obtener historial
-        cursor.execute("""
-            SELECT h.*, i.titulo as incidente_titulo, i.id as incidente_id
-            FROM historial h 
-            LEFT JOIN incidentes i ON h.incidente_id = i.id 
-            ORDER BY h.fecha DESC 
-            LIMIT %s OFFSET %s
-        """, (items_per_page, offset))
-        
-        historial = cursor.fetchall()
-        
-        # Contar total de registros
-        cursor.execute("SELECT COUNT(*) as total FROM historial")
-        total = cursor.fetchone()['total']
-        total_pages = (total + items_per_page - 1) // items_per_page
-        
-        cursor.close()
-        db.close()
+        where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+        total, total_aproximado = contar_historial(where, parametros)
+        if 'incidente' in filtros:
+            # Más las filas archivadas del incidente (sin aplicarles el resto de filtros)
+            db = get_db(lectura=True)
+            archivadas = archivo_historial.contar_archivado(db, filtros['incidente'])
+            db.close()
+            if archivadas:
+                total += archivadas
+                total_aproximado = total_aproximado or len(condiciones) > 1
         
         return render_template(
             "historial.html",
             historial=historial,
-            page=page,
-            total_pages=total_pages,
-            total=total
+            filtros=filtros,
+            siguiente=siguiente,
+            es_primera=not request.args.get('cursor'),
+            total=total,
+            total_aproximado=total_aproximado
         )
     
     except Exception as e:
         logger.error(f"Error obteniendo historial: {e}")
         flash("Error al cargar el historial", "danger")
-        return render_template("historial.html", historial=[], page=1, total_pages=0, total=0)
+        return render_template("historial.html", **vacio)
+
+@app.route("/api/historial")
+def api_historial():
+    """Historial global paginado en JSON (mismos filtros que /historial)"""
+    try:
+        if not historial_disponible():
+            return jsonify({'historial': [], 'siguiente': None, 'filtros': {}})
+        
+        historial, siguiente, filtros, _, _ = consultar_historial()
+        return jsonify({
+            'historial': [serializar_fila(h) for h in historial],
+            'siguiente': siguiente,
+            'filtros': filtros
+        })
+    except Exception as e:
+        logger.error(f"Error obteniendo historial (API): {e}")
+        return jsonify({'error': 'No se pudo obtener el historial'}), 500
     
 @app.route("/incidentes/<int:incidente_id>/evidencias/agregar", methods=["POST"])
 def agregar_evidencias(incidente_id):
@@ -661,33 +2060,9 @@ def agregar_evidencias(incidente_id):
                         flash(f'Archivo "{filename}" es muy grande (máx 16MB)', 'warning')
                         continue
                     
-                    incidente_folder = os.path.join(app.config["UPLOAD_FOLDER"], str(incidente_id))
-                    os.makedirs(incidente_folder, exist_ok=True)
-                    
-                    unique_filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{filename}"
-                    ruta = os.path.join(incidente_folder, unique_filename)
-                    file.save(ruta)
-                    
-                    # Determinar tipo de archivo
-                    extension = filename.lower().split('.')[-1]
-                    if extension in ['png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp']:
-                        tipo_archivo = 'imagen'
-                    else:
-                        tipo_archivo = 'documento'
-                    
-                    sql_evidencia = """
-                        INSERT INTO evidencias
-                        (incidente_id, nombre_archivo, tipo_archivo, ruta, tamano)
-                        VALUES (%s, %s, %s, %s, %s)
-                    """
-                    
-                    cursor.execute(sql_evidencia, (
-                        incidente_id,
-                        filename,
-                        tipo_archivo,
-                        ruta,
-                        os.path.getsize(ruta)
-                    ))
+                    # Se guarda por contenido: un archivo repetido no ocupa disco dos veces
+                    temporal, sha256, file_size = get_almacen().recibir(file.stream)
+                    agregar_evidencia(cursor, incidente_id, filename, temporal, sha256, file_size)
                     
                     uploaded_files += 1
                     
@@ -703,6 +2078,7 @@ def agregar_evidencias(incidente_id):
             db.close()
             
             if uploaded_files > 0:
+                incidente_modificado(incidente_id)
                 flash(f'✅ {uploaded_files} archivo(s) agregado(s)', 'success')
             else:
                 flash('❌ No se pudieron agregar los archivos', 'warning')
@@ -721,64 +2097,131 @@ def ver_imagen(evidencia_id):
         db = get_db()
         cursor = db.cursor(dictionary=True)
         
-        cursor.execute("SELECT * FROM evidencias WHERE id = %s", (evidencia_id,))
+        cursor.execute("""
+            SELECT id, incidente_id, nombre_archivo, tipo_archivo, ruta, sha256, fecha_subida
+            FROM evidencias WHERE id = %s
+        """, (evidencia_id,))
         evidencia = cursor.fetchone()
         
         cursor.close()
         db.close()
-        
-        if not evidencia or not evidencia['ruta']:
-            abort(404, "Imagen no encontrada")
-        
-        # Verificar que sea una imagen
-        if evidencia['tipo_archivo'] != 'imagen':
-            abort(400, "No es una imagen válida")
-        
-        if not os.path.exists(evidencia['ruta']):
-            abort(404, "Archivo no encontrado en el servidor")
-        
-        # Registrar visualización en historial
-        registrar_historial(
-            incidente_id=evidencia['incidente_id'],
-            accion="VISUALIZACION_IMAGEN",
-            descripcion=f"Imagen visualizada: {evidencia['nombre_archivo']}"
-        )
-        
-        return send_file(evidencia['ruta'], mimetype=f'image/{evidencia["nombre_archivo"].split(".")[-1]}')
-    
     except Exception as e:
         logger.error(f"Error mostrando imagen: {e}")
         abort(404, f"Error al mostrar la imagen: {str(e)}")
+    
+    if not evidencia or not evidencia['ruta']:
+        abort(404, "Imagen no encontrada")
+    
+    # Verificar que sea una imagen
+    if evidencia['tipo_archivo'] != 'imagen':
+        abort(400, "No es una imagen válida")
+    
+    respuesta = enviar_evidencia(
+        evidencia,
+        adjunto=False,
+        accion="VISUALIZACION_IMAGEN",
+        descripcion=f"Imagen visualizada: {evidencia['nombre_archivo']}"
+    )
+    if respuesta is None:
+        abort(404, "Archivo no encontrado en el servidor")
+    return respuesta
+
+@app.route("/evidencias/<int:evidencia_id>/miniatura/<tamano>")
+def ver_miniatura(evidencia_id, tamano):
+    """Sirve una versión reducida de una imagen para las rejillas.
+
+    No se registra en el historial: la visualización que cuenta es la de la
+    imagen completa en el visor. La URL lleva ``v`` (prefijo del SHA-256),
+    así que el navegador puede guardarla indefinidamente.
+    """
+    if tamano not in TAMANOS_MINIATURA:
+        abort(404)
+    try:
+        db = get_db()
+        cursor = db.cursor(dictionary=True)
+        cursor.execute(
+            "SELECT id, ruta, tipo_archivo, sha256 FROM evidencias WHERE id = %s",
+            (evidencia_id,)
+        )
+        evidencia = cursor.fetchone()
+        cursor.close()
+        db.close()
+    except Exception as e:
+        logger.error(f"Error obteniendo miniatura {evidencia_id}: {e}")
+        abort(500)
+    
+    if not evidencia or not evidencia['ruta'] or evidencia['tipo_archivo'] != 'imagen':
+        abort(404)
+    
+    # Con el hash en la base de datos el 304 no necesita tocar el disco
+    etag = f"{evidencia['sha256']}-{tamano}" if evidencia['sha256'] else None
+    if etag and request.if_none_match.contains(etag):
+        respuesta = Response(status=304)
+    else:
+        try:
+            clave = clave_miniatura(evidencia)
+            ruta = get_miniaturas().ruta(clave, tamano)
+            if not os.path.exists(ruta):
+                # El original solo se lee (o descarga de S3) si falta la miniatura
+                with get_almacen().copia_local(evidencia['ruta']) as origen:
+                    ruta = get_miniaturas().obtener(origen, clave, tamano)
+        except Exception as e:
+            logger.warning(f"No se pudo generar la miniatura de la evidencia {evidencia_id}: {e}")
+            abort(404)
+        etag = f"{clave}-{tamano}"
+        respuesta = send_file(ruta, mimetype='image/jpeg', etag=etag, conditional=True)
+    
+    respuesta.set_etag(etag)
+    respuesta.cache_control.no_cache = None
+    respuesta.cache_control.private = True
+    respuesta.cache_control.max_age = app.config["MINIATURAS_MAX_AGE"]
+    respuesta.cache_control.immutable = True
+    return respuesta
 
 @app.route("/incidentes/<int:incidente_id>/descargar-todo")
 def descargar_todo(incidente_id):
-    """Descarga todas las evidencias de un incidente en un ZIP"""
+    """Descarga todas las evidencias de un incidente en un ZIP.
+
+    Con trabajos en segundo plano el ZIP lo construye el worker y se redirige
+    a la página de progreso; sin ellos se genera mientras se envía.
+    """
     try:
-        import zipfile
-        import io
-        import tempfile
-        
         db = get_db()
         cursor = db.cursor(dictionary=True)
         
-        cursor.execute("SELECT * FROM evidencias WHERE incidente_id = %s", (incidente_id,))
+        cursor.execute("""
+            SELECT id, ruta, nombre_archivo, sha256 FROM evidencias
+            WHERE incidente_id = %s ORDER BY id
+        """, (incidente_id,))
         evidencias = cursor.fetchall()
         
-        cursor.close()
-        db.close()
-        
         if not evidencias:
+            cursor.close()
+            db.close()
             flash("No hay evidencias para descargar", "warning")
             return redirect(url_for('detalle_incidente', id=incidente_id))
         
-        # Crear archivo ZIP en memoria
-        memory_file = io.BytesIO()
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for evidencia in evidencias:
-                if os.path.exists(evidencia['ruta']):
-                    zf.write(evidencia['ruta'], evidencia['nombre_archivo'])
+        if app.config["TRABAJOS_EN_SEGUNDO_PLANO"]:
+            # El worker construye el ZIP en disco; si ya hay uno con las
+            # mismas evidencias se reutiliza
+            clave = clave_zip(incidente_id, evidencias)
+            anterior = trabajos.ultimo_completado(cursor, clave)
+            if anterior and get_almacen().existe(anterior['resultado']['archivo']):
+                cursor.close()
+                db.close()
+                return redirect(url_for('descargar_trabajo', trabajo_id=anterior['id']))
+            archivos = [(e['ruta'], e['nombre_archivo']) for e in evidencias]
+            destino = os.path.join(app.config["ZIPS_FOLDER"], f"{clave.split(':')[-1]}.zip")
+            trabajo_id = trabajos.encolar(cursor, 'zip_incidente',
+                                          {'archivos': archivos, 'destino': destino},
+                                          incidente_id=incidente_id, clave=clave)
+            db.commit()
+            cursor.close()
+            db.close()
+            return redirect(url_for('ver_trabajo', trabajo_id=trabajo_id))
         
-        memory_file.seek(0)
+        cursor.close()
+        db.close()
         
         # Registrar en historial
         registrar_historial(
@@ -787,11 +2230,16 @@ def descargar_todo(incidente_id):
             descripcion=f"Descargadas todas las evidencias ({len(evidencias)} archivos)"
         )
         
-        return send_file(
-            memory_file,
+        # El ZIP se genera mientras se envía (transferencia chunked), sin
+        # tenerlo completo en memoria
+        archivos = [(e['ruta'], e['nombre_archivo']) for e in evidencias]
+        return Response(
+            metricas.contar_bytes(generar_zip(archivos, almacen=get_almacen()), 'zip'),
             mimetype='application/zip',
-            as_attachment=True,
-            download_name=f'incidente_{incidente_id}_evidencias.zip'
+            headers={
+                'Content-Disposition': f'attachment; filename=incidente_{incidente_id}_evidencias.zip',
+                'X-Accel-Buffering': 'no'
+            }
         )
     
     except Exception as e:
@@ -799,6 +2247,126 @@ def descargar_todo(incidente_id):
         flash("Error al crear el archivo ZIP", "danger")
         return redirect(url_for('detalle_incidente', id=incidente_id))
 
+def clave_zip(incidente_id, evidencias):
+    """Identifica el ZIP de un incidente por el conjunto de evidencias que lleva"""
+    firma = '\n'.join(f"{e['id']}|{e['nombre_archivo']}|{e['sha256'] or e['ruta']}" for e in evidencias)
+    return f"zip:{incidente_id}:{hashlib.sha256(firma.encode('utf-8')).hexdigest()}"
+
+# ==============================
+# TRABAJOS EN SEGUNDO PLANO
+# ==============================
+
+def serializar_trabajo(trabajo):
+    """Estado de un trabajo para la API (sin parámetros internos como rutas)"""
+    datos = {
+        'id': trabajo['id'],
+        'tipo': trabajo['tipo'],
+        'incidente_id': trabajo['incidente_id'],
+        'estado': trabajo['estado'],
+        'progreso': round(trabajo['progreso'], 3),
+        'mensaje': trabajo['mensaje'],
+        'intentos': trabajo['intentos'],
+        'max_intentos': trabajo['max_intentos'],
+        'error': trabajo['error'],
+        'fecha_creacion': trabajo['fecha_creacion'].isoformat() if trabajo['fecha_creacion'] else None,
+        'fecha_fin': trabajo['fecha_fin'].isoformat() if trabajo['fecha_fin'] else None
+    }
+    if trabajo['estado'] == 'pendiente' and trabajo['intentos']:
+        datos['reintento'] = trabajo['disponible'].isoformat() if trabajo['disponible'] else None
+    if trabajo['estado'] == 'completado' and (trabajo['resultado'] or {}).get('archivo'):
+        datos['descarga'] = url_for('descargar_trabajo', trabajo_id=trabajo['id'])
+    return datos
+
+def _obtener_trabajo(trabajo_id):
+    db = get_db()
+    cursor = db.cursor(dictionary=True)
+    trabajo = trabajos.obtener(cursor, trabajo_id)
+    cursor.close()
+    db.close()
+    return trabajo
+
+@app.route("/trabajos/<int:trabajo_id>")
+def ver_trabajo(trabajo_id):
+    """Página de progreso de un trabajo; consulta la API hasta que termina"""
+    try:
+        trabajo = _obtener_trabajo(trabajo_id)
+    except Exception as e:
+        logger.error(f"Error obteniendo trabajo {trabajo_id}: {e}")
+        flash("Error al cargar el trabajo", "danger")
+        return redirect(url_for('listar_incidentes'))
+    
+    if not trabajo:
+        flash("Trabajo no encontrado", "danger")
+        return redirect(url_for('listar_incidentes'))
+    
+    return render_template("trabajo.html", trabajo=serializar_trabajo(trabajo))
+
+@app.route("/api/trabajos/<int:trabajo_id>")
+def api_trabajo(trabajo_id):
+    try:
+        trabajo = _obtener_trabajo(trabajo_id)
+    except Exception as e:
+        logger.error(f"Error obteniendo trabajo {trabajo_id}: {e}")
+        return jsonify({'error': 'No se pudo obtener el trabajo'}), 500
+    
+    if not trabajo:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    respuesta = jsonify(serializar_trabajo(trabajo))
+    respuesta.cache_control.no_store = True
+    return respuesta
+
+@app.route("/api/incidentes/<int:incidente_id>/trabajos")
+def api_trabajos_incidente(incidente_id):
+    """Trabajos recientes de un incidente; ?activos=1 para solo los no terminados"""
+    try:
+        db = get_db()
+        cursor = db.cursor(dictionary=True)
+        condicion = "AND estado IN ('pendiente', 'procesando')" if request.args.get('activos') == '1' else ""
+        cursor.execute(f"""
+            SELECT id FROM trabajos
+            WHERE incidente_id = %s {condicion}
+            ORDER BY id DESC
+            LIMIT %s
+        """, (incidente_id, app.config["MAX_POR_PAGINA"]))
+        lista = [trabajos.obtener(cursor, fila['id']) for fila in cursor.fetchall()]
+        cursor.close()
+        db.close()
+        respuesta = jsonify({'trabajos': [serializar_trabajo(t) for t in lista if t]})
+        respuesta.cache_control.no_store = True
+        return respuesta
+    except Exception as e:
+        logger.error(f"Error obteniendo trabajos del incidente {incidente_id}: {e}")
+        return jsonify({'error': 'No se pudieron obtener los trabajos'}), 500
+
+@app.route("/trabajos/<int:trabajo_id>/descarga")
+def descargar_trabajo(trabajo_id):
+    """Descarga el archivo generado por un trabajo (p. ej. el ZIP de un incidente)"""
+    try:
+        trabajo = _obtener_trabajo(trabajo_id)
+    except Exception as e:
+        logger.error(f"Error obteniendo trabajo {trabajo_id}: {e}")
+        abort(404)
+    
+    if not trabajo or trabajo['estado'] != 'completado' or not (trabajo['resultado'] or {}).get('archivo'):
+        abort(404, "Archivo no disponible")
+    
+    resultado = trabajo['resultado']
+    respuesta = enviar_evidencia(
+        {
+            'ruta': resultado['archivo'],
+            'nombre_archivo': f"incidente_{trabajo['incidente_id']}_evidencias.zip",
+            'sha256': f"{trabajo['clave'].split(':')[-1]}-{trabajo['id']}",
+            'fecha_subida': trabajo['fecha_fin'],
+            'incidente_id': trabajo['incidente_id']
+        },
+        adjunto=True,
+        accion="DESCARGA_COMPLETA",
+        descripcion=f"Descargadas todas las evidencias ({resultado.get('archivos', 0)} archivos)"
+    )
+    if respuesta is None:
+        abort(404, "El archivo ya no existe")
+    return respuesta
+
 @app.route("/incidentes/<int:incidente_id>/exportar")
 def exportar_informe(incidente_id):
     """Genera un informe PDF del incidente"""
@@ -818,10 +2386,6 @@ def exportar_informe(incidente_id):
         cursor.execute("SELECT * FROM evidencias WHERE incidente_id = %s", (incidente_id,))
         evidencias = cursor.fetchall()
         
-        # Obtener historial
-        cursor.execute("SELECT * FROM historial WHERE incidente_id = %s ORDER BY fecha DESC", (incidente_id,))
-        historial = cursor.fetchall()
-        
         cursor.close()
         db.close()
         
@@ -884,10 +2448,56 @@ ALLOWED_EXTENSIONS = {
 }
 
 
+# ==============================
+# EVENTOS EN TIEMPO REAL (SSE)
+# ==============================
+
+@app.context_processor
+def contexto_eventos():
+    return {'eventos_en_vivo': app.config["EVENTOS_EN_VIVO"]}
+
+@app.route("/api/eventos")
+def eventos_globales():
+    """Flujo SSE de todos los incidentes: historial, cambios y estadísticas"""
+    return flujo_eventos(GLOBAL)
+
+@app.route("/api/incidentes/<int:incidente_id>/eventos")
+def eventos_incidente(incidente_id):
+    """Flujo SSE de un incidente"""
+    return flujo_eventos(incidente_id)
+
+def flujo_eventos(incidente_id):
+    """Respuesta text/event-stream; no usa la base de datos mientras dura"""
+    canal = get_canal_eventos()
+    if canal.activas() >= app.config["EVENTOS_MAX_CLIENTES"]:
+        return jsonify({'error': 'Demasiados clientes de eventos'}), 503, {'Retry-After': '30'}
+    
+    ultimo = ultimo_id(request.headers.get('Last-Event-ID') or request.args.get('desde'))
+    suscripcion, inicial, enviado = abrir_flujo(canal, incidente_id, ultimo)
+    latido = app.config["EVENTOS_LATIDO"]
+    fin = time.monotonic() + app.config["EVENTOS_DURACION"]
+    
+    def generar(enviado):
+        try:
+            yield inicial
+            while time.monotonic() < fin:
+                evento = suscripcion.esperar(latido)
+                if evento is DESBORDADA:
+                    break
+                if evento is None:
+                    yield ": latido\n\n"
+                elif evento['id'] > enviado:
+                    enviado = evento['id']
+                    yield formato_sse(evento)
+        finally:
+            canal.cancelar(suscripcion)
+    
+    return Response(generar(enviado), mimetype='text/event-stream', headers=CABECERAS_SSE)
+
 @app.route("/status")
 def status():
     try:
-        db = get_db()
+        db = get_db(lectura=True)
         cursor = db.cursor()
         
         cursor.execute("SELECT 1")
@@ -903,8 +2513,7 @@ def status():
         total_evidencias = cursor.fetchone()[0]
         
         # Verificar si existe la tabla historial
-        cursor.execute("SHOW TABLES LIKE 'historial'")
-        historial_exists = cursor.fetchone() is not None
+        historial_exists = historial_disponible()
         
         if historial_exists:
             cursor.execute("SELECT COUNT(*) as total FROM historial")
@@ -925,7 +2534,14 @@ def status():
             'total_evidencias': total_evidencias,
             'total_historial': total_historial,
             'historial_disponible': historial_exists,
-            'uploads_folder': os.path.exists(app.config["UPLOAD_FOLDER"])
+            'uploads_folder': os.path.exists(app.config["UPLOAD_FOLDER"]),
+            'almacen_evidencias': ALMACEN_CONFIG['tipo'],
+            'pool': get_pool().estadisticas(),
+            'historial_escritor': get_escritor_historial().estadisticas(),
+            'cache_detalle': get_cache_detalle().estadisticas(),
+            'eventos': get_canal_eventos().estadisticas(),
+            'lectura_desde': g.replica.nombre if 'replica' in g else 'primaria',
+            'replicas': get_enrutador().estadisticas() if DB_REPLICAS else None
         }
         
         return jsonify(status_info)
@@ -934,9 +2550,571 @@ def status():
         return jsonify({
             'flask': 'running',
             'database': 'disconnected',
-            'error': str(e)
+            'error': str(e),
+            'pool': get_pool().estadisticas()
         })
 
+@app.route("/metrics")
+def metrics():
+    """Métricas de este proceso en formato de texto de Prometheus"""
+    if not app.config["METRICAS"]:
+        abort(404)
+    pool = get_pool().estadisticas()
+    escritor = get_escritor_historial().estadisticas() if _escritor_historial else {}
+    valores = [
+        ('pool_conexiones', 'gauge', 'Conexiones del pool principal por estado',
+         [({'estado': estado}, pool[estado]) for estado in ('abiertas', 'en_uso', 'libres', 'esperando')]),
+        ('pool_timeouts_total', 'counter', 'Peticiones que no obtuvieron conexión a tiempo',
+         [({}, pool['timeouts'])]),
+        ('consulta_info', 'gauge', 'Texto normalizado de cada identificador de consulta',
+         metricas.sentencias())
+    ]
+    if escritor:
+        valores += [
+            ('historial_en_cola', 'gauge', 'Registros de historial esperando al escritor',
+             [({}, escritor['en_cola'])]),
+            ('historial_registros_total', 'counter', 'Registros de historial insertados o rechazados',
+             [({'resultado': 'insertado'}, escritor['insertadas']),
+              ({'resultado': 'rechazado'}, escritor['rechazadas'])]),
+            ('historial_lotes_total', 'counter', 'Lotes insertados por el escritor de historial',
+             [({}, escritor['lotes'])]),
+            ('historial_errores_total', 'counter', 'Errores del escritor de historial',
+             [({}, escritor['errores'])]),
+            ('historial_reintentando', 'gauge', 'El escritor de historial está reintentando un lote fallido',
+             [({}, int(escritor['reintentando']))])
+        ]
+    cache = get_cache_detalle().estadisticas()
+    valores.append(('cache_detalle_total', 'counter', 'Vistas de detalle servidas desde la caché o cargadas',
+                    [({'resultado': 'acierto'}, cache['aciertos']), ({'resultado': 'fallo'}, cache['fallos'])]))
+    if 'bytes' in cache:
+        valores.append(('cache_detalle_bytes', 'gauge', 'Memoria ocupada por la caché del detalle en este proceso',
+                        [({}, cache['bytes'])]))
+    eventos = get_canal_eventos().estadisticas()
+    valores += [
+        ('eventos_clientes', 'gauge', 'Clientes SSE conectados a este proceso', [({}, eventos['suscripciones'])]),
+        ('eventos_total', 'counter', 'Eventos recibidos para reenviar a los clientes SSE',
+         [({}, eventos['publicados'])])
+    ]
+    if DB_REPLICAS:
+        valores.append(('replica_disponible', 'gauge', 'Réplicas de lectura en uso (1) o apartadas (0)',
+                        [({'replica': r['nombre']}, int(r['disponible']))
+                         for r in get_enrutador().estadisticas()['replicas']]))
+    return Response(metricas.texto(metricas.TODAS, valores),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+# ==============================
+# COMANDOS CLI
+# ==============================
+
+@app.cli.command("migrar")
+def comando_migrar():
+    """Crea la base de datos y aplica las migraciones pendientes"""
+    if not init_database():
+        sys.exit(1)
+    db = get_db()
+    cursor = db.cursor()
+    click.echo(f"Esquema en la versión {version_actual(cursor)}")
+    cursor.close()
+    db.close()
+
+class _CursorGrabador:
+    """Cursor que anota cada sentencia ejecutada antes de delegarla"""
+
+    def __init__(self, cursor, consultas):
+        self._cursor = cursor
+        self._consultas = consultas
+
+    def __getattr__(self, nombre):
+        return getattr(self._cursor, nombre)
+
+    def execute(self, sql, parametros=()):
+        self._consultas.append((request.endpoint, sql, parametros))
+        return self._cursor.execute(sql, parametros)
+
+class _ConexionGrabadora(_ConexionPeticion):
+    """Conexión de petición cuyos cursores anotan las consultas"""
+
+    def __init__(self, conn, consultas):
+        super().__init__(conn)
+        self._consultas = consultas
+
+    def cursor(self, *args, **kwargs):
+        return _CursorGrabador(self._conn.cursor(*args, **kwargs), self._consultas)
+
+def urls_auditoria(incidente_id):
+    """Peticiones de solo lectura que cubren las consultas de la aplicación"""
+    cursor_muestra = codificar_cursor(datetime.now(), 2 ** 31 - 1)
+    urls = [
+        "/",
+        "/api/estadisticas",
+        "/status",
+        "/incidentes",
+        "/incidentes?estado=Abierto",
+        "/incidentes?severidad=critica",
+        "/incidentes?tipo=phishing",
+        "/incidentes?reporta=admin",
+        "/incidentes?desde=2024-01-01&hasta=2030-12-31",
+        "/incidentes?orden=asc",
+        f"/incidentes?cursor={cursor_muestra}",
+        f"/incidentes?estado=Abierto&cursor={cursor_muestra}",
+        "/historial",
+        "/historial?accion=COMENTARIO",
+        "/historial?usuario=admin",
+        f"/historial?incidente={incidente_id}",
+        "/historial?desde=2024-01-01&hasta=2030-12-31",
+        f"/historial?cursor={cursor_muestra}",
+    ]
+    if incidente_id:
+        urls.append(f"/incidentes/{incidente_id}")
+    return urls
+
+@app.cli.command("auditar-consultas", with_appcontext=False)
+@click.option("--verbose", is_flag=True, help="Muestra el plan de todas las consultas, no solo las problemáticas")
+def comando_auditar_consultas(verbose):
+    """Ejecuta EXPLAIN sobre las consultas de la aplicación.
+
+    Recorre las rutas de solo lectura con el cliente de pruebas de Flask
+    (cada petición con su propio contexto, para que se libere su conexión),
+    anota cada SELECT que emiten y revisa su plan. Termina con código 1 si
+    alguna hace un recorrido completo de tabla (type=ALL), un filesort o una
+    tabla temporal.
+    """
+    db = get_db()
+    cursor = db.cursor()
+    cursor.execute("SELECT MAX(id) FROM incidentes")
+    incidente_id = cursor.fetchone()[0] or 0
+    cursor.close()
+    db.close()
+    
+    consultas = []
+    
+    def grabar_consultas():
+        g.db = _ConexionGrabadora(get_pool().acquire(), consultas)
+    
+    app.before_request_funcs.setdefault(None, []).insert(0, grabar_consultas)
+    try:
+        cliente = app.test_client()
+        for url in urls_auditoria(incidente_id):
+            cliente.get(url)
+    finally:
+        app.before_request_funcs[None].remove(grabar_consultas)
+    
+    vistas = set()
+    problemas = 0
+    db = get_db()
+    cursor = db.cursor(dictionary=True)
+    for endpoint, sql, parametros in consultas:
+        sql_normalizado = " ".join(sql.split())
+        if not sql_normalizado.upper().startswith("SELECT") or sql_normalizado in vistas:
+            continue
+        vistas.add(sql_normalizado)
+        
+        cursor.execute(f"EXPLAIN {sql}", parametros)
+        plan = cursor.fetchall()
+        
+        avisos = []
+        for paso in plan:
+            extra = paso.get('Extra') or ''
+            if paso.get('type') == 'ALL':
+                avisos.append(f"recorrido completo de '{paso.get('table')}' (~{paso.get('rows')} filas)")
+            if 'Using filesort' in extra:
+                avisos.append(f"filesort en '{paso.get('table')}'")
+            if 'Using temporary' in extra:
+                avisos.append(f"tabla temporal en '{paso.get('table')}'")
+        
+        if avisos:
+            problemas += 1
+        if avisos or verbose:
+            click.echo(f"\n[{endpoint}] {sql_normalizado}")
+            for paso in plan:
+                click.echo(f"    {paso.get('table')}: type={paso.get('type')} key={paso.get('key')} "
+                           f"rows={paso.get('rows')} extra={paso.get('Extra')}")
+            for aviso in avisos:
+                click.echo(f"    ⚠️  {aviso}")
+    cursor.close()
+    db.close()
+    
+    click.echo(f"\n{len(vistas)} consultas revisadas, {problemas} con problemas")
+    if problemas:
+        sys.exit(1)
+
+@app.cli.command("migrar-evidencias", with_appcontext=False)
+@click.option("--lote", default=500, help="Evidencias leídas por consulta")
+def comando_migrar_evidencias(lote):
+    """Pasa las evidencias guardadas por ruta al almacén por contenido.
+
+    Con EVIDENCIAS_ALMACEN=s3 también sube a S3 los blobs del disco local.
+    Se puede interrumpir y volver a lanzar: las evidencias ya migradas se
+    saltan y al final se recalculan los recuentos de referencias desde la
+    tabla evidencias, borrando los blobs que no usa nadie.
+    """
+    almacen = get_almacen()
+    # Un blob local puede ser de varias evidencias: se borra al final
+    blobs_locales = set()
+    db = get_db()
+    cursor = db.cursor(dictionary=True)
+    
+    ultimo = 0
+    migradas = duplicadas = faltantes = 0
+    bytes_ahorrados = 0
+    while True:
+        cursor.execute(
+            "SELECT id, ruta FROM evidencias WHERE id > %s ORDER BY id LIMIT %s",
+            (ultimo, lote)
+        )
+        filas = cursor.fetchall()
+        if not filas:
+            break
+        
+        for evidencia in filas:
+            ultimo = evidencia['id']
+            ruta_anterior = evidencia['ruta']
+            if almacen.pertenece(ruta_anterior):
+                continue
+            if not ruta_anterior or not os.path.exists(ruta_anterior):
+                faltantes += 1
+                continue
+            
+            blob_local = os.path.abspath(ruta_anterior).startswith(
+                os.path.abspath(app.config["BLOBS_FOLDER"]) + os.sep)
+            ruta, sha256, tamano = almacen.importar(ruta_anterior)
+            cursor.execute("""
+                INSERT INTO blobs (sha256, tamano, referencias)
+                VALUES (%s, %s, 1)
+                ON DUPLICATE KEY UPDATE referencias = referencias + 1
+            """, (sha256, tamano))
+            if cursor.rowcount == 2 and not blob_local:  # fila existente actualizada
+                duplicadas += 1
+                bytes_ahorrados += tamano
+            cursor.execute(
+                "UPDATE evidencias SET ruta = %s, sha256 = %s, tamano = %s WHERE id = %s",
+                (ruta, sha256, tamano, evidencia['id'])
+            )
+            if blob_local:
+                blobs_locales.add(ruta_anterior)
+            else:
+                os.remove(ruta_anterior)
+            migradas += 1
+    
+    # Recuentos exactos a partir de evidencias (corrige interrupciones previas)
+    cursor.execute("""
+        UPDATE blobs b
+        SET referencias = (SELECT COUNT(*) FROM evidencias e WHERE e.sha256 = b.sha256)
+    """)
+    cursor.execute("SELECT sha256 FROM blobs WHERE referencias = 0")
+    huerfanos = [fila['sha256'] for fila in cursor.fetchall()]
+    cursor.close()
+    db.close()
+    for sha256 in huerfanos:
+        liberar_blob(sha256, cantidad=0)
+    for ruta_local in blobs_locales:
+        almacen.eliminar(ruta_local)
+    
+    click.echo(f"{migradas} evidencias migradas ({duplicadas} duplicadas, "
+               f"{bytes_ahorrados / 1024 / 1024:.1f} MB ahorrados), "
+               f"{faltantes} sin archivo, {len(huerfanos)} blobs sin referencias eliminados")
+
+@app.cli.command("reindexar-busqueda", with_appcontext=False)
+def comando_reindexar_busqueda():
+    """Reconstruye el índice de búsqueda desde cero"""
+    db = get_db()
+    cursor = db.cursor()
+    db.start_transaction()
+    busqueda.reconstruir(cursor)
+    db.commit()
+    cursor.execute("SELECT COUNT(*) FROM busqueda")
+    total = cursor.fetchone()[0]
+    cursor.close()
+    db.close()
+    click.echo(f"{total} documentos indexados")
+
+@app.cli.command("extraer-indicadores", with_appcontext=False)
+@click.option("--procesos", default=None, type=int, help="Procesos del pool (INDICADORES_PROCESOS)")
+@click.option("--lote", default=100, help="Extracciones repartidas por ronda")
+@click.option("--continuo", is_flag=True, help="Seguir esperando evidencias nuevas")
+@click.option("--intervalo", default=30, help="Segundos entre rondas con --continuo")
+def comando_extraer_indicadores(procesos, lote, continuo, intervalo):
+    """Extrae IP, dominios, URL, hashes y correos de las evidencias de texto.
+
+    Cada contenido se procesa una sola vez; una extracción interrumpida se
+    reanuda desde su último punto de control. Se pueden lanzar varias
+    instancias a la vez: cada archivo lo reclama un único trabajador.
+    """
+    procesos = procesos or app.config["INDICADORES_PROCESOS"]
+    caducidad = app.config["INDICADORES_CADUCIDAD"]
+    
+    with ProcessPoolExecutor(max_workers=procesos) as pool:
+        while True:
+            db = get_db()
+            cursor = db.cursor()
+            trabajos = indicadores.pendientes(cursor, lote)
+            cursor.close()
+            db.close()
+            
+            futuros = [pool.submit(indicadores.trabajar, DB_CONFIG, sha256, ruta, caducidad)
+                       for sha256, ruta in trabajos]
+            completas = errores = 0
+            for futuro in as_completed(futuros):
+                sha256, lineas, error = futuro.result()
+                if error:
+                    errores += 1
+                    click.echo(f"Error en {sha256[:12]}: {error}", err=True)
+                elif lineas is not None:
+                    completas += 1
+            if futuros:
+                click.echo(f"{completas} evidencias procesadas, {errores} con error")
+            
+            if not continuo:
+                break
+            if len(trabajos) < lote:
+                time.sleep(intervalo)
+
+@app.cli.command("resumir-capturas", with_appcontext=False)
+@click.option("--procesos", default=None, type=int, help="Procesos del pool (CAPTURAS_PROCESOS)")
+@click.option("--lote", default=100, help="Capturas repartidas por ronda")
+@click.option("--continuo", is_flag=True, help="Seguir esperando capturas nuevas")
+@click.option("--intervalo", default=30, help="Segundos entre rondas con --continuo")
+def comando_resumir_capturas(procesos, lote, continuo, intervalo):
+    """Resume las capturas pcap/pcapng: protocolos, IPs, puertos y flujos.
+
+    Cada contenido se resume una sola vez y en un proceso aparte, así que una
+    captura de varios GB no bloquea a los trabajadores web.
+    """
+    procesos = procesos or app.config["CAPTURAS_PROCESOS"]
+    caducidad = app.config["CAPTURAS_CADUCIDAD"]
+    
+    with ProcessPoolExecutor(max_workers=procesos) as pool:
+        while True:
+            db = get_db()
+            cursor = db.cursor()
+            trabajos = capturas.pendientes(cursor, lote)
+            cursor.close()
+            db.close()
+            
+            futuros = [pool.submit(capturas.trabajar, DB_CONFIG, sha256, ruta, caducidad)
+                       for sha256, ruta in trabajos]
+            completas = errores = 0
+            for futuro in as_completed(futuros):
+                sha256, paquetes, error = futuro.result()
+                if error:
+                    errores += 1
+                    click.echo(f"Error en {sha256[:12]}: {error}", err=True)
+                elif paquetes is not None:
+                    completas += 1
+            if futuros:
+                click.echo(f"{completas} capturas resumidas, {errores} con error")
+            
+            if not continuo:
+                break
+            if len(trabajos) < lote:
+                time.sleep(intervalo)
+
+@app.cli.command("worker", with_appcontext=False)
+@click.option("--procesos", default=None, type=int, help="Procesos del pool (TRABAJOS_PROCESOS)")
+@click.option("--intervalo", default=2.0, help="Segundos de espera con la cola vacía")
+@click.option("--vaciar", is_flag=True, help="Terminar cuando no queden trabajos disponibles")
+def comando_worker(procesos, intervalo, vaciar):
+    """Ejecuta los trabajos en segundo plano (ZIP, miniaturas, indicadores, capturas).
+
+    Cada proceso del pool reclama un trabajo a la vez; se pueden lanzar
+    varios workers en distintas máquinas contra la misma base de datos. Un
+    trabajo que falla se reintenta con espera exponencial hasta agotar sus
+    intentos.
+    """
+    procesos = procesos or app.config["TRABAJOS_PROCESOS"]
+    caducidad = app.config["TRABAJOS_CADUCIDAD"]
+    nombre = trabajos.nombre_trabajador()
+    click.echo(f"Worker {nombre} con {procesos} procesos")
+    
+    ultima_revision = 0
+    cola_vacia = False
+    with ProcessPoolExecutor(max_workers=procesos) as pool:
+        en_curso = set()
+        while True:
+            # Trabajos de workers caídos vuelven a la cola
+            if time.time() - ultima_revision > 60:
+                db = get_db()
+                cursor = db.cursor()
+                recuperados = trabajos.recuperar_abandonados(cursor, caducidad)
+                cursor.close()
+                db.close()
+                if recuperados:
+                    click.echo(f"{recuperados} trabajos abandonados devueltos a la cola")
+                ultima_revision = time.time()
+            
+            # Con --vaciar, vista la cola vacía solo se espera a los que están en curso
+            if not (vaciar and cola_vacia):
+                while len(en_curso) < procesos:
+                    en_curso.add(pool.submit(trabajos.ejecutar_siguiente, DB_CONFIG, nombre))
+            if not en_curso:
+                break
+            hechos, en_curso = wait(en_curso, return_when=FIRST_COMPLETED)
+            
+            sin_trabajo = False
+            for futuro in hechos:
+                resultado = futuro.result()
+                if resultado is None:
+                    sin_trabajo = True
+                    continue
+                trabajo_id, tipo, estado, error = resultado
+                if error:
+                    click.echo(f"Trabajo {trabajo_id} ({tipo}) falló, queda {estado}: {error}", err=True)
+                else:
+                    click.echo(f"Trabajo {trabajo_id} ({tipo}) completado")
+            
+            if sin_trabajo:
+                cola_vacia = True
+                if not vaciar:
+                    time.sleep(intervalo)
+
+@app.cli.command("limpiar-trabajos", with_appcontext=False)
+def comando_limpiar_trabajos():
+    """Borra los trabajos terminados (y sus ZIP) más antiguos que TRABAJOS_RETENCION"""
+    db = get_db()
+    cursor = db.cursor()
+    eliminados = trabajos.limpiar(cursor, app.config["TRABAJOS_RETENCION"])
+    cursor.close()
+    db.close()
+    click.echo(f"{eliminados} trabajos eliminados")
+
+@app.cli.command("importar-incidentes", with_appcontext=False)
+@click.argument("archivo", type=click.File("rb"))
+@click.option("--lote", default=None, type=int, help="Incidentes por transacción (INGESTA_TAMANO_LOTE)")
+@click.option("--usuario", default="importacion", help="Usuario de las entradas de historial")
+@click.option("--ventana", default=None, type=int, help="Segundos de correlación (CORRELACION_VENTANA; 0 la desactiva)")
+def comando_importar_incidentes(archivo, lote, usuario, ventana):
+    """Importa incidentes de un JSON o NDJSON ('-' para la entrada estándar)"""
+    conn = mysql.connector.connect(**DB_CONFIG)
+    inicio = time.time()
+    try:
+        resultados, creados = ingesta.importar(
+            conn, ingesta.leer_registros(archivo), usuario,
+            tamano_lote=lote or app.config["INGESTA_TAMANO_LOTE"],
+            ventana=app.config["CORRELACION_VENTANA"] if ventana is None else ventana
+        )
+    except ingesta.RegistroInvalido as e:
+        raise click.ClickException(str(e))
+    finally:
+        conn.close()
+    duracion = time.time() - inicio
+    
+    errores = 0
+    for resultado in resultados:
+        if 'error' in resultado:
+            errores += 1
+            click.echo(f"Registro {resultado['indice']}: {resultado['error']}", err=True)
+    # Los contadores del dashboard se recalculan en la próxima consulta
+    get_estadisticas().invalidar()
+    
+    total = sum(creados.values())
+    fusionados = sum(1 for r in resultados if r.get('fusionado'))
+    click.echo(f"{total} incidentes creados, {fusionados} alertas fusionadas, {errores} con error "
+               f"en {duracion:.1f}s ({len(resultados) / duracion if duracion else 0:.0f} registros/s)")
+
+@app.cli.command("limpiar-subidas", with_appcontext=False)
+def comando_limpiar_subidas():
+    """Elimina las subidas por fragmentos abandonadas (SUBIDA_CADUCIDAD)"""
+    eliminadas = get_gestor_subidas().limpiar(app.config["SUBIDA_CADUCIDAD"])
+    click.echo(f"{eliminadas} subidas abandonadas eliminadas")
+
+@app.cli.command("historial-particionar", with_appcontext=False)
+@click.option("--meses-adelante", type=int, default=None,
+              help="Particiones de meses futuros (por defecto HISTORIAL_PARTICIONES_ADELANTE)")
+def comando_historial_particionar(meses_adelante):
+    """Particiona historial por meses para poder archivar los meses antiguos.
+
+    Reescribe la tabla entera (conviene hacerlo fuera de horas) y quita su
+    clave foránea a incidentes, que MySQL no admite en tablas particionadas;
+    al eliminar un incidente su historial se borra desde la aplicación.
+    """
+    if meses_adelante is None:
+        meses_adelante = app.config["HISTORIAL_PARTICIONES_ADELANTE"]
+    conn = mysql.connector.connect(**DB_CONFIG)
+    try:
+        cursor = conn.cursor()
+        if archivo_historial.particiones(cursor):
+            click.echo("historial ya está particionada")
+            return
+        inicio = time.monotonic()
+        archivo_historial.particionar(cursor, meses_adelante)
+        click.echo(f"historial particionada en {len(archivo_historial.particiones(cursor))} "
+                   f"particiones ({time.monotonic() - inicio:.0f} s)")
+        cursor.close()
+    finally:
+        conn.close()
+
+@app.cli.command("archivar-historial", with_appcontext=False)
+@click.option("--dias", type=int, default=None, help="Retención en días (por defecto HISTORIAL_RETENCION_DIAS)")
+@click.option("--formato", type=click.Choice(sorted(archivo_historial.EXTENSIONES)), default=None)
+@click.option("--solo-particiones", is_flag=True, help="Crear las particiones de los próximos meses sin archivar")
+def comando_archivar_historial(dias, formato, solo_particiones):
+    """Prepara las particiones de historial y archiva los meses fuera de la retención"""
+    dias = app.config["HISTORIAL_RETENCION_DIAS"] if dias is None else dias
+    conn = mysql.connector.connect(**DB_CONFIG)
+    try:
+        cursor = conn.cursor()
+        if not archivo_historial.particiones(cursor):
+            raise click.ClickException("historial no está particionada: ejecute antes flask historial-particionar")
+        nuevas = archivo_historial.preparar_particiones(cursor, app.config["HISTORIAL_PARTICIONES_ADELANTE"])
+        cursor.close()
+        if nuevas:
+            click.echo(f"Particiones nuevas: {', '.join(nuevas)}")
+        if solo_particiones or dias <= 0:
+            return
+        
+        antes_de = (datetime.now() - timedelta(days=dias)).date()
+        archivados = archivo_historial.archivar(
+            conn, get_almacen(), app.config["HISTORIAL_ARCHIVO_FOLDER"], antes_de,
+            formato or app.config["HISTORIAL_ARCHIVO_FORMATO"] or None
+        )
+    finally:
+        conn.close()
+    
+    for archivado in archivados:
+        click.echo(f"{archivado['particion']}: {archivado['filas']} filas, "
+                   f"{archivado['bytes'] / 1024 / 1024:.1f} MB -> {archivado['ruta']}")
+    # Los totales de /historial se recalculan con la tabla ya reducida
+    _conteos_historial.clear()
+    click.echo(f"{len(archivados)} meses archivados (anteriores a {antes_de.isoformat()})")
+
+@app.cli.command("servir-eventos", with_appcontext=False)
+@click.option("--host", default="127.0.0.1")
+@click.option("--puerto", default=5001, help="Puerto al que el proxy envía /api/eventos y /api/incidentes/<id>/eventos")
+@click.option("--max-clientes", default=10000)
+def comando_servir_eventos(host, puerto, max_clientes):
+    """Sirve los flujos SSE con asyncio, sin ocupar workers de la aplicación.
+
+    Necesita EVENTOS_REDIS_URL para recibir los eventos que publican los
+    workers web, y EVENTOS_EN_VIVO=1 en esos workers para que las páginas
+    abran los flujos.
+    """
+    import asyncio
+    from servidor_eventos import ServidorEventos
+    
+    if not app.config["EVENTOS_REDIS_URL"]:
+        click.echo("Aviso: sin EVENTOS_REDIS_URL este proceso no recibe los eventos de los workers", err=True)
+    servidor = ServidorEventos(
+        get_canal_eventos(),
+        latido=app.config["EVENTOS_LATIDO"],
+        max_clientes=max_clientes
+    )
+    try:
+        asyncio.run(servidor.servir(host, puerto))
+    except KeyboardInterrupt:
+        pass
+
+@app.cli.command("servir-asgi", with_appcontext=False)
+@click.option("--host", default="127.0.0.1")
+@click.option("--puerto", default=8000)
+@click.option("--workers", default=1, help="Procesos; con más de uno, EVENTOS_REDIS_URL para compartir los eventos")
+def comando_servir_asgi(host, puerto, workers):
+    """Sirve la aplicación en modo ASGI con uvicorn (ver asgi.py)"""
+    try:
+        import uvicorn
+    except ImportError:
+        raise click.ClickException("El modo ASGI necesita uvicorn (pip install uvicorn)")
+    uvicorn.run("asgi:aplicacion", host=host, port=puerto, workers=workers, lifespan="on")
+
 # ==============================
 # MANEJO DE ERRORES
 # ==============================
@@ -980,6 +3158,7 @@ if __name__ == "__main__":
     # Inicializar base de datos
     if init_database():
         print("✅ Base de datos inicializada")
+        historial_disponible()
     else:
         print("❌ Error inicializando base de datos")
     
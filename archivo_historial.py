@@ -0,0 +1,430 @@
+# archivo_historial.py
+"""Particiones mensuales de historial y archivo de los meses antiguos.
+
+historial está particionada por meses (RANGE sobre UNIX_TIMESTAMP(fecha)):
+las consultas con rango de fechas solo leen sus meses y retirar un mes es
+un DROP PARTITION, sin borrar fila a fila. Los meses más antiguos que la
+retención se exportan antes a un archivo NDJSON comprimido (zstd si está
+instalado ``zstandard``, si no gzip) y se publican en el almacén de
+evidencias, que con S3 hace de almacenamiento frío.
+
+El archivo está formado por bloques comprimidos independientes (frames de
+zstd o miembros de gzip concatenados, así que también se lee entero con
+zstdcat o zcat). Las filas van ordenadas por incidente y la tabla
+historial_archivo_bloques guarda en qué bloques está cada incidente: la
+línea de tiempo de un incidente lee solo esos bloques.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONES = {'zstd': '.ndjson.zst', 'gzip': '.ndjson.gz'}
+
+# Bytes sin comprimir por bloque: lo que se lee para consultar un incidente
+TAMANO_BLOQUE = 256 * 1024
+
+PARTICION_FUTURO = 'pfuturo'
+
+# Filas archivadas ya descomprimidas que se guardan en memoria por proceso
+MAX_FILAS_CACHE = 100000
+
+_COLUMNAS = ('id', 'incidente_id', 'usuario', 'accion', 'descripcion', 'fecha')
+
+
+# ==============================
+# COMPRESIÓN
+# ==============================
+def formato_predeterminado():
+    try:
+        import zstandard  # noqa: F401
+        return 'zstd'
+    except ImportError:
+        return 'gzip'
+
+
+def _comprimir(formato, datos):
+    if formato == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=10).compress(datos)
+    return gzip.compress(datos, compresslevel=9)
+
+
+def _descomprimir(formato, datos):
+    if formato == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(datos)
+    return gzip.decompress(datos)
+
+
+# ==============================
+# PARTICIONES
+# ==============================
+def _mes(fecha):
+    return date(fecha.year, fecha.month, 1)
+
+
+def _siguiente_mes(mes):
+    return date(mes.year + mes.month // 12, mes.month % 12 + 1, 1)
+
+
+def nombre_particion(mes):
+    return f"p{mes.year:04d}{mes.month:02d}"
+
+
+def mes_particion(nombre):
+    """Primer día del mes de una partición ``pAAAAMM`` (None para pfuturo)"""
+    if nombre == PARTICION_FUTURO:
+        return None
+    return date(int(nombre[1:5]), int(nombre[5:7]), 1)
+
+
+def _definiciones(desde, hasta):
+    """Particiones de los meses ``desde``..``hasta`` (inclusive) más pfuturo"""
+    partes = []
+    mes = desde
+    while mes <= hasta:
+        limite = _siguiente_mes(mes)
+        partes.append(f"PARTITION {nombre_particion(mes)} VALUES LESS THAN "
+                      f"(UNIX_TIMESTAMP('{limite.isoformat()} 00:00:00'))")
+        mes = limite
+    partes.append(f"PARTITION {PARTICION_FUTURO} VALUES LESS THAN MAXVALUE")
+    return ', '.join(partes)
+
+
+def _mes_adelante(meses_adelante):
+    mes = _mes(datetime.now())
+    for _ in range(meses_adelante):
+        mes = _siguiente_mes(mes)
+    return mes
+
+
+def particiones(cursor):
+    """[(nombre, filas aproximadas)] de historial en orden; vacía si no está particionada"""
+    cursor.execute("""
+        SELECT PARTITION_NAME, TABLE_ROWS FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'historial'
+          AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+    """)
+    return [(fila[0], int(fila[1] or 0)) for fila in cursor.fetchall()]
+
+
+def particionar(cursor, meses_adelante=3):
+    """Convierte historial en una tabla particionada por meses.
+
+    MySQL no admite claves foráneas en tablas particionadas y exige que la
+    clave primaria incluya la columna de partición: se quita la clave
+    foránea a incidentes (eliminar_incidente borra su historial) y la clave
+    primaria pasa a ser (id, fecha). Reescribe la tabla entera: se lanza a
+    propósito con flask historial-particionar, nunca al arrancar.
+    """
+    if particiones(cursor):
+        return
+    cursor.execute("""
+        SELECT CONSTRAINT_NAME FROM information_schema.REFERENTIAL_CONSTRAINTS
+        WHERE CONSTRAINT_SCHEMA = DATABASE() AND TABLE_NAME = 'historial'
+    """)
+    for (nombre,) in cursor.fetchall():
+        cursor.execute(f"ALTER TABLE historial DROP FOREIGN KEY {nombre}")
+
+    cursor.execute("SELECT MIN(fecha) FROM historial")
+    primera = cursor.fetchone()[0] or datetime.now()
+    cursor.execute("""
+        ALTER TABLE historial
+            MODIFY fecha TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            DROP PRIMARY KEY,
+            ADD PRIMARY KEY (id, fecha)
+    """)
+    cursor.execute(f"""
+        ALTER TABLE historial PARTITION BY RANGE (UNIX_TIMESTAMP(fecha))
+        ({_definiciones(_mes(primera), _mes_adelante(meses_adelante))})
+    """)
+
+
+def preparar_particiones(cursor, meses_adelante=3):
+    """Crea las particiones de los próximos meses separándolas de pfuturo.
+
+    Si no se ejecuta a tiempo las filas nuevas caen en pfuturo, que sigue
+    siendo válido; la reorganización solo tarda más al moverlas.
+    Devuelve los nombres creados.
+    """
+    meses = [mes_particion(nombre) for nombre, _ in particiones(cursor) if nombre != PARTICION_FUTURO]
+    if not meses:
+        return []
+    desde = _siguiente_mes(max(meses))
+    hasta = _mes_adelante(meses_adelante)
+    if desde > hasta:
+        return []
+    cursor.execute(f"""
+        ALTER TABLE historial REORGANIZE PARTITION {PARTICION_FUTURO}
+        INTO ({_definiciones(desde, hasta)})
+    """)
+    nuevas = []
+    mes = desde
+    while mes <= hasta:
+        nuevas.append(nombre_particion(mes))
+        mes = _siguiente_mes(mes)
+    return nuevas
+
+
+# ==============================
+# ARCHIVO
+# ==============================
+class _EscritorArchivo:
+    """Escribe filas (ordenadas por incidente) en bloques comprimidos independientes"""
+
+    def __init__(self, archivo, formato, tamano_bloque=TAMANO_BLOQUE):
+        self.archivo = archivo
+        self.formato = formato
+        self.tamano_bloque = tamano_bloque
+        self.hasher = hashlib.sha256()
+        self.bloques = []          # (incidente_id, desplazamiento, longitud, filas)
+        self.filas = 0
+        self.bytes = 0
+        self._lineas = []
+        self._pendiente = 0
+        self._por_incidente = {}
+
+    def agregar(self, fila):
+        registro = dict(zip(_COLUMNAS, fila))
+        registro['fecha'] = registro['fecha'].isoformat()
+        linea = (json.dumps(registro, ensure_ascii=False) + '\n').encode('utf-8')
+        self._lineas.append(linea)
+        self._pendiente += len(linea)
+        self._por_incidente[registro['incidente_id']] = self._por_incidente.get(registro['incidente_id'], 0) + 1
+        self.filas += 1
+        if self._pendiente >= self.tamano_bloque:
+            self._cerrar_bloque()
+
+    def _cerrar_bloque(self):
+        if not self._lineas:
+            return
+        comprimido = _comprimir(self.formato, b''.join(self._lineas))
+        self.archivo.write(comprimido)
+        self.hasher.update(comprimido)
+        for incidente_id, filas in self._por_incidente.items():
+            self.bloques.append((incidente_id, self.bytes, len(comprimido), filas))
+        self.bytes += len(comprimido)
+        self._lineas = []
+        self._pendiente = 0
+        self._por_incidente = {}
+
+    def cerrar(self):
+        self._cerrar_bloque()
+        self.archivo.flush()
+        os.fsync(self.archivo.fileno())
+
+
+def archivar_particion(db, almacen, carpeta, particion, formato=None):
+    """Exporta una partición a un archivo, la registra y la elimina.
+
+    Si la partición ya figura en historial_archivos (un intento anterior se
+    cortó antes del DROP) solo se elimina. Devuelve un resumen, o None si la
+    partición ya estaba archivada.
+    """
+    formato = formato or formato_predeterminado()
+    cursor = db.cursor()
+    try:
+        cursor.execute("SELECT id FROM historial_archivos WHERE particion = %s", (particion,))
+        if cursor.fetchone():
+            cursor.execute(f"ALTER TABLE historial DROP PARTITION {particion}")
+            return None
+
+        os.makedirs(carpeta, exist_ok=True)
+        nombre = f"historial_{particion[1:]}{EXTENSIONES[formato]}"
+        temporal = os.path.join(carpeta, nombre + '.tmp')
+        with open(temporal, 'wb') as archivo:
+            escritor = _EscritorArchivo(archivo, formato)
+            cursor.execute(f"""
+                SELECT {', '.join(_COLUMNAS)} FROM historial PARTITION ({particion})
+                ORDER BY incidente_id, fecha, id
+            """)
+            while True:
+                filas = cursor.fetchmany(5000)
+                if not filas:
+                    break
+                for fila in filas:
+                    escritor.agregar(fila)
+            escritor.cerrar()
+
+        # Una fila que llegara durante la exportación se perdería con el DROP
+        cursor.execute(f"SELECT COUNT(*) FROM historial PARTITION ({particion})")
+        if cursor.fetchone()[0] != escritor.filas:
+            os.remove(temporal)
+            raise RuntimeError(f"La partición {particion} cambió durante la exportación")
+
+        local = os.path.join(carpeta, nombre)
+        os.replace(temporal, local)
+        ruta = almacen.publicar(local, f"historial/{nombre}")
+
+        mes = mes_particion(particion)
+        cursor.execute("""
+            INSERT INTO historial_archivos (particion, desde, hasta, ruta, formato, filas, bytes, sha256)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, (particion, mes, _siguiente_mes(mes), ruta, formato, escritor.filas, escritor.bytes,
+              escritor.hasher.hexdigest()))
+        archivo_id = cursor.lastrowid
+        for inicio in range(0, len(escritor.bloques), 1000):
+            cursor.executemany("""
+                INSERT INTO historial_archivo_bloques (incidente_id, archivo_id, desplazamiento, longitud, filas)
+                VALUES (%s, %s, %s, %s, %s)
+            """, [(incidente_id, archivo_id, desplazamiento, longitud, filas)
+                  for incidente_id, desplazamiento, longitud, filas in escritor.bloques[inicio:inicio + 1000]])
+        db.commit()
+
+        cursor.execute(f"ALTER TABLE historial DROP PARTITION {particion}")
+        logger.info(f"Partición {particion} archivada en {ruta}: {escritor.filas} filas, {escritor.bytes} bytes")
+        return {'particion': particion, 'ruta': ruta, 'filas': escritor.filas, 'bytes': escritor.bytes}
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def archivar(db, almacen, carpeta, antes_de, formato=None):
+    """Archiva los meses que terminan antes de ``antes_de`` (el más antiguo primero)"""
+    cursor = db.cursor()
+    try:
+        candidatas = [nombre for nombre, _ in particiones(cursor)
+                      if nombre != PARTICION_FUTURO and _siguiente_mes(mes_particion(nombre)) <= antes_de]
+    finally:
+        cursor.close()
+    resultados = []
+    for particion in candidatas:
+        resultado = archivar_particion(db, almacen, carpeta, particion, formato)
+        if resultado:
+            resultados.append(resultado)
+    return resultados
+
+
+# ==============================
+# CONSULTA
+# ==============================
+class _CacheBloques:
+    """Filas de un incidente por bloque leído, con expulsión LRU.
+
+    Los archivos no cambian una vez publicados, así que una entrada nunca
+    queda obsoleta: solo se expulsa por tamaño.
+    """
+
+    def __init__(self, max_filas):
+        self.max_filas = max_filas
+        self._entradas = OrderedDict()      # (ruta, desplazamiento, incidente_id) -> filas
+        self._filas = 0
+        self._lock = threading.Lock()
+
+    def leer(self, clave):
+        with self._lock:
+            filas = self._entradas.get(clave)
+            if filas is not None:
+                self._entradas.move_to_end(clave)
+            return filas
+
+    def guardar(self, clave, filas):
+        with self._lock:
+            if clave in self._entradas or len(filas) > self.max_filas:
+                return
+            self._entradas[clave] = filas
+            self._filas += len(filas)
+            while self._filas > self.max_filas:
+                _, expulsadas = self._entradas.popitem(last=False)
+                self._filas -= len(expulsadas)
+
+
+_cache_bloques = _CacheBloques(MAX_FILAS_CACHE)
+
+
+def _filas_bloque(almacen, incidente_id, ruta, formato, desplazamiento, longitud):
+    clave = (ruta, desplazamiento, incidente_id)
+    filas = _cache_bloques.leer(clave)
+    if filas is None:
+        datos = _descomprimir(formato, almacen.leer_rango(ruta, desplazamiento, longitud))
+        filas = []
+        for linea in datos.splitlines():
+            registro = json.loads(linea)
+            if registro['incidente_id'] == incidente_id:
+                registro['fecha'] = datetime.fromisoformat(registro['fecha'])
+                filas.append(registro)
+        _cache_bloques.guardar(clave, filas)
+    return filas
+
+
+def historial_archivado(db, almacen, incidente_id, limite=None):
+    """Filas archivadas de un incidente, de la más reciente a la más antigua.
+
+    Los bloques se leen del más nuevo al más antiguo (los meses no se
+    solapan y dentro de un archivo las filas de un incidente van por
+    fecha), así que con ``limite`` se deja de leer en cuanto hay bastantes.
+    """
+    cursor = db.cursor()
+    try:
+        cursor.execute("""
+            SELECT a.ruta, a.formato, b.desplazamiento, b.longitud
+            FROM historial_archivo_bloques b
+            JOIN historial_archivos a ON a.id = b.archivo_id
+            WHERE b.incidente_id = %s
+            ORDER BY a.desde DESC, b.desplazamiento DESC
+        """, (incidente_id,))
+        bloques = cursor.fetchall()
+    finally:
+        cursor.close()
+
+    filas = []
+    for bloque in bloques:
+        if limite and len(filas) >= limite:
+            break
+        filas.extend(_filas_bloque(almacen, incidente_id, *bloque))
+    # Copias: quien llama puede añadir claves (p. ej. incidente_titulo)
+    filas = [dict(fila) for fila in sorted(filas, key=lambda fila: (fila['fecha'], fila['id']), reverse=True)]
+    return filas[:limite] if limite else filas
+
+
+def contar_archivado(db, incidente_id):
+    cursor = db.cursor()
+    try:
+        cursor.execute("SELECT COALESCE(SUM(filas), 0) FROM historial_archivo_bloques WHERE incidente_id = %s",
+                       (incidente_id,))
+        return int(cursor.fetchone()[0])
+    finally:
+        cursor.close()
+
+
+def fusionar(recientes, archivadas, limite=None):
+    """Une filas de historial y archivadas (ambas de más reciente a más
+    antigua) sin repetir ids: entre el registro de un archivo y el DROP de
+    su partición una fila puede estar en los dos sitios"""
+    vistos = {fila['id'] for fila in recientes}
+    filas = list(recientes) + [fila for fila in archivadas if fila['id'] not in vistos]
+    return filas[:limite] if limite else filas
+
+
+def historial_incidente(db, almacen, incidente_id, limite=None):
+    """Línea de tiempo de un incidente, uniendo historial y lo archivado.
+
+    Los meses archivados son siempre anteriores a los que siguen en la
+    tabla, así que los archivos solo se leen si la tabla no llega a
+    ``limite`` filas.
+    """
+    cursor = db.cursor(dictionary=True)
+    try:
+        cursor.execute(f"""
+            SELECT * FROM historial
+            WHERE incidente_id = %s
+            ORDER BY fecha DESC, id DESC
+            {'LIMIT %s' if limite else ''}
+        """, (incidente_id, limite) if limite else (incidente_id,))
+        recientes = cursor.fetchall()
+    finally:
+        cursor.close()
+    if limite and len(recientes) >= limite:
+        return recientes
+    archivadas = historial_archivado(db, almacen, incidente_id, limite - len(recientes) if limite else None)
+    return fusionar(recientes, archivadas, limite)
@@ -0,0 +1,269 @@
+# asgi.py
+"""Modo de servicio ASGI: uvicorn asgi:aplicacion (o flask servir-asgi).
+
+Con workers síncronos cada cliente lento ocupa un worker mientras sube o
+descarga. Aquí las mismas rutas y plantillas de Flask se ejecutan en un
+grupo de ASGI_HILOS hilos, pero el bucle de eventos se ocupa de todo lo que
+depende de la velocidad del cliente:
+
+- el cuerpo de la petición se recibe entero antes de pasar la petición a
+  un hilo (en memoria hasta ASGI_CUERPO_MEMORIA_MB, después en un archivo
+  temporal), así que una subida lenta no ocupa ningún hilo;
+- las evidencias y los ZIP ya generados se entregan con wsgi.file_wrapper:
+  el hilo vuelve al grupo en cuanto tiene la respuesta y el archivo se lee
+  por bloques fuera del bucle y se envía al ritmo del cliente;
+- los flujos SSE los atiende ServidorEventos sin ningún hilo.
+
+Las rutas siguen usando get_db() y el pool síncrono: las consultas tardan
+lo que tarda MySQL, no lo que tarda el cliente, y su concurrencia ya la
+limita DB_POOL_SIZE. Solo las respuestas que Flask genera por partes (ZIP o
+informes al vuelo) siguen ocupando su hilo mientras se envían.
+"""
+import asyncio
+import logging
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app, get_canal_eventos
+from servidor_eventos import ServidorEventos, ruta_eventos
+
+logger = logging.getLogger(__name__)
+
+
+class ArchivoASGI:
+    """wsgi.file_wrapper: marca un archivo para enviarlo desde el bucle de eventos"""
+
+    def __init__(self, archivo, tamano_bloque=256 * 1024):
+        self.archivo = archivo
+        self.tamano_bloque = tamano_bloque
+
+    def __iter__(self):
+        # Por si algo intermedio recorre la respuesta en el hilo
+        while True:
+            bloque = self.archivo.read(self.tamano_bloque)
+            if not bloque:
+                break
+            yield bloque
+
+    def close(self):
+        self.archivo.close()
+
+
+def _entorno(scope, cuerpo, longitud):
+    """Entorno WSGI (PEP 3333) de una petición HTTP de ASGI"""
+    servidor = scope.get('server') or ('localhost', 80)
+    cliente = scope.get('client') or ('', 0)
+    entorno = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': servidor[0],
+        'SERVER_PORT': str(servidor[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': cliente[0],
+        'REMOTE_PORT': str(cliente[1]),
+        'CONTENT_LENGTH': str(longitud),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': cuerpo,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': ArchivoASGI
+    }
+    for nombre, valor in scope['headers']:
+        nombre = nombre.decode('latin-1').upper().replace('-', '_')
+        valor = valor.decode('latin-1')
+        if nombre == 'CONTENT_TYPE':
+            entorno['CONTENT_TYPE'] = valor
+            continue
+        if nombre == 'CONTENT_LENGTH':
+            continue                       # el cuerpo ya está completo
+        clave = f"HTTP_{nombre}"
+        entorno[clave] = f"{entorno[clave]},{valor}" if clave in entorno else valor
+    return entorno
+
+
+async def _esperar_desconexion(receive, desconectado):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+    desconectado.set()
+
+
+class AplicacionASGI:
+    """Aplicación ASGI que sirve una aplicación WSGI sin atar hilos a clientes lentos"""
+
+    def __init__(self, wsgi, hilos=32, cuerpo_memoria=1024 * 1024, max_cuerpo=None, eventos=None):
+        self.wsgi = wsgi
+        self.cuerpo_memoria = cuerpo_memoria
+        self.max_cuerpo = max_cuerpo
+        self.eventos = eventos
+        self._hilos = ThreadPoolExecutor(hilos, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._ciclo_de_vida(receive, send)
+        if scope['type'] != 'http':
+            return
+        if self.eventos is not None and scope['method'] == 'GET':
+            es_flujo, incidente_id = ruta_eventos(scope['path'])
+            if es_flujo:
+                return await self.eventos.asgi(scope, receive, send, incidente_id)
+        await self._wsgi(scope, receive, send)
+
+    async def _ciclo_de_vida(self, receive, send):
+        while True:
+            mensaje = await receive()
+            if mensaje['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif mensaje['type'] == 'lifespan.shutdown':
+                self._hilos.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _recibir_cuerpo(self, receive):
+        """Cuerpo completo en un archivo temporal (o None si el cliente se va);
+        lanza ValueError si supera ``max_cuerpo``"""
+        bucle = asyncio.get_running_loop()
+        cuerpo = tempfile.SpooledTemporaryFile(max_size=self.cuerpo_memoria)
+        recibidos = 0
+        try:
+            while True:
+                mensaje = await receive()
+                if mensaje['type'] == 'http.disconnect':
+                    cuerpo.close()
+                    return None, 0
+                datos = mensaje.get('body', b'')
+                if datos:
+                    recibidos += len(datos)
+                    if self.max_cuerpo and recibidos > self.max_cuerpo:
+                        raise ValueError(recibidos)
+                    if recibidos > self.cuerpo_memoria:
+                        # Ya en disco: la escritura no debe parar el bucle
+                        await bucle.run_in_executor(None, cuerpo.write, datos)
+                    else:
+                        cuerpo.write(datos)
+                if not mensaje.get('more_body', False):
+                    break
+        except BaseException:
+            cuerpo.close()
+            raise
+        cuerpo.seek(0)
+        return cuerpo, recibidos
+
+    async def _wsgi(self, scope, receive, send):
+        try:
+            cuerpo, longitud = await self._recibir_cuerpo(receive)
+        except ValueError:
+            await send({'type': 'http.response.start', 'status': 413,
+                        'headers': [(b'content-type', b'text/plain; charset=utf-8'), (b'connection', b'close')]})
+            await send({'type': 'http.response.body', 'body': b'Request Entity Too Large'})
+            return
+        if cuerpo is None:
+            return
+
+        bucle = asyncio.get_running_loop()
+        desconectado = threading.Event()
+        vigilancia = asyncio.ensure_future(_esperar_desconexion(receive, desconectado))
+        try:
+            archivo = await bucle.run_in_executor(
+                self._hilos, self._ejecutar, _entorno(scope, cuerpo, longitud), send, bucle, desconectado)
+            if archivo is not None:
+                await self._enviar_archivo(send, *archivo)
+        finally:
+            vigilancia.cancel()
+            cuerpo.close()
+
+    def _ejecutar(self, entorno, send, bucle, desconectado):
+        """Llama a la aplicación WSGI en un hilo del grupo.
+
+        Envía la respuesta desde aquí, salvo que sea un ArchivoASGI: entonces
+        devuelve (estado, cabeceras, archivo, longitud) para que lo envíe el
+        bucle y el hilo queda libre.
+        """
+        inicio = {}
+
+        def start_response(estado, cabeceras, exc_info=None):
+            if exc_info and inicio.get('enviado'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            inicio.update(estado=int(estado.split(' ', 1)[0]), cabeceras=[
+                (nombre.lower().encode('latin-1'), valor.encode('latin-1')) for nombre, valor in cabeceras
+            ])
+            return escribir
+
+        def enviar(mensaje):
+            asyncio.run_coroutine_threadsafe(send(mensaje), bucle).result()
+
+        def empezar():
+            if not inicio.get('enviado'):
+                inicio['enviado'] = True
+                enviar({'type': 'http.response.start', 'status': inicio['estado'], 'headers': inicio['cabeceras']})
+
+        def escribir(datos):
+            empezar()
+            if datos:
+                enviar({'type': 'http.response.body', 'body': datos, 'more_body': True})
+
+        try:
+            resultado = self.wsgi(entorno, start_response)
+        except Exception as e:
+            logger.error(f"Error atendiendo {entorno['REQUEST_METHOD']} {entorno['PATH_INFO']}: {e}")
+            inicio.update(estado=500, cabeceras=[(b'content-type', b'text/plain; charset=utf-8')])
+            resultado = [b'Internal Server Error']
+
+        if isinstance(resultado, ArchivoASGI):
+            longitud = next((int(valor) for nombre, valor in inicio['cabeceras'] if nombre == b'content-length'), None)
+            return inicio['estado'], inicio['cabeceras'], resultado, longitud
+
+        try:
+            for bloque in resultado:
+                if desconectado.is_set():
+                    break
+                escribir(bloque)
+            empezar()
+            enviar({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(resultado, 'close'):
+                resultado.close()
+        return None
+
+    async def _enviar_archivo(self, send, estado, cabeceras, archivo, longitud):
+        bucle = asyncio.get_running_loop()
+        try:
+            await send({'type': 'http.response.start', 'status': estado, 'headers': cabeceras})
+            restante = longitud
+            while restante is None or restante > 0:
+                tamano = archivo.tamano_bloque if restante is None else min(archivo.tamano_bloque, restante)
+                bloque = await bucle.run_in_executor(None, archivo.archivo.read, tamano)
+                if not bloque:
+                    break
+                if restante is not None:
+                    restante -= len(bloque)
+                await send({'type': 'http.response.body', 'body': bloque, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            archivo.close()
+
+
+def crear_aplicacion():
+    # Aquí los flujos SSE no ocupan hilos: las páginas ya pueden abrirlos
+    app.config["EVENTOS_EN_VIVO"] = True
+    return AplicacionASGI(
+        app,
+        hilos=app.config["ASGI_HILOS"],
+        cuerpo_memoria=app.config["ASGI_CUERPO_MEMORIA_MB"] * 1024 * 1024,
+        max_cuerpo=app.config["MAX_CONTENT_LENGTH"],
+        eventos=ServidorEventos(
+            get_canal_eventos(),
+            latido=app.config["EVENTOS_LATIDO"],
+            duracion=app.config["EVENTOS_DURACION"],
+            max_clientes=app.config["ASGI_MAX_CLIENTES_EVENTOS"]
+        )
+    )
+
+
+aplicacion = crear_aplicacion()
@@ -0,0 +1,84 @@
+# benchmarks/bench_almacen.py
+"""Mide subida, lectura y borrado en el almacén de evidencias configurado.
+
+Uso:
+    python benchmarks/bench_almacen.py                   # ALMACEN_CONFIG de config.py
+    EVIDENCIAS_ALMACEN=s3 S3_BUCKET=evidencias S3_ENDPOINT_URL=http://localhost:9000 \\
+        python benchmarks/bench_almacen.py --mb 500 --archivos 4
+
+Con S3 sirve contra MinIO (o cualquier S3 compatible): cada archivo se
+sube con colocar (multiparte, S3_HILOS partes en paralelo), se descarga con
+copia_local y se lee en streaming con abrir; después se comprueba que la URL
+firmada responde y se borra con retirar/purgar como al liberar un blob.
+"""
+import argparse
+import os
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from almacen_blobs import predeterminado  # noqa: E402
+
+
+class _Aleatorio:
+    """Flujo de ``tamano`` bytes pseudoaleatorios (contenido distinto por semilla)"""
+
+    def __init__(self, tamano, semilla):
+        self._restante = tamano
+        self._bloque = os.urandom(1024 * 1024 - 8) + semilla.to_bytes(8, 'big')
+
+    def read(self, n=-1):
+        n = self._restante if n < 0 else min(n, self._restante)
+        self._restante -= n
+        veces, resto = divmod(n, len(self._bloque))
+        return self._bloque * veces + self._bloque[:resto]
+
+
+def _mb_s(tamano, segundos):
+    return f"{tamano / 1024 / 1024 / segundos:.0f} MB/s"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mb', type=int, default=100, help='Tamaño de cada archivo')
+    parser.add_argument('--archivos', type=int, default=2)
+    args = parser.parse_args()
+
+    almacen = predeterminado()
+    tamano = args.mb * 1024 * 1024
+    print(f"Almacén {type(almacen).__name__}, {args.archivos} archivos de {args.mb} MB")
+
+    for n in range(args.archivos):
+        temporal, sha256, _ = almacen.recibir(_Aleatorio(tamano, time.time_ns() + n))
+
+        inicio = time.perf_counter()
+        ruta = almacen.colocar(temporal, sha256)
+        subida = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        with almacen.copia_local(ruta) as local:
+            assert os.path.getsize(local) == tamano
+        descarga = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        leidos = 0
+        with almacen.abrir(ruta) as flujo:
+            for bloque in iter(lambda: flujo.read(1024 * 1024), b''):
+                leidos += len(bloque)
+        lectura = time.perf_counter() - inicio
+        assert leidos == tamano
+
+        url = almacen.url_descarga(ruta, f"bench_{n}.bin", 'application/octet-stream')
+        if url:
+            with urllib.request.urlopen(urllib.request.Request(url, headers={'Range': 'bytes=0-0'})) as r:
+                estado_url = r.status
+
+        almacen.purgar(almacen.retirar(sha256))
+        print(f"  {sha256[:12]}: colocar {_mb_s(tamano, subida)}, copia_local {_mb_s(tamano, descarga)}, "
+              f"abrir {_mb_s(tamano, lectura)}" + (f", URL firmada {estado_url}" if url else ""))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# benchmarks/bench_ingesta.py
+"""Mide la importación masiva de incidentes (ingesta.importar) contra MySQL.
+
+Uso:
+    python benchmarks/bench_ingesta.py                   # 50 000 incidentes
+    python benchmarks/bench_ingesta.py --n 200000 --lote 2000
+
+Escribe en la base de datos de DB_CONFIG (con las migraciones aplicadas):
+los incidentes creados se borran al terminar salvo con --conservar.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mysql.connector  # noqa: E402
+
+import ingesta  # noqa: E402
+from app import DB_CONFIG  # noqa: E402
+
+_TITULOS = (
+    'Intento de phishing detectado', 'Escaneo de puertos desde {ip}', 'Malware en {host}',
+    'Inicio de sesión sospechoso de {ip}', 'Tráfico saliente anómalo en {host}'
+)
+
+
+def generar_ndjson(n, semilla=1):
+    """NDJSON con ``n`` alertas como las que enviaría un SIEM"""
+    rnd = random.Random(semilla)
+    lineas = []
+    for _ in range(n):
+        ip = f"203.0.113.{rnd.randrange(256)}"
+        host = f"srv-{rnd.randrange(500):03d}"
+        lineas.append(json.dumps({
+            'titulo': rnd.choice(_TITULOS).format(ip=ip, host=host),
+            'descripcion': f"Regla {rnd.randrange(1000, 9999)} disparada en {host} desde {ip}. " * 3,
+            'tipo': rnd.choice(sorted(ingesta.TIPOS)),
+            'severidad': rnd.choice(sorted(ingesta.SEVERIDADES)),
+            'usuario_reporta': 'siem'
+        }))
+    return '\n'.join(lineas).encode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--n', type=int, default=50000, help='Incidentes a importar')
+    parser.add_argument('--lote', type=int, default=ingesta.TAMANO_LOTE, help='Filas por transacción')
+    parser.add_argument('--conservar', action='store_true', help='No borrar los incidentes creados')
+    args = parser.parse_args()
+
+    datos = generar_ndjson(args.n)
+    conn = mysql.connector.connect(**DB_CONFIG)
+    try:
+        inicio = time.perf_counter()
+        resultados, creados = ingesta.importar(
+            conn, ingesta.leer_registros(io.BytesIO(datos)), 'bench', tamano_lote=args.lote
+        )
+        segundos = time.perf_counter() - inicio
+        total = sum(creados.values())
+        print(f"{total} incidentes en {segundos:.2f} s: {total / segundos:.0f} incidentes/s "
+              f"(lote {args.lote}, {len(datos) / 1024 / 1024:.1f} MB de NDJSON)")
+
+        if not args.conservar:
+            ids = [r['id'] for r in resultados if 'id' in r]
+            cursor = conn.cursor()
+            for i in range(0, len(ids), 10000):
+                parte = ids[i:i + 10000]
+                cursor.execute(f"DELETE FROM incidentes WHERE id IN ({', '.join(['%s'] * len(parte))})", parte)
+            conn.commit()
+            cursor.close()
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+# benchmarks/bench_pcap.py
+"""Mide el resumen de capturas (capturas.resumir) con archivos sintéticos.
+
+Uso:
+    python benchmarks/bench_pcap.py                 # 200 MB pcap y pcapng
+    python benchmarks/bench_pcap.py --mb 2000 --flujos 100000
+
+Genera las capturas en un directorio temporal (o en --dir), las resume y
+muestra MB/s, paquetes/s y memoria máxima. Para comparar con la velocidad
+del disco se mide también una lectura secuencial del mismo archivo.
+"""
+import argparse
+import os
+import random
+import resource
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from capturas import resumir  # noqa: E402
+
+
+def _paquete(rnd, flujos):
+    """Trama Ethernet + IPv4 + TCP/UDP con carga de tamaño variable"""
+    proto, origen, destino, sport, dport = flujos[rnd.randrange(len(flujos))]
+    carga = rnd.choice((0, 64, 512, 1400))
+    l4 = struct.pack('>HH', sport, dport) + b'\x00' * (16 if proto == 6 else 4)
+    total = 20 + len(l4) + carga
+    ip = struct.pack('>BBHHHBBH4s4s', 0x45, 0, total, 0, 0, 64, proto, 0, origen, destino)
+    return b'\x00\x11\x22\x33\x44\x55\x66\x77\x88\x99\xaa\xbb\x08\x00' + ip + l4 + b'\x00' * carga
+
+
+def _flujos(rnd, n):
+    return [
+        (rnd.choice((6, 6, 17)), rnd.randbytes(4), rnd.randbytes(4),
+         rnd.randrange(1024, 65535), rnd.choice((53, 80, 443, 445, 3389, 8080)))
+        for _ in range(n)
+    ]
+
+
+def generar_pcap(ruta, megas, flujos, semilla=1):
+    rnd = random.Random(semilla)
+    lista = _flujos(rnd, flujos)
+    limite = megas * 1024 * 1024
+    paquetes = 0
+    ts = 1700000000.0
+    with open(ruta, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        escrito = 24
+        while escrito < limite:
+            datos = _paquete(rnd, lista)
+            ts += 0.0001
+            f.write(struct.pack('<IIII', int(ts), int((ts % 1) * 1e6), len(datos), len(datos)))
+            f.write(datos)
+            escrito += 16 + len(datos)
+            paquetes += 1
+    return paquetes
+
+
+def generar_pcapng(ruta, megas, flujos, semilla=1):
+    rnd = random.Random(semilla)
+    lista = _flujos(rnd, flujos)
+    limite = megas * 1024 * 1024
+    paquetes = 0
+    ts = 1700000000 * 10 ** 6
+    with open(ruta, 'wb') as f:
+        f.write(struct.pack('<IIIHHqI', 0x0a0d0d0a, 28, 0x1a2b3c4d, 1, 0, -1, 28))
+        f.write(struct.pack('<IIHHII', 1, 20, 1, 0, 65535, 20))
+        escrito = 48
+        while escrito < limite:
+            datos = _paquete(rnd, lista)
+            relleno = (-len(datos)) % 4
+            longitud = 32 + len(datos) + relleno
+            ts += 100
+            f.write(struct.pack('<IIIIIII', 6, longitud, 0, ts >> 32, ts & 0xffffffff, len(datos), len(datos)))
+            f.write(datos + b'\x00' * relleno + struct.pack('<I', longitud))
+            escrito += longitud
+            paquetes += 1
+    return paquetes
+
+
+def lectura_secuencial(ruta):
+    inicio = time.perf_counter()
+    with open(ruta, 'rb') as f:
+        while f.read(8 * 1024 * 1024):
+            pass
+    return time.perf_counter() - inicio
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mb', type=int, default=200, help='Tamaño de cada captura')
+    parser.add_argument('--flujos', type=int, default=10000, help='Flujos distintos')
+    parser.add_argument('--dir', default=None, help='Directorio para las capturas')
+    args = parser.parse_args()
+
+    directorio = args.dir or tempfile.mkdtemp(prefix='bench_pcap_')
+    for formato, generar in (('pcap', generar_pcap), ('pcapng', generar_pcapng)):
+        ruta = os.path.join(directorio, f'sintetica_{args.mb}mb.{formato}')
+        if not os.path.exists(ruta):
+            print(f"Generando {ruta}...")
+            generar(ruta, args.mb, args.flujos)
+        megas = os.path.getsize(ruta) / 1024 / 1024
+
+        disco = lectura_secuencial(ruta)
+        inicio = time.perf_counter()
+        resumen = resumir(ruta)
+        segundos = time.perf_counter() - inicio
+        memoria = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+        print(f"{formato:7} {megas:8.1f} MB  {resumen['paquetes']:>10} paquetes  "
+              f"{segundos:6.2f} s  {megas / segundos:7.1f} MB/s  "
+              f"{resumen['paquetes'] / segundos:10.0f} paq/s  "
+              f"(lectura secuencial {megas / disco:7.1f} MB/s)  "
+              f"flujos {resumen['total_flujos']}  RSS máx {memoria:.0f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,434 @@
+# benchmarks/carga.py
+"""Pruebas de carga de las rutas de Flask sobre los datos de benchmarks/datos_carga.py.
+
+Uso:
+    python benchmarks/datos_carga.py                     # sembrar una vez
+    python benchmarks/carga.py                           # cliente de pruebas de Flask
+    python benchmarks/carga.py --modo wsgi --hilos 8     # servidor WSGI real (werkzeug) en este proceso
+    python benchmarks/carga.py --modo url --url http://localhost:8000 --pid 1234
+    python benchmarks/carga.py --escenarios listado,detalle --salida resultados.json
+    python benchmarks/carga.py --comparar anterior.json  # diferencias con otra ejecución
+
+Cada escenario repite una operación (una petición, o todas las de una
+subida por fragmentos) desde --hilos hilos hasta completar --peticiones,
+tras --calentamiento operaciones sin medir. Por escenario se informa de
+operaciones por segundo, latencia p50/p95/p99 y el pico de memoria
+residente (RSS) del proceso que sirve las peticiones mientras dura:
+este mismo con --modo cliente/wsgi, el de --pid con --modo url (sin
+--pid no se mide). Las respuestas se leen completas, sin seguir
+redirecciones; cuenta como error cualquier código >= 400 o excepción.
+El escenario zip mide la generación del ZIP mientras se envía con
+TRABAJOS_EN_SEGUNDO_PLANO=0; con trabajos en segundo plano solo mide
+encolarlo (o redirigir al ZIP ya construido).
+
+Los resultados se escriben en JSON con el commit, los parámetros y el
+tamaño de los datos, para comparar entre commits con --comparar.
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import app, codificar_cursor, get_db  # noqa: E402
+from datos_carga import generar_evidencia, ids_sembrados  # noqa: E402
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+# ==============================
+# CLIENTES
+# ==============================
+class ClienteFlask:
+    """Peticiones con el cliente de pruebas de Flask (sin red)"""
+
+    def __init__(self):
+        self._cliente = app.test_client()
+
+    def peticion(self, metodo, url, cuerpo=None, cabeceras=None, guardar=False):
+        respuesta = self._cliente.open(url, method=metodo, data=cuerpo, headers=cabeceras or {})
+        try:
+            bloques = list(respuesta.response) if guardar else None
+            leidos = sum(len(bloque) for bloque in bloques or respuesta.response)
+        finally:
+            respuesta.close()
+        return respuesta.status_code, leidos, b''.join(bloques) if guardar else None
+
+    def cerrar(self):
+        pass
+
+
+class ClienteHTTP:
+    """Peticiones HTTP/1.1 con conexión persistente (una por hilo)"""
+
+    def __init__(self, url):
+        partes = urllib.parse.urlsplit(url)
+        self._host = partes.hostname
+        self._puerto = partes.port or 80
+        self._conexion = None
+
+    def peticion(self, metodo, url, cuerpo=None, cabeceras=None, guardar=False):
+        if self._conexion is None:
+            self._conexion = http.client.HTTPConnection(self._host, self._puerto, timeout=120)
+        try:
+            self._conexion.request(metodo, url, body=cuerpo, headers=cabeceras or {})
+            respuesta = self._conexion.getresponse()
+            bloques = []
+            leidos = 0
+            for bloque in iter(lambda: respuesta.read(256 * 1024), b''):
+                leidos += len(bloque)
+                if guardar:
+                    bloques.append(bloque)
+        except Exception:
+            self.cerrar()
+            raise
+        if respuesta.will_close:
+            self.cerrar()
+        return respuesta.status, leidos, b''.join(bloques) if guardar else None
+
+    def cerrar(self):
+        if self._conexion is not None:
+            self._conexion.close()
+            self._conexion = None
+
+
+def servidor_wsgi():
+    """Arranca la aplicación en un servidor WSGI con hilos; devuelve (url, servidor)"""
+    from werkzeug.serving import make_server
+    servidor = make_server('127.0.0.1', 0, app, threaded=True)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{servidor.server_port}", servidor
+
+
+# ==============================
+# MEMORIA
+# ==============================
+class MedidorRSS:
+    """Muestrea la memoria residente de un proceso en un hilo aparte"""
+
+    def __init__(self, pid, intervalo=0.02):
+        self.pid = pid
+        self.intervalo = intervalo
+        self._pagina = os.sysconf('SC_PAGE_SIZE')
+        self._pico = 0
+        self._parar = threading.Event()
+        self._hilo = None
+
+    def actual(self):
+        """Bytes residentes; sin /proc, el máximo de getrusage de este proceso"""
+        if self.pid is None:
+            return None
+        try:
+            with open(f"/proc/{self.pid}/statm") as f:
+                return int(f.read().split()[1]) * self._pagina
+        except OSError:
+            if self.pid != os.getpid():
+                return None
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _muestrear(self):
+        while not self._parar.wait(self.intervalo):
+            self._pico = max(self._pico, self.actual() or 0)
+
+    def __enter__(self):
+        self._pico = self.actual() or 0
+        self._parar.clear()
+        self._hilo = threading.Thread(target=self._muestrear, daemon=True)
+        self._hilo.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._parar.set()
+        self._hilo.join()
+        self._pico = max(self._pico, self.actual() or 0)
+
+    @property
+    def pico(self):
+        return self._pico
+
+
+# ==============================
+# ESCENARIOS
+# ==============================
+class Datos:
+    """Ids de los datos sembrados de los que salen las URL"""
+
+    def __init__(self):
+        with app.app_context():
+            db = get_db()
+            cursor = db.cursor()
+            try:
+                self.incidentes = ids_sembrados(cursor)
+                if not self.incidentes:
+                    raise SystemExit("No hay datos sembrados: ejecute antes benchmarks/datos_carga.py")
+                cursor.execute("""
+                    SELECT e.id, e.incidente_id FROM evidencias e
+                    JOIN incidentes i ON i.id = e.incidente_id
+                    WHERE i.usuario_reporta = 'carga'
+                """)
+                filas = cursor.fetchall()
+                self.evidencias = [fila[0] for fila in filas]
+                self.con_evidencias = sorted({fila[1] for fila in filas})
+                cursor.execute("SELECT COUNT(*) FROM historial")
+                historial = cursor.fetchone()[0]
+            finally:
+                cursor.close()
+                db.close()
+        self.resumen = {
+            'incidentes': len(self.incidentes),
+            'evidencias': len(self.evidencias),
+            'historial': historial
+        }
+
+
+def _multipart(nombre, contenido, campo='evidencias'):
+    limite = uuid.uuid4().hex
+    cuerpo = (f'--{limite}\r\nContent-Disposition: form-data; name="{campo}"; filename="{nombre}"\r\n'
+              f'Content-Type: application/octet-stream\r\n\r\n').encode() + contenido + f'\r\n--{limite}--\r\n'.encode()
+    return cuerpo, {'Content-Type': f'multipart/form-data; boundary={limite}'}
+
+
+def _get(url):
+    def operacion(cliente, datos, rnd):
+        return [cliente.peticion('GET', url(datos, rnd) if callable(url) else url)]
+    return operacion
+
+
+def _subida(cliente, datos, rnd):
+    nombre, contenido = generar_evidencia(rnd, 0.1)
+    cuerpo, cabeceras = _multipart(nombre, contenido)
+    url = f"/incidentes/{rnd.choice(datos.incidentes)}/evidencias/agregar"
+    return [cliente.peticion('POST', url, cuerpo, cabeceras)]
+
+
+def _subida_fragmentos(cliente, datos, rnd, fragmento=1024 * 1024):
+    nombre, contenido = generar_evidencia(rnd, 0.2)
+    json_ = {'Content-Type': 'application/json'}
+    respuestas = [cliente.peticion(
+        'POST', f"/api/incidentes/{rnd.choice(datos.incidentes)}/subidas",
+        json.dumps({'nombre': nombre, 'tamano': len(contenido)}).encode(), json_, guardar=True
+    )]
+    if respuestas[0][0] != 201:
+        return respuestas
+    subida_id = json.loads(respuestas[0][2])['subida_id']
+    for inicio in range(0, len(contenido), fragmento):
+        parte = contenido[inicio:inicio + fragmento]
+        rango = f"bytes {inicio}-{inicio + len(parte) - 1}/{len(contenido)}"
+        respuestas.append(cliente.peticion('PUT', f"/api/subidas/{subida_id}", parte,
+                                           {'Content-Range': rango, 'Content-Type': 'application/octet-stream'}))
+    respuestas.append(cliente.peticion('POST', f"/api/subidas/{subida_id}/finalizar", b'{}', json_))
+    return respuestas
+
+
+ESCENARIOS = {
+    'panel': _get('/'),
+    'listado': _get('/incidentes'),
+    'listado_filtrado': _get('/incidentes?estado=Abierto&severidad=critica'),
+    'listado_profundo': _get(lambda datos, rnd: "/incidentes?cursor="
+                             + codificar_cursor(datetime.now() - timedelta(days=rnd.randrange(30, 330)), 2 ** 31 - 1)),
+    'detalle': _get(lambda datos, rnd: f"/incidentes/{rnd.choice(datos.con_evidencias or datos.incidentes)}"),
+    'historial': _get('/historial'),
+    'historial_filtrado': _get(lambda datos, rnd: f"/historial?incidente={rnd.choice(datos.incidentes)}"),
+    'api_historial': _get('/api/historial?accion=COMENTARIO'),
+    'busqueda': _get(lambda datos, rnd: f"/buscar?q={rnd.choice(('phishing', 'malware', 'srv-042', '203.0.113.7'))}"),
+    'descarga': _get(lambda datos, rnd: f"/descargar/{rnd.choice(datos.evidencias)}"),
+    'zip': _get(lambda datos, rnd: f"/incidentes/{rnd.choice(datos.con_evidencias)}/descargar-todo"),
+    'subida': _subida,
+    'subida_fragmentos': _subida_fragmentos,
+}
+
+
+# ==============================
+# EJECUCIÓN Y RESULTADOS
+# ==============================
+def percentil(ordenados, p):
+    """Percentil por rango más cercano de una lista ordenada"""
+    if not ordenados:
+        return None
+    return ordenados[max(0, math.ceil(p / 100 * len(ordenados)) - 1)]
+
+
+def ejecutar(nombre, crear_cliente, datos, peticiones, hilos, calentamiento, medidor, semilla):
+    operacion = ESCENARIOS[nombre]
+    latencias = []
+    errores = []
+    bytes_leidos = [0]
+    lock = threading.Lock()
+
+    def trabajar(indice, cantidad, medir):
+        rnd = random.Random(f"{semilla}:{nombre}:{indice}:{medir}")
+        cliente = crear_cliente()
+        propias = []
+        try:
+            for _ in range(cantidad):
+                inicio = time.perf_counter()
+                try:
+                    respuestas = operacion(cliente, datos, rnd)
+                    fallo = next((str(codigo) for codigo, _, _ in respuestas if codigo >= 400), None)
+                except Exception as e:
+                    respuestas, fallo = [], type(e).__name__
+                propias.append(time.perf_counter() - inicio)
+                if medir:
+                    with lock:
+                        bytes_leidos[0] += sum(leidos for _, leidos, _ in respuestas)
+                        if fallo:
+                            errores.append(fallo)
+        finally:
+            cliente.cerrar()
+        if medir:
+            with lock:
+                latencias.extend(propias)
+
+    def repartir(total, medir):
+        partes = [total // hilos + (1 if i < total % hilos else 0) for i in range(hilos)]
+        trabajadores = [threading.Thread(target=trabajar, args=(i, parte, medir))
+                        for i, parte in enumerate(partes) if parte]
+        for trabajador in trabajadores:
+            trabajador.start()
+        for trabajador in trabajadores:
+            trabajador.join()
+
+    if calentamiento:
+        repartir(calentamiento, False)
+    with medidor:
+        inicio = time.perf_counter()
+        repartir(peticiones, True)
+        segundos = time.perf_counter() - inicio
+
+    latencias.sort()
+    ms = lambda valor: None if valor is None else round(valor * 1000, 2)  # noqa: E731
+    return {
+        'operaciones': len(latencias),
+        'errores': len(errores),
+        'tipos_error': {tipo: errores.count(tipo) for tipo in sorted(set(errores))},
+        'segundos': round(segundos, 3),
+        'operaciones_s': round(len(latencias) / segundos, 1) if segundos else None,
+        'mb_s': round(bytes_leidos[0] / 1024 / 1024 / segundos, 1) if segundos else None,
+        'p50_ms': ms(percentil(latencias, 50)),
+        'p95_ms': ms(percentil(latencias, 95)),
+        'p99_ms': ms(percentil(latencias, 99)),
+        'max_ms': ms(latencias[-1] if latencias else None),
+        'rss_pico_mb': round(medidor.pico / 1024 / 1024, 1) if medidor.pico else None
+    }
+
+
+def commit_actual():
+    try:
+        salida = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ,
+                                capture_output=True, text=True, timeout=10)
+        return salida.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def _delta(actual, anterior):
+    if actual is None or not anterior:
+        return ''
+    return f"{(actual - anterior) / anterior * 100:+.0f}%"
+
+
+def imprimir(resultados, anteriores=None):
+    anteriores = (anteriores or {}).get('escenarios', {})
+    print(f"{'escenario':<20} {'ops/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'RSS MB':>8} {'errores':>8}"
+          + ("   Δ ops/s  Δ p95" if anteriores else ""))
+    for nombre, r in resultados.items():
+        linea = (f"{nombre:<20} {r['operaciones_s'] or 0:>8} {r['p50_ms'] or 0:>9} {r['p95_ms'] or 0:>9} "
+                 f"{r['p99_ms'] or 0:>9} {r['rss_pico_mb'] or '-':>8} {r['errores']:>8}")
+        if nombre in anteriores:
+            previo = anteriores[nombre]
+            linea += (f"   {_delta(r['operaciones_s'], previo.get('operaciones_s')):>7}"
+                      f"  {_delta(r['p95_ms'], previo.get('p95_ms')):>5}")
+        print(linea)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modo', choices=('cliente', 'wsgi', 'url'), default='cliente')
+    parser.add_argument('--url', help='Servidor a probar con --modo url')
+    parser.add_argument('--pid', type=int, help='Proceso del servidor con --modo url (para el RSS)')
+    parser.add_argument('--escenarios', default=','.join(ESCENARIOS),
+                        help=f"Separados por comas (por defecto todos: {', '.join(ESCENARIOS)})")
+    parser.add_argument('--peticiones', type=int, default=500, help='Operaciones medidas por escenario')
+    parser.add_argument('--hilos', type=int, default=4)
+    parser.add_argument('--calentamiento', type=int, default=20)
+    parser.add_argument('--semilla', type=int, default=1)
+    parser.add_argument('--salida', default='resultados_carga.json')
+    parser.add_argument('--comparar', help='JSON de una ejecución anterior')
+    args = parser.parse_args()
+
+    escenarios = [nombre.strip() for nombre in args.escenarios.split(',') if nombre.strip()]
+    desconocidos = [nombre for nombre in escenarios if nombre not in ESCENARIOS]
+    if desconocidos:
+        parser.error(f"Escenarios desconocidos: {', '.join(desconocidos)}")
+    if args.modo == 'url' and not args.url:
+        parser.error("--modo url necesita --url")
+
+    datos = Datos()
+    if not datos.evidencias:
+        escenarios = [e for e in escenarios if e not in ('descarga', 'zip')]
+
+    servidor = None
+    if args.modo == 'cliente':
+        crear_cliente = ClienteFlask
+    else:
+        url = args.url
+        if args.modo == 'wsgi':
+            url, servidor = servidor_wsgi()
+        crear_cliente = lambda: ClienteHTTP(url)  # noqa: E731
+    medidor = MedidorRSS(args.pid if args.modo == 'url' else os.getpid())
+
+    print(f"Modo {args.modo}, {args.hilos} hilos, {args.peticiones} operaciones por escenario; "
+          f"datos: {datos.resumen['incidentes']} incidentes, {datos.resumen['evidencias']} evidencias, "
+          f"{datos.resumen['historial']} filas de historial")
+    resultados = {}
+    try:
+        for nombre in escenarios:
+            resultados[nombre] = ejecutar(nombre, crear_cliente, datos, args.peticiones, args.hilos,
+                                          args.calentamiento, medidor, args.semilla)
+            r = resultados[nombre]
+            print(f"  {nombre}: {r['operaciones_s']} ops/s, p95 {r['p95_ms']} ms, {r['errores']} errores")
+    finally:
+        if servidor is not None:
+            servidor.shutdown()
+
+    informe = {
+        'commit': commit_actual(),
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'modo': args.modo,
+        'parametros': {
+            'hilos': args.hilos,
+            'peticiones': args.peticiones,
+            'calentamiento': args.calentamiento,
+            'semilla': args.semilla,
+            'trabajos_en_segundo_plano': app.config["TRABAJOS_EN_SEGUNDO_PLANO"],
+            'python': sys.version.split()[0]
+        },
+        'datos': datos.resumen,
+        'escenarios': resultados
+    }
+    with open(args.salida, 'w', encoding='utf-8') as f:
+        json.dump(informe, f, indent=2, ensure_ascii=False)
+
+    anteriores = None
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            anteriores = json.load(f)
+        print(f"Comparado con {anteriores.get('commit')} ({anteriores.get('fecha')})")
+    imprimir(resultados, anteriores)
+    print(f"Resultados en {args.salida}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+# benchmarks/clientes_lentos.py
+"""Despliegue síncrono frente a modo ASGI con muchos clientes lentos.
+
+Uso (con los datos de benchmarks/datos_carga.py):
+    gunicorn -w 4 -b 127.0.0.1:8000 app:app
+    python benchmarks/clientes_lentos.py --url http://127.0.0.1:8000 --pid <pid> \\
+        --etiqueta sync --salida lentos_sync.json
+
+    flask servir-asgi --puerto 8001            # o: uvicorn asgi:aplicacion --port 8001
+    python benchmarks/clientes_lentos.py --url http://127.0.0.1:8001 --pid <pid> \\
+        --etiqueta asgi --comparar lentos_sync.json
+
+Para cada número de clientes lentos de --lentos se mantienen abiertas
+durante --segundos esas conexiones: la mitad descarga las evidencias más
+grandes leyendo a --velocidad bytes/s (con un búfer de recepción pequeño,
+para que el servidor tenga que esperar al cliente) y la otra mitad sube un
+fragmento de una subida por fragmentos a la misma velocidad. Cuando una
+termina se abre otra. Mientras tanto --sondas hilos piden páginas normales
+(panel, listado, detalle) y se mide su latencia: con workers síncronos
+suben en cuanto los clientes lentos ocupan todos los workers; en modo ASGI
+deberían quedarse como en el nivel 0.
+
+Por nivel se informa de las sondas (operaciones por segundo, p50/p95/p99,
+errores), de los clientes lentos (tiempo hasta la primera respuesta,
+completados, errores) y del pico de RSS del proceso de --pid (del maestro
+de gunicorn solo cuenta ese proceso: pase el de un worker, o compare con
+-w 1). Los resultados se guardan en JSON como los de carga.py.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import app, get_db  # noqa: E402
+from carga import ClienteHTTP, Datos, MedidorRSS, _delta, commit_actual, percentil  # noqa: E402
+
+BUFER_RECEPCION = 4096
+FRAGMENTO_SUBIDA = 256 * 1024
+
+
+def evidencias_grandes(limite=20):
+    """Ids de las evidencias sembradas más grandes (las que más tarda un cliente lento)"""
+    with app.app_context():
+        db = get_db()
+        cursor = db.cursor()
+        try:
+            cursor.execute("""
+                SELECT e.id FROM evidencias e
+                JOIN incidentes i ON i.id = e.incidente_id
+                WHERE i.usuario_reporta = 'carga' AND e.ruta IS NOT NULL
+                ORDER BY e.tamano DESC LIMIT %s
+            """, (limite,))
+            return [fila[0] for fila in cursor.fetchall()]
+        finally:
+            cursor.close()
+            db.close()
+
+
+# ==============================
+# CLIENTES LENTOS (asyncio)
+# ==============================
+class ClientesLentos:
+    """Mantiene ``cantidad`` conexiones lentas abiertas hasta ``parar``"""
+
+    def __init__(self, url, datos, grandes, cantidad, velocidad, semilla):
+        partes = urllib.parse.urlsplit(url)
+        self.host = partes.hostname
+        self.puerto = partes.port or 80
+        self.datos = datos
+        self.grandes = grandes
+        self.cantidad = cantidad
+        self.velocidad = velocidad
+        self.rnd = random.Random(semilla)
+        self.primer_byte = []
+        self.completados = 0
+        self.errores = []
+        self.bytes = 0
+        self._parar = None
+
+    async def _conectar(self):
+        conexion = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conexion.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, BUFER_RECEPCION)
+        conexion.setblocking(False)
+        await asyncio.get_running_loop().sock_connect(conexion, (self.host, self.puerto))
+        return await asyncio.open_connection(sock=conexion)
+
+    async def _cabecera(self, lector):
+        """Código de estado y cabeceras de la respuesta"""
+        linea = await lector.readline()
+        if not linea:
+            raise ConnectionError("Conexión cerrada sin respuesta")
+        codigo = int(linea.split()[1])
+        cabeceras = {}
+        while True:
+            linea = await lector.readline()
+            if linea in (b'\r\n', b''):
+                return codigo, cabeceras
+            nombre, _, valor = linea.decode('latin-1').partition(':')
+            cabeceras[nombre.strip().lower()] = valor.strip()
+
+    async def _peticion(self, metodo, ruta, cuerpo=b'', cabeceras=None):
+        """Petición rápida (preparar o cancelar una subida); devuelve (código, cuerpo)"""
+        lector, escritor = await asyncio.open_connection(self.host, self.puerto)
+        try:
+            extra = ''.join(f"{nombre}: {valor}\r\n" for nombre, valor in (cabeceras or {}).items())
+            escritor.write(f"{metodo} {ruta} HTTP/1.1\r\nHost: {self.host}\r\nConnection: close\r\n"
+                           f"Content-Length: {len(cuerpo)}\r\n{extra}\r\n".encode('latin-1') + cuerpo)
+            await escritor.drain()
+            codigo, _ = await self._cabecera(lector)
+            return codigo, await lector.read()
+        finally:
+            escritor.close()
+
+    async def _goteo(self, escribir_o_leer, total):
+        """Mueve ``total`` bytes a ``velocidad`` bytes/s en pasos de 0,1 s"""
+        paso = max(1, self.velocidad // 10)
+        movidos = 0
+        while movidos < total and not self._parar.is_set():
+            cantidad = await escribir_o_leer(min(paso, total - movidos))
+            movidos += cantidad
+            self.bytes += cantidad
+            await asyncio.sleep(0.1)
+        return movidos >= total
+
+    async def _descarga(self):
+        lector, escritor = await self._conectar()
+        try:
+            inicio = time.perf_counter()
+            escritor.write(f"GET /descargar/{self.rnd.choice(self.grandes)} HTTP/1.1\r\n"
+                           f"Host: {self.host}\r\nConnection: close\r\n\r\n".encode('latin-1'))
+            await escritor.drain()
+            codigo, cabeceras = await self._cabecera(lector)
+            self.primer_byte.append(time.perf_counter() - inicio)
+            if codigo >= 400:
+                raise ConnectionError(str(codigo))
+
+            async def leer(cantidad):
+                bloque = await lector.read(cantidad)
+                if not bloque:
+                    raise ConnectionError("Descarga cortada")
+                return len(bloque)
+
+            if await self._goteo(leer, int(cabeceras.get('content-length', 0))):
+                self.completados += 1
+        finally:
+            escritor.close()
+
+    async def _subida(self):
+        incidente = self.rnd.choice(self.datos.incidentes)
+        codigo, cuerpo = await self._peticion(
+            'POST', f"/api/incidentes/{incidente}/subidas",
+            json.dumps({'nombre': 'lento.log', 'tamano': FRAGMENTO_SUBIDA}).encode(),
+            {'Content-Type': 'application/json'})
+        if codigo != 201:
+            raise ConnectionError(str(codigo))
+        subida_id = json.loads(cuerpo)['subida_id']
+        lector, escritor = await self._conectar()
+        try:
+            escritor.write(f"PUT /api/subidas/{subida_id} HTTP/1.1\r\nHost: {self.host}\r\nConnection: close\r\n"
+                           f"Content-Type: application/octet-stream\r\nContent-Length: {FRAGMENTO_SUBIDA}\r\n"
+                           f"Content-Range: bytes 0-{FRAGMENTO_SUBIDA - 1}/{FRAGMENTO_SUBIDA}\r\n\r\n"
+                           .encode('latin-1'))
+
+            async def escribir(cantidad):
+                escritor.write(b'x' * cantidad)
+                await escritor.drain()
+                return cantidad
+
+            if await self._goteo(escribir, FRAGMENTO_SUBIDA):
+                inicio = time.perf_counter()
+                codigo, _ = await self._cabecera(lector)
+                self.primer_byte.append(time.perf_counter() - inicio)
+                if codigo >= 400:
+                    raise ConnectionError(str(codigo))
+                self.completados += 1
+        finally:
+            escritor.close()
+            await self._peticion('DELETE', f"/api/subidas/{subida_id}")
+
+    async def _cliente(self, indice):
+        operacion = self._descarga if indice % 2 == 0 or not self.datos.incidentes else self._subida
+        while not self._parar.is_set():
+            try:
+                await operacion()
+            except Exception as e:
+                if not self._parar.is_set():
+                    self.errores.append(str(e) or type(e).__name__)
+                    await asyncio.sleep(0.5)
+
+    async def ejecutar(self, parar):
+        self._parar = asyncio.Event()
+        clientes = [asyncio.ensure_future(self._cliente(i)) for i in range(self.cantidad)]
+        await asyncio.get_running_loop().run_in_executor(None, parar.wait)
+        self._parar.set()
+        if clientes:
+            await asyncio.wait(clientes, timeout=10)
+        for cliente in clientes:
+            cliente.cancel()
+
+
+# ==============================
+# SONDAS Y NIVELES
+# ==============================
+def sondear(url, datos, hilos, parar, semilla):
+    """Peticiones normales en bucle hasta ``parar``; devuelve (latencias, errores)"""
+    latencias = []
+    errores = []
+    lock = threading.Lock()
+    rutas = [
+        lambda rnd: '/',
+        lambda rnd: '/incidentes',
+        lambda rnd: f"/incidentes/{rnd.choice(datos.con_evidencias or datos.incidentes)}"
+    ]
+
+    def trabajar(indice):
+        rnd = random.Random(f"{semilla}:sonda:{indice}")
+        cliente = ClienteHTTP(url)
+        try:
+            while not parar.is_set():
+                inicio = time.perf_counter()
+                try:
+                    codigo, _, _ = cliente.peticion('GET', rnd.choice(rutas)(rnd))
+                    fallo = str(codigo) if codigo >= 400 else None
+                except Exception as e:
+                    fallo = type(e).__name__
+                    cliente.cerrar()
+                with lock:
+                    latencias.append(time.perf_counter() - inicio)
+                    if fallo:
+                        errores.append(fallo)
+        finally:
+            cliente.cerrar()
+
+    trabajadores = [threading.Thread(target=trabajar, args=(i,)) for i in range(hilos)]
+    for trabajador in trabajadores:
+        trabajador.start()
+    return trabajadores, latencias, errores
+
+
+def nivel(url, datos, grandes, cantidad, args, medidor):
+    lentos = ClientesLentos(url, datos, grandes, cantidad, args.velocidad, f"{args.semilla}:{cantidad}")
+    parar = threading.Event()
+    hilo_lentos = threading.Thread(target=asyncio.run, args=(lentos.ejecutar(parar),))
+    with medidor:
+        hilo_lentos.start()
+        time.sleep(args.preparacion if cantidad else 0)   # que los lentos lleguen a conectarse
+        trabajadores, latencias, errores = sondear(url, datos, args.sondas, parar, args.semilla)
+        inicio = time.perf_counter()
+        time.sleep(args.segundos)
+        parar.set()
+        for trabajador in trabajadores:
+            trabajador.join()
+        segundos = time.perf_counter() - inicio
+        hilo_lentos.join()
+
+    latencias.sort()
+    primer_byte = sorted(lentos.primer_byte)
+    ms = lambda valor: None if valor is None else round(valor * 1000, 2)  # noqa: E731
+    return {
+        'sondas': {
+            'operaciones': len(latencias),
+            'operaciones_s': round(len(latencias) / segundos, 1) if segundos else None,
+            'errores': len(errores),
+            'tipos_error': {tipo: errores.count(tipo) for tipo in sorted(set(errores))},
+            'p50_ms': ms(percentil(latencias, 50)),
+            'p95_ms': ms(percentil(latencias, 95)),
+            'p99_ms': ms(percentil(latencias, 99)),
+            'max_ms': ms(latencias[-1] if latencias else None)
+        },
+        'lentos': {
+            'clientes': cantidad,
+            'completados': lentos.completados,
+            'errores': len(lentos.errores),
+            'tipos_error': {tipo: lentos.errores.count(tipo) for tipo in sorted(set(lentos.errores))},
+            'primera_respuesta_p50_ms': ms(percentil(primer_byte, 50)),
+            'primera_respuesta_p95_ms': ms(percentil(primer_byte, 95)),
+            'mb_movidos': round(lentos.bytes / 1024 / 1024, 1)
+        },
+        'rss_pico_mb': round(medidor.pico / 1024 / 1024, 1) if medidor.pico else None
+    }
+
+
+def imprimir(resultados, anteriores=None):
+    anteriores = (anteriores or {}).get('niveles', {})
+    print(f"{'lentos':>7} {'ops/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'err':>6} "
+          f"{'1ª resp p95':>12} {'lentos err':>11} {'RSS MB':>8}"
+          + ("   Δ ops/s  Δ p95" if anteriores else ""))
+    for clave, r in resultados.items():
+        s, l = r['sondas'], r['lentos']
+        linea = (f"{clave:>7} {s['operaciones_s'] or 0:>8} {s['p50_ms'] or 0:>9} {s['p95_ms'] or 0:>9} "
+                 f"{s['p99_ms'] or 0:>9} {s['errores']:>6} {l['primera_respuesta_p95_ms'] or '-':>12} "
+                 f"{l['errores']:>11} {r['rss_pico_mb'] or '-':>8}")
+        if clave in anteriores:
+            previo = anteriores[clave]['sondas']
+            linea += (f"   {_delta(s['operaciones_s'], previo.get('operaciones_s')):>7}"
+                      f"  {_delta(s['p95_ms'], previo.get('p95_ms')):>5}")
+        print(linea)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', required=True, help='Servidor a probar')
+    parser.add_argument('--pid', type=int, help='Proceso del servidor (para el RSS)')
+    parser.add_argument('--etiqueta', default='', help='Nombre del despliegue (sync, asgi...)')
+    parser.add_argument('--lentos', default='0,50,500', help='Clientes lentos por nivel, separados por comas')
+    parser.add_argument('--velocidad', type=int, default=16 * 1024, help='Bytes/s de cada cliente lento')
+    parser.add_argument('--segundos', type=float, default=20, help='Duración de cada nivel')
+    parser.add_argument('--preparacion', type=float, default=3, help='Espera a que conecten los lentos')
+    parser.add_argument('--sondas', type=int, default=4, help='Hilos que piden páginas normales')
+    parser.add_argument('--semilla', type=int, default=1)
+    parser.add_argument('--salida', default='resultados_lentos.json')
+    parser.add_argument('--comparar', help='JSON de otra ejecución (otro despliegue o commit)')
+    args = parser.parse_args()
+
+    try:
+        niveles = [int(valor) for valor in args.lentos.split(',') if valor.strip()]
+    except ValueError:
+        parser.error("--lentos debe ser una lista de enteros")
+
+    datos = Datos()
+    grandes = evidencias_grandes()
+    if not grandes:
+        raise SystemExit("No hay evidencias sembradas: ejecute benchmarks/datos_carga.py con --evidencias")
+    medidor = MedidorRSS(args.pid)
+
+    print(f"{args.etiqueta or args.url}: niveles {niveles}, {args.velocidad} B/s por cliente lento, "
+          f"{args.sondas} sondas, {args.segundos:g} s por nivel")
+    resultados = {}
+    for cantidad in niveles:
+        resultados[str(cantidad)] = r = nivel(args.url, datos, grandes, cantidad, args, medidor)
+        print(f"  {cantidad} lentos: sondas {r['sondas']['operaciones_s']} ops/s, p95 {r['sondas']['p95_ms']} ms, "
+              f"{r['sondas']['errores']} errores; lentos: {r['lentos']['errores']} errores")
+
+    informe = {
+        'commit': commit_actual(),
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'etiqueta': args.etiqueta,
+        'url': args.url,
+        'parametros': {
+            'velocidad': args.velocidad,
+            'segundos': args.segundos,
+            'sondas': args.sondas,
+            'semilla': args.semilla,
+            'python': sys.version.split()[0]
+        },
+        'datos': datos.resumen,
+        'niveles': resultados
+    }
+    with open(args.salida, 'w', encoding='utf-8') as f:
+        json.dump(informe, f, indent=2, ensure_ascii=False)
+
+    anteriores = None
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            anteriores = json.load(f)
+        print(f"Comparado con {anteriores.get('etiqueta') or anteriores.get('url')} "
+              f"({anteriores.get('commit')}, {anteriores.get('fecha')})")
+    imprimir(resultados, anteriores)
+    print(f"Resultados en {args.salida}")
+
+
+if __name__ == '__main__':
+    main()
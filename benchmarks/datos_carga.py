@@ -0,0 +1,278 @@
+# benchmarks/datos_carga.py
+"""Siembra un conjunto de datos grande para las pruebas de carga (benchmarks/carga.py).
+
+Uso:
+    python benchmarks/datos_carga.py                     # 20 000 incidentes, 2 000 evidencias, 500 000 filas de historial
+    python benchmarks/datos_carga.py --incidentes 200000 --evidencias 10000 --historial 5000000
+    python benchmarks/datos_carga.py --escala 0.1        # evidencias 10 veces más pequeñas
+    python benchmarks/datos_carga.py --limpiar           # borra todo lo sembrado
+
+Escribe en la base de datos de DB_CONFIG (con las migraciones aplicadas) y
+en el almacén de evidencias configurado. Todo lo sembrado pertenece a
+incidentes con usuario_reporta='carga', así que --limpiar (o volver a
+sembrar) lo borra sin tocar el resto. Con la misma --semilla el conjunto es
+el mismo, para comparar resultados entre commits.
+
+- Incidentes: con ingesta.importar (también su historial de creación y su
+  índice de búsqueda), repartidos en el último año.
+- Evidencias: con agregar_evidencia, como una subida real. Mezcla de logs
+  de texto, capturas de pantalla PNG, informes PDF y capturas de red, con
+  tamaños de unos KB a varios MB y un 10 % de contenido repetido.
+- Historial: INSERT multi-fila de acciones sobre los incidentes sembrados.
+"""
+import argparse
+import io
+import os
+import random
+import struct
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ingesta  # noqa: E402
+from app import app, agregar_evidencia, eliminar_archivo_evidencia, get_almacen, get_db, get_estadisticas  # noqa: E402
+
+USUARIO = 'carga'
+TAMANO_LOTE = 1000
+
+_TITULOS = (
+    'Intento de phishing detectado', 'Escaneo de puertos desde {ip}', 'Malware en {host}',
+    'Inicio de sesión sospechoso de {ip}', 'Tráfico saliente anómalo en {host}',
+    'Exfiltración de datos desde {host}', 'Cuenta comprometida en {host}'
+)
+_ESTADOS = ('Abierto',) * 4 + ('En Investigación',) * 3 + ('Resuelto',) * 2 + ('Cerrado',)
+_SEVERIDADES = ('baja',) * 3 + ('media',) * 4 + ('alta',) * 2 + ('critica',)
+_USUARIOS = ('admin', 'analista1', 'analista2', 'soc', 'siem')
+_ACCIONES = (
+    ('COMENTARIO', 'Revisado el tráfico de {ip}'),
+    ('COMENTARIO', 'Escalado al equipo de respuesta'),
+    ('CAMBIO_ESTADO', 'Estado cambiado de Abierto a En Investigación'),
+    ('CAMBIO_ESTADO', 'Estado cambiado de En Investigación a Resuelto'),
+    ('EVIDENCIA_AGREGADA', 'Evidencia agregada: captura_{n}.png'),
+    ('DESCARGA_EVIDENCIA', 'Descargada evidencia: registro_{n}.log'),
+    ('VISUALIZACION_IMAGEN', 'Visualizada imagen: captura_{n}.png'),
+)
+
+# (extensión, peso, tamaño mínimo, tamaño máximo) de las evidencias
+MEZCLA_EVIDENCIAS = (
+    ('log', 45, 2 * 1024, 512 * 1024),
+    ('png', 30, 50 * 1024, 2 * 1024 * 1024),
+    ('pdf', 15, 100 * 1024, 5 * 1024 * 1024),
+    ('pcap', 10, 1024 * 1024, 15 * 1024 * 1024),
+)
+
+
+# ==============================
+# CONTENIDO DE LAS EVIDENCIAS
+# ==============================
+def _log(rnd, tamano):
+    lineas = []
+    total = 0
+    while total < tamano:
+        linea = (f"2024-{rnd.randrange(1, 13):02d}-{rnd.randrange(1, 29):02d} "
+                 f"{rnd.randrange(24):02d}:{rnd.randrange(60):02d}:{rnd.randrange(60):02d} "
+                 f"sshd[{rnd.randrange(1000, 65000)}]: Failed password for admin from "
+                 f"198.51.100.{rnd.randrange(256)} port {rnd.randrange(1024, 65536)} ssh2 "
+                 f"host=srv-{rnd.randrange(500):03d}.example.net\n").encode()
+        lineas.append(linea)
+        total += len(linea)
+    return b''.join(lineas)[:tamano]
+
+
+def _png(rnd, tamano):
+    from PIL import Image
+    # El ruido no se comprime: el PNG ocupa aproximadamente ancho * alto * 3
+    lado = max(16, int((tamano / 3) ** 0.5))
+    imagen = Image.frombytes('RGB', (lado, lado), rnd.randbytes(lado * lado * 3))
+    salida = io.BytesIO()
+    imagen.save(salida, 'PNG', compress_level=1)
+    return salida.getvalue()
+
+
+def _pdf(rnd, tamano):
+    cabecera = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n1 0 obj\n<< /Length ' + str(tamano).encode() + b' >>\nstream\n'
+    return cabecera + rnd.randbytes(tamano) + b'\nendstream\nendobj\n%%EOF\n'
+
+
+def _pcap(rnd, tamano):
+    partes = [struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)]
+    total = 24
+    segundo = 1700000000
+    while total < tamano:
+        longitud = rnd.randrange(60, 1514)
+        trama = (b'\x00\x11\x22\x33\x44\x55\x66\x77\x88\x99\xaa\xbb\x08\x00'
+                 + struct.pack('!BBHHHBBH4s4s', 0x45, 0, longitud - 14, rnd.randrange(65536), 0, 64, 6, 0,
+                               bytes([10, 0, rnd.randrange(256), rnd.randrange(256)]),
+                               bytes([203, 0, 113, rnd.randrange(256)]))
+                 + rnd.randbytes(longitud - 34))
+        segundo += rnd.randrange(2)
+        partes.append(struct.pack('<IIII', segundo, rnd.randrange(1000000), longitud, longitud) + trama)
+        total += 16 + longitud
+    return b''.join(partes)
+
+
+_GENERADORES = {'log': _log, 'png': _png, 'pdf': _pdf, 'pcap': _pcap}
+_NOMBRES = {'log': 'registro', 'png': 'captura', 'pdf': 'informe', 'pcap': 'trafico'}
+
+
+def generar_evidencia(rnd, escala=1.0):
+    """(nombre, contenido) de una evidencia de la mezcla MEZCLA_EVIDENCIAS"""
+    extension, _, minimo, maximo = rnd.choices(MEZCLA_EVIDENCIAS, [m[1] for m in MEZCLA_EVIDENCIAS])[0]
+    # Distribución log-uniforme: abundan los pequeños y hay pocos grandes
+    tamano = int(minimo * (maximo / minimo) ** rnd.random() * escala) or 1
+    nombre = f"{_NOMBRES[extension]}_{rnd.randrange(10 ** 6)}.{extension}"
+    return nombre, _GENERADORES[extension](rnd, tamano)
+
+
+# ==============================
+# SIEMBRA
+# ==============================
+def _incidentes(n, rnd):
+    ahora = datetime.now()
+    for _ in range(n):
+        ip = f"203.0.113.{rnd.randrange(256)}"
+        host = f"srv-{rnd.randrange(500):03d}"
+        yield {
+            'titulo': rnd.choice(_TITULOS).format(ip=ip, host=host),
+            'descripcion': f"Regla {rnd.randrange(1000, 9999)} disparada en {host} desde {ip}. " * rnd.randrange(1, 6),
+            'tipo': rnd.choice(sorted(ingesta.TIPOS)),
+            'severidad': rnd.choice(_SEVERIDADES),
+            'estado': rnd.choice(_ESTADOS),
+            'usuario_reporta': USUARIO,
+            'fecha_creacion': (ahora - timedelta(seconds=rnd.randrange(365 * 86400))).isoformat()
+        }
+
+
+def ids_sembrados(cursor):
+    cursor.execute("SELECT id FROM incidentes WHERE usuario_reporta = %s ORDER BY id", (USUARIO,))
+    return [fila[0] for fila in cursor.fetchall()]
+
+
+def sembrar_incidentes(n, rnd):
+    db = get_db()
+    try:
+        resultados, _ = ingesta.importar(db, _incidentes(n, rnd), USUARIO)
+    finally:
+        db.close()
+    get_estadisticas().invalidar()
+    return [r['id'] for r in resultados if 'id' in r]
+
+
+def sembrar_evidencias(ids, n, rnd, escala):
+    """Evidencias repartidas entre los incidentes (algunos con muchas)"""
+    almacen = get_almacen()
+    # Un 20 % de los incidentes concentra la mayoría de las evidencias
+    destacados = rnd.sample(ids, max(1, len(ids) // 5))
+    anteriores = []
+    total = 0
+    db = get_db()
+    cursor = db.cursor()
+    try:
+        for i in range(n):
+            if anteriores and rnd.random() < 0.1:
+                nombre, contenido = rnd.choice(anteriores)
+            else:
+                nombre, contenido = generar_evidencia(rnd, escala)
+                if len(anteriores) < 50:
+                    anteriores.append((nombre, contenido))
+            incidente_id = rnd.choice(destacados if rnd.random() < 0.8 else ids)
+            temporal, sha256, tamano = almacen.recibir(io.BytesIO(contenido))
+            agregar_evidencia(cursor, incidente_id, nombre, temporal, sha256, tamano)
+            total += tamano
+            if (i + 1) % 100 == 0:
+                db.commit()
+        db.commit()
+    finally:
+        cursor.close()
+        db.close()
+    return total
+
+
+def sembrar_historial(ids, n, rnd, tamano_lote=TAMANO_LOTE):
+    ahora = datetime.now()
+    db = get_db()
+    cursor = db.cursor()
+    try:
+        for inicio in range(0, n, tamano_lote):
+            parametros = []
+            cantidad = min(tamano_lote, n - inicio)
+            for _ in range(cantidad):
+                accion, descripcion = rnd.choice(_ACCIONES)
+                parametros += [
+                    rnd.choice(ids), rnd.choice(_USUARIOS), accion,
+                    descripcion.format(ip=f"203.0.113.{rnd.randrange(256)}", n=rnd.randrange(1000)),
+                    ahora - timedelta(seconds=rnd.randrange(365 * 86400))
+                ]
+            valores = ", ".join(["(%s, %s, %s, %s, %s)"] * cantidad)
+            cursor.execute(f"""
+                INSERT INTO historial (incidente_id, usuario, accion, descripcion, fecha)
+                VALUES {valores}
+            """, parametros)
+            db.commit()
+    finally:
+        cursor.close()
+        db.close()
+
+
+def limpiar():
+    """Borra los incidentes sembrados y libera el contenido de sus evidencias"""
+    db = get_db()
+    cursor = db.cursor(dictionary=True)
+    try:
+        cursor.execute("SELECT id FROM incidentes WHERE usuario_reporta = %s", (USUARIO,))
+        ids = [fila['id'] for fila in cursor.fetchall()]
+        evidencias = []
+        for i in range(0, len(ids), 10000):
+            parte = ids[i:i + 10000]
+            marcadores = ', '.join(['%s'] * len(parte))
+            cursor.execute(f"SELECT ruta, sha256 FROM evidencias WHERE incidente_id IN ({marcadores})", parte)
+            evidencias.extend(cursor.fetchall())
+            cursor.execute(f"DELETE FROM incidentes WHERE id IN ({marcadores})", parte)
+            db.commit()
+    finally:
+        cursor.close()
+        db.close()
+    for evidencia in evidencias:
+        eliminar_archivo_evidencia(evidencia)
+    get_estadisticas().invalidar()
+    return len(ids), len(evidencias)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--incidentes', type=int, default=20000)
+    parser.add_argument('--evidencias', type=int, default=2000)
+    parser.add_argument('--historial', type=int, default=500000, help='Filas de historial además de las de creación')
+    parser.add_argument('--escala', type=float, default=1.0, help='Factor sobre el tamaño de las evidencias')
+    parser.add_argument('--semilla', type=int, default=1)
+    parser.add_argument('--limpiar', action='store_true', help='Solo borrar lo sembrado')
+    args = parser.parse_args()
+
+    with app.app_context():
+        incidentes, evidencias = limpiar()
+        if incidentes:
+            print(f"Borrados {incidentes} incidentes sembrados antes ({evidencias} evidencias)")
+        if args.limpiar:
+            return
+
+        rnd = random.Random(args.semilla)
+
+        inicio = time.perf_counter()
+        ids = sembrar_incidentes(args.incidentes, rnd)
+        print(f"{len(ids)} incidentes en {time.perf_counter() - inicio:.1f} s")
+
+        if ids and args.evidencias:
+            inicio = time.perf_counter()
+            total = sembrar_evidencias(ids, args.evidencias, rnd, args.escala)
+            print(f"{args.evidencias} evidencias ({total / 1024 / 1024:.0f} MB) en {time.perf_counter() - inicio:.1f} s")
+
+        if ids and args.historial:
+            inicio = time.perf_counter()
+            sembrar_historial(ids, args.historial, rnd)
+            print(f"{args.historial} filas de historial en {time.perf_counter() - inicio:.1f} s")
+
+
+if __name__ == '__main__':
+    main()
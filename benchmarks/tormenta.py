@@ -0,0 +1,153 @@
+# benchmarks/tormenta.py
+"""Reproduce tormentas sintéticas de alertas contra la correlación de incidentes.
+
+Uso:
+    python benchmarks/tormenta.py                        # solo huellas, sin BD
+    python benchmarks/tormenta.py --alertas 100000 --fuentes 300
+    python benchmarks/tormenta.py --bd                   # importa en DB_CONFIG
+
+Cada alerta sale de una "fuente" (regla + atacante) con contadores, fechas
+e identificadores de evento que cambian en cada disparo. Sin --bd se
+comprueba que cada fuente da una única huella y que dos fuentes distintas
+no comparten huella. Con --bd se importa la tormenta con ingesta.importar
+y se comparan los incidentes creados con el número de fuentes; los
+incidentes creados se borran al terminar salvo con --conservar.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import correlacion  # noqa: E402
+import ingesta  # noqa: E402
+
+_REGLAS = (
+    ('Intento de phishing detectado', 'phishing',
+     'Correo de {email} con enlace a http://{dominio}/login?s={evento}. {n} destinatarios.'),
+    ('{n} intentos de inicio de sesión fallidos desde {ip}', 'intrusion',
+     'Usuario admin, evento {evento}, {fecha}.'),
+    ('Escaneo de puertos desde {ip}', 'intrusion',
+     '{n} puertos sondeados entre {fecha} y {fecha}. Evento {evento}.'),
+    ('Malware detectado en el equipo PC-{equipo}', 'malware',
+     'Hash {hash}, detectado por el antivirus en {fecha} (evento {evento}).'),
+    ('Tráfico DDoS hacia {dominio}: {n} Mbps', 'ddos',
+     'Origen principal {ip}. Medición {evento} a las {fecha}.'),
+)
+_INFORMANTES = ('siem', 'edr', 'ids')
+
+
+def generar_fuentes(n, rnd):
+    fuentes = []
+    # Atacantes distintos por fuente: si dos fuentes compartieran IP serían la misma alerta
+    for i in rnd.sample(range(2 ** 20), n):
+        titulo, tipo, descripcion = rnd.choice(_REGLAS)
+        fuentes.append({
+            'titulo': titulo, 'tipo': tipo, 'descripcion': descripcion,
+            'usuario_reporta': rnd.choice(_INFORMANTES),
+            'ip': f"10.{i >> 16}.{(i >> 8) & 0xff}.{i & 0xff}",
+            'dominio': f"{rnd.choice(('login', 'secure', 'cdn'))}-{i}.example.net",
+            'email': f"soporte{i}@example.org",
+            'equipo': f"{rnd.randrange(1000):03d}",
+            'hash': '%064x' % rnd.getrandbits(256),
+            'severidad': rnd.choice(sorted(ingesta.SEVERIDADES))
+        })
+    return fuentes
+
+
+def generar_tormenta(alertas, fuentes, semilla=1):
+    """Lista de (fuente, registro); unas pocas fuentes disparan la mayoría"""
+    rnd = random.Random(semilla)
+    lista = generar_fuentes(fuentes, rnd)
+    pesos = [1 / (i + 1) for i in range(fuentes)]
+    tormenta = []
+    for indice in rnd.choices(range(fuentes), weights=pesos, k=alertas):
+        f = lista[indice]
+        variables = dict(
+            f, n=rnd.randrange(2, 5000), evento=f"{rnd.getrandbits(32):08x}",
+            fecha=f"2025-03-{rnd.randrange(1, 29):02d} {rnd.randrange(24):02d}:{rnd.randrange(60):02d}:00"
+        )
+        tormenta.append((indice, {
+            'titulo': f['titulo'].format(**variables),
+            'descripcion': f['descripcion'].format(**variables),
+            'tipo': f['tipo'],
+            'severidad': f['severidad'],
+            'usuario_reporta': f['usuario_reporta']
+        }))
+    return tormenta
+
+
+def comprobar_huellas(tormenta):
+    inicio = time.perf_counter()
+    por_fuente = {}
+    por_huella = {}
+    for fuente, registro in tormenta:
+        h = correlacion.huella(registro['titulo'], registro['tipo'],
+                               registro['usuario_reporta'], registro['descripcion'])
+        por_fuente.setdefault(fuente, set()).add(h)
+        por_huella.setdefault(h, set()).add(fuente)
+    segundos = time.perf_counter() - inicio
+
+    partidas = sum(1 for huellas in por_fuente.values() if len(huellas) > 1)
+    mezcladas = sum(1 for fuentes in por_huella.values() if len(fuentes) > 1)
+    print(f"{len(tormenta)} alertas de {len(por_fuente)} fuentes -> {len(por_huella)} huellas "
+          f"({len(tormenta) / segundos:.0f} huellas/s)")
+    print(f"  fuentes con más de una huella: {partidas}")
+    print(f"  huellas compartidas por fuentes distintas: {mezcladas}")
+    return partidas == 0 and mezcladas == 0
+
+
+def importar_en_bd(tormenta, lote, ventana, conservar):
+    import mysql.connector
+    from app import DB_CONFIG
+
+    datos = '\n'.join(json.dumps(registro) for _, registro in tormenta).encode('utf-8')
+    conn = mysql.connector.connect(**DB_CONFIG)
+    try:
+        inicio = time.perf_counter()
+        resultados, creados = ingesta.importar(
+            conn, ingesta.leer_registros(io.BytesIO(datos)), 'tormenta',
+            tamano_lote=lote, ventana=ventana
+        )
+        segundos = time.perf_counter() - inicio
+        fuentes = len({fuente for fuente, _ in tormenta})
+        fusionados = sum(1 for r in resultados if r.get('fusionado'))
+        print(f"Importadas {len(tormenta)} alertas en {segundos:.2f} s ({len(tormenta) / segundos:.0f}/s): "
+              f"{sum(creados.values())} incidentes creados (fuentes: {fuentes}), {fusionados} fusionadas")
+
+        if not conservar:
+            ids = sorted({r['id'] for r in resultados if 'id' in r and not r.get('fusionado')})
+            cursor = conn.cursor()
+            for i in range(0, len(ids), 10000):
+                parte = ids[i:i + 10000]
+                cursor.execute(f"DELETE FROM incidentes WHERE id IN ({', '.join(['%s'] * len(parte))})", parte)
+            conn.commit()
+            cursor.close()
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--alertas', type=int, default=20000, help='Alertas de la tormenta')
+    parser.add_argument('--fuentes', type=int, default=100, help='Fuentes distintas (incidentes esperados)')
+    parser.add_argument('--semilla', type=int, default=1)
+    parser.add_argument('--bd', action='store_true', help='Importar la tormenta en la base de datos')
+    parser.add_argument('--lote', type=int, default=ingesta.TAMANO_LOTE)
+    parser.add_argument('--ventana', type=int, default=3600, help='Segundos de correlación')
+    parser.add_argument('--conservar', action='store_true', help='No borrar los incidentes creados')
+    args = parser.parse_args()
+
+    tormenta = generar_tormenta(args.alertas, args.fuentes, args.semilla)
+    correcta = comprobar_huellas(tormenta)
+    if args.bd:
+        importar_en_bd(tormenta, args.lote, args.ventana, args.conservar)
+    sys.exit(0 if correcta else 1)
+
+
+if __name__ == '__main__':
+    main()
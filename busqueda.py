@@ -0,0 +1,126 @@
+# busqueda.py
+"""Búsqueda de texto completo sobre incidentes, evidencias y comentarios"""
+import re
+
+# Tipos de documento de la tabla ``busqueda``
+TIPOS = ('incidente', 'evidencia', 'comentario')
+
+# InnoDB ignora las palabras más cortas que innodb_ft_min_token_size (3)
+_LONGITUD_MINIMA = 3
+_TERMINO = re.compile(r'"([^"]+)"|([^\s"]+)')
+_OPERADORES = re.compile(r'[+\-<>()~*@"]')
+_PALABRA = re.compile(r'\w+')
+
+
+def consulta_booleana(texto):
+    """Convierte lo escrito por el usuario en una consulta IN BOOLEAN MODE.
+
+    Cada palabra es obligatoria y admite prefijo (``+palabra*``) y el texto
+    entre comillas se busca como frase. Los operadores que escriba el usuario
+    se eliminan. Devuelve '' si no queda ningún término buscable.
+    """
+    terminos = []
+    for frase, palabra in _TERMINO.findall(texto or ''):
+        if frase:
+            frase = _OPERADORES.sub(' ', frase).strip()
+            if len(frase) >= _LONGITUD_MINIMA:
+                terminos.append(f'+"{frase}"')
+        else:
+            # El analizador de FULLTEXT también corta en puntos, guiones, etc.
+            for parte in _PALABRA.findall(palabra):
+                if len(parte) >= _LONGITUD_MINIMA:
+                    terminos.append(f'+{parte}*')
+    return ' '.join(terminos)
+
+
+def palabras_archivo(nombre):
+    """Nombre de archivo separado en palabras (``informe_final.pdf`` -> ``informe final pdf``)"""
+    return re.sub(r'[_.\-]+', ' ', nombre or '').strip()
+
+
+def indexar(cursor, tipo, ref_id, incidente_id, titulo, contenido=''):
+    """Añade o actualiza un documento; se llama dentro de la transacción que lo escribe"""
+    if ref_id is None:
+        cursor.execute("""
+            INSERT INTO busqueda (tipo, ref_id, incidente_id, titulo, contenido)
+            VALUES (%s, NULL, %s, %s, %s)
+        """, (tipo, incidente_id, titulo, contenido))
+        return
+    cursor.execute("""
+        INSERT INTO busqueda (tipo, ref_id, incidente_id, titulo, contenido)
+        VALUES (%s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE titulo = VALUES(titulo), contenido = VALUES(contenido)
+    """, (tipo, ref_id, incidente_id, titulo, contenido))
+
+
+def desindexar(cursor, tipo, ref_id):
+    cursor.execute("DELETE FROM busqueda WHERE tipo = %s AND ref_id = %s", (tipo, ref_id))
+
+
+def reconstruir(cursor):
+    """Rellena la tabla desde incidentes, evidencias y comentarios del historial"""
+    cursor.execute("DELETE FROM busqueda")
+    cursor.execute("""
+        INSERT INTO busqueda (tipo, ref_id, incidente_id, titulo, contenido, fecha)
+        SELECT 'incidente', id, id, titulo, descripcion, fecha_creacion
+        FROM incidentes
+    """)
+    cursor.execute("""
+        INSERT INTO busqueda (tipo, ref_id, incidente_id, titulo, contenido, fecha)
+        SELECT 'evidencia', id, incidente_id, nombre_archivo,
+               REPLACE(REPLACE(REPLACE(nombre_archivo, '_', ' '), '.', ' '), '-', ' '),
+               fecha_subida
+        FROM evidencias
+    """)
+    cursor.execute("""
+        INSERT INTO busqueda (tipo, ref_id, incidente_id, titulo, contenido, fecha)
+        SELECT 'comentario', id, incidente_id, '', descripcion, fecha
+        FROM historial
+        WHERE accion = 'COMENTARIO' AND descripcion IS NOT NULL
+    """)
+
+
+def buscar(cursor, texto, tipos=None, estado=None, severidad=None,
+           desde=None, hasta=None, limite=20, desplazamiento=0):
+    """Documentos que contienen todos los términos, del más al menos relevante.
+
+    La consulta booleana filtra por el índice FULLTEXT y la puntuación en
+    lenguaje natural ordena. Devuelve ``limite + 1`` filas como máximo para
+    saber si hay una página siguiente sin contar el total.
+    """
+    booleana = consulta_booleana(texto)
+    if not booleana:
+        return []
+
+    natural = ' '.join(t.strip('+*"') for t in booleana.split())
+    condiciones = ["MATCH(b.titulo, b.contenido) AGAINST (%s IN BOOLEAN MODE)"]
+    parametros = [natural, booleana]
+
+    if tipos:
+        condiciones.append(f"b.tipo IN ({', '.join(['%s'] * len(tipos))})")
+        parametros.extend(tipos)
+    if estado:
+        condiciones.append("i.estado = %s")
+        parametros.append(estado)
+    if severidad:
+        condiciones.append("i.severidad = %s")
+        parametros.append(severidad)
+    if desde:
+        condiciones.append("b.fecha >= %s")
+        parametros.append(desde)
+    if hasta:
+        condiciones.append("b.fecha < %s")
+        parametros.append(hasta)
+
+    cursor.execute(f"""
+        SELECT b.id, b.tipo, b.ref_id, b.incidente_id, b.titulo,
+               LEFT(b.contenido, 200) AS fragmento, b.fecha,
+               i.titulo AS incidente_titulo, i.estado, i.severidad,
+               MATCH(b.titulo, b.contenido) AGAINST (%s IN NATURAL LANGUAGE MODE) AS puntuacion
+        FROM busqueda b
+        JOIN incidentes i ON i.id = b.incidente_id
+        WHERE {' AND '.join(condiciones)}
+        ORDER BY puntuacion DESC, b.id DESC
+        LIMIT %s OFFSET %s
+    """, (*parametros, limite + 1, desplazamiento))
+    return cursor.fetchall()
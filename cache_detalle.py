@@ -0,0 +1,217 @@
+# cache_detalle.py
+"""Caché del detalle de incidentes ya renderizado, por versión del incidente"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Incidentes con verificación reciente recordados por proceso
+_MAX_VERIFICADOS = 10000
+
+
+def _tamano(entrada):
+    """Bytes aproximados de una entrada (sus textos más un margen fijo)"""
+    return 256 + sum(len(valor) for valor in entrada.values() if isinstance(valor, str))
+
+
+class _AlmacenLocal:
+    """Entradas en memoria del proceso, con expulsión LRU por tamaño total"""
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entradas = OrderedDict()     # id -> (versión, entrada, tamaño, guardada)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.expulsadas = 0
+
+    def _quitar(self, incidente_id):
+        anterior = self._entradas.pop(incidente_id, None)
+        if anterior:
+            self._bytes -= anterior[2]
+
+    def leer(self, incidente_id):
+        with self._lock:
+            guardado = self._entradas.get(incidente_id)
+            if guardado is None:
+                return None
+            if time.monotonic() - guardado[3] > self.ttl:
+                self._quitar(incidente_id)
+                return None
+            self._entradas.move_to_end(incidente_id)
+            return guardado[0], guardado[1]
+
+    def escribir(self, incidente_id, version, entrada):
+        """Guarda salvo que ya haya una versión más nueva; devuelve si se guardó"""
+        tamano = _tamano(entrada) if entrada else 256
+        with self._lock:
+            if tamano > self.max_bytes:
+                self._quitar(incidente_id)     # no cabe, pero la anterior ya no vale
+                return False
+            anterior = self._entradas.get(incidente_id)
+            if anterior and anterior[0] > version and time.monotonic() - anterior[3] <= self.ttl:
+                return False
+            self._quitar(incidente_id)
+            self._entradas[incidente_id] = (version, entrada, tamano, time.monotonic())
+            self._bytes += tamano
+            while self._bytes > self.max_bytes:
+                _, expulsada = self._entradas.popitem(last=False)
+                self._bytes -= expulsada[2]
+                self.expulsadas += 1
+        return True
+
+    def borrar(self, incidente_id):
+        with self._lock:
+            self._quitar(incidente_id)
+
+    def estadisticas(self):
+        with self._lock:
+            return {'entradas': len(self._entradas), 'bytes': self._bytes,
+                    'max_bytes': self.max_bytes, 'expulsadas': self.expulsadas}
+
+
+class _AlmacenRedis:
+    """Entradas compartidas entre procesos, una clave JSON por incidente.
+
+    La expulsión la hace Redis (maxmemory con allkeys-lru) y cada clave
+    caduca a los ``ttl`` segundos.
+    """
+
+    def __init__(self, url, ttl, prefijo='cyberincident:detalle'):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self._prefijo = prefijo
+
+    def _clave(self, incidente_id):
+        return f"{self._prefijo}:{incidente_id}"
+
+    def leer(self, incidente_id):
+        valor = self._redis.get(self._clave(incidente_id))
+        if valor is None:
+            return None
+        guardado = json.loads(valor)
+        return guardado['version'], guardado['entrada']
+
+    def escribir(self, incidente_id, version, entrada):
+        import redis
+        clave = self._clave(incidente_id)
+        valor = json.dumps({'version': version, 'entrada': entrada})
+        with self._redis.pipeline() as pipe:
+            try:
+                # WATCH: si otro proceso escribe entre la lectura y el SET no se pisa
+                pipe.watch(clave)
+                anterior = pipe.get(clave)
+                if anterior is not None and json.loads(anterior)['version'] > version:
+                    return False
+                pipe.multi()
+                pipe.set(clave, valor, ex=self.ttl)
+                pipe.execute()
+            except redis.WatchError:
+                return False
+        return True
+
+    def borrar(self, incidente_id):
+        self._redis.delete(self._clave(incidente_id))
+
+    def estadisticas(self):
+        return {'redis': True}
+
+
+class CacheDetalle:
+    """Cuerpo renderizado del detalle de cada incidente, por versión.
+
+    La versión (columna incidentes.version) sube con cada cambio del
+    incidente: estado, comentarios, evidencias, alertas fusionadas. Quien
+    lo modifica llama a ``invalidar`` con la versión nueva, que queda como
+    marca sin contenido: una vista que cargó datos anteriores no puede
+    guardarlos encima (``guardar`` nunca sustituye una versión más nueva).
+
+    Con el almacén en memoria cada proceso solo se entera de sus propias
+    invalidaciones, y con Redis no se enteran las escrituras hechas fuera de
+    la aplicación (worker, comandos). Por eso, si ``verificar`` > 0, una
+    entrada se comprueba contra la versión de la base de datos (una lectura
+    por clave primaria) como mucho cada ``verificar`` segundos por proceso;
+    entre comprobaciones las vistas no tocan la base de datos. Con un solo
+    proceso y sin escrituras externas puede ser 0.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=300, verificar=5, redis_url=None,
+                 prefijo='cyberincident:detalle'):
+        self.activa = max_bytes > 0
+        self.verificar = verificar
+        self._almacen = _AlmacenRedis(redis_url, ttl, prefijo) if redis_url else _AlmacenLocal(max_bytes, ttl)
+        self._verificados = {}             # id -> (versión, instante de la comprobación)
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def _anotar_verificada(self, incidente_id, version):
+        with self._lock:
+            if len(self._verificados) >= _MAX_VERIFICADOS:
+                self._verificados.clear()
+            self._verificados[incidente_id] = (version, time.monotonic())
+
+    def _verificada(self, incidente_id, version, leer_version):
+        if not self.verificar:
+            return True
+        anterior = self._verificados.get(incidente_id)
+        if anterior and anterior[0] == version and time.monotonic() - anterior[1] < self.verificar:
+            return True
+        if leer_version() != version:
+            return False
+        self._anotar_verificada(incidente_id, version)
+        return True
+
+    def obtener(self, incidente_id, leer_version):
+        """Entrada vigente del incidente o None.
+
+        ``leer_version()`` devuelve la versión actual en la base de datos
+        (None si el incidente ya no existe); solo se llama al verificar.
+        """
+        if not self.activa:
+            return None
+        try:
+            guardado = self._almacen.leer(incidente_id)
+            if guardado is not None and guardado[1] is not None:
+                if self._verificada(incidente_id, guardado[0], leer_version):
+                    self.aciertos += 1
+                    return guardado[1]
+                self._almacen.borrar(incidente_id)
+        except Exception as e:
+            logger.warning(f"Error leyendo la caché del detalle del incidente {incidente_id}: {e}")
+        self.fallos += 1
+        return None
+
+    def guardar(self, incidente_id, version, entrada):
+        """Guarda la entrada (un dict de textos) cargada con ``version``"""
+        if not self.activa:
+            return
+        try:
+            # Recién leída de la base de datos: cuenta como verificada
+            if self._almacen.escribir(incidente_id, version, entrada):
+                self._anotar_verificada(incidente_id, version)
+        except Exception as e:
+            logger.warning(f"Error guardando el detalle del incidente {incidente_id} en caché: {e}")
+
+    def invalidar(self, incidente_id, version=None):
+        """Tras modificar un incidente; sin ``version`` (no se conoce o se
+        ha eliminado) solo se borra la entrada"""
+        if not self.activa:
+            return
+        try:
+            if version is None:
+                self._almacen.borrar(incidente_id)
+            else:
+                self._almacen.escribir(incidente_id, version, None)
+        except Exception as e:
+            logger.warning(f"Error invalidando el detalle del incidente {incidente_id} en caché: {e}")
+        with self._lock:
+            self._verificados.pop(incidente_id, None)
+
+    def estadisticas(self):
+        return dict(self._almacen.estadisticas(), activa=self.activa,
+                    aciertos=self.aciertos, fallos=self.fallos, verificar=self.verificar)
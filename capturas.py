@@ -0,0 +1,470 @@
+# capturas.py
+"""Resumen de capturas de red pcap/pcapng leídas en streaming con mmap"""
+import heapq
+import json
+import logging
+import mmap
+import socket
+import struct
+import time
+
+import mysql.connector
+
+from almacen_blobs import predeterminado as almacen
+
+logger = logging.getLogger(__name__)
+
+TOP_IPS = 20
+TOP_PUERTOS = 20
+TOP_FLUJOS = 500
+# Flujos distintos en memoria; al superarlos se descarta la mitad más pequeña
+MAX_FLUJOS = 500000
+MAX_INTENTOS = 3
+
+# Extensiones que detectar_tipo_archivo() clasifica como 'captura_red'
+EXTENSIONES_CAPTURA = ('pcap', 'pcapng')
+
+_PCAP_US = 0xa1b2c3d4
+_PCAP_NS = 0xa1b23c4d
+_PCAPNG_SHB = 0x0a0d0d0a
+_PCAPNG_BOM = 0x1a2b3c4d
+
+# Tipos de enlace (LINKTYPE_*)
+_ENLACE_NULL = 0
+_ENLACE_ETHERNET = 1
+_ENLACE_RAW = 101
+_ENLACE_LOOP = 108
+_ENLACE_SLL = 113
+_ENLACE_IPV4 = 228
+_ENLACE_IPV6 = 229
+_ENLACE_SLL2 = 276
+
+_PROTOCOLOS_IP = {1: 'ICMP', 2: 'IGMP', 6: 'TCP', 17: 'UDP', 47: 'GRE', 50: 'ESP', 58: 'ICMPv6', 132: 'SCTP'}
+_EXTENSIONES_IPV6 = {0, 43, 44, 60}
+
+_U16_BE = struct.Struct('>H')
+
+
+class CapturaInvalida(Exception):
+    """El archivo no es una captura pcap ni pcapng"""
+
+
+# ==============================
+# ACUMULACIÓN
+# ==============================
+class _Resumen:
+    """Contadores de una captura.
+
+    Por cada paquete solo se actualiza la tabla de flujos, cuya clave es
+    (protocolo IP, direcciones y puertos tal cual vienen en el paquete); los
+    paquetes que no son IP cuentan bajo el nombre de su protocolo. Las IPs,
+    puertos y protocolos se agregan a partir de los flujos al terminar.
+    """
+
+    def __init__(self):
+        self.paquetes = 0
+        self.bytes = 0
+        self.bytes_capturados = 0
+        self.inicio = None
+        self.fin = None
+        self.flujos = {}          # clave -> [paquetes, bytes, inicio, fin]
+        self.enlaces = set()
+        self.truncada = False
+        # Agregados de los flujos descartados al recortar la tabla
+        self.flujos_descartados = 0
+        self.protocolos = {}      # nombre -> [paquetes, bytes]
+        self.ips = {}             # ip (binaria) -> [paquetes, bytes]
+        self.puertos = {}         # (proto, puerto menor del par) -> [paquetes, bytes]
+
+    def paquete(self, ts, m, inicio, capturado, longitud, enlace):
+        self.paquetes += 1
+        self.bytes += longitud
+        self.bytes_capturados += capturado
+        if ts is not None:
+            if self.inicio is None or ts < self.inicio:
+                self.inicio = ts
+            if self.fin is None or ts > self.fin:
+                self.fin = ts
+
+        clave = _clave_flujo(m, inicio, capturado, enlace)
+        flujo = self.flujos.get(clave)
+        if flujo is None:
+            self.flujos[clave] = [1, longitud, ts, ts]
+            if len(self.flujos) > MAX_FLUJOS:
+                self._recortar_flujos()
+        else:
+            flujo[0] += 1
+            flujo[1] += longitud
+            flujo[3] = ts
+
+    def _recortar_flujos(self):
+        """Acota la tabla de flujos quedándose con los mayores.
+
+        Los descartados se suman antes a los agregados, así que IPs, puertos
+        y protocolos siguen siendo exactos; solo se pierde su detalle.
+        """
+        conservar = MAX_FLUJOS // 2
+        ordenados = sorted(self.flujos.items(), key=lambda item: item[1][1], reverse=True)
+        for clave, flujo in ordenados[conservar:]:
+            self._agregar(clave, flujo)
+        self.flujos_descartados += len(ordenados) - conservar
+        self.flujos = dict(ordenados[:conservar])
+
+    def _agregar(self, clave, flujo):
+        paquetes, bytes_, _, _ = flujo
+        if isinstance(clave, str):
+            _sumar(self.protocolos, clave, paquetes, bytes_)
+            return
+        proto, origen, puerto_origen, destino, puerto_destino = _decodificar_clave(clave)
+        _sumar(self.protocolos, _PROTOCOLOS_IP.get(proto, f'IP {proto}'), paquetes, bytes_)
+        _sumar(self.ips, origen, paquetes, bytes_)
+        _sumar(self.ips, destino, paquetes, bytes_)
+        if puerto_origen is not None:
+            _sumar(self.puertos, (proto, min(puerto_origen, puerto_destino)), paquetes, bytes_)
+
+    def resultado(self, formato):
+        for clave, flujo in self.flujos.items():
+            self._agregar(clave, flujo)
+
+        def _mayores(diccionario, n):
+            return heapq.nlargest(n, diccionario.items(), key=lambda item: item[1][1])
+
+        flujos_ip = {clave: flujo for clave, flujo in self.flujos.items() if not isinstance(clave, str)}
+        flujos = []
+        for clave, (p, b, inicio, fin) in _mayores(flujos_ip, TOP_FLUJOS):
+            proto, origen, puerto_origen, destino, puerto_destino = _decodificar_clave(clave)
+            flujos.append({
+                'protocolo': _PROTOCOLOS_IP.get(proto, str(proto)),
+                'origen': _ip_texto(origen), 'puerto_origen': puerto_origen,
+                'destino': _ip_texto(destino), 'puerto_destino': puerto_destino,
+                'paquetes': p, 'bytes': b, 'inicio': inicio, 'fin': fin
+            })
+
+        return {
+            'formato': formato,
+            'enlaces': sorted(self.enlaces),
+            'paquetes': self.paquetes,
+            'bytes': self.bytes,
+            'bytes_capturados': self.bytes_capturados,
+            'inicio': self.inicio,
+            'fin': self.fin,
+            'duracion': (self.fin - self.inicio) if self.inicio is not None else 0,
+            'protocolos': {
+                nombre: {'paquetes': p, 'bytes': b}
+                for nombre, (p, b) in sorted(self.protocolos.items(), key=lambda item: -item[1][1])
+            },
+            'top_ips': [
+                {'ip': _ip_texto(ip), 'paquetes': p, 'bytes': b}
+                for ip, (p, b) in _mayores(self.ips, TOP_IPS)
+            ],
+            'top_puertos': [
+                {'protocolo': _PROTOCOLOS_IP.get(proto, str(proto)), 'puerto': puerto, 'paquetes': p, 'bytes': b}
+                for (proto, puerto), (p, b) in _mayores(self.puertos, TOP_PUERTOS)
+            ],
+            # Un flujo descartado que reaparece cuenta dos veces: con recorte es una cota superior
+            'total_flujos': len(flujos_ip) + self.flujos_descartados,
+            'flujos_recortados': self.flujos_descartados > 0,
+            'flujos': flujos,
+            'truncada': self.truncada
+        }
+
+
+def _sumar(diccionario, clave, paquetes, bytes_):
+    contador = diccionario.get(clave)
+    if contador is None:
+        diccionario[clave] = [paquetes, bytes_]
+    else:
+        contador[0] += paquetes
+        contador[1] += bytes_
+
+
+def _ip_texto(ip):
+    return socket.inet_ntop(socket.AF_INET if len(ip) == 4 else socket.AF_INET6, ip)
+
+
+# ==============================
+# DECODIFICACIÓN DE PAQUETES
+# ==============================
+_IPV4 = struct.Struct('>B5xHxB')          # versión/IHL, flags/fragmento, protocolo
+_PUERTOS = struct.Struct('>HH')
+
+
+def _decodificar_clave(clave):
+    """(proto, origen, puerto_origen, destino, puerto_destino) de una clave de flujo.
+
+    La parte binaria mide 12 (IPv4 con puertos), 8 (IPv4), 36 (IPv6 con
+    puertos) o 32 bytes (IPv6).
+    """
+    proto, datos = clave
+    ancho = 4 if len(datos) in (8, 12) else 16
+    origen, destino = datos[:ancho], datos[ancho:2 * ancho]
+    if len(datos) in (12, 36):
+        puerto_origen, puerto_destino = _PUERTOS.unpack_from(datos, 2 * ancho)
+        return proto, origen, puerto_origen, destino, puerto_destino
+    return proto, origen, None, destino, None
+
+
+def _clave_flujo(m, inicio, capturado, enlace):
+    """Clave de flujo del paquete en ``m[inicio:inicio + capturado]``.
+
+    Para IP es (protocolo, direcciones + puertos en binario), que en IPv4
+    sin opciones es un único corte contiguo de 12 bytes. Para el resto es el
+    nombre del protocolo.
+    """
+    fin = inicio + capturado
+    if enlace == _ENLACE_ETHERNET:
+        if capturado < 14:
+            return 'Ethernet'
+        tipo = _U16_BE.unpack_from(m, inicio + 12)[0]
+        ip = inicio + 14
+        while tipo in (0x8100, 0x88a8) and ip + 4 <= fin:   # VLAN
+            tipo = _U16_BE.unpack_from(m, ip + 2)[0]
+            ip += 4
+    elif enlace in (_ENLACE_RAW, _ENLACE_IPV4, _ENLACE_IPV6):
+        if not capturado:
+            return 'otro'
+        version = m[inicio] >> 4
+        tipo = 0x0800 if version == 4 else 0x86dd if version == 6 else 0
+        ip = inicio
+    elif enlace == _ENLACE_SLL:
+        if capturado < 16:
+            return 'otro'
+        tipo = _U16_BE.unpack_from(m, inicio + 14)[0]
+        ip = inicio + 16
+    elif enlace == _ENLACE_SLL2:
+        if capturado < 20:
+            return 'otro'
+        tipo = _U16_BE.unpack_from(m, inicio)[0]
+        ip = inicio + 20
+    elif enlace in (_ENLACE_NULL, _ENLACE_LOOP):
+        if capturado < 4:
+            return 'otro'
+        familia = int.from_bytes(m[inicio:inicio + 4], 'little')
+        if familia > 0xffff:
+            familia = int.from_bytes(m[inicio:inicio + 4], 'big')
+        tipo = 0x0800 if familia == 2 else 0x86dd if familia in (10, 24, 28, 30) else 0
+        ip = inicio + 4
+    else:
+        return f'enlace {enlace}'
+
+    if tipo == 0x0800:
+        if ip + 20 > fin:
+            return 'IPv4'
+        version_ihl, fragmento, proto = _IPV4.unpack_from(m, ip)
+        ihl = (version_ihl & 0x0f) * 4
+        if proto in (6, 17) and not fragmento & 0x1fff and ip + ihl + 4 <= fin:
+            if ihl == 20:
+                return proto, m[ip + 12:ip + 24]
+            return proto, m[ip + 12:ip + 20] + m[ip + ihl:ip + ihl + 4]
+        return proto, m[ip + 12:ip + 20]
+
+    if tipo == 0x86dd:
+        if ip + 40 > fin:
+            return 'IPv6'
+        proto = m[ip + 6]
+        l4 = ip + 40
+        while proto in _EXTENSIONES_IPV6 and l4 is not None and l4 + 8 <= fin:
+            if proto == 44 and _U16_BE.unpack_from(m, l4 + 2)[0] & 0xfff8:
+                l4 = None                    # fragmento que no es el primero
+                break
+            siguiente = m[l4]
+            l4 += 8 if proto == 44 else (m[l4 + 1] + 1) * 8
+            proto = siguiente
+        if proto in (6, 17) and l4 is not None and l4 + 4 <= fin:
+            return proto, m[ip + 8:ip + 40] + m[l4:l4 + 4]
+        return proto, m[ip + 8:ip + 40]
+
+    if tipo == 0x0806:
+        return 'ARP'
+    return 'otro'
+
+
+# ==============================
+# LECTURA DE FORMATOS
+# ==============================
+def _leer_pcap(m, resumen):
+    magia = struct.unpack_from('<I', m, 0)[0]
+    if magia in (_PCAP_US, _PCAP_NS):
+        orden = '<'
+    else:
+        orden = '>'
+        magia = struct.unpack_from('>I', m, 0)[0]
+    divisor = 1e9 if magia == _PCAP_NS else 1e6
+    enlace = struct.unpack_from(orden + 'I', m, 20)[0] & 0x0fffffff
+    resumen.enlaces.add(enlace)
+
+    desempaquetar = struct.Struct(orden + 'IIII').unpack_from
+    paquete = resumen.paquete
+    tamano = len(m)
+    posicion = 24
+    while posicion + 16 <= tamano:
+        segundos, fraccion, capturado, original = desempaquetar(m, posicion)
+        posicion += 16
+        if posicion + capturado > tamano:
+            resumen.truncada = True
+            return
+        paquete(segundos + fraccion / divisor, m, posicion, capturado, original, enlace)
+        posicion += capturado
+    resumen.truncada = posicion != tamano
+
+
+def _resolucion_ts(m, inicio, fin, orden):
+    """Unidades por segundo según la opción if_tsresol de una IDB"""
+    posicion = inicio
+    while posicion + 4 <= fin:
+        codigo, longitud = struct.unpack_from(orden + 'HH', m, posicion)
+        if codigo == 0:
+            break
+        if codigo == 9 and longitud >= 1:
+            valor = m[posicion + 4]
+            return 2 ** (valor & 0x7f) if valor & 0x80 else 10 ** valor
+        posicion += 4 + ((longitud + 3) & ~3)
+    return 10 ** 6
+
+
+def _leer_pcapng(m, resumen):
+    tamano = len(m)
+    posicion = 0
+    orden = '<'
+    cabecera = struct.Struct('<II')
+    epb = struct.Struct('<IIIII')
+    interfaces = []                          # (enlace, unidades por segundo)
+    paquete = resumen.paquete
+    while posicion + 12 <= tamano:
+        tipo, longitud = cabecera.unpack_from(m, posicion)
+        if tipo == _PCAPNG_SHB:
+            bom = struct.unpack_from('<I', m, posicion + 8)[0]
+            orden = '<' if bom == _PCAPNG_BOM else '>'
+            cabecera = struct.Struct(orden + 'II')
+            epb = struct.Struct(orden + 'IIIII')
+            longitud = cabecera.unpack_from(m, posicion)[1]
+            interfaces = []                  # cada sección define sus interfaces
+        if longitud < 12 or posicion + longitud > tamano:
+            resumen.truncada = True
+            return
+        cuerpo = posicion + 8
+
+        if tipo == 6:                        # Enhanced Packet Block
+            interfaz, alto, bajo, capturado, original = epb.unpack_from(m, cuerpo)
+            enlace, unidades = interfaces[interfaz] if interfaz < len(interfaces) else (_ENLACE_ETHERNET, 10 ** 6)
+            capturado = min(capturado, longitud - 32)
+            paquete(((alto << 32) | bajo) / unidades, m, cuerpo + 20, capturado, original, enlace)
+        elif tipo == 3:                      # Simple Packet Block
+            original = struct.unpack_from(orden + 'I', m, cuerpo)[0]
+            enlace = interfaces[0][0] if interfaces else _ENLACE_ETHERNET
+            paquete(None, m, cuerpo + 4, min(original, longitud - 16), original, enlace)
+        elif tipo == 2:                      # Packet Block (obsoleto)
+            interfaz, _, alto, bajo, capturado, original = struct.unpack_from(orden + 'HHIIII', m, cuerpo)
+            enlace, unidades = interfaces[interfaz] if interfaz < len(interfaces) else (_ENLACE_ETHERNET, 10 ** 6)
+            capturado = min(capturado, longitud - 32)
+            paquete(((alto << 32) | bajo) / unidades, m, cuerpo + 20, capturado, original, enlace)
+        elif tipo == 1:                      # Interface Description Block
+            enlace = struct.unpack_from(orden + 'H', m, cuerpo)[0]
+            interfaces.append((enlace, _resolucion_ts(m, cuerpo + 8, posicion + longitud - 4, orden)))
+            resumen.enlaces.add(enlace)
+
+        posicion += longitud
+    resumen.truncada = resumen.truncada or posicion != tamano
+
+
+def resumir(ruta):
+    """Lee una captura pcap o pcapng completa y devuelve su resumen.
+
+    El archivo se mapea en memoria y se recorre secuencialmente: el sistema
+    operativo va trayendo y soltando páginas, así que el consumo no depende
+    del tamaño de la captura sino del número de IPs y flujos distintos.
+    """
+    with open(ruta, 'rb') as f:
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise CapturaInvalida("Archivo vacío")
+    try:
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            m.madvise(mmap.MADV_SEQUENTIAL)
+        if len(m) < 24:
+            raise CapturaInvalida("Archivo demasiado corto")
+
+        resumen = _Resumen()
+        magia = struct.unpack_from('<I', m, 0)[0]
+        if magia == _PCAPNG_SHB:
+            formato = 'pcapng'
+            _leer_pcapng(m, resumen)
+        elif magia in (_PCAP_US, _PCAP_NS) or struct.unpack_from('>I', m, 0)[0] in (_PCAP_US, _PCAP_NS):
+            formato = 'pcap'
+            _leer_pcap(m, resumen)
+        else:
+            raise CapturaInvalida("Formato no reconocido")
+        return resumen.resultado(formato)
+    finally:
+        m.close()
+
+
+# ==============================
+# COLA DE RESÚMENES
+# ==============================
+def pendientes(cursor, limite, max_intentos=MAX_INTENTOS):
+    """Capturas sin resumir, con la ruta de una evidencia que tenga ese contenido"""
+    cursor.execute("""
+        SELECT r.sha256, MIN(e.ruta)
+        FROM resumenes_captura r
+        JOIN evidencias e ON e.sha256 = r.sha256
+        WHERE r.estado IN ('pendiente', 'procesando', 'error') AND r.intentos < %s
+        GROUP BY r.sha256
+        LIMIT %s
+    """, (max_intentos, limite))
+    return cursor.fetchall()
+
+
+def _incidentes_modificados(cursor, sha256):
+    """Sube la versión de los incidentes con esa captura: su detalle en
+    caché muestra el estado del resumen"""
+    cursor.execute("""
+        UPDATE incidentes i JOIN evidencias e ON e.incidente_id = i.id
+        SET i.version = i.version + 1
+        WHERE e.sha256 = %s
+    """, (sha256,))
+
+
+def trabajar(db_config, sha256, ruta, caducidad=3600):
+    """Punto de entrada de cada proceso del pool: (sha256, paquetes o None, error)"""
+    conn = mysql.connector.connect(**db_config)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE resumenes_captura
+            SET estado = 'procesando', reclamada = CURRENT_TIMESTAMP, intentos = intentos + 1
+            WHERE sha256 = %s AND intentos < %s
+              AND (estado IN ('pendiente', 'error')
+                   OR (estado = 'procesando' AND reclamada < NOW() - INTERVAL %s SECOND))
+        """, (sha256, MAX_INTENTOS, caducidad))
+        if cursor.rowcount != 1:
+            cursor.close()
+            return sha256, None, None
+        _incidentes_modificados(cursor, sha256)
+
+        inicio = time.time()
+        try:
+            with almacen().copia_local(ruta) as local:
+                resultado = resumir(local)
+        except Exception as e:
+            estado = 'invalida' if isinstance(e, CapturaInvalida) else 'error'
+            cursor.execute(
+                "UPDATE resumenes_captura SET estado = %s, error = %s WHERE sha256 = %s",
+                (estado, str(e)[:500], sha256)
+            )
+            _incidentes_modificados(cursor, sha256)
+            cursor.close()
+            return sha256, None, str(e)
+
+        resultado['segundos_analisis'] = round(time.time() - inicio, 3)
+        cursor.execute("""
+            UPDATE resumenes_captura
+            SET estado = 'completa', resumen = %s, error = NULL, fecha_fin = CURRENT_TIMESTAMP
+            WHERE sha256 = %s
+        """, (json.dumps(resultado), sha256))
+        _incidentes_modificados(cursor, sha256)
+        cursor.close()
+        return sha256, resultado['paquetes'], None
+    finally:
+        conn.close()
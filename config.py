@@ -2,12 +2,28 @@
 import os
 
 class Config:
-    # Configuración XAMPP MySQL
-    DB_HOST = "localhost"
-    DB_USER = "root"
-    DB_PASSWORD = ""  # XAMPP por defecto tiene password vacío
-    DB_NAME = "cyberincident"
-    DB_PORT = 3306
+    # Configuración XAMPP MySQL (las variables de entorno tienen prioridad)
+    DB_HOST = os.environ.get("DB_HOST", "localhost")
+    DB_USER = os.environ.get("DB_USER", "root")
+    DB_PASSWORD = os.environ.get("DB_PASSWORD", "")  # XAMPP por defecto tiene password vacío
+    DB_NAME = os.environ.get("DB_NAME", "cyberincident")
+    DB_PORT = int(os.environ.get("DB_PORT", 3306))
+    
+    # Réplicas de solo lectura: "host[:puerto]" separadas por comas. Usan el
+    # mismo usuario, contraseña y base de datos que la primaria
+    DB_REPLICAS = os.environ.get("DB_REPLICAS", "")
+    
+    # Almacén de evidencias: "local" (UPLOAD_FOLDER/blobs) o "s3". Con s3 las
+    # credenciales salen de la cadena estándar de boto3 (variables AWS_*,
+    # perfil o rol de la instancia); S3_ENDPOINT_URL sirve para MinIO
+    ALMACEN = os.environ.get("EVIDENCIAS_ALMACEN", "local")
+    S3_BUCKET = os.environ.get("S3_BUCKET", "")
+    S3_PREFIJO = os.environ.get("S3_PREFIJO", "evidencias/")
+    S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL") or None
+    S3_REGION = os.environ.get("S3_REGION") or None
+    S3_TAMANO_PARTE = int(os.environ.get("S3_TAMANO_PARTE", 16 * 1024 * 1024))
+    S3_HILOS = int(os.environ.get("S3_HILOS", 8))
+    S3_URL_CADUCIDAD = int(os.environ.get("S3_URL_CADUCIDAD", 300))
     
     # Configuración Flask
     SECRET_KEY = os.environ.get('SECRET_KEY', 'dev-key-12345-cambiar-en-produccion')
@@ -20,12 +36,33 @@ class Config:
         'pcap', 'gif', 'bmp', 'webp'
     }
 
-# Diccionario para mysql.connector
+# Diccionario para mysql.connector (el único: app.py lo importa de aquí)
 DB_CONFIG = {
     "host": Config.DB_HOST,
     "user": Config.DB_USER,
     "password": Config.DB_PASSWORD,
     "database": Config.DB_NAME,
     "port": Config.DB_PORT,
-    "charset": "utf8mb4"
-}
\ No newline at end of file
+    "charset": "utf8mb4",
+    "autocommit": True
+}
+
+def _config_replica(direccion):
+    host, _, puerto = direccion.strip().partition(':')
+    return dict(DB_CONFIG, host=host, port=int(puerto or Config.DB_PORT))
+
+# Una configuración por réplica, igual que DB_CONFIG salvo host y puerto
+DB_REPLICAS = [_config_replica(d) for d in Config.DB_REPLICAS.split(',') if d.strip()]
+
+# Parámetros de almacen_blobs.crear_almacen
+ALMACEN_CONFIG = {"tipo": Config.ALMACEN, "raiz": os.path.join(Config.UPLOAD_FOLDER, "blobs")}
+if Config.ALMACEN == "s3":
+    ALMACEN_CONFIG.update({
+        "bucket": Config.S3_BUCKET,
+        "prefijo": Config.S3_PREFIJO,
+        "endpoint_url": Config.S3_ENDPOINT_URL,
+        "region": Config.S3_REGION,
+        "tamano_parte": Config.S3_TAMANO_PARTE,
+        "hilos": Config.S3_HILOS,
+        "caducidad_url": Config.S3_URL_CADUCIDAD
+    })
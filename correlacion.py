@@ -0,0 +1,206 @@
+# correlacion.py
+"""Correlación de incidentes entrantes: las alertas repetidas se fusionan"""
+import hashlib
+import logging
+import re
+import unicodedata
+
+from indicadores import extraer_de_linea
+
+logger = logging.getLogger(__name__)
+
+# Solo se buscan coincidencias entre incidentes sin cerrar
+ESTADOS_ABIERTOS = ('Abierto', 'En Investigación')
+
+# De menor a mayor: al fusionar, el incidente se queda con la más alta
+ORDEN_SEVERIDAD = ('baja', 'media', 'alta', 'critica')
+
+# Los indicadores que identifican el ataque; las URL suelen llevar
+# parámetros que cambian en cada alerta (su dominio ya cuenta)
+TIPOS_INDICADOR = ('ipv4', 'dominio', 'email', 'sha256', 'sha1', 'md5')
+MAX_INDICADORES = 20
+
+VERSION_HUELLA = 1
+
+# Segundos que se espera por una huella que otra conexión está correlacionando
+ESPERA_BLOQUEO = 10
+
+# Partes variables de un título: identificadores hexadecimales y números
+_VARIABLES = re.compile(r'\b[0-9a-f]*\d[0-9a-f]*\b|\d+')
+_PALABRA = re.compile(r'[\w#]+')
+
+
+def normalizar_titulo(titulo):
+    """Minúsculas, sin tildes y con números e identificadores como '#'"""
+    texto = titulo.lower()
+    if not texto.isascii():
+        texto = unicodedata.normalize('NFKD', texto)
+        texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    texto = _VARIABLES.sub('#', texto)
+    return ' '.join(_PALABRA.findall(texto))
+
+
+def indicadores_de(*textos):
+    """Indicadores ordenados de los textos, como 'tipo:valor'"""
+    encontrados = {}
+    texto = '\n'.join(texto for texto in textos if texto)
+    extraer_de_linea(texto.encode('utf-8', 'replace'), encontrados, TIPOS_INDICADOR)
+    valores = sorted(f"{tipo}:{valor}" for tipo, valor in encontrados)
+    return valores[:MAX_INDICADORES]
+
+
+def huella(titulo, tipo, usuario_reporta, descripcion=''):
+    """Huella de correlación (SHA-1 en hexadecimal, 40 caracteres).
+
+    Dos alertas con el mismo título normalizado, tipo, informante e
+    indicadores (IP, dominios, hashes, correos del título y la descripción)
+    tienen la misma huella.
+    """
+    partes = [
+        str(VERSION_HUELLA),
+        (tipo or '').lower(),
+        (usuario_reporta or '').strip().lower(),
+        normalizar_titulo(titulo or ''),
+        ','.join(indicadores_de(titulo, descripcion))
+    ]
+    return hashlib.sha1('|'.join(partes).encode('utf-8')).hexdigest()
+
+
+# ==============================
+# BLOQUEO POR HUELLA
+# ==============================
+class HuellaOcupada(Exception):
+    """Otra conexión lleva demasiado tiempo correlacionando la misma huella"""
+
+
+def _nombre_bloqueo(huella):
+    # GET_LOCK admite nombres de hasta 64 caracteres
+    return f"correlacion:{huella}"
+
+
+def bloquear(cursor, huellas, espera=ESPERA_BLOQUEO):
+    """Toma un bloqueo con nombre (GET_LOCK) por huella.
+
+    Sin él, dos alertas iguales que llegan a la vez no ven el incidente de
+    la otra y abren dos. Se toman en orden para que dos lotes no se
+    interbloqueen y duran hasta ``liberar`` (no con el commit): hay que
+    liberarlos después de confirmar la transacción. Devuelve las huellas
+    bloqueadas; lanza HuellaOcupada si alguna no llega en ``espera`` segundos.
+    """
+    huellas = sorted(set(huellas))
+    if not huellas:
+        return []
+    columnas = ', '.join(['GET_LOCK(%s, %s)'] * len(huellas))
+    try:
+        cursor.execute(f"SELECT {columnas}",
+                       [valor for huella in huellas for valor in (_nombre_bloqueo(huella), espera)])
+        obtenidos = cursor.fetchone()
+    except Exception:
+        liberar(cursor, huellas)
+        raise
+    if any(obtenido != 1 for obtenido in obtenidos):
+        liberar(cursor, huellas)
+        raise HuellaOcupada(f"No se pudo bloquear la huella de correlación en {espera} s")
+    return huellas
+
+
+def liberar(cursor, huellas):
+    """Suelta los bloqueos de ``bloquear`` (los que no se tienen se ignoran)"""
+    if not huellas:
+        return
+    columnas = ', '.join(['RELEASE_LOCK(%s)'] * len(huellas))
+    try:
+        cursor.execute(f"SELECT {columnas}", [_nombre_bloqueo(huella) for huella in huellas])
+        cursor.fetchone()
+    except Exception as e:
+        # Si la conexión se ha perdido, sus bloqueos se han ido con ella
+        logger.warning(f"Error liberando bloqueos de correlación: {e}")
+
+
+# ==============================
+# BÚSQUEDA Y FUSIÓN
+# ==============================
+def buscar_abiertos(cursor, huellas, ventana):
+    """{huella: id} del incidente abierto más reciente con cada huella.
+
+    Solo cuentan los que han tenido actividad (creación o última repetición)
+    en los últimos ``ventana`` segundos. Usa el índice por huella.
+    """
+    huellas = list(set(huellas))
+    if not huellas or ventana <= 0:
+        return {}
+    marcadores = ', '.join(['%s'] * len(huellas))
+    cursor.execute(f"""
+        SELECT huella, MAX(id)
+        FROM incidentes
+        WHERE huella IN ({marcadores})
+          AND estado IN (%s, %s)
+          AND COALESCE(ultima_repeticion, fecha_creacion) >= NOW() - INTERVAL %s SECOND
+        GROUP BY huella
+    """, huellas + list(ESTADOS_ABIERTOS) + [ventana])
+    return {fila[0]: fila[1] for fila in cursor.fetchall()}
+
+
+def mayor_severidad(*severidades):
+    """La más alta de las severidades dadas"""
+    return max(severidades, key=lambda severidad: (
+        ORDEN_SEVERIDAD.index(severidad) if severidad in ORDEN_SEVERIDAD else -1))
+
+
+def fusionar(cursor, fusiones, usuario):
+    """Suma repeticiones (y la versión) y deja constancia en el historial.
+
+    ``fusiones`` es {incidente_id: (repeticiones, título de la última
+    alerta, severidad más alta de las alertas)}; si la severidad supera a
+    la del incidente, este sube a ella. Se hace con un SELECT, un UPDATE y
+    un INSERT multi-fila sea cual sea el número de incidentes.
+
+    Devuelve [(estado, severidad anterior, severidad nueva)] de los
+    incidentes que han subido de severidad, para las estadísticas.
+    """
+    if not fusiones:
+        return []
+    ids = list(fusiones)
+    marcadores = ', '.join(['%s'] * len(ids))
+    cursor.execute(f"""
+        SELECT id, estado, severidad FROM incidentes
+        WHERE id IN ({marcadores})
+        FOR UPDATE
+    """, ids)
+    escaladas = {}
+    for incidente_id, estado, actual in cursor.fetchall():
+        entrante = fusiones[incidente_id][2]
+        if mayor_severidad(actual, entrante) != actual:
+            escaladas[incidente_id] = (estado, actual, entrante)
+
+    casos = ' '.join(['WHEN %s THEN %s'] * len(ids))
+    parametros = [valor for incidente_id in ids for valor in (incidente_id, fusiones[incidente_id][0])]
+    severidades = ''
+    if escaladas:
+        severidades = f"severidad = CASE id {' '.join(['WHEN %s THEN %s'] * len(escaladas))} ELSE severidad END,"
+        parametros += [valor for incidente_id, (_, _, nueva) in escaladas.items()
+                       for valor in (incidente_id, nueva)]
+    cursor.execute(f"""
+        UPDATE incidentes
+        SET repeticiones = repeticiones + CASE id {casos} END,
+            {severidades}
+            ultima_repeticion = CURRENT_TIMESTAMP,
+            version = version + 1
+        WHERE id IN ({marcadores})
+    """, parametros + ids)
+
+    valores = ', '.join(["(%s, %s, 'CORRELACION', %s)"] * len(ids))
+    parametros = []
+    for incidente_id in ids:
+        cantidad, titulo, severidad = fusiones[incidente_id]
+        descripcion = (f"Alerta repetida fusionada (severidad {severidad}): {titulo}" if cantidad == 1
+                       else f"{cantidad} alertas repetidas fusionadas (severidad máxima {severidad}): {titulo}")
+        if incidente_id in escaladas:
+            _, anterior, nueva = escaladas[incidente_id]
+            descripcion += f". Severidad elevada de {anterior} a {nueva}"
+        parametros += [incidente_id, usuario, descripcion]
+    cursor.execute(f"""
+        INSERT INTO historial (incidente_id, usuario, accion, descripcion)
+        VALUES {valores}
+    """, parametros)
+    return list(escaladas.values())
@@ -0,0 +1,205 @@
+# db_pool.py
+"""Pool de conexiones acotado por proceso para MySQL"""
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class PoolAgotado(Exception):
+    """No se obtuvo una conexión libre dentro del tiempo de espera"""
+
+
+class ConnectionPool:
+    """Pool de conexiones con tamaño máximo, verificación de salud y reciclaje.
+
+    Las conexiones se crean bajo demanda hasta ``size``. Cuando todas están en
+    uso, ``acquire`` espera hasta ``timeout`` segundos antes de fallar con
+    ``PoolAgotado``. Las conexiones más viejas que ``recycle`` segundos se
+    cierran y se reemplazan, y las que llevan más de ``ping_interval``
+    segundos ociosas se verifican con un ping antes de entregarse.
+    """
+
+    def __init__(self, connect, size=10, timeout=5.0, recycle=3600, ping_interval=30):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_interval = ping_interval
+
+        self._cond = threading.Condition()
+        self._libres = deque()      # (conexion, creada, ultimo_uso)
+        self._creadas = {}          # id(conexion) -> creada
+        self._reservadas = 0        # conexiones en proceso de apertura
+        self._en_uso = 0
+        self._esperando = 0
+        self._cerrado = False
+
+        # Métricas acumuladas
+        self._adquisiciones = 0
+        self._esperas = 0
+        self._tiempo_espera_total = 0.0
+        self._tiempo_espera_max = 0.0
+        self._timeouts = 0
+        self._recicladas = 0
+        self._descartadas = 0
+
+    # ------------------------------
+    # Ciclo de vida de conexiones
+    # ------------------------------
+    def _nueva_conexion(self):
+        conn = self._connect()
+        with self._cond:
+            self._creadas[id(conn)] = time.monotonic()
+        return conn
+
+    def _cerrar_conexion(self, conn):
+        with self._cond:
+            self._creadas.pop(id(conn), None)
+            self._cond.notify()
+        try:
+            conn.close()
+        except Exception as e:
+            logger.debug(f"Error cerrando conexión del pool: {e}")
+
+    def _conexion_sana(self, conn, creada, ultimo_uso):
+        """Indica si una conexión libre puede reutilizarse"""
+        ahora = time.monotonic()
+        if self.recycle and ahora - creada > self.recycle:
+            self._recicladas += 1
+            return False
+        if self.ping_interval is not None and ahora - ultimo_uso > self.ping_interval:
+            try:
+                if not conn.is_connected():
+                    self._descartadas += 1
+                    return False
+            except Exception:
+                self._descartadas += 1
+                return False
+        return True
+
+    def acquire(self, timeout=None):
+        """Obtiene una conexión del pool, esperando si está agotado"""
+        timeout = self.timeout if timeout is None else timeout
+        inicio = time.monotonic()
+        espero = False
+
+        with self._cond:
+            while True:
+                if self._cerrado:
+                    raise PoolAgotado("El pool de conexiones está cerrado")
+
+                if self._libres:
+                    conn, creada, ultimo_uso = self._libres.pop()
+                    self._en_uso += 1
+                    break
+
+                if len(self._creadas) + self._reservadas < self.size:
+                    # Reservar el cupo antes de conectar fuera del lock
+                    self._reservadas += 1
+                    conn = None
+                    self._en_uso += 1
+                    break
+
+                restante = timeout - (time.monotonic() - inicio)
+                if restante <= 0:
+                    self._timeouts += 1
+                    raise PoolAgotado(
+                        f"No hay conexiones libres tras {timeout}s "
+                        f"({self._en_uso} en uso de {self.size})"
+                    )
+                espero = True
+                self._esperando += 1
+                try:
+                    self._cond.wait(restante)
+                finally:
+                    self._esperando -= 1
+
+        reservada = conn is None
+        try:
+            if reservada:
+                conn = self._nueva_conexion()
+            elif not self._conexion_sana(conn, creada, ultimo_uso):
+                # El cupo sigue reservado hasta registrar la conexión nueva:
+                # si no, otro hilo lo ocuparía mientras se abre el reemplazo
+                with self._cond:
+                    self._reservadas += 1
+                reservada = True
+                self._cerrar_conexion(conn)
+                conn = self._nueva_conexion()
+        except Exception:
+            with self._cond:
+                self._en_uso -= 1
+                self._cond.notify()
+            raise
+        finally:
+            if reservada:
+                with self._cond:
+                    self._reservadas -= 1
+
+        espera = time.monotonic() - inicio
+        with self._cond:
+            self._adquisiciones += 1
+            if espero:
+                self._esperas += 1
+            self._tiempo_espera_total += espera
+            self._tiempo_espera_max = max(self._tiempo_espera_max, espera)
+        return conn
+
+    def release(self, conn, descartar=False):
+        """Devuelve una conexión al pool (o la cierra si está dañada)"""
+        if not descartar:
+            try:
+                if getattr(conn, 'unread_result', False):
+                    conn.get_rows()
+                if getattr(conn, 'in_transaction', False):
+                    conn.rollback()
+            except Exception as e:
+                logger.warning(f"Conexión descartada al devolverla al pool: {e}")
+                descartar = True
+
+        with self._cond:
+            self._en_uso -= 1
+
+        if descartar or self._cerrado:
+            if descartar:
+                self._descartadas += 1
+            self._cerrar_conexion(conn)
+            return
+
+        with self._cond:
+            creada = self._creadas.get(id(conn), time.monotonic())
+            self._libres.append((conn, creada, time.monotonic()))
+            self._cond.notify()
+
+    def cerrar(self):
+        """Cierra todas las conexiones libres y rechaza nuevas adquisiciones"""
+        with self._cond:
+            self._cerrado = True
+            libres = list(self._libres)
+            self._libres.clear()
+            self._cond.notify_all()
+        for conn, _, _ in libres:
+            self._cerrar_conexion(conn)
+
+    # ------------------------------
+    # Métricas
+    # ------------------------------
+    def estadisticas(self):
+        with self._cond:
+            return {
+                'tamano': self.size,
+                'abiertas': len(self._creadas),
+                'en_uso': self._en_uso,
+                'libres': len(self._libres),
+                'esperando': self._esperando,
+                'adquisiciones': self._adquisiciones,
+                'esperas': self._esperas,
+                'tiempo_espera_total_ms': round(self._tiempo_espera_total * 1000, 2),
+                'tiempo_espera_max_ms': round(self._tiempo_espera_max * 1000, 2),
+                'timeouts': self._timeouts,
+                'recicladas': self._recicladas,
+                'descartadas': self._descartadas,
+            }
@@ -0,0 +1,245 @@
+# envio_archivos.py
+"""Envío de evidencias con peticiones condicionales y rangos de bytes"""
+import mimetypes
+import os
+import uuid
+from datetime import timezone
+from urllib.parse import quote
+
+from flask import Response
+from werkzeug.http import http_date, parse_date, quote_etag, unquote_etag
+
+TAMANO_BLOQUE = 256 * 1024
+
+# Más rangos que estos en una petición se atienden con la respuesta completa
+MAX_RANGOS = 16
+
+
+def tipo_mime(nombre, defecto='application/octet-stream'):
+    return mimetypes.guess_type(nombre)[0] or defecto
+
+
+def fecha_http(fecha):
+    """Convierte una fecha de MySQL (hora local, sin zona) a fecha HTTP"""
+    if fecha is None:
+        return None
+    if fecha.tzinfo is None:
+        fecha = fecha.astimezone(timezone.utc)
+    return fecha.replace(microsecond=0)
+
+
+def _coincide_etag(cabecera, etag):
+    """Comparación débil de If-None-Match / If-Range (RFC 9110)"""
+    if cabecera.strip() == '*':
+        return True
+    for candidata in cabecera.split(','):
+        valor, _debil = unquote_etag(candidata.strip())
+        if valor == etag:
+            return True
+    return False
+
+
+def no_modificado(entorno, etag, ultima_modificacion):
+    """Indica si la copia del cliente sigue siendo válida (respuesta 304).
+
+    Solo usa las cabeceras y los metadatos de la base de datos, sin tocar el
+    archivo. If-None-Match tiene prioridad sobre If-Modified-Since.
+    """
+    if_none_match = entorno.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        return bool(etag) and _coincide_etag(if_none_match, etag)
+
+    if_modified_since = parse_date(entorno.get('HTTP_IF_MODIFIED_SINCE'))
+    if if_modified_since is not None and ultima_modificacion is not None:
+        return ultima_modificacion <= if_modified_since
+    return False
+
+
+def _rango_vigente(entorno, etag, ultima_modificacion):
+    """Aplica If-Range: si la representación cambió se ignora el Range"""
+    if_range = entorno.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith(('"', 'W/')):
+        # If-Range exige comparación fuerte
+        valor, debil = unquote_etag(if_range)
+        return bool(etag) and not debil and valor == etag
+    fecha = parse_date(if_range)
+    return fecha is not None and ultima_modificacion is not None and fecha == ultima_modificacion
+
+
+def _parsear_rangos(cabecera):
+    """Lee ``bytes=a-b,c-,-n`` en pares (inicio, fin exclusivo).
+
+    A diferencia de ``werkzeug.http.parse_range_header`` admite rangos
+    desordenados o solapados, que el RFC permite. Un sufijo ``-n`` se
+    devuelve como (None, n). Devuelve None si la cabecera no es válida.
+    """
+    unidad, _, especificacion = cabecera.partition('=')
+    if unidad.strip().lower() != 'bytes':
+        return None
+    rangos = []
+    for parte in especificacion.split(','):
+        parte = parte.strip()
+        if not parte:
+            continue
+        inicio, guion, fin = parte.partition('-')
+        if not guion or not (inicio.strip() + fin.strip()).isdigit():
+            return None
+        if not inicio.strip():
+            rangos.append((None, int(fin)))
+        elif not fin.strip():
+            rangos.append((int(inicio), None))
+        elif int(fin) < int(inicio):
+            return None
+        else:
+            rangos.append((int(inicio), int(fin) + 1))
+    return rangos or None
+
+
+def rangos_solicitados(entorno, tamano, etag=None, ultima_modificacion=None):
+    """Devuelve la lista de rangos [inicio, fin) a enviar, o None para el archivo completo.
+
+    Los rangos solapados o contiguos se fusionan. Lanza ``ValueError`` si
+    ninguno de los rangos pedidos cae dentro del archivo (respuesta 416).
+    """
+    cabecera = entorno.get('HTTP_RANGE')
+    if not cabecera or tamano == 0:
+        return None
+    if not _rango_vigente(entorno, etag, ultima_modificacion):
+        return None
+
+    pedidos = _parsear_rangos(cabecera)
+    if pedidos is None:
+        return None
+
+    rangos = []
+    for inicio, fin in pedidos:
+        if inicio is None:                   # sufijo: últimos ``fin`` bytes
+            inicio, fin = max(tamano - fin, 0), tamano
+        elif fin is None or fin > tamano:
+            fin = tamano
+        if inicio < fin:
+            rangos.append([inicio, fin])
+
+    if not rangos:
+        raise ValueError("Rango no satisfacible")
+
+    rangos.sort()
+    fusionados = [rangos[0]]
+    for inicio, fin in rangos[1:]:
+        if inicio <= fusionados[-1][1]:
+            fusionados[-1][1] = max(fusionados[-1][1], fin)
+        else:
+            fusionados.append([inicio, fin])
+
+    if len(fusionados) > MAX_RANGOS or fusionados == [[0, tamano]]:
+        return None
+    return [tuple(r) for r in fusionados]
+
+
+def _leer(ruta, inicio, fin, tamano_bloque):
+    with open(ruta, 'rb') as f:
+        f.seek(inicio)
+        restante = fin - inicio
+        while restante > 0:
+            bloque = f.read(min(tamano_bloque, restante))
+            if not bloque:
+                break
+            restante -= len(bloque)
+            yield bloque
+
+
+def _cuerpo(entorno, ruta, inicio, fin, tamano_bloque):
+    """Bytes [inicio, fin) de ``ruta`` como cuerpo de la respuesta.
+
+    Si el servidor ofrece ``wsgi.file_wrapper`` (sendfile en gunicorn, envío
+    desde el bucle de eventos en asgi.py) recibe el archivo abierto en
+    ``inicio``: PEP 3333 le impide enviar más de Content-Length, que aquí
+    siempre es ``fin - inicio``.
+    """
+    envoltorio = entorno.get('wsgi.file_wrapper')
+    if envoltorio is None:
+        return _leer(ruta, inicio, fin, tamano_bloque)
+    archivo = open(ruta, 'rb')
+    archivo.seek(inicio)
+    return envoltorio(archivo, tamano_bloque)
+
+
+def _leer_multiparte(ruta, rangos, tamano, mimetype, separador, tamano_bloque):
+    for inicio, fin in rangos:
+        yield _cabecera_parte(separador, mimetype, inicio, fin, tamano)
+        yield from _leer(ruta, inicio, fin, tamano_bloque)
+    yield f"\r\n--{separador}--\r\n".encode('ascii')
+
+
+def _cabecera_parte(separador, mimetype, inicio, fin, tamano):
+    return (
+        f"\r\n--{separador}\r\n"
+        f"Content-Type: {mimetype}\r\n"
+        f"Content-Range: bytes {inicio}-{fin - 1}/{tamano}\r\n\r\n"
+    ).encode('ascii')
+
+
+def disposicion(nombre, adjunto=True):
+    """Content-Disposition con el nombre original (RFC 6266)"""
+    tipo = 'attachment' if adjunto else 'inline'
+    simple = nombre.encode('ascii', 'ignore').decode('ascii').replace('"', '') or 'evidencia'
+    return f"{tipo}; filename=\"{simple}\"; filename*=UTF-8''{quote(nombre)}"
+
+
+def enviar_archivo(entorno, ruta, mimetype, etag=None, ultima_modificacion=None,
+                   nombre=None, adjunto=False, modo='python', raiz_accel=None,
+                   prefijo_accel='/_evidencias/', tamano_bloque=TAMANO_BLOQUE):
+    """Construye la respuesta para enviar ``ruta`` (200, 206 o 416).
+
+    ``modo`` elige quién envía los bytes: ``python`` los lee por bloques,
+    ``x-sendfile`` delega en Apache/lighttpd y ``x-accel`` en nginx con una
+    redirección interna a ``prefijo_accel`` + la ruta relativa a
+    ``raiz_accel``. En los dos últimos el servidor web resuelve los rangos.
+    La comprobación de 304 se hace antes, con ``no_modificado``.
+    """
+    cabeceras = {'Accept-Ranges': 'bytes'}
+    if etag:
+        cabeceras['ETag'] = quote_etag(etag)
+    if ultima_modificacion is not None:
+        cabeceras['Last-Modified'] = http_date(ultima_modificacion)
+    if nombre:
+        cabeceras['Content-Disposition'] = disposicion(nombre, adjunto)
+
+    if modo == 'x-sendfile':
+        cabeceras['X-Sendfile'] = os.path.abspath(ruta)
+        return Response(status=200, mimetype=mimetype, headers=cabeceras)
+    if modo == 'x-accel':
+        relativa = os.path.relpath(os.path.abspath(ruta), os.path.abspath(raiz_accel))
+        cabeceras['X-Accel-Redirect'] = prefijo_accel.rstrip('/') + '/' + quote(relativa.replace(os.sep, '/'))
+        return Response(status=200, mimetype=mimetype, headers=cabeceras)
+
+    tamano = os.path.getsize(ruta)
+    try:
+        rangos = rangos_solicitados(entorno, tamano, etag, ultima_modificacion)
+    except ValueError:
+        cabeceras['Content-Range'] = f"bytes */{tamano}"
+        return Response(status=416, headers=cabeceras)
+
+    if rangos is None:
+        cabeceras['Content-Length'] = str(tamano)
+        return Response(_cuerpo(entorno, ruta, 0, tamano, tamano_bloque), status=200,
+                        mimetype=mimetype, headers=cabeceras, direct_passthrough=True)
+
+    if len(rangos) == 1:
+        inicio, fin = rangos[0]
+        cabeceras['Content-Range'] = f"bytes {inicio}-{fin - 1}/{tamano}"
+        cabeceras['Content-Length'] = str(fin - inicio)
+        return Response(_cuerpo(entorno, ruta, inicio, fin, tamano_bloque), status=206,
+                        mimetype=mimetype, headers=cabeceras, direct_passthrough=True)
+
+    separador = uuid.uuid4().hex
+    longitud = sum(len(_cabecera_parte(separador, mimetype, inicio, fin, tamano)) + fin - inicio
+                   for inicio, fin in rangos)
+    longitud += len(f"\r\n--{separador}--\r\n")
+    cabeceras['Content-Length'] = str(longitud)
+    cabeceras['Content-Type'] = f"multipart/byteranges; boundary={separador}"
+    return Response(_leer_multiparte(ruta, rangos, tamano, mimetype, separador, tamano_bloque),
+                    status=206, headers=cabeceras, direct_passthrough=True)
@@ -0,0 +1,333 @@
+# escritor_historial.py
+"""Escritor en segundo plano para la tabla historial"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+_FORMATO_FECHA = '%Y-%m-%d %H:%M:%S'
+
+# Resultado de registrar(esperar=True) cuando el registro está en la cola
+# (y en el spool) pero aún no en la base de datos: se insertará más tarde
+ENCOLADO = object()
+
+
+def _error_de_datos(error):
+    """Indica si el error se debe a los datos y no a la conexión"""
+    return type(error).__name__ in ('IntegrityError', 'DataError')
+
+
+class EscritorHistorial:
+    """Acumula registros de historial en memoria y los inserta por lotes.
+
+    Un único hilo vacía la cola con INSERT de varias filas cuando se juntan
+    ``lote`` registros o pasan ``intervalo`` segundos; si alguien espera a un
+    registro (``esperar=True``) el lote sale en cuanto se vacía la cola, sin
+    esperar al intervalo. Al ser una sola cola
+    FIFO, el orden de inserción (y por tanto el ``id``) es el mismo orden en
+    que se registraron las acciones. La fecha se toma al registrar, no al
+    insertar.
+
+    La cola está acotada a ``max_cola`` registros: si se llena, quien registra
+    espera hasta ``bloqueo`` segundos y luego se rechaza el registro.
+
+    Si se indica ``spool``, cada registro se añade también a ese archivo
+    NDJSON antes de confirmarse, y un archivo de control ``<spool>.ok`` guarda
+    cuántas líneas ya están en la base de datos. Al iniciar se reinsertan las
+    líneas pendientes, de modo que una caída del proceso no pierde entradas
+    (en el peor caso se repite el último lote).
+
+    ``al_insertar(filas)``, si se indica, se llama desde el hilo escritor
+    con cada lote ya confirmado, antes de avisar a quien espera.
+
+    Quien espera no se queda bloqueado mientras la base de datos falla: si
+    el escritor está reintentando, o la espera se agota, ``registrar``
+    devuelve ENCOLADO en vez de True.
+    """
+
+    def __init__(self, conectar, lote=100, intervalo=0.5, max_cola=10000,
+                 bloqueo=2.0, spool=None, fsync=False, al_insertar=None):
+        self._conectar = conectar
+        self._al_insertar = al_insertar
+        self.lote = lote
+        self.intervalo = intervalo
+        self.bloqueo = bloqueo
+        self.spool = spool
+        self.fsync = fsync
+
+        self._cola = queue.Queue()
+        self._huecos = threading.Semaphore(max_cola)
+        self._lock = threading.Lock()
+        # Orden común de la cola y el spool; nunca se retiene mientras se espera
+        self._orden = threading.Lock()
+        self._hilo = None
+        self._pid = None
+        self._detener = threading.Event()
+        self._spool_archivo = None
+        self._confirmadas_spool = 0
+        self._recuperadas = []
+        # El último lote falló por la conexión y se está reintentando
+        self._reintentando = False
+
+        # Métricas
+        self._insertadas = 0
+        self._lotes = 0
+        self._rechazadas = 0
+        self._errores = 0
+
+    # ------------------------------
+    # Arranque y parada
+    # ------------------------------
+    def iniciar(self):
+        """Arranca el hilo escritor (una vez por proceso)"""
+        if self._hilo is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._hilo is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._detener.clear()
+            if self.spool:
+                self._recuperar_spool()
+                self._spool_archivo = open(self.spool, 'a', encoding='utf-8')
+            self._hilo = threading.Thread(target=self._bucle, name='escritor-historial', daemon=True)
+            self._hilo.start()
+
+    def detener(self, timeout=10):
+        """Vacía la cola pendiente y detiene el hilo escritor"""
+        if self._hilo is None or self._pid != os.getpid():
+            return
+        self._detener.set()
+        self._cola.put(None)
+        self._hilo.join(timeout)
+        self._hilo = None
+        if self._spool_archivo is not None:
+            self._spool_archivo.close()
+            self._spool_archivo = None
+
+    # ------------------------------
+    # Registro
+    # ------------------------------
+    def registrar(self, incidente_id, usuario, accion, descripcion=None, esperar=False):
+        """Encola un registro; con ``esperar`` bloquea hasta que esté insertado.
+
+        Devuelve True si está encolado (o insertado, con ``esperar``), False si
+        se ha descartado y ENCOLADO si se esperaba pero la inserción se retrasa.
+        """
+        self.iniciar()
+
+        fecha = datetime.now().replace(microsecond=0)
+        hecho = threading.Event() if esperar else None
+        # El tercer elemento pasa a True (insertado) o False (descartado)
+        entrada = [(incidente_id, usuario, accion, descripcion, fecha), hecho, ENCOLADO]
+
+        # La espera por un hueco se hace sin lock para no frenar al escritor
+        if not self._huecos.acquire(timeout=self.bloqueo):
+            self._rechazadas += 1
+            logger.error(f"Cola de historial llena, registro descartado: {accion} para incidente {incidente_id}")
+            return False
+
+        with self._orden:
+            self._cola.put_nowait(entrada)
+            if self._spool_archivo is not None:
+                self._escribir_spool([entrada[0]])
+
+        if hecho is None:
+            return True
+        if self._reintentando:
+            # La base de datos está caída: no se hace esperar a la petición
+            return ENCOLADO
+        hecho.wait(self.bloqueo + self.intervalo + 5)
+        return entrada[2]
+
+    def _escribir_spool(self, filas):
+        for incidente_id, usuario, accion, descripcion, fecha in filas:
+            self._spool_archivo.write(json.dumps({
+                'incidente_id': incidente_id,
+                'usuario': usuario,
+                'accion': accion,
+                'descripcion': descripcion,
+                'fecha': fecha.strftime(_FORMATO_FECHA)
+            }, ensure_ascii=False) + '\n')
+        self._spool_archivo.flush()
+        if self.fsync:
+            os.fsync(self._spool_archivo.fileno())
+
+    # ------------------------------
+    # Hilo escritor
+    # ------------------------------
+    def _bucle(self):
+        if self._recuperadas:
+            self._vaciar(self._recuperadas)
+            self._recuperadas = []
+
+        while True:
+            pendientes = []
+            limite = None
+            while len(pendientes) < self.lote:
+                espera = None if limite is None else max(0, limite - time.monotonic())
+                try:
+                    entrada = self._cola.get(timeout=espera)
+                except queue.Empty:
+                    break
+                if entrada is None:
+                    break
+                self._huecos.release()
+                pendientes.append(entrada)
+                if entrada[1] is not None:
+                    # Hay una petición esperando: se junta lo ya encolado y sale
+                    limite = time.monotonic()
+                elif limite is None:
+                    limite = time.monotonic() + self.intervalo
+
+            if pendientes:
+                self._vaciar(pendientes)
+
+            if self._detener.is_set() and self._cola.empty():
+                return
+
+    def _vaciar(self, pendientes):
+        """Inserta un lote, reintentando con espera creciente si falla"""
+        filas = [entrada[0] for entrada in pendientes]
+        espera = 0.5
+        while True:
+            try:
+                self._insertar(filas)
+                break
+            except Exception as e:
+                self._errores += 1
+                logger.error(f"Error escribiendo lote de historial ({len(filas)} registros): {e}")
+                if _error_de_datos(e):
+                    # Una fila inválida (p. ej. incidente ya eliminado) no
+                    # debe bloquear al resto del lote
+                    filas = self._insertar_individual(pendientes)
+                    break
+                if self._detener.is_set():
+                    # Al cerrar no se reintenta más; si hay spool se
+                    # recuperarán en el próximo arranque
+                    for entrada in pendientes:
+                        if not self.spool:
+                            entrada[2] = False
+                        if entrada[1] is not None:
+                            entrada[1].set()
+                    return
+                if not self._reintentando:
+                    # Quien espera a este lote vuelve ya con ENCOLADO
+                    self._reintentando = True
+                    for entrada in pendientes:
+                        if entrada[1] is not None:
+                            entrada[1].set()
+                time.sleep(espera)
+                espera = min(espera * 2, 30)
+
+        self._reintentando = False
+
+        self._insertadas += len(filas)
+        self._lotes += 1
+        if self._al_insertar is not None and filas:
+            try:
+                self._al_insertar(filas)
+            except Exception as e:
+                logger.warning(f"Error tras insertar un lote de historial: {e}")
+        insertadas = {id(fila) for fila in filas}
+        for entrada in pendientes:
+            entrada[2] = id(entrada[0]) in insertadas
+            if entrada[1] is not None:
+                entrada[1].set()
+
+        if self.spool:
+            self._marcar_spool(len(pendientes))
+
+    def _insertar_individual(self, pendientes):
+        """Inserta fila por fila, descartando las que la base de datos rechaza"""
+        insertadas = []
+        for entrada in pendientes:
+            try:
+                self._insertar([entrada[0]])
+                insertadas.append(entrada[0])
+            except Exception as e:
+                incidente_id, _, accion = entrada[0][:3]
+                logger.error(f"Registro de historial descartado ({accion} para incidente {incidente_id}): {e}")
+        return insertadas
+
+    def _insertar(self, filas):
+        conn = self._conectar()
+        try:
+            cursor = conn.cursor()
+            valores = ", ".join(["(%s, %s, %s, %s, %s)"] * len(filas))
+            parametros = [valor for fila in filas for valor in fila]
+            cursor.execute(f"""
+                INSERT INTO historial
+                (incidente_id, usuario, accion, descripcion, fecha)
+                VALUES {valores}
+            """, parametros)
+            conn.commit()
+            cursor.close()
+        finally:
+            conn.close()
+
+    # ------------------------------
+    # Spool en disco
+    # ------------------------------
+    def _marcar_spool(self, cantidad):
+        """Anota las líneas ya insertadas y trunca el spool si no queda nada"""
+        with self._orden:
+            self._confirmadas_spool += cantidad
+            if self._cola.empty() and self._spool_archivo is not None:
+                self._spool_archivo.truncate(0)
+                self._spool_archivo.seek(0)
+                self._confirmadas_spool = 0
+            control = self.spool + '.ok'
+            with open(control + '.tmp', 'w') as f:
+                f.write(str(self._confirmadas_spool))
+            os.replace(control + '.tmp', control)
+
+    def _recuperar_spool(self):
+        """Reinserta los registros del spool que no llegaron a la base de datos"""
+        self._confirmadas_spool = 0
+        if not os.path.exists(self.spool):
+            return
+
+        control = self.spool + '.ok'
+        if os.path.exists(control):
+            with open(control) as f:
+                self._confirmadas_spool = int(f.read().strip() or 0)
+
+        filas = []
+        with open(self.spool, encoding='utf-8') as f:
+            for numero, linea in enumerate(f):
+                if numero < self._confirmadas_spool or not linea.strip():
+                    continue
+                try:
+                    r = json.loads(linea)
+                except ValueError:
+                    # Última línea a medio escribir durante la caída
+                    continue
+                filas.append((r['incidente_id'], r['usuario'], r['accion'], r['descripcion'],
+                              datetime.strptime(r['fecha'], _FORMATO_FECHA)))
+
+        if not filas:
+            return
+
+        logger.info(f"Recuperando {len(filas)} registros de historial del spool")
+        # El hilo escritor los inserta antes que cualquier registro nuevo
+        self._recuperadas = [[fila, None, False] for fila in filas]
+
+    # ------------------------------
+    # Métricas
+    # ------------------------------
+    def estadisticas(self):
+        return {
+            'en_cola': self._cola.qsize(),
+            'insertadas': self._insertadas,
+            'lotes': self._lotes,
+            'rechazadas': self._rechazadas,
+            'errores': self._errores,
+            'reintentando': self._reintentando,
+            'spool': self.spool or None
+        }
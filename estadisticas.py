@@ -0,0 +1,199 @@
+# estadisticas.py
+"""Contadores de incidentes por estado y severidad para el dashboard"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_SEPARADOR = '|'
+
+
+class _AlmacenLocal:
+    """Contadores en memoria del proceso"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conteos = None
+        self._cargado = 0.0
+
+    def leer(self):
+        with self._lock:
+            if self._conteos is None:
+                return None, 0.0
+            return dict(self._conteos), self._cargado
+
+    def reemplazar(self, conteos):
+        with self._lock:
+            self._conteos = dict(conteos)
+            self._cargado = time.time()
+
+    def sumar(self, clave, delta):
+        with self._lock:
+            if self._conteos is None:
+                return
+            self._conteos[clave] = self._conteos.get(clave, 0) + delta
+
+    def invalidar(self):
+        with self._lock:
+            self._conteos = None
+
+
+class _AlmacenRedis:
+    """Contadores compartidos entre procesos en un hash de Redis"""
+
+    def __init__(self, url, prefijo='cyberincident:estadisticas'):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._clave = prefijo
+        self._clave_cargado = prefijo + ':cargado'
+
+    def leer(self):
+        conteos, cargado = self._redis.pipeline().hgetall(self._clave).get(self._clave_cargado).execute()
+        if cargado is None:
+            return None, 0.0
+        return {k.decode(): int(v) for k, v in conteos.items()}, float(cargado)
+
+    def reemplazar(self, conteos):
+        pipe = self._redis.pipeline()
+        pipe.delete(self._clave)
+        if conteos:
+            pipe.hset(self._clave, mapping=conteos)
+        pipe.set(self._clave_cargado, time.time())
+        pipe.execute()
+
+    def sumar(self, clave, delta):
+        # Sin carga previa no hay base sobre la que sumar
+        if self._redis.exists(self._clave_cargado):
+            self._redis.hincrby(self._clave, clave, delta)
+
+    def invalidar(self):
+        self._redis.delete(self._clave_cargado)
+
+
+class ContadoresIncidentes:
+    """Conteo de incidentes por (estado, severidad) mantenido incrementalmente.
+
+    Con la caché fría se carga con una sola consulta agrupada. Después, las
+    rutas que crean, cambian de estado o eliminan incidentes ajustan los
+    contadores sin consultar la base de datos. Cada ``reconciliar`` segundos
+    un hilo vuelve a cargarlos para corregir desvíos (p. ej. escrituras hechas
+    fuera de la aplicación), y cualquier lectura con datos de más de ``ttl``
+    segundos los recarga, de modo que ningún desvío dura más de ``ttl``.
+    """
+
+    def __init__(self, conectar, ttl=60, reconciliar=300, redis_url=None):
+        self._conectar = conectar
+        self.ttl = ttl
+        self.reconciliar = reconciliar
+        self._almacen = _AlmacenRedis(redis_url) if redis_url else _AlmacenLocal()
+        self._hilo = None
+        self._lock = threading.Lock()
+
+    # ------------------------------
+    # Carga desde la base de datos
+    # ------------------------------
+    def recargar(self):
+        """Recalcula todos los contadores con una consulta agrupada"""
+        conn = self._conectar()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT estado, severidad, COUNT(*)
+                FROM incidentes
+                GROUP BY estado, severidad
+            """)
+            conteos = {
+                f"{estado}{_SEPARADOR}{severidad}": total
+                for estado, severidad, total in cursor.fetchall()
+            }
+            cursor.close()
+        finally:
+            conn.close()
+
+        self._almacen.reemplazar(conteos)
+        return conteos
+
+    def _bucle_reconciliar(self):
+        while True:
+            time.sleep(self.reconciliar)
+            try:
+                self.recargar()
+            except Exception as e:
+                logger.warning(f"Error reconciliando estadísticas: {e}")
+
+    def _iniciar_reconciliacion(self):
+        if not self.reconciliar:
+            return
+        with self._lock:
+            if self._hilo is None or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._bucle_reconciliar,
+                                              name='estadisticas', daemon=True)
+                self._hilo.start()
+
+    # ------------------------------
+    # Lectura
+    # ------------------------------
+    def conteos(self):
+        """Devuelve el diccionario 'estado|severidad' -> total"""
+        self._iniciar_reconciliacion()
+        conteos, cargado = self._almacen.leer()
+        if conteos is None or time.time() - cargado > self.ttl:
+            conteos = self.recargar()
+        return conteos
+
+    def resumen(self):
+        """Totales por estado y por severidad, más los atajos del dashboard"""
+        por_estado = {}
+        por_severidad = {}
+        total = 0
+        for clave, cantidad in self.conteos().items():
+            if cantidad <= 0:
+                continue
+            estado, severidad = clave.split(_SEPARADOR, 1)
+            por_estado[estado] = por_estado.get(estado, 0) + cantidad
+            por_severidad[severidad] = por_severidad.get(severidad, 0) + cantidad
+            total += cantidad
+
+        return {
+            'total': total,
+            'abiertos': por_estado.get('Abierto', 0),
+            'criticos': por_severidad.get('critica', 0),
+            'resueltos': por_estado.get('Resuelto', 0),
+            'por_estado': por_estado,
+            'por_severidad': por_severidad
+        }
+
+    # ------------------------------
+    # Actualización incremental
+    # ------------------------------
+    def _sumar(self, estado, severidad, delta):
+        try:
+            self._almacen.sumar(f"{estado}{_SEPARADOR}{severidad}", delta)
+        except Exception as e:
+            logger.warning(f"Error actualizando estadísticas, se invalidan: {e}")
+            self.invalidar()
+
+    def incidente_creado(self, estado, severidad, cantidad=1):
+        self._sumar(estado, severidad, cantidad)
+
+    def incidente_eliminado(self, estado, severidad):
+        self._sumar(estado, severidad, -1)
+
+    def estado_cambiado(self, anterior, nuevo, severidad):
+        if anterior == nuevo:
+            return
+        self._sumar(anterior, severidad, -1)
+        self._sumar(nuevo, severidad, 1)
+
+    def severidad_cambiada(self, estado, anterior, nueva):
+        if anterior == nueva:
+            return
+        self._sumar(estado, anterior, -1)
+        self._sumar(estado, nueva, 1)
+
+    def invalidar(self):
+        try:
+            self._almacen.invalidar()
+        except Exception as e:
+            logger.warning(f"Error invalidando estadísticas: {e}")
@@ -0,0 +1,207 @@
+# eventos.py
+"""Eventos en tiempo real (historial, incidentes, estadísticas) para Server-Sent Events"""
+import json
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+GLOBAL = None            # incidente_id de las suscripciones al feed global
+
+# Marca que recibe una suscripción cuya cola se llenó (cliente demasiado lento)
+DESBORDADA = object()
+
+# Espera del navegador antes de reconectar (campo retry de SSE)
+REINTENTO_MS = 3000
+
+CABECERAS_SSE = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'        # nginx: enviar cada evento sin acumular
+}
+
+
+def formato_sse(evento):
+    """Texto de un evento en el formato de text/event-stream"""
+    datos = json.dumps(evento, ensure_ascii=False, default=str)
+    return f"id: {evento['id']}\nevent: {evento['tipo']}\ndata: {datos}\n\n"
+
+
+def ultimo_id(valor):
+    """Last-Event-ID (o ?desde=) como entero; None si falta o no es válido"""
+    try:
+        return int(valor) if valor else None
+    except ValueError:
+        return None
+
+
+def abrir_flujo(canal, incidente_id, ultimo, suscripcion=None):
+    """Suscribe a un cliente; devuelve (suscripción, texto inicial, último id enviado).
+
+    La suscripción se hace antes de leer los pendientes para no perder nada
+    entre medias; los eventos repetidos se descartan por id al enviarlos.
+    """
+    suscripcion = canal.suscribir(incidente_id, suscripcion)
+    partes = [f"retry: {REINTENTO_MS}\n\n"]
+    enviado = ultimo or 0
+    if ultimo is not None:
+        pendientes = canal.pendientes(ultimo, incidente_id)
+        if pendientes is None:
+            partes.append(formato_sse({'id': ultimo, 'tipo': 'recargar', 'incidente_id': incidente_id}))
+        else:
+            for evento in pendientes:
+                partes.append(formato_sse(evento))
+                enviado = evento['id']
+    return suscripcion, ''.join(partes), enviado
+
+
+class Suscripcion:
+    """Cola de eventos de un cliente (del feed global o de un incidente)"""
+
+    def __init__(self, incidente_id=GLOBAL, max_cola=100):
+        self.incidente_id = incidente_id
+        self._cola = queue.Queue(max_cola)
+        self.desbordada = False
+
+    def acepta(self, evento):
+        return self.incidente_id is GLOBAL or evento.get('incidente_id') == self.incidente_id
+
+    def entregar(self, evento):
+        if self.desbordada:
+            return
+        try:
+            self._cola.put_nowait(evento)
+        except queue.Full:
+            # Se corta el flujo: el cliente reconecta y se pone al día con Last-Event-ID
+            self.desbordada = True
+            self._cola = queue.Queue(1)
+            self._cola.put_nowait(DESBORDADA)
+
+    def esperar(self, timeout):
+        """Siguiente evento, DESBORDADA o None si no llega ninguno a tiempo"""
+        try:
+            return self._cola.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class _BusLocal:
+    """Reparto dentro del proceso: lo publicado solo lo ven sus suscriptores"""
+
+    def __init__(self, entregar):
+        self._entregar = entregar
+        self._ultimo = 0
+        self._lock = threading.Lock()
+
+    def publicar(self, evento):
+        with self._lock:
+            # Ids crecientes también entre reinicios (microsegundos de la época)
+            self._ultimo = max(self._ultimo + 1, time.time_ns() // 1000)
+            evento['id'] = self._ultimo
+            self._entregar(evento)
+
+
+class _BusRedis:
+    """Reparto entre procesos con PUBLISH/SUBSCRIBE de Redis.
+
+    Cada proceso publica en el canal y un hilo suyo recibe todos los
+    eventos (también los propios) y los entrega a sus suscriptores, así que
+    todos los procesos ven los mismos eventos en el mismo orden. Los ids
+    salen de un INCR compartido.
+    """
+
+    def __init__(self, entregar, url, canal='cyberincident:eventos'):
+        import redis
+        self._entregar = entregar
+        self._redis = redis.Redis.from_url(url)
+        self._canal = canal
+        self._clave_id = canal + ':id'
+        self._hilo = threading.Thread(target=self._escuchar, name='eventos-redis', daemon=True)
+        self._hilo.start()
+
+    def publicar(self, evento):
+        evento['id'] = self._redis.incr(self._clave_id)
+        self._redis.publish(self._canal, json.dumps(evento, default=str))
+
+    def _escuchar(self):
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self._canal)
+                for mensaje in pubsub.listen():
+                    self._entregar(json.loads(mensaje['data']))
+            except Exception as e:
+                logger.warning(f"Conexión de eventos con Redis perdida, se reintenta: {e}")
+                time.sleep(1)
+
+
+class CanalEventos:
+    """Publicación de eventos y suscripciones de los clientes SSE.
+
+    Guarda los ``historial`` últimos eventos para que un cliente que
+    reconecta (cabecera Last-Event-ID) reciba lo que se perdió; si su último
+    id ya no está en memoria recibe un evento 'recargar'. Sin ``redis_url``
+    los eventos no salen del proceso.
+    """
+
+    def __init__(self, redis_url=None, historial=500, max_cola=100):
+        self.max_cola = max_cola
+        self._recientes = deque(maxlen=historial)
+        self._suscripciones = set()
+        self._lock = threading.Lock()
+        self.publicados = 0
+        self.desbordadas = 0
+        self._bus = _BusRedis(self._entregar, redis_url) if redis_url else _BusLocal(self._entregar)
+
+    def publicar(self, tipo, incidente_id=None, **datos):
+        """Publica un evento; un fallo del broker no debe romper la petición"""
+        evento = dict(datos, tipo=tipo, incidente_id=incidente_id)
+        try:
+            self._bus.publicar(evento)
+        except Exception as e:
+            logger.warning(f"Error publicando el evento {tipo}: {e}")
+
+    def _entregar(self, evento):
+        with self._lock:
+            self._recientes.append(evento)
+            self.publicados += 1
+            suscripciones = list(self._suscripciones)
+        for suscripcion in suscripciones:
+            if suscripcion.acepta(evento):
+                suscripcion.entregar(evento)
+                if suscripcion.desbordada:
+                    self.desbordadas += 1
+                    self.cancelar(suscripcion)
+
+    def suscribir(self, incidente_id=GLOBAL, suscripcion=None):
+        suscripcion = suscripcion or Suscripcion(incidente_id, self.max_cola)
+        with self._lock:
+            self._suscripciones.add(suscripcion)
+        return suscripcion
+
+    def cancelar(self, suscripcion):
+        with self._lock:
+            self._suscripciones.discard(suscripcion)
+
+    def pendientes(self, ultimo_id, incidente_id=GLOBAL):
+        """Eventos posteriores a ``ultimo_id``, o None si ya no están en memoria"""
+        with self._lock:
+            recientes = list(self._recientes)
+        if recientes and ultimo_id < recientes[0]['id'] - 1:
+            return None
+        return [evento for evento in recientes if evento['id'] > ultimo_id
+                and (incidente_id is GLOBAL or evento.get('incidente_id') == incidente_id)]
+
+    def activas(self):
+        with self._lock:
+            return len(self._suscripciones)
+
+    def estadisticas(self):
+        return {
+            'suscripciones': self.activas(),
+            'publicados': self.publicados,
+            'desbordadas': self.desbordadas,
+            'broker': 'redis' if isinstance(self._bus, _BusRedis) else 'local'
+        }
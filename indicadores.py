@@ -0,0 +1,184 @@
+# indicadores.py
+"""Extracción de indicadores de compromiso (IOC) de evidencias de texto"""
+import logging
+import os
+import re
+import time
+
+import mysql.connector
+
+from almacen_blobs import predeterminado as almacen
+
+logger = logging.getLogger(__name__)
+
+# Cada cuántos bytes se guardan los indicadores y la posición en el archivo
+PUNTO_CONTROL = 64 * 1024 * 1024
+# Indicadores distintos acumulados en memoria antes de forzar un guardado
+MAX_PENDIENTES = 50000
+# Las líneas más largas se leen en trozos (un indicador partido se pierde)
+MAX_LINEA = 1024 * 1024
+MAX_VALOR = 255
+MAX_INTENTOS = 3
+
+# Extensiones que detectar_tipo_archivo() clasifica como 'texto'
+EXTENSIONES_TEXTO = ('txt', 'log', 'csv', 'json', 'xml', 'html', 'htm')
+
+_OCTETO = rb'(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)'
+_PATRONES = (
+    ('url', re.compile(rb'\bhttps?://[^\s"\'<>()\[\]{}|\\^`]+', re.I)),
+    ('email', re.compile(rb'\b[\w.+-]+@(?:[a-z0-9-]+\.)+[a-z]{2,24}\b', re.I)),
+    # El (?=\d) inicial descarta rápido las posiciones sin dígito
+    ('ipv4', re.compile(rb'(?=\d)(?<![\d.])' + _OCTETO + rb'(?:\.' + _OCTETO + rb'){3}(?![\d.])')),
+    ('sha256', re.compile(rb'\b[a-f0-9]{64}\b', re.I)),
+    ('sha1', re.compile(rb'\b[a-f0-9]{40}\b', re.I)),
+    ('md5', re.compile(rb'\b[a-f0-9]{32}\b', re.I)),
+    ('dominio', re.compile(rb'\b(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z]{2,24}\b', re.I)),
+)
+TIPOS = tuple(tipo for tipo, _ in _PATRONES)
+
+# "Dominios" que en un log casi siempre son nombres de archivo
+_EXTENSIONES = {
+    b'txt', b'log', b'csv', b'json', b'xml', b'html', b'htm', b'php', b'asp', b'aspx',
+    b'jsp', b'js', b'css', b'py', b'sh', b'exe', b'dll', b'sys', b'bat', b'ps1', b'zip',
+    b'gz', b'tar', b'rar', b'pdf', b'doc', b'docx', b'xls', b'xlsx', b'png', b'jpg',
+    b'jpeg', b'gif', b'bmp', b'conf', b'ini', b'yml', b'yaml', b'tmp', b'bak', b'pcap'
+}
+
+# Formas "desactivadas" habituales en informes: hxxp://, ejemplo[.]com
+_DESACTIVADOS = ((b'hxxp', b'http'), (b'[.]', b'.'), (b'(.)', b'.'), (b'[@]', b'@'))
+
+
+def extraer_de_linea(linea, encontrados, tipos=TIPOS):
+    """Suma a ``encontrados`` los indicadores de una línea (bytes)"""
+    for desactivado, activo in _DESACTIVADOS:
+        if desactivado in linea:
+            linea = linea.replace(desactivado, activo)
+
+    for tipo, patron in _PATRONES:
+        if tipo not in tipos or (tipo == 'email' and b'@' not in linea):
+            continue
+        for coincidencia in patron.finditer(linea):
+            valor = coincidencia.group(0)
+            if tipo == 'dominio' and valor.rsplit(b'.', 1)[-1].lower() in _EXTENSIONES:
+                continue
+            if tipo != 'url':
+                valor = valor.lower()
+            clave = (tipo, valor[:MAX_VALOR].decode('utf-8', 'replace'))
+            encontrados[clave] = encontrados.get(clave, 0) + 1
+
+
+def _guardar(conn, sha256, encontrados, posicion, lineas, completa):
+    """Vuelca los indicadores y la posición en una misma transacción"""
+    cursor = conn.cursor()
+    try:
+        conn.start_transaction()
+        if encontrados:
+            filas = [(sha256, tipo, valor, n) for (tipo, valor), n in encontrados.items()]
+            cursor.executemany("""
+                INSERT INTO indicadores (sha256, tipo, valor, apariciones)
+                VALUES (%s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE apariciones = apariciones + VALUES(apariciones)
+            """, filas)
+        cursor.execute("""
+            UPDATE extracciones
+            SET posicion = %s, lineas = %s, estado = %s, reclamada = CURRENT_TIMESTAMP,
+                fecha_fin = IF(%s, CURRENT_TIMESTAMP, NULL)
+            WHERE sha256 = %s
+        """, (posicion, lineas, 'completa' if completa else 'procesando', completa, sha256))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def procesar_archivo(conn, sha256, ruta, punto_control=PUNTO_CONTROL):
+    """Extrae los indicadores de ``ruta`` continuando donde se quedó.
+
+    Lee línea a línea con memoria acotada y cada ``punto_control`` bytes (o
+    al acumular MAX_PENDIENTES indicadores distintos) guarda lo encontrado
+    junto con la posición alcanzada, así que una extracción interrumpida se
+    reanuda sin repetir ni perder apariciones.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT posicion, lineas FROM extracciones WHERE sha256 = %s", (sha256,))
+    posicion, lineas = cursor.fetchone() or (0, 0)
+    cursor.close()
+
+    encontrados = {}
+    ultimo_guardado = posicion
+    with open(ruta, 'rb') as f:
+        f.seek(posicion)
+        for linea in iter(lambda: f.readline(MAX_LINEA), b''):
+            extraer_de_linea(linea, encontrados)
+            posicion += len(linea)
+            lineas += 1
+            if posicion - ultimo_guardado >= punto_control or len(encontrados) >= MAX_PENDIENTES:
+                _guardar(conn, sha256, encontrados, posicion, lineas, completa=False)
+                encontrados = {}
+                ultimo_guardado = posicion
+
+    _guardar(conn, sha256, encontrados, posicion, lineas, completa=True)
+    return lineas
+
+
+def reclamar(cursor, sha256, caducidad, max_intentos=MAX_INTENTOS):
+    """Marca una extracción como en curso; False si otro trabajador la tiene.
+
+    Una extracción 'procesando' cuyo trabajador no da señales (no guarda un
+    punto de control) en ``caducidad`` segundos se considera abandonada.
+    """
+    cursor.execute("""
+        UPDATE extracciones
+        SET estado = 'procesando', reclamada = CURRENT_TIMESTAMP, intentos = intentos + 1
+        WHERE sha256 = %s AND intentos < %s
+          AND (estado IN ('pendiente', 'error')
+               OR (estado = 'procesando' AND reclamada < NOW() - INTERVAL %s SECOND))
+    """, (sha256, max_intentos, caducidad))
+    return cursor.rowcount == 1
+
+
+def pendientes(cursor, limite, max_intentos=MAX_INTENTOS):
+    """Extracciones por hacer, con la ruta de una evidencia que tenga ese contenido"""
+    cursor.execute("""
+        SELECT x.sha256, MIN(e.ruta)
+        FROM extracciones x
+        JOIN evidencias e ON e.sha256 = x.sha256
+        WHERE x.estado <> 'completa' AND x.intentos < %s
+        GROUP BY x.sha256
+        LIMIT %s
+    """, (max_intentos, limite))
+    return cursor.fetchall()
+
+
+def trabajar(db_config, sha256, ruta, caducidad=3600):
+    """Punto de entrada de cada proceso del pool: (sha256, lineas o None, error)"""
+    conn = mysql.connector.connect(**db_config)
+    try:
+        cursor = conn.cursor()
+        reclamada = reclamar(cursor, sha256, caducidad)
+        cursor.close()
+        if not reclamada:
+            return sha256, None, None
+
+        inicio = time.time()
+        try:
+            # Con el almacén en S3 se trabaja sobre una copia descargada
+            with almacen().copia_local(ruta) as local:
+                lineas = procesar_archivo(conn, sha256, local)
+                tamano = os.path.getsize(local)
+        except Exception as e:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE extracciones SET estado = 'error', error = %s WHERE sha256 = %s",
+                (str(e)[:500], sha256)
+            )
+            cursor.close()
+            return sha256, None, str(e)
+
+        logger.info(f"Indicadores de {sha256[:12]}: {lineas} líneas, "
+                    f"{tamano / 1024 / 1024:.1f} MB en {time.time() - inicio:.1f}s")
+        return sha256, lineas, None
+    finally:
+        conn.close()
@@ -0,0 +1,288 @@
+# ingesta.py
+"""Alta masiva de incidentes (API /api/incidentes/lote y flask importar-incidentes)"""
+import json
+import logging
+from datetime import datetime
+
+import correlacion
+
+logger = logging.getLogger(__name__)
+
+# Filas por INSERT multi-fila y por transacción
+TAMANO_LOTE = 1000
+
+TIPOS = {
+    'phishing', 'malware', 'intrusion', 'ddos', 'config_error', 'data_leak',
+    'social_engineering', 'insider_threat', 'vulnerability', 'physical', 'otro'
+}
+SEVERIDADES = {'baja', 'media', 'alta', 'critica'}
+ESTADOS = {'Abierto', 'En Investigación', 'Resuelto', 'Cerrado'}
+
+# Longitudes de las columnas de incidentes
+MAX_TITULO = 200
+MAX_TIPO = 50
+MAX_USUARIO = 100
+
+
+class RegistroInvalido(ValueError):
+    pass
+
+
+# ==============================
+# LECTURA Y VALIDACIÓN
+# ==============================
+def leer_registros(flujo):
+    """Registros de un JSON (lista u objeto con "incidentes") o de un NDJSON.
+
+    ``flujo`` es un archivo binario. El NDJSON se lee línea a línea, sin
+    cargarlo entero en memoria; una línea que no es JSON válido se entrega
+    como RegistroInvalido para informarla como error de ese registro.
+    """
+    primera = b''
+    for primera in iter(flujo.readline, b''):
+        if primera.strip():
+            break
+    primera = primera.strip()
+    if not primera:
+        return
+
+    if primera.startswith(b'{'):
+        try:
+            datos = json.loads(primera)
+        except ValueError:
+            datos = None                     # objeto JSON en varias líneas
+        if isinstance(datos, dict) and 'incidentes' not in datos:
+            yield datos
+            yield from _leer_ndjson(iter(flujo.readline, b''))
+            return
+    else:
+        datos = None
+
+    if datos is None:
+        try:
+            datos = json.loads(primera + flujo.read())
+        except ValueError as e:
+            raise RegistroInvalido(f"JSON no válido: {e}")
+    if isinstance(datos, dict):
+        datos = datos.get('incidentes')
+    if not isinstance(datos, list):
+        raise RegistroInvalido("Se esperaba una lista de incidentes")
+    yield from datos
+
+
+def _leer_ndjson(lineas):
+    for linea in lineas:
+        if not linea.strip():
+            continue
+        try:
+            yield json.loads(linea)
+        except ValueError as e:
+            yield RegistroInvalido(f"JSON no válido: {e}")
+
+
+def _texto(registro, campo, maximo=None, requerido=True):
+    valor = registro.get(campo)
+    if valor is None or (isinstance(valor, str) and not valor.strip()):
+        if requerido:
+            raise RegistroInvalido(f"Falta el campo '{campo}'")
+        return None
+    if not isinstance(valor, str):
+        raise RegistroInvalido(f"'{campo}' debe ser texto")
+    valor = valor.strip()
+    if maximo and len(valor) > maximo:
+        raise RegistroInvalido(f"'{campo}' supera los {maximo} caracteres")
+    return valor
+
+
+def validar(registro, usuario_defecto='Anónimo'):
+    """Tupla lista para insertar o RegistroInvalido con el motivo"""
+    if isinstance(registro, Exception):
+        raise registro
+    if not isinstance(registro, dict):
+        raise RegistroInvalido("Cada incidente debe ser un objeto JSON")
+
+    titulo = _texto(registro, 'titulo', MAX_TITULO)
+    descripcion = _texto(registro, 'descripcion')
+    tipo = _texto(registro, 'tipo', MAX_TIPO)
+    if tipo not in TIPOS:
+        raise RegistroInvalido(f"Tipo '{tipo}' no válido")
+    severidad = _texto(registro, 'severidad')
+    if severidad not in SEVERIDADES:
+        raise RegistroInvalido(f"Severidad '{severidad}' no válida")
+    estado = _texto(registro, 'estado', requerido=False) or 'Abierto'
+    if estado not in ESTADOS:
+        raise RegistroInvalido(f"Estado '{estado}' no válido")
+    usuario = _texto(registro, 'usuario_reporta', MAX_USUARIO, requerido=False) or usuario_defecto
+
+    fecha = _texto(registro, 'fecha_creacion', requerido=False)
+    if fecha:
+        try:
+            fecha = datetime.fromisoformat(fecha.replace('Z', '+00:00'))
+        except ValueError:
+            raise RegistroInvalido("'fecha_creacion' debe estar en formato ISO 8601")
+        if fecha.tzinfo is not None:
+            fecha = fecha.astimezone().replace(tzinfo=None)
+
+    return titulo, descripcion, tipo, severidad, estado, usuario, fecha
+
+
+# ==============================
+# INSERCIÓN
+# ==============================
+def _incremento(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT @@auto_increment_increment")
+    incremento = cursor.fetchone()[0]
+    cursor.close()
+    return incremento
+
+
+def _insertar(cursor, filas, usuario, incremento):
+    """Inserta incidentes, historial e índice de búsqueda; devuelve los ids.
+
+    Un INSERT multi-fila con el número de filas conocido recibe ids
+    consecutivos (según auto_increment_increment) aunque haya otras
+    inserciones a la vez, así que los ids salen del primero. El historial y
+    la búsqueda se copian en el servidor desde ese rango de ids, sin volver
+    a enviar los textos.
+    """
+    valores = ", ".join(["(%s, %s, %s, %s, %s, %s, COALESCE(%s, CURRENT_TIMESTAMP), %s)"] * len(filas))
+    cursor.execute(f"""
+        INSERT INTO incidentes
+        (titulo, descripcion, tipo, severidad, estado, usuario_reporta, fecha_creacion, huella)
+        VALUES {valores}
+    """, [valor for fila in filas for valor in fila])
+    primero = cursor.lastrowid
+    ids = [primero + i * incremento for i in range(len(filas))]
+    rango = (primero, ids[-1], primero, incremento)
+
+    cursor.execute("""
+        INSERT INTO historial (incidente_id, usuario, accion, descripcion, fecha)
+        SELECT id, %s, 'CREACION', CONCAT('Incidente creado: ', titulo), fecha_creacion
+        FROM incidentes
+        WHERE id BETWEEN %s AND %s AND MOD(id - %s, %s) = 0
+    """, (usuario,) + rango)
+    cursor.execute("""
+        INSERT INTO busqueda (tipo, ref_id, incidente_id, titulo, contenido, fecha)
+        SELECT 'incidente', id, id, titulo, descripcion, fecha_creacion
+        FROM incidentes
+        WHERE id BETWEEN %s AND %s AND MOD(id - %s, %s) = 0
+    """, rango)
+    return ids
+
+
+def _correlacionar(cursor, lote, ventana, bloqueadas):
+    """Separa el lote en incidentes nuevos y alertas a fusionar.
+
+    Devuelve (nuevas, destinos): las filas a insertar (con su huella) y,
+    por cada entrada del lote, ('nuevo', posición en nuevas) o
+    ('fusion', id existente | ('nuevo', posición)). Las repeticiones dentro
+    del mismo lote se fusionan con la primera. Las huellas abiertas quedan
+    bloqueadas (y añadidas a ``bloqueadas``) hasta que el llamador las libere.
+    """
+    huellas = [correlacion.huella(fila[0], fila[2], fila[5], fila[1]) for _, fila in lote]
+    abiertas = [h for (_, fila), h in zip(lote, huellas) if fila[4] in correlacion.ESTADOS_ABIERTOS]
+    existentes = {}
+    if ventana > 0:
+        bloqueadas.extend(correlacion.bloquear(cursor, abiertas))
+        existentes = correlacion.buscar_abiertos(cursor, abiertas, ventana)
+
+    nuevas = []
+    destinos = []
+    primera = {}
+    for (_, fila), huella in zip(lote, huellas):
+        abierta = ventana > 0 and fila[4] in correlacion.ESTADOS_ABIERTOS
+        if abierta and huella in existentes:
+            destinos.append(('fusion', existentes[huella]))
+        elif abierta and huella in primera:
+            destinos.append(('fusion', ('nuevo', primera[huella])))
+        else:
+            if abierta:
+                primera[huella] = len(nuevas)
+            destinos.append(('nuevo', len(nuevas)))
+            nuevas.append(fila + (huella,))
+    return nuevas, destinos
+
+
+def _guardar_lote(conn, lote, usuario, incremento, ventana, resultados, creados):
+    """Guarda un lote en una transacción; si falla, fila a fila para aislar el error"""
+    cursor = conn.cursor()
+    bloqueadas = []
+    try:
+        conn.start_transaction()
+        nuevas, destinos = _correlacionar(cursor, lote, ventana, bloqueadas)
+        ids = _insertar(cursor, nuevas, usuario, incremento) if nuevas else []
+
+        salida = []
+        fusiones = {}
+        for (indice, fila), (accion, destino) in zip(lote, destinos):
+            if accion == 'nuevo':
+                salida.append(({'indice': indice, 'id': ids[destino]}, fila))
+                continue
+            incidente_id = ids[destino[1]] if isinstance(destino, tuple) else destino
+            cantidad, _, severidad = fusiones.get(incidente_id, (0, None, fila[3]))
+            fusiones[incidente_id] = (cantidad + 1, fila[0], correlacion.mayor_severidad(severidad, fila[3]))
+            salida.append(({'indice': indice, 'id': incidente_id, 'fusionado': True}, None))
+        escaladas = correlacion.fusionar(cursor, fusiones, usuario)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        correlacion.liberar(cursor, bloqueadas)
+        bloqueadas = []
+        if len(lote) == 1:
+            indice, _ = lote[0]
+            logger.warning(f"Incidente {indice} de la importación rechazado: {e}")
+            resultados.append({'indice': indice, 'error': str(e)})
+            return
+        for entrada in lote:
+            _guardar_lote(conn, [entrada], usuario, incremento, ventana, resultados, creados)
+        return
+    finally:
+        # Tras el commit, para que la siguiente alerta con la huella vea el incidente
+        correlacion.liberar(cursor, bloqueadas)
+        cursor.close()
+
+    for resultado, fila in salida:
+        resultados.append(resultado)
+        if fila is not None:
+            clave = (fila[4], fila[3])
+            creados[clave] = creados.get(clave, 0) + 1
+    # Los que suben de severidad al fusionar cambian de casilla (suma cero)
+    for estado, anterior, nueva in escaladas:
+        creados[(estado, anterior)] = creados.get((estado, anterior), 0) - 1
+        creados[(estado, nueva)] = creados.get((estado, nueva), 0) + 1
+
+
+def importar(conn, registros, usuario, usuario_defecto='Anónimo', tamano_lote=TAMANO_LOTE, ventana=0):
+    """Valida e inserta los registros por lotes.
+
+    Con ``ventana`` (segundos) > 0, las alertas que coinciden con un
+    incidente abierto reciente se fusionan en él (ver correlacion.py).
+    Devuelve (resultados, creados): un resultado por registro, en orden,
+    con su 'id' (y 'fusionado' si no se creó uno nuevo) o su 'error'; y la
+    variación del número de incidentes por (estado, severidad) para
+    actualizar las estadísticas: los creados y, en negativo y positivo, los
+    que una alerta fusionada ha subido de severidad.
+    """
+    resultados = []
+    creados = {}
+    incremento = None
+    lote = []
+    for indice, registro in enumerate(registros):
+        try:
+            lote.append((indice, validar(registro, usuario_defecto)))
+        except RegistroInvalido as e:
+            resultados.append({'indice': indice, 'error': str(e)})
+            continue
+        if len(lote) >= tamano_lote:
+            if incremento is None:
+                incremento = _incremento(conn)
+            _guardar_lote(conn, lote, usuario, incremento, ventana, resultados, creados)
+            lote = []
+    if lote:
+        if incremento is None:
+            incremento = _incremento(conn)
+        _guardar_lote(conn, lote, usuario, incremento, ventana, resultados, creados)
+
+    resultados.sort(key=lambda resultado: resultado['indice'])
+    return resultados, creados
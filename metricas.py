@@ -0,0 +1,237 @@
+# metricas.py
+"""Métricas de la aplicación en formato de texto de Prometheus (/metrics)"""
+import hashlib
+import logging
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PREFIJO = 'cyberincident'
+
+# Límites (segundos) de los histogramas de latencia
+LIMITES = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LIMITES_CONSULTAS = (1, 2, 5, 10, 20, 50, 100)
+
+# Sentencias distintas guardadas para consulta_info
+MAX_SENTENCIAS = 1000
+
+_INFINITO = 'le="+Inf"'
+
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _etiquetas(nombres, valores, extra=''):
+    partes = [f'{nombre}="{_escapar(valor)}"' for nombre, valor in zip(nombres, valores)]
+    if extra:
+        partes.append(extra)
+    return '{' + ','.join(partes) + '}' if partes else ''
+
+
+def _numero(valor):
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+
+class Contador:
+    """Contador acumulado por combinación de etiquetas"""
+
+    tipo = 'counter'
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = f"{PREFIJO}_{nombre}"
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._valores = {}
+        self._lock = threading.Lock()
+
+    def sumar(self, cantidad=1, *etiquetas):
+        with self._lock:
+            self._valores[etiquetas] = self._valores.get(etiquetas, 0) + cantidad
+
+    def lineas(self):
+        with self._lock:
+            valores = sorted(self._valores.items())
+        for etiquetas, valor in valores:
+            yield f"{self.nombre}{_etiquetas(self.etiquetas, etiquetas)} {_numero(valor)}"
+
+
+class Histograma:
+    """Histograma acumulativo por combinación de etiquetas"""
+
+    tipo = 'histogram'
+
+    def __init__(self, nombre, ayuda, etiquetas=(), limites=LIMITES):
+        self.nombre = f"{PREFIJO}_{nombre}"
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self.limites = tuple(limites)
+        self._series = {}            # etiquetas -> [cubetas..., suma, cuenta]
+        self._lock = threading.Lock()
+
+    def observar(self, valor, *etiquetas):
+        with self._lock:
+            serie = self._series.get(etiquetas)
+            if serie is None:
+                serie = self._series[etiquetas] = [0] * len(self.limites) + [0.0, 0]
+            for i, limite in enumerate(self.limites):
+                if valor <= limite:
+                    serie[i] += 1
+                    break
+            serie[-2] += valor
+            serie[-1] += 1
+
+    def lineas(self):
+        with self._lock:
+            series = sorted((etiquetas, list(serie)) for etiquetas, serie in self._series.items())
+        for etiquetas, serie in series:
+            acumulado = 0
+            for limite, cantidad in zip(self.limites, serie):
+                acumulado += cantidad
+                le = f'le="{_numero(limite)}"'
+                yield f"{self.nombre}_bucket{_etiquetas(self.etiquetas, etiquetas, le)} {acumulado}"
+            yield f"{self.nombre}_bucket{_etiquetas(self.etiquetas, etiquetas, _INFINITO)} {serie[-1]}"
+            yield f"{self.nombre}_sum{_etiquetas(self.etiquetas, etiquetas)} {_numero(serie[-2])}"
+            yield f"{self.nombre}_count{_etiquetas(self.etiquetas, etiquetas)} {serie[-1]}"
+
+
+def texto(metricas, valores=()):
+    """Exposición de texto de Prometheus.
+
+    ``metricas`` son Contador/Histograma; ``valores`` son tuplas (nombre,
+    tipo, ayuda, [(etiquetas dict, valor), ...]) calculadas al pedirlas,
+    como el estado del pool.
+    """
+    lineas = []
+    for metrica in metricas:
+        lineas.append(f"# HELP {metrica.nombre} {metrica.ayuda}")
+        lineas.append(f"# TYPE {metrica.nombre} {metrica.tipo}")
+        lineas.extend(metrica.lineas())
+    for nombre, tipo, ayuda, muestras in valores:
+        nombre = f"{PREFIJO}_{nombre}"
+        lineas.append(f"# HELP {nombre} {ayuda}")
+        lineas.append(f"# TYPE {nombre} {tipo}")
+        for etiquetas, valor in muestras:
+            lineas.append(f"{nombre}{_etiquetas(etiquetas.keys(), etiquetas.values())} {_numero(valor)}")
+    return '\n'.join(lineas) + '\n'
+
+
+# ==============================
+# MÉTRICAS DE LA APLICACIÓN
+# ==============================
+PETICIONES = Histograma('peticion_segundos', 'Duración de las peticiones hasta generar la respuesta',
+                        ('endpoint', 'metodo'))
+RESPUESTAS = Contador('respuestas_total', 'Respuestas por endpoint y código HTTP',
+                      ('endpoint', 'metodo', 'codigo'))
+PLANTILLAS = Histograma('plantilla_segundos', 'Tiempo de renderizado de plantillas', ('plantilla',))
+CONSULTAS = Histograma('consulta_segundos', 'Duración de cada sentencia SQL (ejecución y lectura de filas)',
+                       ('endpoint', 'consulta'))
+CONSULTAS_PETICION = Histograma('consultas_por_peticion', 'Sentencias SQL ejecutadas en cada petición',
+                                ('endpoint',), LIMITES_CONSULTAS)
+SQL_PETICION = Histograma('sql_por_peticion_segundos', 'Tiempo total en SQL de cada petición', ('endpoint',))
+CONEXION_ESPERA = Histograma('conexion_espera_segundos', 'Tiempo para obtener una conexión del pool',
+                             ('destino',))
+EVIDENCIA_BYTES = Contador('evidencia_bytes_total', 'Bytes de evidencias enviados (o delegados al servidor web/S3)',
+                           ('modo',))
+HISTORIAL_REGISTRO = Histograma('historial_registro_segundos',
+                                'Tiempo que espera una petición al registrar en el historial', ('modo',))
+
+TODAS = (PETICIONES, RESPUESTAS, PLANTILLAS, CONSULTAS, CONSULTAS_PETICION, SQL_PETICION,
+         CONEXION_ESPERA, EVIDENCIA_BYTES, HISTORIAL_REGISTRO)
+
+# ==============================
+# SENTENCIAS SQL
+# ==============================
+_MARCADORES = re.compile(r'%s(?:\s*,\s*%s)+')
+_PARENTESIS = re.compile(r'\(%s(?:\s*,\s*%s)*\)(?:\s*,\s*\(%s(?:\s*,\s*%s)*\))+')
+_sentencias = {}
+_ids = {}
+
+
+def id_consulta(sql):
+    """Identificador estable de una sentencia (los IN y VALUES de longitud
+    variable cuentan como la misma) y su texto normalizado"""
+    guardado = _ids.get(sql)
+    if guardado:
+        return guardado
+    normalizada = ' '.join(sql.split())
+    normalizada = _PARENTESIS.sub('(%s, ...), ...', _MARCADORES.sub('%s, ...', normalizada))
+    identificador = hashlib.sha1(normalizada.encode('utf-8')).hexdigest()[:10]
+    if identificador not in _sentencias and len(_sentencias) < MAX_SENTENCIAS:
+        _sentencias[identificador] = normalizada[:300]
+    if len(_ids) >= 5000:
+        _ids.clear()
+    _ids[sql] = identificador, normalizada
+    return identificador, normalizada
+
+
+def sentencias():
+    """Muestras de consulta_info: el texto de cada identificador"""
+    return [({'consulta': identificador, 'sql': sql}, 1) for identificador, sql in sorted(_sentencias.items())]
+
+
+class CursorMedido:
+    """Cursor que mide cada sentencia desde execute hasta la siguiente o close.
+
+    Incluye el tiempo de leer las filas (fetch*), que con cursores sin
+    buffer es parte del coste de la consulta. Al cerrar cada medida se
+    llama a ``medir(sql, segundos)``.
+    """
+
+    def __init__(self, cursor, medir):
+        self._cursor = cursor
+        self._medir = medir
+        self._sql = None
+        self._segundos = 0.0
+
+    def _terminar(self):
+        if self._sql is not None:
+            sql, self._sql = self._sql, None
+            self._medir(sql, self._segundos)
+
+    def _medido(self, funcion, *args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return funcion(*args, **kwargs)
+        finally:
+            self._segundos += time.perf_counter() - inicio
+
+    def execute(self, sql, *args, **kwargs):
+        self._terminar()
+        self._sql = sql
+        self._segundos = 0.0
+        return self._medido(self._cursor.execute, sql, *args, **kwargs)
+
+    def executemany(self, sql, *args, **kwargs):
+        self._terminar()
+        self._sql = sql
+        self._segundos = 0.0
+        return self._medido(self._cursor.executemany, sql, *args, **kwargs)
+
+    def fetchone(self):
+        return self._medido(self._cursor.fetchone)
+
+    def fetchmany(self, *args, **kwargs):
+        return self._medido(self._cursor.fetchmany, *args, **kwargs)
+
+    def fetchall(self):
+        return self._medido(self._cursor.fetchall)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def close(self):
+        self._terminar()
+        return self._cursor.close()
+
+    def __getattr__(self, nombre):
+        return getattr(self._cursor, nombre)
+
+
+def contar_bytes(bloques, modo):
+    """Pasa los bloques de una respuesta en streaming sumando sus bytes"""
+    for bloque in bloques:
+        EVIDENCIA_BYTES.sumar(len(bloque), modo)
+        yield bloque
@@ -0,0 +1,338 @@
+# migraciones.py
+"""Migraciones versionadas del esquema MySQL"""
+import logging
+
+from busqueda import reconstruir as reconstruir_busqueda
+from capturas import EXTENSIONES_CAPTURA
+from correlacion import ESTADOS_ABIERTOS, huella
+from indicadores import EXTENSIONES_TEXTO
+
+logger = logging.getLogger(__name__)
+
+MIGRACIONES = []
+
+
+def migracion(version, descripcion):
+    """Registra una función ``f(cursor)`` como la migración ``version``"""
+    def registrar(funcion):
+        MIGRACIONES.append((version, descripcion, funcion))
+        return funcion
+    return registrar
+
+
+# ==============================
+# AUXILIARES
+# ==============================
+def existe_indice(cursor, tabla, nombre):
+    cursor.execute("""
+        SELECT 1 FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s
+        LIMIT 1
+    """, (tabla, nombre))
+    return cursor.fetchone() is not None
+
+
+def existe_columna(cursor, tabla, columna):
+    cursor.execute("""
+        SELECT 1 FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s
+        LIMIT 1
+    """, (tabla, columna))
+    return cursor.fetchone() is not None
+
+
+def crear_indice(cursor, tabla, nombre, columnas, tipo=""):
+    """Crea un índice si no existe ya uno con ese nombre"""
+    if existe_indice(cursor, tabla, nombre):
+        return
+    cursor.execute(f"CREATE {tipo} INDEX {nombre} ON {tabla} ({columnas})")
+
+
+def agregar_columna(cursor, tabla, columna, definicion):
+    """Añade una columna si no existe"""
+    if existe_columna(cursor, tabla, columna):
+        return
+    cursor.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {definicion}")
+
+
+# ==============================
+# MIGRACIONES
+# ==============================
+@migracion(1, "Tablas incidentes, evidencias e historial")
+def _tablas_iniciales(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS incidentes (
+            id INT PRIMARY KEY AUTO_INCREMENT,
+            titulo VARCHAR(200) NOT NULL,
+            descripcion TEXT NOT NULL,
+            tipo VARCHAR(50) NOT NULL,
+            severidad VARCHAR(20) NOT NULL,
+            estado VARCHAR(30) DEFAULT 'Abierto',
+            usuario_reporta VARCHAR(100),
+            fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS evidencias (
+            id INT PRIMARY KEY AUTO_INCREMENT,
+            incidente_id INT NOT NULL,
+            nombre_archivo VARCHAR(255) NOT NULL,
+            tipo_archivo VARCHAR(30),
+            ruta TEXT,
+            tamano BIGINT,
+            fecha_subida TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (incidente_id) REFERENCES incidentes(id) ON DELETE CASCADE
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS historial (
+            id INT PRIMARY KEY AUTO_INCREMENT,
+            incidente_id INT NOT NULL,
+            usuario VARCHAR(100) NOT NULL,
+            accion VARCHAR(50) NOT NULL,
+            descripcion TEXT,
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (incidente_id) REFERENCES incidentes(id) ON DELETE CASCADE
+        )
+    """)
+
+
+@migracion(2, "Índices para dashboard, listado de incidentes e historial")
+def _indices_consultas(cursor):
+    # Listado de incidentes: orden por (fecha_creacion, id), solo o tras un filtro
+    crear_indice(cursor, 'incidentes', 'idx_incidentes_fecha', 'fecha_creacion, id')
+    crear_indice(cursor, 'incidentes', 'idx_incidentes_estado_fecha', 'estado, fecha_creacion, id')
+    crear_indice(cursor, 'incidentes', 'idx_incidentes_severidad_fecha', 'severidad, fecha_creacion, id')
+    crear_indice(cursor, 'incidentes', 'idx_incidentes_tipo_fecha', 'tipo, fecha_creacion, id')
+    crear_indice(cursor, 'incidentes', 'idx_incidentes_reporta_fecha', 'usuario_reporta, fecha_creacion, id')
+    # Conteo agrupado del dashboard (índice cubriente)
+    crear_indice(cursor, 'incidentes', 'idx_incidentes_estado_severidad', 'estado, severidad')
+
+    # Historial global y por incidente, ordenado por (fecha, id)
+    crear_indice(cursor, 'historial', 'idx_historial_fecha', 'fecha, id')
+    crear_indice(cursor, 'historial', 'idx_historial_incidente_fecha', 'incidente_id, fecha, id')
+    crear_indice(cursor, 'historial', 'idx_historial_accion_fecha', 'accion, fecha, id')
+    crear_indice(cursor, 'historial', 'idx_historial_usuario_fecha', 'usuario, fecha, id')
+
+
+@migracion(3, "SHA-256 de las evidencias")
+def _sha256_evidencias(cursor):
+    agregar_columna(cursor, 'evidencias', 'sha256', 'CHAR(64) NULL')
+
+
+@migracion(4, "Almacén de evidencias por contenido con recuento de referencias")
+def _blobs(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 CHAR(64) PRIMARY KEY,
+            tamano BIGINT NOT NULL,
+            referencias INT NOT NULL DEFAULT 0,
+            fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    crear_indice(cursor, 'evidencias', 'idx_evidencias_sha256', 'sha256')
+
+
+@migracion(5, "Índice de búsqueda de texto completo")
+def _busqueda(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS busqueda (
+            id INT PRIMARY KEY AUTO_INCREMENT,
+            tipo VARCHAR(20) NOT NULL,
+            ref_id INT NULL,
+            incidente_id INT NOT NULL,
+            titulo VARCHAR(255) NOT NULL DEFAULT '',
+            contenido TEXT,
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY uk_busqueda_ref (tipo, ref_id),
+            KEY idx_busqueda_incidente (incidente_id),
+            FOREIGN KEY (incidente_id) REFERENCES incidentes(id) ON DELETE CASCADE
+        ) ENGINE=InnoDB
+    """)
+    # El índice FULLTEXT se crea después de la carga inicial, que es más rápido
+    reconstruir_busqueda(cursor)
+    crear_indice(cursor, 'busqueda', 'ft_busqueda', 'titulo, contenido', tipo='FULLTEXT')
+
+
+@migracion(6, "Indicadores de compromiso extraídos de evidencias de texto")
+def _indicadores(cursor):
+    # Ambas tablas van por contenido (SHA-256): una evidencia repetida se
+    # procesa una vez y al borrar su blob desaparecen en cascada
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS extracciones (
+            sha256 CHAR(64) PRIMARY KEY,
+            estado VARCHAR(20) NOT NULL DEFAULT 'pendiente',
+            posicion BIGINT NOT NULL DEFAULT 0,
+            lineas BIGINT NOT NULL DEFAULT 0,
+            intentos INT NOT NULL DEFAULT 0,
+            error VARCHAR(500),
+            reclamada TIMESTAMP NULL,
+            fecha_fin TIMESTAMP NULL,
+            KEY idx_extracciones_estado (estado),
+            FOREIGN KEY (sha256) REFERENCES blobs(sha256) ON DELETE CASCADE
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS indicadores (
+            id BIGINT PRIMARY KEY AUTO_INCREMENT,
+            sha256 CHAR(64) NOT NULL,
+            tipo VARCHAR(10) NOT NULL,
+            valor VARCHAR(255) NOT NULL,
+            apariciones BIGINT NOT NULL DEFAULT 0,
+            UNIQUE KEY uk_indicadores (sha256, tipo, valor),
+            KEY idx_indicadores_valor (valor, tipo),
+            FOREIGN KEY (sha256) REFERENCES blobs(sha256) ON DELETE CASCADE
+        )
+    """)
+    # Evidencias de texto ya existentes
+    patron = f"\\.({'|'.join(EXTENSIONES_TEXTO)})$"
+    cursor.execute("""
+        INSERT IGNORE INTO extracciones (sha256)
+        SELECT DISTINCT e.sha256
+        FROM evidencias e
+        JOIN blobs b ON b.sha256 = e.sha256
+        WHERE LOWER(e.nombre_archivo) REGEXP %s
+    """, (patron,))
+
+
+@migracion(7, "Resúmenes de capturas de red")
+def _resumenes_captura(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS resumenes_captura (
+            sha256 CHAR(64) PRIMARY KEY,
+            estado VARCHAR(20) NOT NULL DEFAULT 'pendiente',
+            intentos INT NOT NULL DEFAULT 0,
+            error VARCHAR(500),
+            reclamada TIMESTAMP NULL,
+            resumen LONGTEXT,
+            fecha_fin TIMESTAMP NULL,
+            KEY idx_resumenes_captura_estado (estado),
+            FOREIGN KEY (sha256) REFERENCES blobs(sha256) ON DELETE CASCADE
+        )
+    """)
+    patron = f"\\.({'|'.join(EXTENSIONES_CAPTURA)})$"
+    cursor.execute("""
+        INSERT IGNORE INTO resumenes_captura (sha256)
+        SELECT DISTINCT e.sha256
+        FROM evidencias e
+        JOIN blobs b ON b.sha256 = e.sha256
+        WHERE LOWER(e.nombre_archivo) REGEXP %s
+    """, (patron,))
+
+
+@migracion(8, "Cola de trabajos en segundo plano")
+def _trabajos(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS trabajos (
+            id BIGINT PRIMARY KEY AUTO_INCREMENT,
+            tipo VARCHAR(40) NOT NULL,
+            parametros LONGTEXT NOT NULL,
+            clave VARCHAR(100) NULL,
+            incidente_id INT NULL,
+            estado VARCHAR(20) NOT NULL DEFAULT 'pendiente',
+            intentos INT NOT NULL DEFAULT 0,
+            max_intentos INT NOT NULL DEFAULT 3,
+            disponible TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            trabajador VARCHAR(150) NULL,
+            reclamado TIMESTAMP NULL,
+            progreso FLOAT NOT NULL DEFAULT 0,
+            mensaje VARCHAR(255),
+            resultado LONGTEXT,
+            error VARCHAR(500),
+            fecha_creacion TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            fecha_fin TIMESTAMP NULL,
+            KEY idx_trabajos_cola (estado, disponible),
+            KEY idx_trabajos_clave (clave),
+            KEY idx_trabajos_trabajador (trabajador),
+            FOREIGN KEY (incidente_id) REFERENCES incidentes(id) ON DELETE CASCADE
+        )
+    """)
+
+
+@migracion(9, "Huella de correlación de incidentes")
+def _correlacion(cursor):
+    agregar_columna(cursor, 'incidentes', 'huella', 'CHAR(40) NULL')
+    agregar_columna(cursor, 'incidentes', 'repeticiones', 'INT NOT NULL DEFAULT 0')
+    agregar_columna(cursor, 'incidentes', 'ultima_repeticion', 'TIMESTAMP NULL')
+    crear_indice(cursor, 'incidentes', 'idx_incidentes_huella', 'huella, estado')
+    # Solo los incidentes abiertos pueden recibir alertas repetidas
+    cursor.execute("""
+        SELECT id, titulo, tipo, usuario_reporta, descripcion
+        FROM incidentes WHERE estado IN (%s, %s)
+    """, ESTADOS_ABIERTOS)
+    for incidente_id, titulo, tipo, usuario, descripcion in cursor.fetchall():
+        cursor.execute("UPDATE incidentes SET huella = %s WHERE id = %s",
+                       (huella(titulo, tipo, usuario, descripcion), incidente_id))
+
+
+@migracion(10, "Versión de los incidentes para la caché del detalle")
+def _version_incidentes(cursor):
+    agregar_columna(cursor, 'incidentes', 'version', 'INT NOT NULL DEFAULT 0')
+
+
+@migracion(11, "Archivos de los meses retirados del historial")
+def _archivo_historial(cursor):
+    # El particionado de historial (que reescribe la tabla) no es una
+    # migración: se hace a propósito con flask historial-particionar
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS historial_archivos (
+            id INT PRIMARY KEY AUTO_INCREMENT,
+            particion VARCHAR(16) NOT NULL UNIQUE,
+            desde DATE NOT NULL,
+            hasta DATE NOT NULL,
+            ruta TEXT NOT NULL,
+            formato VARCHAR(10) NOT NULL,
+            filas INT NOT NULL,
+            bytes BIGINT NOT NULL,
+            sha256 CHAR(64) NOT NULL,
+            fecha_archivado TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # Índice de los archivos por incidente: qué bloques leer para su línea de tiempo
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS historial_archivo_bloques (
+            incidente_id INT NOT NULL,
+            archivo_id INT NOT NULL,
+            desplazamiento BIGINT NOT NULL,
+            longitud INT NOT NULL,
+            filas INT NOT NULL,
+            PRIMARY KEY (incidente_id, archivo_id, desplazamiento),
+            FOREIGN KEY (archivo_id) REFERENCES historial_archivos(id) ON DELETE CASCADE
+        )
+    """)
+
+
+# ==============================
+# EJECUCIÓN
+# ==============================
+def version_actual(cursor):
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migraciones")
+    return cursor.fetchone()[0]
+
+
+def aplicar_migraciones(cursor, hasta=None):
+    """Aplica en orden las migraciones pendientes; devuelve las aplicadas"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migraciones (
+            version INT PRIMARY KEY,
+            descripcion VARCHAR(255) NOT NULL,
+            fecha_aplicada TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("SELECT version FROM schema_migraciones")
+    aplicadas = {fila[0] for fila in cursor.fetchall()}
+
+    nuevas = []
+    for version, descripcion, funcion in sorted(MIGRACIONES, key=lambda m: m[0]):
+        if version in aplicadas or (hasta is not None and version > hasta):
+            continue
+        logger.info(f"Aplicando migración {version}: {descripcion}")
+        funcion(cursor)
+        cursor.execute(
+            "INSERT INTO schema_migraciones (version, descripcion) VALUES (%s, %s)",
+            (version, descripcion)
+        )
+        nuevas.append(version)
+    return nuevas
@@ -0,0 +1,96 @@
+# miniaturas.py
+"""Caché en disco de miniaturas de las evidencias de imagen"""
+import logging
+import os
+import threading
+import uuid
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Lado máximo en píxeles de cada tamaño derivado
+TAMANOS = {
+    'miniatura': 400,   # rejilla de evidencias
+    'mediana': 800      # rejilla en pantallas de alta densidad
+}
+
+CALIDAD_JPEG = 82
+
+
+class CacheMiniaturas:
+    """Imágenes reducidas guardadas en ``raiz/ab/cd/<clave>.<tamano>.jpg``.
+
+    La clave es el SHA-256 del original, así que una miniatura nunca queda
+    obsoleta: si el contenido cambia, cambia la clave. Se generan la primera
+    vez que se piden (o al subir la evidencia) y se escriben en un temporal
+    que se renombra, de modo que otro proceso nunca lee una a medias.
+    """
+
+    def __init__(self, raiz):
+        self.raiz = raiz
+        self._locks = {}
+        self._lock = threading.Lock()
+        os.makedirs(raiz, exist_ok=True)
+
+    def ruta(self, clave, tamano):
+        return os.path.join(self.raiz, clave[:2], clave[2:4], f"{clave}.{tamano}.jpg")
+
+    def _lock_clave(self, clave, tamano):
+        with self._lock:
+            return self._locks.setdefault((clave, tamano), threading.Lock())
+
+    def obtener(self, origen, clave, tamano):
+        """Devuelve la ruta de la miniatura, generándola si aún no existe"""
+        ruta = self.ruta(clave, tamano)
+        if os.path.exists(ruta):
+            return ruta
+
+        with self._lock_clave(clave, tamano):
+            if not os.path.exists(ruta):
+                self._generar(origen, ruta, TAMANOS[tamano])
+        with self._lock:
+            self._locks.pop((clave, tamano), None)
+        return ruta
+
+    def _generar(self, origen, ruta, lado):
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        temporal = f"{ruta}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            with Image.open(origen) as imagen:
+                # En JPEG decodifica directamente a una escala reducida
+                imagen.draft('RGB', (lado, lado))
+                imagen = ImageOps.exif_transpose(imagen)
+                imagen.thumbnail((lado, lado), Image.LANCZOS)
+                if imagen.mode in ('RGBA', 'LA', 'P'):
+                    imagen = imagen.convert('RGBA')
+                    fondo = Image.new('RGB', imagen.size, (255, 255, 255))
+                    fondo.paste(imagen, mask=imagen.getchannel('A'))
+                    imagen = fondo
+                elif imagen.mode != 'RGB':
+                    imagen = imagen.convert('RGB')
+                imagen.save(temporal, 'JPEG', quality=CALIDAD_JPEG, optimize=True, progressive=True)
+            os.replace(temporal, ruta)
+        except Exception:
+            try:
+                os.remove(temporal)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def pregenerar(self, origen, clave):
+        """Genera todos los tamaños; los errores solo se registran"""
+        for tamano in TAMANOS:
+            try:
+                self.obtener(origen, clave, tamano)
+            except Exception as e:
+                logger.warning(f"No se pudo generar la miniatura {tamano} de {clave}: {e}")
+                return
+
+    def eliminar(self, clave):
+        """Borra las miniaturas de un contenido que ya no se usa"""
+        for tamano in TAMANOS:
+            try:
+                os.remove(self.ruta(clave, tamano))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,152 @@
+# replicas.py
+"""Reparto de las lecturas entre réplicas de la base de datos"""
+import logging
+import threading
+import time
+
+from db_pool import PoolAgotado
+
+logger = logging.getLogger(__name__)
+
+
+def retraso_mysql(conn):
+    """Segundos de retraso de una réplica MySQL/MariaDB.
+
+    None si la replicación está parada; 0 si el servidor no es una réplica
+    (por ejemplo, la propia primaria usada como réplica en desarrollo).
+    """
+    cursor = conn.cursor(dictionary=True, buffered=True)
+    try:
+        try:
+            cursor.execute("SHOW REPLICA STATUS")      # MySQL 8.0.22+, MariaDB 10.5.1+
+        except Exception:
+            cursor.execute("SHOW SLAVE STATUS")
+        fila = cursor.fetchone()
+    finally:
+        cursor.close()
+    if fila is None:
+        return 0.0
+    retraso = fila.get('Seconds_Behind_Source', fila.get('Seconds_Behind_Master'))
+    return None if retraso is None else float(retraso)
+
+
+class Replica:
+    """Una réplica con su pool y su último estado conocido"""
+
+    def __init__(self, nombre, pool):
+        self.nombre = nombre
+        self.pool = pool
+        self.caida_hasta = 0.0        # sin usar hasta este instante (monotonic)
+        self.retraso = None
+        self.retraso_medido = 0.0
+        self.error = None
+        self.lecturas = 0
+        self.fallos = 0
+
+    def estadisticas(self):
+        return {
+            'nombre': self.nombre,
+            'disponible': self.caida_hasta <= time.monotonic(),
+            'retraso': self.retraso,
+            'error': self.error,
+            'lecturas': self.lecturas,
+            'fallos': self.fallos,
+            'pool': self.pool.estadisticas()
+        }
+
+
+class EnrutadorBD:
+    """Elige réplica para las lecturas, por turnos y evitando las que fallan.
+
+    ``adquirir`` reparte las lecturas por turnos entre las réplicas
+    disponibles. Una réplica a la que no se puede conectar, o cuyo
+    retraso supera ``max_retraso`` segundos (o cuya replicación está
+    parada), se aparta durante ``penalizacion`` segundos. El retraso se mide
+    con ``medir_retraso(conn)`` como mucho cada ``intervalo_retraso``
+    segundos por réplica; con ``medir_retraso=None`` no se mide (réplicas
+    sin replicación real, como un SQLite de pruebas). Si ninguna réplica
+    sirve devuelve None y la lectura va a la primaria.
+    """
+
+    def __init__(self, replicas, max_retraso=5, intervalo_retraso=5, penalizacion=30,
+                 medir_retraso=retraso_mysql):
+        self.replicas = list(replicas)
+        self.max_retraso = max_retraso
+        self.intervalo_retraso = intervalo_retraso
+        self.penalizacion = penalizacion
+        self.medir_retraso = medir_retraso
+
+        self._lock = threading.Lock()
+        self._turno = 0
+        self.lecturas_primaria = 0
+
+    def _candidatas(self):
+        """Réplicas disponibles, empezando por la que toca en el turno"""
+        ahora = time.monotonic()
+        sanas = [replica for replica in self.replicas if replica.caida_hasta <= ahora]
+        if not sanas:
+            return []
+        with self._lock:
+            inicio = self._turno % len(sanas)
+            self._turno += 1
+        return sanas[inicio:] + sanas[:inicio]
+
+    def apartar(self, replica, motivo):
+        """Deja de usar la réplica durante ``penalizacion`` segundos"""
+        if replica.caida_hasta <= time.monotonic():
+            logger.warning(f"Réplica {replica.nombre} apartada {self.penalizacion}s: {motivo}")
+        replica.caida_hasta = time.monotonic() + self.penalizacion
+        replica.error = motivo
+        replica.fallos += 1
+
+    def _retraso_aceptable(self, replica, conn):
+        if self.medir_retraso is None:
+            return True
+        ahora = time.monotonic()
+        if ahora - replica.retraso_medido >= self.intervalo_retraso:
+            replica.retraso = self.medir_retraso(conn)
+            replica.retraso_medido = ahora
+        if replica.retraso is None:
+            self.apartar(replica, "replicación detenida")
+            return False
+        if replica.retraso > self.max_retraso:
+            self.apartar(replica, f"retraso de {replica.retraso:.0f}s")
+            return False
+        return True
+
+    def adquirir(self):
+        """(conexión, réplica) de la primera réplica sana o None"""
+        if self.replicas:
+            for replica in self._candidatas():
+                try:
+                    conn = replica.pool.acquire()
+                except PoolAgotado:
+                    continue                      # ocupada, no caída
+                except Exception as e:
+                    self.apartar(replica, str(e))
+                    continue
+                try:
+                    sana = self._retraso_aceptable(replica, conn)
+                except Exception as e:
+                    replica.pool.release(conn, descartar=True)
+                    self.apartar(replica, f"no se pudo medir el retraso: {e}")
+                    continue
+                if not sana:
+                    replica.pool.release(conn)
+                    continue
+                replica.error = None
+                replica.lecturas += 1
+                return conn, replica
+        self.lecturas_primaria += 1
+        return None
+
+    def cerrar(self):
+        for replica in self.replicas:
+            replica.pool.cerrar()
+
+    def estadisticas(self):
+        return {
+            'replicas': [replica.estadisticas() for replica in self.replicas],
+            'lecturas_primaria': self.lecturas_primaria,
+            'max_retraso': self.max_retraso
+        }
@@ -0,0 +1,184 @@
+# servidor_eventos.py
+"""Servidor asyncio para los flujos SSE (flask servir-eventos y asgi.py).
+
+Un cliente SSE conectado a un worker síncrono ocupa ese worker (o uno de
+sus hilos) mientras dura la conexión. Este servidor atiende las mismas
+rutas (/api/eventos y /api/incidentes/<id>/eventos) con una sola
+corrutina por cliente, así que miles de analistas mirando un incidente no
+restan workers a la aplicación. Recibe los eventos de los workers a través
+del broker Redis (EVENTOS_REDIS_URL); el proxy inverso envía a este puerto
+las rutas de eventos. En el modo ASGI (asgi.py) las mismas rutas se
+atienden con ``ServidorEventos.asgi`` dentro del proceso de la aplicación.
+"""
+import asyncio
+import logging
+import re
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from eventos import CABECERAS_SSE, DESBORDADA, GLOBAL, Suscripcion, abrir_flujo, formato_sse, ultimo_id
+
+logger = logging.getLogger(__name__)
+
+_RUTA_INCIDENTE = re.compile(r'^/api/incidentes/(\d+)/eventos$')
+
+
+def ruta_eventos(ruta):
+    """(True, incidente_id) si ``ruta`` es un flujo de eventos (GLOBAL para
+    /api/eventos); (False, None) si no"""
+    if ruta == '/api/eventos':
+        return True, GLOBAL
+    coincidencia = _RUTA_INCIDENTE.match(ruta)
+    if coincidencia:
+        return True, int(coincidencia.group(1))
+    return False, None
+
+
+class _SuscripcionAsync(Suscripcion):
+    """Suscripción que entrega en una cola de asyncio desde el hilo del broker"""
+
+    def __init__(self, incidente_id, max_cola, bucle):
+        super().__init__(incidente_id, max_cola)
+        self._bucle = bucle
+        self._cola_async = asyncio.Queue(max_cola)
+
+    def _poner(self, evento):
+        if self._cola_async.full():
+            evento = DESBORDADA
+            self.desbordada = True
+            self._cola_async = asyncio.Queue(1)
+        self._cola_async.put_nowait(evento)
+
+    def entregar(self, evento):
+        if not self.desbordada:
+            self._bucle.call_soon_threadsafe(self._poner, evento)
+
+    async def esperar_async(self, timeout):
+        try:
+            return await asyncio.wait_for(self._cola_async.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+async def _esperar_desconexion(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def _responder(escritor, codigo, texto):
+    cuerpo = texto.encode('utf-8')
+    escritor.write(f"HTTP/1.1 {codigo}\r\nContent-Type: text/plain; charset=utf-8\r\n"
+                   f"Content-Length: {len(cuerpo)}\r\nConnection: close\r\n\r\n".encode() + cuerpo)
+    await escritor.drain()
+
+
+class ServidorEventos:
+    def __init__(self, canal, latido=15, duracion=3600, max_clientes=10000):
+        self.canal = canal
+        self.latido = latido
+        self.duracion = duracion
+        self.max_clientes = max_clientes
+        self.clientes = 0
+
+    async def _leer_peticion(self, lector):
+        linea = await asyncio.wait_for(lector.readline(), 10)
+        partes = linea.decode('latin-1').split()
+        cabeceras = {}
+        while True:
+            cabecera = await asyncio.wait_for(lector.readline(), 10)
+            if cabecera in (b'\r\n', b'\n', b''):
+                break
+            nombre, _, valor = cabecera.decode('latin-1').partition(':')
+            cabeceras[nombre.strip().lower()] = valor.strip()
+        return partes, cabeceras
+
+    async def atender(self, lector, escritor):
+        try:
+            partes, cabeceras = await self._leer_peticion(lector)
+            if len(partes) < 2 or partes[0] != 'GET':
+                return await _responder(escritor, '405 Method Not Allowed', 'Solo GET')
+            url = urlsplit(partes[1])
+            es_flujo, incidente_id = ruta_eventos(url.path)
+            if not es_flujo:
+                return await _responder(escritor, '404 Not Found', 'No encontrado')
+            if self.clientes >= self.max_clientes:
+                return await _responder(escritor, '503 Service Unavailable', 'Demasiados clientes')
+
+            ultimo = ultimo_id(cabeceras.get('last-event-id') or parse_qs(url.query).get('desde', [None])[0])
+            await self._enviar_flujo(escritor, incidente_id, ultimo)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Error en un flujo de eventos: {e}")
+        finally:
+            escritor.close()
+
+    async def _transmitir(self, escribir, incidente_id, ultimo, cabecera=b''):
+        """Envía el flujo con ``await escribir(bytes)`` hasta ``duracion``;
+        ``cabecera`` sale junto con el texto inicial"""
+        suscripcion = _SuscripcionAsync(incidente_id, self.canal.max_cola, asyncio.get_running_loop())
+        suscripcion, inicial, enviado = abrir_flujo(self.canal, incidente_id, ultimo, suscripcion)
+        self.clientes += 1
+        try:
+            await escribir(cabecera + inicial.encode('utf-8'))
+            fin = time.monotonic() + self.duracion
+            while time.monotonic() < fin:
+                evento = await suscripcion.esperar_async(self.latido)
+                if evento is DESBORDADA:
+                    break
+                if evento is None:
+                    await escribir(b": latido\n\n")
+                elif evento['id'] > enviado:
+                    await escribir(formato_sse(evento).encode('utf-8'))
+                    enviado = evento['id']
+        finally:
+            self.clientes -= 1
+            self.canal.cancelar(suscripcion)
+
+    async def _enviar_flujo(self, escritor, incidente_id, ultimo):
+        async def escribir(datos):
+            escritor.write(datos)
+            await escritor.drain()
+
+        cabeceras = ''.join(f"{nombre}: {valor}\r\n" for nombre, valor in CABECERAS_SSE.items())
+        cabecera = ("HTTP/1.1 200 OK\r\nContent-Type: text/event-stream; charset=utf-8\r\n"
+                    f"{cabeceras}Connection: close\r\n\r\n").encode('latin-1')
+        await self._transmitir(escribir, incidente_id, ultimo, cabecera)
+
+    async def asgi(self, scope, receive, send, incidente_id):
+        """Atiende un flujo de eventos como aplicación ASGI (ver asgi.py)"""
+        if self.clientes >= self.max_clientes:
+            await send({'type': 'http.response.start', 'status': 503,
+                        'headers': [(b'content-type', b'text/plain; charset=utf-8'), (b'retry-after', b'30')]})
+            await send({'type': 'http.response.body', 'body': 'Demasiados clientes'.encode('utf-8')})
+            return
+        cabeceras = dict(scope['headers'])
+        ultimo = ultimo_id(cabeceras.get(b'last-event-id', b'').decode('latin-1')
+                           or parse_qs(scope['query_string'].decode('latin-1')).get('desde', [None])[0])
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream; charset=utf-8')]
+                       + [(nombre.lower().encode('latin-1'), valor.encode('latin-1'))
+                          for nombre, valor in CABECERAS_SSE.items()]
+        })
+
+        async def escribir(datos):
+            await send({'type': 'http.response.body', 'body': datos, 'more_body': True})
+
+        # El flujo termina por duración o cuando el cliente se desconecta
+        flujo = asyncio.ensure_future(self._transmitir(escribir, incidente_id, ultimo))
+        desconexion = asyncio.ensure_future(_esperar_desconexion(receive))
+        try:
+            await asyncio.wait([flujo, desconexion], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for tarea in (flujo, desconexion):
+                tarea.cancel()
+        if flujo.done() and not flujo.cancelled() and flujo.exception() is None:
+            await send({'type': 'http.response.body', 'body': b''})
+
+    async def servir(self, host, puerto):
+        servidor = await asyncio.start_server(self.atender, host, puerto)
+        logger.info(f"Eventos SSE en http://{host}:{puerto} (latido {self.latido}s)")
+        async with servidor:
+            await servidor.serve_forever()
@@ -24,24 +24,167 @@ function confirmarAccion(mensaje) {
 function cargarEstadisticas() {
     fetch('/api/estadisticas')
         .then(response => response.json())
-        .then(data => {
-            // Actualizar elementos con estadísticas si existen
-            if (document.getElementById('totalIncidentes')) {
-                document.getElementById('totalIncidentes').textContent = data.total;
-            }
-            if (document.getElementById('incidentesAbiertos')) {
-                document.getElementById('incidentesAbiertos').textContent = data.abiertos;
-            }
-            if (document.getElementById('incidentesCriticos')) {
-                document.getElementById('incidentesCriticos').textContent = data.criticos;
-            }
-        })
+        .then(mostrarEstadisticas)
         .catch(error => console.error('Error cargando estadísticas:', error));
 }
 
-// Cargar estadísticas al iniciar si estamos en la página principal
+// Función para pintar las estadísticas del dashboard
+function mostrarEstadisticas(data) {
+    if (document.getElementById('totalIncidentes')) {
+        document.getElementById('totalIncidentes').textContent = data.total;
+    }
+    if (document.getElementById('incidentesAbiertos')) {
+        document.getElementById('incidentesAbiertos').textContent = data.abiertos;
+    }
+    if (document.getElementById('incidentesCriticos')) {
+        document.getElementById('incidentesCriticos').textContent = data.criticos;
+    }
+}
+
+// Función para escuchar eventos del servidor (SSE).
+// El navegador reconecta solo y envía Last-Event-ID, así que tras un corte
+// llegan los eventos perdidos (o 'recargar' si ya no están disponibles).
+// Devuelve null si el servidor no tiene los eventos activados
+// (EVENTOS_EN_VIVO) o el navegador no los admite.
+function escucharEventos(url, manejadores) {
+    if (!window.EventSource || !document.body.dataset.eventos) {
+        return null;
+    }
+    var fuente = new EventSource(url);
+    Object.keys(manejadores).forEach(function(tipo) {
+        fuente.addEventListener(tipo, function(e) {
+            manejadores[tipo](JSON.parse(e.data));
+        });
+    });
+    window.addEventListener('beforeunload', function() {
+        fuente.close();
+    });
+    return fuente;
+}
+
+// Función para avisar de que la página ha quedado desactualizada
+function avisarRecarga(mensaje) {
+    if (document.getElementById('avisoRecarga')) {
+        return;
+    }
+    var aviso = document.createElement('div');
+    aviso.id = 'avisoRecarga';
+    aviso.className = 'alert alert-warning d-flex justify-content-between align-items-center';
+    var texto = document.createElement('span');
+    texto.textContent = mensaje;
+    var boton = document.createElement('button');
+    boton.className = 'btn btn-sm btn-warning';
+    boton.textContent = 'Recargar';
+    boton.addEventListener('click', function() {
+        window.location.reload();
+    });
+    aviso.appendChild(texto);
+    aviso.appendChild(boton);
+    var contenedor = document.querySelector('.container') || document.body;
+    contenedor.insertBefore(aviso, contenedor.firstChild);
+}
+
+// Colores y textos de las acciones del historial
+var ESTILO_ACCIONES = {
+    CREACION: ['bg-success', 'Creación'],
+    CAMBIO_ESTADO: ['bg-warning', 'Cambio Estado'],
+    COMENTARIO: ['bg-info', 'Comentario'],
+    ELIMINACION: ['bg-danger', 'Eliminación'],
+    CORRELACION: ['bg-secondary', 'Alerta Repetida']
+};
+
+function crearBadgeAccion(accion) {
+    var estilo = ESTILO_ACCIONES[accion] || ['bg-primary', accion];
+    var badge = document.createElement('span');
+    badge.className = 'badge ' + estilo[0];
+    badge.textContent = estilo[1];
+    return badge;
+}
+
+// Función para añadir un evento 'historial' al principio de la línea de tiempo
+function agregarEntradaTimeline(timelineId, evento) {
+    var timeline = document.getElementById(timelineId);
+    if (!timeline) {
+        avisarRecarga('Hay actividad nueva en este incidente.');
+        return;
+    }
+    var item = document.createElement('div');
+    item.className = 'timeline-item mb-3';
+    var marcador = document.createElement('div');
+    marcador.className = 'timeline-marker ' + (ESTILO_ACCIONES[evento.accion] || ['bg-primary'])[0];
+    var contenido = document.createElement('div');
+    contenido.className = 'timeline-content';
+    var tarjeta = document.createElement('div');
+    tarjeta.className = 'card border-0 shadow-sm';
+    var cuerpo = document.createElement('div');
+    cuerpo.className = 'card-body py-2';
+    var cabecera = document.createElement('div');
+    cabecera.className = 'd-flex justify-content-between align-items-start mb-1';
+    cabecera.appendChild(crearBadgeAccion(evento.accion));
+    var fecha = document.createElement('small');
+    fecha.className = 'text-muted';
+    fecha.textContent = formatearFecha(evento.fecha) + ' · ' + evento.usuario;
+    cabecera.appendChild(fecha);
+    cuerpo.appendChild(cabecera);
+    if (evento.descripcion) {
+        var descripcion = document.createElement('p');
+        descripcion.className = 'mb-0 small';
+        descripcion.textContent = evento.descripcion;
+        cuerpo.appendChild(descripcion);
+    }
+    tarjeta.appendChild(cuerpo);
+    contenido.appendChild(tarjeta);
+    item.appendChild(marcador);
+    item.appendChild(contenido);
+    timeline.insertBefore(item, timeline.firstChild);
+}
+
+// Función para añadir un evento 'historial' como primera fila de la tabla
+function agregarFilaHistorial(tbodyId, evento) {
+    var tbody = document.getElementById(tbodyId);
+    if (!tbody) {
+        avisarRecarga('Hay actividad nueva en el historial.');
+        return;
+    }
+    var fila = document.createElement('tr');
+    var celdaFecha = document.createElement('td');
+    var fecha = document.createElement('small');
+    fecha.className = 'text-muted';
+    fecha.textContent = formatearFecha(evento.fecha);
+    celdaFecha.appendChild(fecha);
+    var celdaAccion = document.createElement('td');
+    celdaAccion.appendChild(crearBadgeAccion(evento.accion));
+    var celdaIncidente = document.createElement('td');
+    if (evento.incidente_id) {
+        var enlace = document.createElement('a');
+        enlace.className = 'text-decoration-none';
+        enlace.href = '/incidentes/' + evento.incidente_id;
+        enlace.textContent = '#' + evento.incidente_id;
+        celdaIncidente.appendChild(enlace);
+    }
+    var celdaUsuario = document.createElement('td');
+    var usuario = document.createElement('small');
+    usuario.className = 'text-muted';
+    usuario.textContent = evento.usuario;
+    celdaUsuario.appendChild(usuario);
+    var celdaDescripcion = document.createElement('td');
+    var descripcion = document.createElement('small');
+    descripcion.textContent = evento.descripcion || 'Sin descripción';
+    celdaDescripcion.appendChild(descripcion);
+    [celdaFecha, celdaAccion, celdaIncidente, celdaUsuario, celdaDescripcion].forEach(function(celda) {
+        fila.appendChild(celda);
+    });
+    tbody.insertBefore(fila, tbody.firstChild);
+}
+
+// En la página principal las estadísticas llegan por eventos; sin
+// eventos se cargan una vez al iniciar
 if (window.location.pathname === '/') {
-    document.addEventListener('DOMContentLoaded', cargarEstadisticas);
+    document.addEventListener('DOMContentLoaded', function() {
+        if (!escucharEventos('/api/eventos', {estadisticas: mostrarEstadisticas})) {
+            cargarEstadisticas();
+        }
+    });
 }
 
 // Función para previsualizar imágenes
@@ -85,6 +228,11 @@ function formatearFecha(fechaISO) {
 window.CyberIncident = {
     confirmarAccion,
     cargarEstadisticas,
+    mostrarEstadisticas,
+    escucharEventos,
+    avisarRecarga,
+    agregarEntradaTimeline,
+    agregarFilaHistorial,
     previsualizarImagen,
     validarTamanoArchivo,
     formatearFecha
@@ -0,0 +1,244 @@
+# subidas.py
+"""Subida de evidencias por fragmentos, reanudable y con SHA-256 incremental"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows (XAMPP): solo bloqueo entre hilos
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_ID_VALIDO = re.compile(r'^[0-9a-f]{32}$')
+_BLOQUE_LECTURA = 1024 * 1024
+
+
+class SubidaNoEncontrada(Exception):
+    """La subida no existe o ya fue finalizada"""
+
+
+class SubidaInvalida(Exception):
+    """La petición no encaja con el estado de la subida"""
+
+    def __init__(self, mensaje, recibido=None):
+        super().__init__(mensaje)
+        self.recibido = recibido
+
+
+class GestorSubidas:
+    """Subidas por fragmentos escritas directamente en ``raiz/<incidente_id>``.
+
+    Los datos se van añadiendo a ``raiz/<incidente_id>/.parcial_<id>`` y los
+    metadatos de la subida se guardan en ``raiz/.subidas/<id>.json``. Cada
+    fragmento debe empezar exactamente donde terminó el anterior, lo que
+    permite calcular el SHA-256 a medida que llegan los datos. El estado del
+    hash solo existe en la memoria del proceso: si un fragmento llega a otro
+    proceso (u otro arranque) el hash incremental se abandona y se calcula
+    una sola vez al finalizar, leyendo el archivo completo. Ningún fragmento
+    vuelve a leer lo ya recibido.
+    """
+
+    def __init__(self, raiz, tamano_bloque=8 * 1024 * 1024, tamano_maximo=None):
+        self.raiz = raiz
+        self.tamano_bloque = tamano_bloque
+        self.tamano_maximo = tamano_maximo
+        self._hashes = {}           # id -> (hasher, bytes hasheados)
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    # ------------------------------
+    # Rutas y metadatos
+    # ------------------------------
+    def _ruta_metadatos(self, subida_id):
+        if not _ID_VALIDO.match(subida_id or ''):
+            raise SubidaNoEncontrada(subida_id)
+        return os.path.join(self.raiz, '.subidas', f"{subida_id}.json")
+
+    def _ruta_parcial(self, meta):
+        return os.path.join(self.raiz, str(meta['incidente_id']), f".parcial_{meta['id']}")
+
+    def _leer_metadatos(self, subida_id):
+        try:
+            with open(self._ruta_metadatos(subida_id), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise SubidaNoEncontrada(subida_id)
+
+    def _lock_subida(self, subida_id):
+        with self._lock:
+            return self._locks.setdefault(subida_id, threading.Lock())
+
+    # ------------------------------
+    # Protocolo
+    # ------------------------------
+    def crear(self, incidente_id, nombre, tamano):
+        """Inicia una subida y devuelve su estado"""
+        if tamano is None or tamano < 0:
+            raise SubidaInvalida("Tamaño de archivo no válido")
+        if self.tamano_maximo and tamano > self.tamano_maximo:
+            raise SubidaInvalida(f"El archivo supera el máximo de {self.tamano_maximo} bytes")
+
+        meta = {
+            'id': uuid.uuid4().hex,
+            'incidente_id': incidente_id,
+            'nombre': nombre,
+            'tamano': tamano,
+            'creada': time.time()
+        }
+        os.makedirs(os.path.join(self.raiz, '.subidas'), exist_ok=True)
+        os.makedirs(os.path.join(self.raiz, str(incidente_id)), exist_ok=True)
+        open(self._ruta_parcial(meta), 'wb').close()
+        with open(self._ruta_metadatos(meta['id']), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        return self.estado(meta['id'])
+
+    def estado(self, subida_id):
+        meta = self._leer_metadatos(subida_id)
+        recibido = os.path.getsize(self._ruta_parcial(meta))
+        return {
+            'subida_id': meta['id'],
+            'incidente_id': meta['incidente_id'],
+            'nombre': meta['nombre'],
+            'tamano': meta['tamano'],
+            'recibido': recibido,
+            'tamano_bloque': self.tamano_bloque,
+            'completa': recibido == meta['tamano']
+        }
+
+    def _hasher(self, subida_id, recibido):
+        """Hash incremental de los primeros ``recibido`` bytes, o None si este
+        proceso no lo tiene (se calculará al finalizar)"""
+        if recibido == 0:
+            return hashlib.sha256()
+        guardado = self._hashes.pop(subida_id, None)
+        if guardado and guardado[1] == recibido:
+            return guardado[0]
+        return None
+
+    @staticmethod
+    def _hash_archivo(parcial, recibido):
+        hasher = hashlib.sha256()
+        with open(parcial, 'rb') as f:
+            restante = recibido
+            while restante > 0:
+                bloque = f.read(min(_BLOQUE_LECTURA, restante))
+                if not bloque:
+                    break
+                hasher.update(bloque)
+                restante -= len(bloque)
+        return hasher
+
+    def escribir(self, subida_id, inicio, flujo, longitud=None):
+        """Añade un fragmento leído de ``flujo`` a partir del byte ``inicio``.
+
+        ``inicio`` debe coincidir con lo ya recibido; si no, se lanza
+        ``SubidaInvalida`` con el desplazamiento correcto para reanudar.
+        """
+        meta = self._leer_metadatos(subida_id)
+        parcial = self._ruta_parcial(meta)
+
+        with self._lock_subida(subida_id), open(parcial, 'ab') as destino:
+            if fcntl is not None:
+                fcntl.flock(destino.fileno(), fcntl.LOCK_EX)
+
+            recibido = os.fstat(destino.fileno()).st_size
+            if inicio != recibido:
+                raise SubidaInvalida(
+                    f"El fragmento empieza en {inicio} pero se han recibido {recibido} bytes",
+                    recibido=recibido
+                )
+
+            hasher = self._hasher(subida_id, recibido)
+            escritos = 0
+            try:
+                while longitud is None or escritos < longitud:
+                    pedir = _BLOQUE_LECTURA if longitud is None else min(_BLOQUE_LECTURA, longitud - escritos)
+                    bloque = flujo.read(pedir)
+                    if not bloque:
+                        break
+                    if recibido + escritos + len(bloque) > meta['tamano']:
+                        raise SubidaInvalida("El fragmento excede el tamaño declarado", recibido=recibido)
+                    destino.write(bloque)
+                    if hasher is not None:
+                        hasher.update(bloque)
+                    escritos += len(bloque)
+            except Exception:
+                # Descartar el fragmento incompleto para poder reanudar limpio
+                destino.flush()
+                destino.truncate(recibido)
+                self._hashes.pop(subida_id, None)
+                raise
+
+            destino.flush()
+            if hasher is not None:
+                self._hashes[subida_id] = (hasher, recibido + escritos)
+
+        return self.estado(subida_id)
+
+    def finalizar(self, subida_id, ruta_final, sha256_esperado=None):
+        """Verifica la subida y la mueve a ``ruta_final``; devuelve (meta, sha256)"""
+        meta = self._leer_metadatos(subida_id)
+        parcial = self._ruta_parcial(meta)
+
+        with self._lock_subida(subida_id):
+            recibido = os.path.getsize(parcial)
+            if recibido != meta['tamano']:
+                raise SubidaInvalida(
+                    f"Faltan datos: recibidos {recibido} de {meta['tamano']} bytes",
+                    recibido=recibido
+                )
+
+            hasher = self._hasher(subida_id, recibido) or self._hash_archivo(parcial, recibido)
+            sha256 = hasher.hexdigest()
+            if sha256_esperado and sha256_esperado.lower() != sha256:
+                raise SubidaInvalida("El SHA-256 no coincide con el declarado", recibido=recibido)
+
+            os.replace(parcial, ruta_final)
+            self._descartar(subida_id)
+
+        return meta, sha256
+
+    def cancelar(self, subida_id):
+        meta = self._leer_metadatos(subida_id)
+        try:
+            os.remove(self._ruta_parcial(meta))
+        except FileNotFoundError:
+            pass
+        self._descartar(subida_id)
+
+    def _descartar(self, subida_id):
+        try:
+            os.remove(self._ruta_metadatos(subida_id))
+        except FileNotFoundError:
+            pass
+        self._hashes.pop(subida_id, None)
+        with self._lock:
+            self._locks.pop(subida_id, None)
+
+    def limpiar(self, antiguedad):
+        """Elimina las subidas sin actividad en los últimos ``antiguedad`` segundos"""
+        carpeta = os.path.join(self.raiz, '.subidas')
+        if not os.path.isdir(carpeta):
+            return 0
+
+        eliminadas = 0
+        limite = time.time() - antiguedad
+        for archivo in os.listdir(carpeta):
+            subida_id = archivo[:-5]
+            try:
+                meta = self._leer_metadatos(subida_id)
+                parcial = self._ruta_parcial(meta)
+                ultima = os.path.getmtime(parcial) if os.path.exists(parcial) else meta['creada']
+                if ultima < limite:
+                    self.cancelar(subida_id)
+                    eliminadas += 1
+            except (SubidaNoEncontrada, ValueError) as e:
+                logger.warning(f"Subida ilegible {archivo}: {e}")
+        return eliminadas
@@ -0,0 +1,307 @@
+# trabajos.py
+"""Cola persistente de trabajos pesados y su ejecución fuera de las peticiones"""
+import json
+import logging
+import os
+import random
+import socket
+import time
+import uuid
+
+import mysql.connector
+
+import capturas
+import indicadores
+from almacen_blobs import predeterminado as almacen
+from miniaturas import CacheMiniaturas
+from zip_stream import generar_zip
+
+logger = logging.getLogger(__name__)
+
+MAX_INTENTOS = 3
+# Espera antes del primer reintento; se duplica en cada fallo hasta ESPERA_MAXIMA
+ESPERA_BASE = 30
+ESPERA_MAXIMA = 3600
+# Mínimo de segundos entre dos avisos de progreso guardados
+INTERVALO_PROGRESO = 1.0
+
+ACTIVOS = ('pendiente', 'procesando')
+
+TAREAS = {}
+
+
+def tarea(nombre):
+    """Registra una función ``f(contexto, **parametros)`` como el tipo ``nombre``"""
+    def registrar(funcion):
+        TAREAS[nombre] = funcion
+        return funcion
+    return registrar
+
+
+# ==============================
+# COLA
+# ==============================
+def encolar(cursor, tipo, parametros, incidente_id=None, clave=None, max_intentos=MAX_INTENTOS):
+    """Añade un trabajo y devuelve su id.
+
+    Con ``clave``, si ya hay un trabajo pendiente o en curso con esa clave se
+    devuelve ese en lugar de crear otro.
+    """
+    if clave:
+        cursor.execute(
+            "SELECT id FROM trabajos WHERE clave = %s AND estado IN (%s, %s) ORDER BY id LIMIT 1",
+            (clave,) + ACTIVOS
+        )
+        fila = cursor.fetchone()
+        if fila:
+            return fila['id'] if isinstance(fila, dict) else fila[0]
+
+    cursor.execute("""
+        INSERT INTO trabajos (tipo, parametros, clave, incidente_id, max_intentos)
+        VALUES (%s, %s, %s, %s, %s)
+    """, (tipo, json.dumps(parametros), clave, incidente_id, max_intentos))
+    return cursor.lastrowid
+
+
+def obtener(cursor, trabajo_id):
+    """Fila de un trabajo (cursor con ``dictionary=True``) o None"""
+    cursor.execute("""
+        SELECT id, tipo, clave, incidente_id, estado, intentos, max_intentos, progreso,
+               mensaje, resultado, error, disponible, fecha_creacion, fecha_fin
+        FROM trabajos WHERE id = %s
+    """, (trabajo_id,))
+    trabajo = cursor.fetchone()
+    if trabajo:
+        trabajo['resultado'] = json.loads(trabajo['resultado']) if trabajo['resultado'] else None
+    return trabajo
+
+
+def ultimo_completado(cursor, clave):
+    """Último trabajo completado con esa clave (cursor con ``dictionary=True``)"""
+    cursor.execute("""
+        SELECT id FROM trabajos
+        WHERE clave = %s AND estado = 'completado'
+        ORDER BY id DESC LIMIT 1
+    """, (clave,))
+    fila = cursor.fetchone()
+    return obtener(cursor, fila['id']) if fila else None
+
+
+def recuperar_abandonados(cursor, caducidad):
+    """Devuelve a la cola los trabajos cuyo proceso dejó de dar señales.
+
+    Un trabajo en curso refresca ``reclamado`` con cada aviso de progreso; si
+    pasan ``caducidad`` segundos sin hacerlo se da por muerto su trabajador.
+    """
+    cursor.execute("""
+        UPDATE trabajos
+        SET estado = IF(intentos < max_intentos, 'pendiente', 'error'),
+            error = 'Trabajador sin respuesta', trabajador = NULL,
+            fecha_fin = IF(intentos < max_intentos, NULL, CURRENT_TIMESTAMP)
+        WHERE estado = 'procesando' AND reclamado < NOW() - INTERVAL %s SECOND
+    """, (caducidad,))
+    return cursor.rowcount
+
+
+def limpiar(cursor, antiguedad):
+    """Borra los trabajos terminados hace más de ``antiguedad`` segundos.
+
+    Si el resultado de un trabajo apunta a un archivo generado, se borra
+    también.
+    """
+    cursor.execute("""
+        SELECT id, resultado FROM trabajos
+        WHERE estado IN ('completado', 'error') AND fecha_fin < NOW() - INTERVAL %s SECOND
+    """, (antiguedad,))
+    filas = cursor.fetchall()
+    for trabajo_id, resultado in filas:
+        archivo = (json.loads(resultado) or {}).get('archivo') if resultado else None
+        if archivo:
+            try:
+                almacen().eliminar(archivo)
+            except Exception as e:
+                logger.warning(f"No se pudo borrar {archivo} del trabajo {trabajo_id}: {e}")
+        cursor.execute("DELETE FROM trabajos WHERE id = %s", (trabajo_id,))
+    return len(filas)
+
+
+def espera_reintento(intentos):
+    """Segundos hasta el siguiente intento: exponencial con un 20% de variación"""
+    espera = min(ESPERA_MAXIMA, ESPERA_BASE * 2 ** max(intentos - 1, 0))
+    return int(espera * random.uniform(0.8, 1.2))
+
+
+def nombre_trabajador():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+# ==============================
+# EJECUCIÓN
+# ==============================
+class Contexto:
+    """Lo que recibe cada tarea: la configuración de la BD y el aviso de progreso"""
+
+    def __init__(self, conn, db_config, trabajo):
+        self.conn = conn
+        self.db_config = db_config
+        self.trabajo = trabajo
+        self._ultimo_aviso = 0
+
+    def progreso(self, fraccion, mensaje=None):
+        """Guarda el avance (0-1); también sirve de señal de vida del trabajo"""
+        ahora = time.monotonic()
+        if ahora - self._ultimo_aviso < INTERVALO_PROGRESO:
+            return
+        self._ultimo_aviso = ahora
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            UPDATE trabajos SET progreso = %s, mensaje = %s, reclamado = CURRENT_TIMESTAMP
+            WHERE id = %s
+        """, (min(max(fraccion, 0), 1), (mensaje or '')[:255] or None, self.trabajo['id']))
+        cursor.close()
+
+
+def reclamar(conn, trabajador):
+    """Toma el siguiente trabajo disponible o devuelve None.
+
+    El UPDATE con LIMIT es atómico: dos trabajadores nunca se llevan el mismo
+    trabajo. El identificador de la reclamación permite leer después cuál fue.
+    """
+    reclamacion = f"{trabajador}:{uuid.uuid4().hex[:12]}"
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            UPDATE trabajos
+            SET estado = 'procesando', trabajador = %s, reclamado = CURRENT_TIMESTAMP,
+                intentos = intentos + 1, progreso = 0, mensaje = NULL
+            WHERE estado = 'pendiente' AND disponible <= NOW()
+            ORDER BY id
+            LIMIT 1
+        """, (reclamacion,))
+        if cursor.rowcount != 1:
+            return None
+        cursor.execute("""
+            SELECT id, tipo, parametros, incidente_id, intentos, max_intentos
+            FROM trabajos WHERE trabajador = %s
+        """, (reclamacion,))
+        trabajo = cursor.fetchone()
+        trabajo['parametros'] = json.loads(trabajo['parametros'])
+        return trabajo
+    finally:
+        cursor.close()
+
+
+def _terminar(conn, trabajo, resultado=None, error=None):
+    """Guarda el resultado, o programa el reintento con espera creciente"""
+    cursor = conn.cursor()
+    if error is None:
+        cursor.execute("""
+            UPDATE trabajos
+            SET estado = 'completado', progreso = 1, resultado = %s, error = NULL,
+                fecha_fin = CURRENT_TIMESTAMP
+            WHERE id = %s
+        """, (json.dumps(resultado), trabajo['id']))
+        estado = 'completado'
+    elif trabajo['intentos'] < trabajo['max_intentos']:
+        cursor.execute("""
+            UPDATE trabajos
+            SET estado = 'pendiente', error = %s, trabajador = NULL,
+                disponible = NOW() + INTERVAL %s SECOND
+            WHERE id = %s
+        """, (error[:500], espera_reintento(trabajo['intentos']), trabajo['id']))
+        estado = 'pendiente'
+    else:
+        cursor.execute("""
+            UPDATE trabajos SET estado = 'error', error = %s, fecha_fin = CURRENT_TIMESTAMP
+            WHERE id = %s
+        """, (error[:500], trabajo['id']))
+        estado = 'error'
+    cursor.close()
+    return estado
+
+
+def ejecutar_siguiente(db_config, trabajador):
+    """Punto de entrada de cada proceso del pool.
+
+    Reclama y ejecuta un trabajo; devuelve (id, tipo, estado, error) o None
+    si la cola estaba vacía.
+    """
+    conn = mysql.connector.connect(**db_config)
+    try:
+        trabajo = reclamar(conn, trabajador)
+        if trabajo is None:
+            return None
+
+        inicio = time.time()
+        funcion = TAREAS.get(trabajo['tipo'])
+        try:
+            if funcion is None:
+                # No tiene sentido reintentarlo
+                trabajo['intentos'] = trabajo['max_intentos']
+                raise ValueError(f"Tipo de trabajo desconocido: {trabajo['tipo']}")
+            resultado = funcion(Contexto(conn, db_config, trabajo), **trabajo['parametros'])
+        except Exception as e:
+            logger.exception(f"Trabajo {trabajo['id']} ({trabajo['tipo']}) falló")
+            estado = _terminar(conn, trabajo, error=str(e) or e.__class__.__name__)
+            return trabajo['id'], trabajo['tipo'], estado, str(e)
+
+        _terminar(conn, trabajo, resultado=resultado)
+        logger.info(f"Trabajo {trabajo['id']} ({trabajo['tipo']}) completado en {time.time() - inicio:.1f}s")
+        return trabajo['id'], trabajo['tipo'], 'completado', None
+    finally:
+        conn.close()
+
+
+# ==============================
+# TAREAS
+# ==============================
+@tarea('zip_incidente')
+def _zip_incidente(contexto, archivos, destino):
+    """Escribe en ``destino`` el ZIP con las evidencias [(ruta, nombre), ...].
+
+    Al terminar se publica en el almacén de evidencias, para que lo pueda
+    servir cualquier nodo web (en local se queda en ``destino``).
+    """
+    informacion = [almacen().info(ruta) for ruta, _ in archivos]
+    total = sum(info[0] for info in informacion if info) or 1
+    if not os.path.exists(destino):
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        parcial = f"{destino}.{os.getpid()}.parcial"
+        escritos = 0
+        try:
+            with open(parcial, 'wb') as salida:
+                for bloque in generar_zip(archivos, almacen=almacen()):
+                    salida.write(bloque)
+                    escritos += len(bloque)
+                    contexto.progreso(min(escritos / total, 0.99), f"{escritos // (1024 * 1024)} MB escritos")
+            os.replace(parcial, destino)
+        except BaseException:
+            if os.path.exists(parcial):
+                os.remove(parcial)
+            raise
+    tamano = os.path.getsize(destino)
+    archivo = almacen().publicar(destino, os.path.basename(destino))
+    return {'archivo': archivo, 'tamano': tamano, 'archivos': len(archivos)}
+
+
+@tarea('miniaturas')
+def _miniaturas(contexto, origen, clave, raiz):
+    with almacen().copia_local(origen) as local:
+        CacheMiniaturas(raiz).pregenerar(local, clave)
+    return {'clave': clave}
+
+
+@tarea('indicadores')
+def _indicadores(contexto, sha256, ruta, caducidad=3600):
+    _, lineas, error = indicadores.trabajar(contexto.db_config, sha256, ruta, caducidad)
+    if error:
+        raise RuntimeError(error)
+    return {'lineas': lineas}
+
+
+@tarea('captura')
+def _captura(contexto, sha256, ruta, caducidad=3600):
+    _, paquetes, error = capturas.trabajar(contexto.db_config, sha256, ruta, caducidad)
+    if error:
+        raise RuntimeError(error)
+    return {'paquetes': paquetes}
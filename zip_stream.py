@@ -0,0 +1,119 @@
+# zip_stream.py
+"""Generación de archivos ZIP en streaming, sin construirlos en memoria"""
+import os
+import time
+import zipfile
+
+# Formatos que ya vienen comprimidos: se guardan sin volver a comprimir
+EXTENSIONES_COMPRIMIDAS = {
+    'png', 'jpg', 'jpeg', 'gif', 'webp',
+    'zip', 'rar', '7z', 'gz', 'tgz', 'bz2', 'xz',
+    'pcapng', 'docx', 'xlsx', 'pptx', 'pdf',
+    'mp4', 'avi', 'mov', 'mkv', 'mp3', 'ogg', 'flac', 'aac'
+}
+
+TAMANO_BLOQUE = 64 * 1024
+
+
+class _Salida:
+    """Destino no posicionable para ZipFile que acumula lo escrito"""
+
+    def __init__(self):
+        self._partes = []
+        self._posicion = 0
+
+    def write(self, datos):
+        self._partes.append(bytes(datos))
+        self._posicion += len(datos)
+        return len(datos)
+
+    def tell(self):
+        return self._posicion
+
+    def flush(self):
+        pass
+
+    def vaciar(self):
+        datos = b''.join(self._partes)
+        self._partes = []
+        return datos
+
+
+def _nombre_unico(nombre, usados):
+    """Evita entradas repetidas cuando dos evidencias tienen el mismo nombre"""
+    if nombre not in usados:
+        usados.add(nombre)
+        return nombre
+    base, extension = os.path.splitext(nombre)
+    n = 2
+    while f"{base} ({n}){extension}" in usados:
+        n += 1
+    nombre = f"{base} ({n}){extension}"
+    usados.add(nombre)
+    return nombre
+
+
+def _info(ruta, almacen):
+    if almacen is not None:
+        return almacen.info(ruta)
+    if not ruta or not os.path.exists(ruta):
+        return None
+    info_archivo = os.stat(ruta)
+    return info_archivo.st_size, info_archivo.st_mtime
+
+
+def _abrir(ruta, almacen):
+    return almacen.abrir(ruta) if almacen is not None else open(ruta, 'rb')
+
+
+def generar_zip(archivos, tamano_bloque=TAMANO_BLOQUE, almacen=None):
+    """Genera los bytes de un ZIP a partir de pares (ruta, nombre_en_zip).
+
+    Cada archivo se lee y se emite por bloques, así que la memoria usada no
+    depende del tamaño del ZIP y el primer byte sale en cuanto se lee el
+    primer bloque. Como la salida no es posicionable, los tamaños de cada
+    entrada van en un descriptor de datos tras su contenido; las entradas y
+    el directorio central usan ZIP64 cuando hace falta. Los archivos que no
+    existen se omiten. Con ``almacen`` las rutas se leen con sus métodos
+    ``info`` y ``abrir`` (p. ej. objetos de S3) en vez de en disco.
+    """
+    salida = _Salida()
+    usados = set()
+
+    with zipfile.ZipFile(salida, 'w', allowZip64=True) as zf:
+        for ruta, nombre in archivos:
+            info_archivo = _info(ruta, almacen)
+            if info_archivo is None:
+                continue
+
+            tamano, modificado = info_archivo
+            zinfo = zipfile.ZipInfo(
+                _nombre_unico(nombre, usados),
+                date_time=time.localtime(modificado)[:6]
+            )
+            extension = nombre.rsplit('.', 1)[-1].lower() if '.' in nombre else ''
+            if extension in EXTENSIONES_COMPRIMIDAS:
+                zinfo.compress_type = zipfile.ZIP_STORED
+            else:
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+            # Con el tamaño conocido de antemano zipfile decide si usar ZIP64
+            zinfo.file_size = tamano
+
+            with _abrir(ruta, almacen) as origen, zf.open(zinfo, 'w') as destino:
+                while True:
+                    bloque = origen.read(tamano_bloque)
+                    if not bloque:
+                        break
+                    destino.write(bloque)
+                    datos = salida.vaciar()
+                    if datos:
+                        yield datos
+
+            datos = salida.vaciar()
+            if datos:
+                yield datos
+
+    # Directorio central
+    datos = salida.vaciar()
+    if datos:
+        yield datos